@@ -5,6 +5,7 @@ import re
 from collections import OrderedDict
 from common import definitions
 from protein.models import Protein
+from protein.family_index import get_selection_proteins
 
 
 def strip_html_tags(text):
@@ -341,36 +342,8 @@ def get_format_props(freq=None, freq_gs=None, res=None, feat=None):
             return {'bg_color': '#ffffff'}
 
 def get_proteins_from_selection(simple_selection):
-
-    proteins = []
-
-    # flatten the selection into individual proteins
-    for target in simple_selection.targets:
-        if target.type == 'protein':
-            proteins.append(target.item)
-        elif target.type == 'family':
-            # species filter
-            species_list = []
-            for species in simple_selection.species:
-                species_list.append(species.item)
-
-            # annotation filter
-            protein_source_list = []
-            for protein_source in simple_selection.annotation:
-                protein_source_list.append(protein_source.item)
-
-            if species_list:
-                family_proteins = Protein.objects.filter(family__slug__startswith=target.item.slug,
-                    species__in=(species_list), source__in=(protein_source_list)).select_related(
-                    'residue_numbering_scheme', 'species')
-            else:
-                family_proteins = Protein.objects.filter(family__slug__startswith=target.item.slug,
-                    source__in=(protein_source_list)).select_related('residue_numbering_scheme', 'species')
-
-            for fp in family_proteins:
-                proteins.append(fp)
-
-    return proteins
+    # flatten the selection into individual proteins (family targets through the in-memory family index)
+    return get_selection_proteins(simple_selection)
 
 def prepare_aa_group_preference():
 
@@ -0,0 +1,27 @@
+# Generated by Django 2.0.8 on 2026-10-16 10:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('protein', '0009_auto_20200511_1818'),
+        ('alignment', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AlignedResidues',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('residue_count', models.IntegerField()),
+                ('segments', models.BinaryField()),
+                ('protein_conformation', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='aligned_residues', to='protein.ProteinConformation')),
+            ],
+            options={
+                'db_table': 'aligned_residues',
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.0.8 on 2026-10-16 10:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('protein', '0009_auto_20200511_1818'),
+        ('alignment', '0002_alignedresidues'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReceptorSimilarity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('segments', models.TextField()),
+                ('data', models.BinaryField()),
+                ('protein', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='receptor_similarity', to='protein.Protein')),
+            ],
+            options={
+                'db_table': 'receptor_similarity',
+            },
+        ),
+    ]
@@ -1,8 +1,61 @@
 from django.db import models
 
+import io
+
+import numpy as np
+
 # Create your models here.
 
 class AlignmentConsensus(models.Model):
     slug = models.SlugField(max_length=100, unique=True)
     alignment = models.BinaryField()
-    gn_consensus = models.BinaryField(blank=True) # Store conservation calculation for each GN
\ No newline at end of file
+    gn_consensus = models.BinaryField(blank=True) # Store conservation calculation for each GN
+
+class AlignedResidues(models.Model):
+    """Precomputed alignment positions of all residues of a protein conformation (see build_aligned_residues)"""
+    protein_conformation = models.OneToOneField('protein.ProteinConformation', related_name='aligned_residues', on_delete=models.CASCADE)
+    residue_count = models.IntegerField()
+    segments = models.BinaryField() # pickled dict: segment slug -> list of (position label, residue tuple)
+
+    class Meta():
+        db_table = 'aligned_residues'
+
+
+class ReceptorSimilarity(models.Model):
+    """Precomputed sequence identity/similarity counts of a protein against all proteins of the store, per segment
+    (see build_receptor_similarity and Alignment.load_similarity_from_store).
+
+    The counts are those of common.alignment.pairwise_similarity_counts (in the order of counts) as an int32 array of
+    (segments x counts x proteins), the proteins (ids) and segments (slugs) of the axes are stored with it.
+    """
+    protein = models.OneToOneField('protein.Protein', related_name='receptor_similarity', on_delete=models.CASCADE)
+    segments = models.TextField() # comma separated segment slugs of the first axis
+    data = models.BinaryField()
+
+    counts = ['total', 'aligned', 'identity', 'similarity', 'positive_score', 'score']
+
+    @classmethod
+    def truncate(cls):
+        from django.db import connection
+        with connection.cursor() as cursor:
+            cursor.execute('TRUNCATE TABLE "{0}" RESTART IDENTITY CASCADE'.format(cls._meta.db_table))
+
+    @staticmethod
+    def pack(protein_ids, counts):
+        with io.BytesIO() as f:
+            np.savez_compressed(f, proteins=np.asarray(protein_ids, dtype=np.int32), counts=counts.astype(np.int32))
+            return f.getvalue()
+
+    def get_segments(self):
+        return self.segments.split(",") if self.segments else []
+
+    def get_counts(self):
+        """Protein ids and (segments x counts x proteins) array of counts"""
+        if getattr(self, "_unpacked", None) is None:
+            with io.BytesIO(bytes(self.data)) as f:
+                store = np.load(f)
+                self._unpacked = (store['proteins'], store['counts'])
+        return self._unpacked
+
+    class Meta():
+        db_table = 'receptor_similarity'
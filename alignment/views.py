@@ -1,6 +1,6 @@
 ﻿from django.shortcuts import render
 from django.conf import settings
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.views.generic import TemplateView
 from django.db.models import Case, When
 from django.core.cache import cache
@@ -356,7 +356,7 @@ def render_fasta_alignment(request):
     # build the alignment data matrix
     a.build_alignment()
 
-    response = render(request, 'alignment/alignment_fasta.html', context={'a': a}, content_type='text/fasta')
+    response = StreamingHttpResponse(a.stream_fasta(), content_type='text/fasta')
     response['Content-Disposition'] = "attachment; filename=" + settings.SITE_TITLE + "_alignment.fasta"
     return response
 
@@ -376,7 +376,7 @@ def render_fasta_family_alignment(request, slug):
     # build the alignment data matrix
     a.build_alignment()
 
-    response = render(request, 'alignment/alignment_fasta.html', context={'a': a}, content_type='text/fasta')
+    response = StreamingHttpResponse(a.stream_fasta(), content_type='text/fasta')
     response['Content-Disposition'] = "attachment; filename=" + settings.SITE_TITLE + "_alignment.fasta"
     return response
 
@@ -398,7 +398,7 @@ def render_csv_alignment(request):
     # calculate consensus sequence + amino acid and feature frequency
     a.calculate_statistics()
 
-    response = render(request, 'alignment/alignment_csv.html', context={'a': a}, content_type='text/csv')
+    response = StreamingHttpResponse(a.stream_csv(), content_type='text/csv')
     response['Content-Disposition'] = "attachment; filename=" + settings.SITE_TITLE + "_alignment.csv"
     return response
 
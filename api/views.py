@@ -3,9 +3,9 @@ from rest_framework import views, generics, viewsets
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser, FileUploadParser
 from rest_framework.renderers import JSONRenderer
-from django.template.loader import render_to_string
 from django.db.models import Q
 from django.conf import settings
+from django.http import StreamingHttpResponse
 
 from interaction.models import ResidueFragmentInteraction
 from mutation.models import MutationRaw
@@ -22,11 +22,13 @@ from api.renderers import PDBRenderer
 from common.alignment import Alignment
 from common.definitions import *
 from drugs.models import Drugs
+from ligand.fingerprints import search_ligands, search_parameters
 
 import json, os
 from io import StringIO
 from Bio.PDB import PDBIO, parse_pdb_header
 from collections import OrderedDict
+from itertools import chain
 
 # FIXME add
 # getMutations
@@ -41,6 +43,13 @@ from rest_framework_swagger.views import get_swagger_view
 
 schema_view = get_swagger_view(title='GPCRdb API')
 
+def alignment_response(request, a, items):
+    """Response of (key, value) items of an alignment: streamed when JSON is the negotiated format, a regular
+    Response for the other renderers (browsable API, ?format=)"""
+    if isinstance(getattr(request, 'accepted_renderer', None), JSONRenderer):
+        return StreamingHttpResponse(a.stream_json(items), content_type='application/json')
+    return Response(OrderedDict([(str(k), v) for k, v in items]))
+
 class ProteinDetail(generics.RetrieveAPIView):
     """
     Get a single protein instance by entry name
@@ -388,43 +397,35 @@ class FamilyAlignment(views.APIView):
             for aa in a.full_consensus:
                 residue_list.append(aa.amino_acid)
 
-            # render the fasta template as string
-            response = render_to_string('alignment/alignment_fasta.html', {'a': a}).split("\n")
-
-            # convert the list to a dict
-            ali_dict = OrderedDict({})
-            for row in response:
-                if row.startswith(">"):
-                    k = row[1:]
-                else:
-                    ali_dict[k] = row
-                    k = False
-            ali_dict['CONSENSUS'] = ''.join(residue_list)
+            # stream the aligned sequences and the consensus as JSON
+            items = chain(a.aligned_sequences(), [('CONSENSUS', ''.join(residue_list))])
 
             # render statistics for output
             if statistics == True:
-                feat = {}
-                for i, feature in enumerate(AMINO_ACID_GROUPS):
-                    feature_stats = a.feature_stats[i]
-                    feature_stats_clean = []
-                    for d in feature_stats:
-                        sub_list = [x[0] for x in d]
-                        feature_stats_clean.append(sub_list) # remove feature frequencies
-                    # print(feature_stats_clean)
-                    feat[feature] = [item for sublist in feature_stats_clean for item in sublist]
-
-                for i, AA in enumerate(AMINO_ACIDS):
-                    feature_stats = a.amino_acid_stats[i]
-                    feature_stats_clean = []
-                    for d in feature_stats:
-                        sub_list = [x[0] for x in d]
-                        feature_stats_clean.append(sub_list) # remove feature frequencies
-                    # print(feature_stats_clean)
-                    feat[AA] = [item for sublist in feature_stats_clean for item in sublist]
-
-                ali_dict["statistics"] = feat
-
-            return Response(ali_dict)
+                items = chain(items, [("statistics", self.get_statistics(a))])
+
+            return alignment_response(request, a, items)
+
+    @staticmethod
+    def get_statistics(a):
+        """Feature and amino acid frequencies of all positions of the alignment"""
+        feat = {}
+        for i, feature in enumerate(AMINO_ACID_GROUPS):
+            feature_stats = a.feature_stats[i]
+            feature_stats_clean = []
+            for d in feature_stats:
+                sub_list = [x[0] for x in d]
+                feature_stats_clean.append(sub_list) # remove feature frequencies
+            feat[feature] = [item for sublist in feature_stats_clean for item in sublist]
+
+        for i, AA in enumerate(AMINO_ACIDS):
+            feature_stats = a.amino_acid_stats[i]
+            feature_stats_clean = []
+            for d in feature_stats:
+                sub_list = [x[0] for x in d]
+                feature_stats_clean.append(sub_list) # remove feature frequencies
+            feat[AA] = [item for sublist in feature_stats_clean for item in sublist]
+        return feat
 
 class FamilyAlignmentPartial(FamilyAlignment):
     """
@@ -524,30 +525,17 @@ class ProteinSimilaritySearchAlignment(views.APIView):
             # calculate identity and similarity of each row compared to the reference
             a.calculate_similarity()
 
-            # render the fasta template as string
-            response = render_to_string('alignment/alignment_fasta.html', {'a': a}).split("\n")
+            # add the query as 100 identical/similar to the beginning (like on the website)
+            if a.proteins:
+                a.proteins[0].identity = 100
+                a.proteins[0].similarity = 100
 
-            # convert the list to a dict
             ali_dict = {}
-            k = False
-            num = 0
-            for i, row in enumerate(response):
-                if row.startswith(">"):
-                    k = row[1:]
-                elif k:
-                    # add the query as 100 identical/similar to the beginning (like on the website)
-                    if num == 0:
-                        a.proteins[num].identity = 100
-                        a.proteins[num].similarity = 100
-                    # order dict after custom list
-                    keyorder = ["similarity","identity","AA"]
-                    ali_dict[k] = {"AA": row, "identity": int(str(a.proteins[num].identity).replace(" ","")),
-                    "similarity": int(str(a.proteins[num].similarity).replace(" ",""))}
-                    ali_dict[k] = OrderedDict(sorted(ali_dict[k].items(), key=lambda t: keyorder.index(t[0])))
-                    num+=1
-                    k = False
-            ali_dict_ordered = OrderedDict(sorted(ali_dict.items(), key=lambda x: x[1]['similarity'], reverse=True))
-            return Response(ali_dict_ordered)
+            for pc, (k, sequence) in zip(a.proteins, a.aligned_sequences()):
+                ali_dict[k] = OrderedDict([("similarity", int(str(pc.similarity).replace(" ",""))),
+                    ("identity", int(str(pc.identity).replace(" ",""))), ("AA", sequence)])
+            ali_dict_ordered = sorted(ali_dict.items(), key=lambda x: x[1]['similarity'], reverse=True)
+            return alignment_response(request, a, ali_dict_ordered)
 
 class ProteinAlignment(views.APIView):
     """
@@ -615,43 +603,14 @@ class ProteinAlignment(views.APIView):
             if statistics == True:
                 a.calculate_statistics()
 
-            # render the fasta template as string
-            response = render_to_string('alignment/alignment_fasta.html', {'a': a}).split("\n")
-
-            # convert the list to a dict
-            ali_dict = {}
-            k = False
-            for row in response:
-                if row.startswith(">"):
-                    k = row[1:]
-                elif k:
-                    ali_dict[k] = row
-                    k = False
+            # stream the aligned sequences as JSON
+            items = a.aligned_sequences()
 
             # render statistics for output
             if statistics == True:
-                feat = {}
-                for i, feature in enumerate(AMINO_ACID_GROUPS):
-                    feature_stats = a.feature_stats[i]
-                    feature_stats_clean = []
-                    for d in feature_stats:
-                        sub_list = [x[0] for x in d]
-                        feature_stats_clean.append(sub_list) # remove feature frequencies
-                    # print(feature_stats_clean)
-                    feat[feature] = [item for sublist in feature_stats_clean for item in sublist]
-
-                for i, AA in enumerate(AMINO_ACIDS):
-                    feature_stats = a.amino_acid_stats[i]
-                    feature_stats_clean = []
-                    for d in feature_stats:
-                        sub_list = [x[0] for x in d]
-                        feature_stats_clean.append(sub_list) # remove feature frequencies
-                    # print(feature_stats_clean)
-                    feat[AA] = [item for sublist in feature_stats_clean for item in sublist]
-
-                ali_dict["statistics"] = feat
-
-            return Response(ali_dict)
+                items = chain(items, [("statistics", FamilyAlignment.get_statistics(a))])
+
+            return alignment_response(request, a, items)
 
 class ProteinAlignmentStatistics(ProteinAlignment):
     """
@@ -706,11 +665,13 @@ class StructureTemplate(views.APIView):
             a.load_proteins(ps)
             a.load_segments(ss)
 
-            # build the alignment data matrix
-            a.build_alignment()
+            # identity and similarity of each row compared to the reference, precomputed or from the alignment
+            if not a.load_similarity_from_store():
+                # build the alignment data matrix
+                a.build_alignment()
 
-            # calculate identity and similarity of each row compared to the reference
-            a.calculate_similarity()
+                # calculate identity and similarity of each row compared to the reference
+                a.calculate_similarity()
 
             # return the entry_name of the closest template
             return Response(a.proteins[1].protein.entry_name)
@@ -835,3 +796,21 @@ class DrugList(views.APIView):
             druglist.append({'name':drugname, 'approval': approval, 'indication': indication, 'status':status, 'drugtype':drugtype, 'moa':moa, 'novelty': novelty})
 
         return Response(druglist)
+
+class LigandSearch(views.APIView):
+    """
+    Search the ligands by chemical structure
+    \n/ligands/search/similarity/?smiles={smiles}&limit={limit}&threshold={threshold}
+    \n/ligands/search/substructure/?smiles={smiles}&limit={limit}
+    \n{smiles} is the SMILES of the query (URL encoded), e.g. CC(C)NCC(O)c1ccc(O)c(O)c1
+    \n{limit} is the maximal number of ligands returned (default 100)
+    \n{threshold} is the minimal Tanimoto similarity of the Morgan fingerprints (default 0)
+    """
+    def get(self, request, mode=None):
+        try:
+            smiles, mode, limit, threshold = search_parameters(request.query_params, mode)
+            return Response(search_ligands(smiles, mode, limit, threshold))
+        except ValueError as msg:
+            return Response({'error': str(msg)}, status=400)
+        except FileNotFoundError:
+            return Response({'error': 'The ligand search is not available'}, status=503)
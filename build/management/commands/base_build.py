@@ -5,6 +5,10 @@ from django.db import connection
 
 import datetime
 import logging
+import os
+import queue
+import time
+import traceback
 from multiprocessing import Queue, Process, Value, Lock
 
 
@@ -26,19 +30,56 @@ class Command(BaseCommand):
             default=False,
             help='Include only a subset of data for testing')
 
-    def prepare_input(self, proc, items, iteration=1):
-        q = Queue()
-        procs = list()
-        num_items = len(items)
-        num = Value('i', 0)
-        lock = Lock()
+    def create_parser(self, *args, **kwargs):
+        # every build command accepts --proc, also when add_arguments is overridden without it
+        parser = super().create_parser(*args, **kwargs)
+        if not any(action.dest == 'proc' for action in parser._actions):
+            option_strings = [option for action in parser._actions for option in action.option_strings]
+            parser.add_argument(*[option for option in ('-p', '--proc') if option not in option_strings],
+                type=int,
+                action='store',
+                dest='proc',
+                default=1,
+                help='Number of processes to run')
+        return parser
+
+    def prepare_input(self, proc, items, iteration=1, costs=None, retries=1):
+        """
+        Run the items over proc processes.
 
+        Commands that implement process_item(item, iteration) are run from a shared task queue: every process
+        takes the next item when it is done with the previous one, failed items are retried (retries times) and
+        the time of every item is reported (see run_task_queue).
+        Commands that implement main_func(positions, iteration, count, lock) get a (first, last) chunk of the
+        items and the shared count/lock to take the items one by one themselves.
+
+        costs: optional cost hint for each item (list, or a function of the item) like the number of residues,
+        the most expensive items are started first so that a large item does not end up last.
+        With main_func the items list is sorted in place, as main_func reads the items from its own attribute.
+        """
+        num_items = len(items)
         if not num_items:
             return False
 
         # make sure not to use more jobs than proteins (chunk size will be 0, which is not good)
-        if proc > num_items:
-            proc = num_items
+        proc = max(1, min(proc or 1, num_items))
+
+        order = list(range(num_items))
+        if costs is not None:
+            if callable(costs):
+                costs = [costs(item) for item in items]
+            order.sort(key=lambda i: costs[i], reverse=True)
+
+        if hasattr(self, 'process_item'):
+            return self.run_task_queue(proc, items, order, iteration, retries)
+
+        if costs is not None:
+            items[:] = [items[i] for i in order]
+
+        q = Queue()
+        procs = list()
+        num = Value('i', 0)
+        lock = Lock()
 
         chunk_size = int(num_items / proc)
         connection.close()
@@ -48,10 +89,133 @@ class Command(BaseCommand):
                 last = False
             else:
                 last = chunk_size * (i + 1)
-    
+
             p = Process(target=self.main_func, args=([(first, last), iteration,num,lock]))
             procs.append(p)
             p.start()
 
         for p in procs:
-            p.join()
\ No newline at end of file
+            p.join()
+
+    def run_task_queue(self, proc, items, order, iteration, retries=1):
+        """
+        Dispatch the item indices (in the given order) to proc worker processes.
+        An item that raises an exception, or whose process dies, is put back on the queue (at most retries times).
+        Processes that die are replaced. Indices taken from the queue by a process that died before it reported
+        the item are put back as well, once the remaining processes are idle without taking them.
+        The timing of the items is kept in self.item_timings as (item, seconds, attempts, error) and summarized at the end.
+        """
+        tasks, results = Queue(), Queue()
+        for index in order:
+            tasks.put(index)
+
+        connection.close()
+        procs = {}
+        def start_worker():
+            p = Process(target=self.task_worker, args=(items, iteration, tasks, results))
+            p.start()
+            procs[p.pid] = p
+        for i in range(proc):
+            start_worker()
+
+        self.item_timings = []
+        attempts = [0] * len(items)
+        running = {}
+        # indices on the queue that no process reported yet, and indices that are done
+        queued = set(order)
+        done = set()
+        pending = len(order)
+        def finish(index, seconds, error):
+            requeued = not self.item_done(tasks, items, index, seconds, error, attempts, retries)
+            (queued if requeued else done).add(index)
+            return 0 if requeued else 1
+        idle_polls = 0
+        failed_starts = 0
+        start = time.time()
+        while pending:
+            try:
+                pid, index, seconds, error = results.get(timeout=5)
+            except queue.Empty:
+                # processes that died (e.g. killed or segfault), with or without an item, are replaced
+                for pid, p in list(procs.items()):
+                    if not p.is_alive():
+                        del procs[pid]
+                        if pid in running:
+                            index, started = running.pop(pid)
+                            pending -= finish(index, time.time() - started,
+                                'Process exited with code {}'.format(p.exitcode))
+                        else:
+                            failed_starts += 1
+                        start_worker()
+                if failed_starts > 3 * proc:
+                    self.logger.error('Build processes keep stopping, {} items not done'.format(pending))
+                    break
+
+                # idle processes take queued indices at once, indices that stay unreported were lost with a
+                # process that died after taking them from the queue
+                idle_polls = idle_polls + 1 if len(procs) > len(running) and queued else 0
+                if idle_polls >= 2:
+                    for index in sorted(queued):
+                        queued.discard(index)
+                        pending -= finish(index, 0, 'Item lost by a stopped process')
+                    idle_polls = 0
+                continue
+
+            idle_polls = 0
+            failed_starts = 0
+            if index in done:
+                # a requeued index that turned up again
+                continue
+            if seconds is None:
+                queued.discard(index)
+                running[pid] = (index, time.time())
+            else:
+                running.pop(pid, None)
+                pending -= finish(index, seconds, error)
+
+        for p in procs.values():
+            tasks.put(None)
+        for p in procs.values():
+            p.join()
+
+        wall_time = time.time() - start
+        failed = [timing for timing in self.item_timings if timing[3]]
+        slowest = sorted(self.item_timings, key=lambda timing: timing[1], reverse=True)[:5]
+        summary = '{} items in {:.1f}s with {} processes ({:.1f}s of work, {} failed), slowest: {}'.format(
+            len(self.item_timings), wall_time, proc, sum(timing[1] for timing in self.item_timings), len(failed),
+            ', '.join('{} ({:.1f}s)'.format(timing[0], timing[1]) for timing in slowest))
+        self.logger.info(summary)
+        print(summary)
+        return not failed
+
+    def item_done(self, tasks, items, index, seconds, error, attempts, retries):
+        """Record a finished item, or put it back on the queue if it failed and has retries left. Returns 1 if done."""
+        attempts[index] += 1
+        if error and attempts[index] <= retries:
+            self.logger.warning('{} failed (attempt {}), retrying\n{}'.format(items[index], attempts[index], error))
+            tasks.put(index)
+            return 0
+
+        if error:
+            self.logger.error('{} failed after {} attempts\n{}'.format(items[index], attempts[index], error))
+        else:
+            self.logger.debug('{} done in {:.2f}s'.format(items[index], seconds))
+        self.item_timings.append((items[index], seconds, attempts[index], error))
+        return 1
+
+    def task_worker(self, items, iteration, tasks, results):
+        """Worker process: run process_item for the item indices from the task queue until it gets None"""
+        pid = os.getpid()
+        while True:
+            index = tasks.get()
+            if index is None:
+                break
+
+            results.put((pid, index, None, None))
+            start = time.time()
+            error = None
+            try:
+                self.process_item(items[index], iteration)
+            except Exception:
+                error = traceback.format_exc()
+            results.put((pid, index, time.time() - start, error))
@@ -0,0 +1,55 @@
+from build.management.commands.base_build import Command as BaseBuild
+
+from alignment.models import AlignedResidues
+from common.alignment import pack_aligned_residues
+from protein.models import ProteinConformation
+from residue.models import Residue
+
+import pickle
+
+
+class Command(BaseBuild):
+    help = 'Store the alignment positions of the residues of all protein conformations, used to build alignments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-p', '--proc',
+            type=int,
+            action='store',
+            dest='proc',
+            default=1,
+            help='Number of processes to run')
+        parser.add_argument('--purge',
+            action='store_true',
+            dest='purge',
+            default=False,
+            help='Purge the stored alignment positions before building')
+        parser.add_argument('--missing',
+            action='store_true',
+            dest='missing',
+            default=False,
+            help='Only build for protein conformations without stored alignment positions')
+
+    def handle(self, *args, **options):
+        if options['purge']:
+            AlignedResidues.objects.all().delete()
+
+        pcs = ProteinConformation.objects.all()
+        if options['missing']:
+            pcs = pcs.filter(aligned_residues=None)
+        self.pconfs = list(pcs.values_list('id', flat=True))
+
+        print('Storing alignment positions of {} protein conformations'.format(len(self.pconfs)))
+        self.prepare_input(options['proc'], self.pconfs)
+        print('Stored alignment positions of {} protein conformations'.format(AlignedResidues.objects.count()))
+
+    def process_item(self, pconf_id, iteration):
+        residues = Residue.objects.filter(protein_conformation_id=pconf_id).exclude(protein_segment=None).prefetch_related(
+            'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
+            'generic_number', 'alternative_generic_numbers')
+        residues = list(residues)
+        if not residues:
+            return
+
+        segments = pack_aligned_residues(residues)
+        AlignedResidues.objects.update_or_create(protein_conformation_id=pconf_id,
+            defaults={'residue_count': len(residues), 'segments': pickle.dumps(segments)})
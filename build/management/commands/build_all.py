@@ -57,6 +57,8 @@ class Command(BaseCommand):
             ['build_structure_extra_proteins']
         ]
         phase2 = [
+            ['build_aligned_residues', {'proc': options['proc']}],
+            ['build_receptor_similarity'],
             ['build_structure_angles', {'proc': options['proc']}],
             # ['build_distance_representative'],
             ['build_contact_representative'],
@@ -64,6 +66,8 @@ class Command(BaseCommand):
             ['update_construct_mutations'],
             ['build_ligands_from_cache', {'proc': options['proc'], 'test_run': options['test']}],
             ['build_ligand_assays', {'test_run': options['test']}],
+            ['build_ligand_activity_summary'],
+            ['build_ligand_fingerprints'],
             ['build_mutant_data', {'proc': options['proc'], 'test_run': options['test']}],
             ['build_protein_sets'],
             ['build_drugs'],
@@ -8,6 +8,8 @@ from Bio.SeqRecord import SeqRecord
 from Bio.Alphabet import IUPAC
 from Bio.Seq import Seq
 
+from io import StringIO
+import hashlib
 import logging, sys, os, tempfile
 from subprocess import Popen, PIPE
 
@@ -26,75 +28,59 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         # All sequences
         self.logger.info('BUILDING BLAST DATABASE')
-
-        sequences = []
-        self.logger.info('Building blast database in {}'.format(self.blast_database_dir))
-        
-        # fetch proteins
-        proteins = Protein.objects.filter(sequence_type__slug='wt')
-        for protein in proteins:
-            sequences.append(SeqRecord(Seq(protein.sequence, IUPAC.protein), id=str(protein.id),
-                description=protein.entry_name))
-        try:
-            if os.path.exists(self.tmp_file_path):
-                os.unlink(self.tmp_file_path)
-            SeqIO.write(sequences, self.tmp_file_path, 'fasta')
-            self.logger.info('Saving sequences into {}'.format(self.tmp_file_path))
-        except Exception as e:
-            self.logger.error('Saving the sequences failed')
-        
-        self.logger.info('Running makeblastdb')
-        try:
-            # No need to unlink the previously existing database - makeblastdb overwrites it
-            makeblastdb = Popen("makeblastdb -in {} -dbtype prot -title protwis_blastdb -out {} -parse_seqids".format(
-                self.tmp_file_path, self.db_file_path), universal_newlines=True, stdout=PIPE, shell=True, stderr=PIPE)
-            out, err = makeblastdb.communicate()
-            if len(err) != 0:
-                self.logger.error(err)
-        except Exception as e:
-            self.logger.error('Makeblastdb failed')
-
-        
-        # remove tmp sequence file
-        if os.path.exists(self.tmp_file_path):
-            os.unlink(self.tmp_file_path)
-
+        self.build_database(Protein.objects.filter(sequence_type__slug='wt'), self.db_file_path)
         self.logger.info('COMPLETED BUILDING BLAST DATABASE')
 
         # Human sequences only
-
         self.logger.info('BUILDING BLAST DATABASE WITH HUMAN SEQUENCES')
+        self.build_database(Protein.objects.filter(sequence_type__slug='wt', species__common_name='Human'),
+            self.human_db_file_path)
+        self.logger.info('COMPLETED BUILDING BLAST DATABASE WITH HUMAN SEQUENCES')
+
+    def build_database(self, proteins, db_file_path):
+        """Runs makeblastdb for the sequences of the proteins, unless the database already has these sequences"""
+        self.logger.info('Building blast database {}'.format(db_file_path))
 
         sequences = []
-        self.logger.info('Building human blast database in {}'.format(self.blast_database_dir))
-        
-        # fetch proteins
-        proteins = Protein.objects.filter(sequence_type__slug='wt', species__common_name='Human')
-        for protein in proteins:
+        for protein in proteins.order_by('id'):
             sequences.append(SeqRecord(Seq(protein.sequence, IUPAC.protein), id=str(protein.id),
                 description=protein.entry_name))
+        fasta = StringIO()
+        SeqIO.write(sequences, fasta, 'fasta')
+        fasta = fasta.getvalue()
+
+        # the build runs this command several times, the database is only rebuilt when the sequences change
+        checksum = hashlib.md5(fasta.encode('utf-8')).hexdigest()
+        checksum_file_path = db_file_path + '.md5'
+        if os.path.exists(checksum_file_path) and (os.path.exists(db_file_path + '.psq') or os.path.exists(db_file_path + '.pal')):
+            with open(checksum_file_path) as checksum_file:
+                if checksum_file.read().strip() == checksum:
+                    self.logger.info('Blast database {} is up to date'.format(db_file_path))
+                    return
+
         try:
             if os.path.exists(self.tmp_file_path):
                 os.unlink(self.tmp_file_path)
-            SeqIO.write(sequences, self.tmp_file_path, 'fasta')
+            with open(self.tmp_file_path, 'w') as tmp_file:
+                tmp_file.write(fasta)
             self.logger.info('Saving sequences into {}'.format(self.tmp_file_path))
         except Exception as e:
             self.logger.error('Saving the sequences failed')
-        
+
         self.logger.info('Running makeblastdb')
         try:
             # No need to unlink the previously existing database - makeblastdb overwrites it
-            makeblastdb = Popen("makeblastdb -in {} -dbtype prot -title protwis_blastdb -out {} -parse_seqids".format(
-                self.tmp_file_path, self.human_db_file_path), universal_newlines=True, stdout=PIPE, shell=True, stderr=PIPE)
+            makeblastdb = Popen(['makeblastdb', '-in', self.tmp_file_path, '-dbtype', 'prot', '-title', 'protwis_blastdb',
+                '-out', db_file_path, '-parse_seqids'], universal_newlines=True, stdout=PIPE, stderr=PIPE)
             out, err = makeblastdb.communicate()
             if len(err) != 0:
                 self.logger.error(err)
+            elif makeblastdb.returncode == 0:
+                with open(checksum_file_path, 'w') as checksum_file:
+                    checksum_file.write(checksum)
         except Exception as e:
             self.logger.error('Makeblastdb failed')
 
-        
         # remove tmp sequence file
         if os.path.exists(self.tmp_file_path):
             os.unlink(self.tmp_file_path)
-
-        self.logger.info('COMPLETED BUILDING BLAST DATABASE WITH HUMAN SEQUENCES')
@@ -90,8 +90,7 @@ class Command(BaseBuild):
                         alpha_protconf.state = ProteinState.objects.get(slug='active')
                         alpha_protconf.save()
 
-                    pdbp = PDBParser(PERMISSIVE=True, QUIET=True)
-                    s = pdbp.get_structure('struct', StringIO(sc.structure.pdb_data.pdb))
+                    s = sc.structure.pdb_data.get_structure('struct')
                     chain = s[0][sc.alpha]
                     nums = []
                     for res in chain:
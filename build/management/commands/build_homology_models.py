@@ -184,7 +184,8 @@ class Command(BaseBuild):
         # Model building
         print("receptors to do",len(self.receptor_list))
         self.processors = options['proc']
-        self.prepare_input(options['proc'], self.receptor_list)
+        # longest receptors first, so that a large model does not end up last
+        self.prepare_input(options['proc'], self.receptor_list, costs=lambda receptor: len(receptor[0].sequence))
 
         # Cleanup
         missing_models = []
@@ -216,34 +217,27 @@ class Command(BaseBuild):
             shutil.rmtree('homology_models')
             shutil.rmtree('PIR')
 
-    def main_func(self, positions, iteration, count, lock):
-        processor_id = round(self.processors*positions[0]/len(self.receptor_list))+1
-        i = 0
-        while count.value<len(self.receptor_list):
-            i += 1
-            with lock:
-                receptor = self.receptor_list[count.value]
-                logger.info('Generating model for  \'{}\' ({})... ({} out of {}) (processor:{} count:{})'.format(receptor[0].entry_name, receptor[1],count.value, len(self.receptor_list),processor_id,i))
-                count.value +=1
-
-            # TODO maybe make check make sense -- since homology_models are deleted, then it doesnt make sense now
-            # check
-            # sm = StructureModel.objects.filter(protein__entry_name=receptor[0].entry_name, state__name=receptor[1]).first()
-            # if sm:
-            #     print('receptor',receptor,'already done',sm)
-            #     main_structure = sm.main_structure.pdb_code.index
-            #     # class_name = 'Class'+class_tree[Protein.objects.get(entry_name=self.reference_entry_name).family.parent.slug[:3]]
-            #     # modelname = '{}_{}_{}_{}_GPCRdb'.format(self.class_name, self.reference_entry_name, self.state, 
-            #     #                          self.main_structure)
-            #     continue
-
-            # then check db
-
-            mod_startTime = datetime.now()
-            chm = CallHomologyModeling(receptor[0].entry_name, receptor[1], iterations=self.modeller_iterations, debug=self.debug, 
-                                       update=self.update, complex_model=self.complex, signprot=self.signprot, force_main_temp=self.force_main_temp, keep_hetatoms=self.keep_hetatoms)
-            chm.run(fast_refinement=self.fast_refinement)
-            logger.info('Model finished for  \'{}\' ({})... (processor:{} count:{}) (Time: {})'.format(receptor[0].entry_name, receptor[1],processor_id,i,datetime.now() - mod_startTime))
+    def process_item(self, receptor, iteration):
+        logger.info('Generating model for  \'{}\' ({})... (process:{})'.format(receptor[0].entry_name, receptor[1], os.getpid()))
+
+        # TODO maybe make check make sense -- since homology_models are deleted, then it doesnt make sense now
+        # check
+        # sm = StructureModel.objects.filter(protein__entry_name=receptor[0].entry_name, state__name=receptor[1]).first()
+        # if sm:
+        #     print('receptor',receptor,'already done',sm)
+        #     main_structure = sm.main_structure.pdb_code.index
+        #     # class_name = 'Class'+class_tree[Protein.objects.get(entry_name=self.reference_entry_name).family.parent.slug[:3]]
+        #     # modelname = '{}_{}_{}_{}_GPCRdb'.format(self.class_name, self.reference_entry_name, self.state, 
+        #     #                          self.main_structure)
+        #     continue
+
+        # then check db
+
+        mod_startTime = datetime.now()
+        chm = CallHomologyModeling(receptor[0].entry_name, receptor[1], iterations=self.modeller_iterations, debug=self.debug, 
+                                   update=self.update, complex_model=self.complex, signprot=self.signprot, force_main_temp=self.force_main_temp, keep_hetatoms=self.keep_hetatoms)
+        chm.run(fast_refinement=self.fast_refinement)
+        logger.info('Model finished for  \'{}\' ({})... (process:{}) (Time: {})'.format(receptor[0].entry_name, receptor[1], os.getpid(), datetime.now() - mod_startTime))
 
     def get_states_to_model(self, receptor):
         rec_class = ProteinFamily.objects.get(name=receptor.get_protein_class())
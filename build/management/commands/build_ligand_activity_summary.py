@@ -0,0 +1,59 @@
+from build.management.commands.base_build import Command as BaseBuild
+from django.db import transaction
+
+from ligand.models import Ligand, AssayExperiment, LigandVendorLink, LigandActivitySummary, NON_PURCHASABLE_SOURCES
+from protein.models import Protein
+
+from itertools import groupby
+import time
+
+
+class Command(BaseBuild):
+    help = 'Aggregates the assay experiments of every ligand, target and assay type into LigandActivitySummary'
+
+    batch_size = 5000
+
+    def handle(self, *args, **options):
+        start = time.time()
+
+        chembl_ids = dict(Ligand.objects.filter(properities__web_links__web_resource__slug='chembl_ligand').values_list(
+            'id', 'properities__web_links__index'))
+        vendor_properities = set(LigandVendorLink.objects.exclude(vendor__name__in=NON_PURCHASABLE_SOURCES).values_list(
+            'lp_id', flat=True))
+        purchasable = set([l for l, lp in Ligand.objects.values_list('id', 'properities_id') if lp in vendor_properities])
+        family_slugs = dict(Protein.objects.values_list('id', 'family__slug'))
+
+        rows = AssayExperiment.objects.order_by('ligand_id', 'protein_id', 'assay_type').values_list(
+            'ligand_id', 'protein_id', 'assay_type', 'pchembl_value', 'standard_units')
+
+        with transaction.atomic():
+            LigandActivitySummary.truncate()
+            summaries = []
+            count = 0
+            for (ligand_id, protein_id, assay_type), records in groupby(rows.iterator(), key=lambda r: r[:3]):
+                records = list(records)
+                values = []
+                for record in records:
+                    try:
+                        value = float(record[3])
+                    except (TypeError, ValueError):
+                        continue
+                    if value:
+                        values.append(value)
+
+                summaries.append(LigandActivitySummary(ligand_id=ligand_id, protein_id=protein_id, assay_type=assay_type,
+                    family_slug=family_slugs[protein_id], chembl_id=chembl_ids.get(ligand_id),
+                    record_count=len(records), value_count=len(values),
+                    min_value=min(values) if values else None,
+                    mean_value=sum(values)/len(values) if values else None,
+                    max_value=max(values) if values else None,
+                    standard_units=', '.join(sorted(set([r[4] for r in records if r[4]]))),
+                    purchasable=ligand_id in purchasable))
+                if len(summaries) == self.batch_size:
+                    LigandActivitySummary.objects.bulk_create(summaries)
+                    count += len(summaries)
+                    summaries = []
+            LigandActivitySummary.objects.bulk_create(summaries)
+            count += len(summaries)
+
+        print('Summarised assays into', count, 'ligand activity rows in', round(time.time()-start, 1), 's')
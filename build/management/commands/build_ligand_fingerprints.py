@@ -0,0 +1,28 @@
+from build.management.commands.base_build import Command as BaseBuild
+
+from ligand.models import LigandProperities
+from ligand.fingerprints import build_fingerprints, fingerprint_file
+
+import numpy
+import os
+import time
+
+
+class Command(BaseBuild):
+    help = 'Computes the Morgan and pattern fingerprints of all ligands for the chemical similarity and substructure search'
+
+    def handle(self, *args, **options):
+        start = time.time()
+        compounds = LigandProperities.objects.exclude(smiles__isnull=True).exclude(smiles='').order_by('pk').values_list(
+            'pk', 'smiles')
+        fingerprints = build_fingerprints(compounds.iterator())
+
+        path = fingerprint_file()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write next to the file and rename, web processes reload the file when it changes
+        tmp_path = path + '.tmp.npz'
+        numpy.savez(tmp_path, **fingerprints)
+        os.replace(tmp_path, path)
+
+        print('Stored the fingerprints of', len(fingerprints['ids']), 'ligands in', path, 'in',
+            round(time.time()-start, 1), 's')
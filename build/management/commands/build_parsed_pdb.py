@@ -0,0 +1,34 @@
+from build.management.commands.base_build import Command as BaseBuild
+
+from structure.models import PdbData
+from structure.parsed_pdb import pack_pdb_text
+
+
+class Command(BaseBuild):
+    help = 'Store the coordinate arrays (PdbData.parsed) of PDB data stored before they were added on save'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-p', '--proc',
+            type=int,
+            action='store',
+            dest='proc',
+            default=1,
+            help='Number of processes to run')
+        parser.add_argument('--all',
+            action='store_true',
+            dest='all',
+            default=False,
+            help='Rebuild the coordinate arrays of all PDB data')
+
+    def handle(self, *args, **options):
+        pdb_data = PdbData.objects.all()
+        if not options['all']:
+            pdb_data = pdb_data.filter(parsed=None)
+        self.pdb_data_ids = list(pdb_data.values_list('id', flat=True))
+
+        print('Storing coordinate arrays of {} PDB data entries'.format(len(self.pdb_data_ids)))
+        self.prepare_input(options['proc'], self.pdb_data_ids)
+
+    def process_item(self, pdb_data_id, iteration):
+        pdb = PdbData.objects.values_list('pdb', flat=True).get(id=pdb_data_id)
+        PdbData.objects.filter(id=pdb_data_id).update(parsed=pack_pdb_text(pdb))
@@ -0,0 +1,62 @@
+from build.management.commands.base_build import Command as BaseBuild
+from django.db import transaction
+
+from alignment.models import AlignedResidues, ReceptorSimilarity
+from common.alignment import AMINO_ACID_CODES, pairwise_similarity_counts
+from protein.models import Protein, ProteinConformation, ProteinSegment
+from structure.models import Structure
+
+from collections import OrderedDict
+
+import numpy as np
+import pickle
+import time
+
+
+class Command(BaseBuild):
+    help = ('Compute the sequence identity/similarity counts of all pairs of human receptors and receptors with a '
+        'structure, per segment, from the stored alignment positions (run build_aligned_residues first)')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        proteins = Protein.objects.filter(species__common_name='Human', sequence_type__slug='wt',
+            family__slug__startswith='00') | Protein.objects.filter(
+            pk__in=Structure.objects.values('protein_conformation__protein__parent'))
+        pconfs = {}
+        for pc_id, protein_id in ProteinConformation.objects.filter(protein__in=proteins).order_by('id').values_list(
+                'id', 'protein_id'):
+            pconfs.setdefault(protein_id, pc_id)
+
+        stored = {}
+        for pc_id, segments in AlignedResidues.objects.filter(protein_conformation__in=list(pconfs.values())).values_list(
+                'protein_conformation', 'segments'):
+            stored[pc_id] = pickle.loads(bytes(segments))
+        protein_ids = sorted([protein_id for protein_id, pc_id in pconfs.items() if pc_id in stored])
+        print(len(protein_ids), 'proteins with stored alignment positions', len(pconfs) - len(protein_ids), 'without')
+
+        # receptor segments, split segments (e.g. ECL2_1) are never part of an alignment
+        segments = list(OrderedDict.fromkeys([slug for slug in ProteinSegment.objects.filter(proteinfamily='GPCR').order_by(
+            'id').values_list('slug', flat=True) if '_' not in slug]))
+        unknown = AMINO_ACID_CODES['X']
+        counts = np.zeros((len(segments), len(ReceptorSimilarity.counts), len(protein_ids), len(protein_ids)), dtype=np.int32)
+        for s, segment in enumerate(segments):
+            # encoded alignment of the segment, one column per position label of any protein, 0 for gaps
+            residues = [dict([(pos_label, record[0]) for pos_label, record in stored[pconfs[p]].get(segment, [])])
+                for p in protein_ids]
+            labels = sorted(set([label for positions in residues for label in positions]))
+            if not labels:
+                continue
+            encoded = np.array([[AMINO_ACID_CODES.get(positions[label], unknown) if label in positions else 0
+                for label in labels] for positions in residues], dtype=np.uint8)
+            segment_counts = pairwise_similarity_counts(encoded)
+            for c, key in enumerate(ReceptorSimilarity.counts):
+                counts[s, c] = segment_counts[key]
+
+        with transaction.atomic():
+            ReceptorSimilarity.truncate()
+            ReceptorSimilarity.objects.bulk_create([ReceptorSimilarity(protein_id=protein_id, segments=','.join(segments),
+                data=ReceptorSimilarity.pack(protein_ids, counts[:, :, i])) for i, protein_id in enumerate(protein_ids)],
+                batch_size=100)
+
+        print('Stored the similarity of', len(protein_ids), 'proteins over', len(segments), 'segments in',
+            round(time.time()-start, 1), 's')
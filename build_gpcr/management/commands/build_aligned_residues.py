@@ -0,0 +1,5 @@
+from build.management.commands.build_aligned_residues import Command as BuildAlignedResidues
+
+
+class Command(BuildAlignedResidues):
+    pass
\ No newline at end of file
@@ -2,6 +2,7 @@ import hashlib
 import json
 import logging
 import os
+import pickle
 import time
 from collections import OrderedDict
 from copy import deepcopy
@@ -10,11 +11,14 @@ from operator import itemgetter
 import numpy as np
 
 from alignment.functions import prepare_aa_group_preference
+from alignment.models import AlignedResidues, ReceptorSimilarity
 from Bio.SubsMat import MatrixInfo
 from common.definitions import *
 from common.selection import Selection
 from django.conf import settings
 from django.core.cache import cache, caches
+from django.utils.html import escape, strip_tags
+from protein.family_index import get_selection_proteins
 from protein.models import (Protein, ProteinConformation, ProteinFamily,
                             ProteinFusionProtein, ProteinSegment, ProteinState)
 from residue.functions import dgn, ggn
@@ -30,6 +34,409 @@ try:
 except:
     cache_alignments = cache
 
+# integer codes of the encoded alignment matrix: 0 for gaps, followed by the amino acids of BLOSUM62
+ENCODED_AMINO_ACIDS = sorted(set([aa for pair in MatrixInfo.blosum62 for aa in pair]))
+AMINO_ACID_CODES = dict([(aa, i + 1) for i, aa in enumerate(ENCODED_AMINO_ACIDS)])
+
+
+def blosum62_array():
+    """BLOSUM62 as a symmetric array indexed by the amino acid codes, with zero scores for gaps"""
+    matrix = np.zeros((len(ENCODED_AMINO_ACIDS) + 1, len(ENCODED_AMINO_ACIDS) + 1), dtype=np.int8)
+    for (aa1, aa2), score in MatrixInfo.blosum62.items():
+        matrix[AMINO_ACID_CODES[aa1], AMINO_ACID_CODES[aa2]] = score
+        matrix[AMINO_ACID_CODES[aa2], AMINO_ACID_CODES[aa1]] = score
+    return matrix
+
+BLOSUM62_ARRAY = blosum62_array()
+
+
+def encode_alignment(proteins, gaps=['-', '_']):
+    """Integer encoded alignment matrix (proteins x positions, uint8) of aligned protein conformations
+    Gaps are encoded as 0, residues missing in BLOSUM62 as X"""
+    unknown = AMINO_ACID_CODES['X']
+    rows = []
+    for pc in proteins:
+        rows.append([0 if p[2] in gaps else AMINO_ACID_CODES.get(p[2], unknown)
+            for segment in pc.alignment.values() for p in segment])
+    return np.array(rows, dtype=np.uint8).reshape(len(proteins), -1)
+
+
+def pairwise_similarity_counts(encoded, rows=None, chunk_size=128):
+    """Compare the selected rows of an encoded alignment matrix with all rows in one vectorised pass per chunk of rows
+
+    Each alignment is one-hot encoded (positions x amino acids), so that the number of identical positions and the
+    (positive) BLOSUM62 scores of all pairs become matrix products.
+    Returns a dict of (rows x proteins) matrices with the number of positions that are not gapped in both ('total'),
+    that are gapped in neither ('aligned'), that are identical ('identity') or have a positive BLOSUM62 score
+    ('similarity'), and the sum of the positive scores ('positive_score') and of all scores ('score')"""
+    if rows is None:
+        rows = np.arange(len(encoded))
+    rows = np.asarray(rows, dtype=int)
+    num_proteins, num_positions = encoded.shape
+
+    # one-hot encoding without the gap code: (proteins, positions x amino acids)
+    one_hot = np.eye(len(BLOSUM62_ARRAY), dtype=np.float32)[encoded][:, :, 1:]
+    all_residues = one_hot.reshape(num_proteins, -1).T
+    gapped = (encoded == 0).astype(np.float32)
+
+    blosum = BLOSUM62_ARRAY[1:, 1:].astype(np.float32)
+    positive = (blosum > 0).astype(np.float32)
+    transforms = {'similarity': positive, 'positive_score': blosum * positive, 'score': blosum}
+
+    counts = dict([(key, np.zeros((len(rows), num_proteins), dtype=int))
+        for key in ['total', 'aligned', 'identity', 'similarity', 'positive_score', 'score']])
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        chunk_slice = slice(start, start + len(chunk))
+        counts['total'][chunk_slice] = num_positions - np.rint(gapped[chunk] @ gapped.T)
+        counts['aligned'][chunk_slice] = np.rint((1 - gapped[chunk]) @ (1 - gapped).T)
+        counts['identity'][chunk_slice] = np.rint(one_hot[chunk].reshape(len(chunk), -1) @ all_residues)
+        for key, matrix in transforms.items():
+            counts[key][chunk_slice] = np.rint((one_hot[chunk] @ matrix).reshape(len(chunk), -1) @ all_residues)
+    return counts
+
+
+def format_similarity(identity, similarity, similarity_score, total):
+    """Identity and similarity percentages (formatted) and similarity score of a pair, -1 if nothing is aligned"""
+    if total:
+        return "{:10.0f}".format(int(identity) / int(total) * 100), "{:10.0f}".format(int(similarity) / int(total) * 100), \
+            int(similarity_score)
+    else:
+        return "{:10.0f}".format(-1), "{:10.0f}".format(-1), 0
+
+class AlignmentStatistics:
+    """Columnar amino acid counts of the positions of an alignment, per segment
+
+    The residues of every segment are encoded as a (proteins x positions) matrix of amino acid codes, which is reduced
+    to (positions x amino acids) counts with a single bincount. Proteins can be added incrementally, only the new rows
+    are encoded and counted."""
+    amino_acids = list(AMINO_ACIDS.keys())
+
+    def __init__(self, gaps=['-', '_'], ignore={}):
+        self.gaps = gaps
+        self.ignore = ignore
+        self.num_proteins = 0
+        self.columns = OrderedDict() # segment -> position -> column
+        self.counts = OrderedDict() # segment -> (columns x amino acids) counts
+        self.first_counted = OrderedDict() # segment -> per column the index of the first protein with a counted residue
+        self.proteins_with_amino_acid = OrderedDict() # position -> amino acid -> entry names
+
+        # ASCII lookup table of amino acid codes, gaps are counted as '-', unknown residues (X) are skipped (-1)
+        self.code_table = np.full(256, -1, dtype=np.int16)
+        for i, amino_acid in enumerate(self.amino_acids):
+            self.code_table[ord(amino_acid)] = i
+        for gap in self.gaps:
+            self.code_table[ord(gap)] = -1 if ignore else self.amino_acids.index('-')
+
+    def encode_residues(self, residues):
+        """Amino acid codes of a list of one-letter residues"""
+        sequence = "".join(residues)
+        if len(sequence) == len(residues) and sequence.isascii():
+            return self.code_table[np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)]
+        return np.array([self.code_table[ord(aa)] if len(aa) == 1 and aa.isascii() else -1 for aa in residues],
+            dtype=np.int16)
+
+    def add_proteins(self, proteins):
+        """Count the residues of aligned protein conformations (with a built alignment)"""
+        if not proteins:
+            return
+        entry_names = np.array([pc.protein.entry_name for pc in proteins])
+        for segment in proteins[0].alignment:
+            if segment not in self.columns:
+                self.columns[segment] = OrderedDict()
+                self.counts[segment] = np.zeros((0, len(self.amino_acids)), dtype=int)
+                self.first_counted[segment] = np.zeros(0, dtype=int)
+            columns = self.columns[segment]
+
+            # encode the new proteins as (proteins x columns) matrix
+            rows = []
+            last_labels, row_columns = None, None
+            for pc in proteins:
+                positions = pc.alignment.get(segment, [])
+                labels = [p[0] for p in positions]
+                # proteins of the same alignment share their positions, only map them once
+                if labels != last_labels:
+                    for label in labels:
+                        if label not in columns:
+                            columns[label] = len(columns)
+                    last_labels, row_columns = labels, [columns[label] for label in labels]
+                rows.append((row_columns, self.encode_residues([p[2] for p in positions])))
+            encoded = np.full((len(proteins), len(columns)), -1, dtype=np.int16)
+            for i, (row_columns, codes) in enumerate(rows):
+                encoded[i, row_columns] = codes
+
+            # skip the positions that are on the ignore list of a protein
+            for position, ignored_entry_names in self.ignore.items():
+                if position in columns and ignored_entry_names:
+                    encoded[np.isin(entry_names, list(ignored_entry_names)), columns[position]] = -1
+
+            # one bincount over (column, amino acid) pairs of all counted residues
+            counted = encoded >= 0
+            cells = (np.arange(len(columns)) * len(self.amino_acids) + encoded)[counted]
+            new_counts = np.bincount(cells, minlength=len(columns)*len(self.amino_acids)).reshape(len(columns), -1)
+            counts = np.zeros((len(columns), len(self.amino_acids)), dtype=int)
+            counts[:len(self.counts[segment])] = self.counts[segment]
+            self.counts[segment] = counts + new_counts
+
+            # remember when a position was counted for the first time (order of the positions in the statistics)
+            first_counted = np.full(len(columns), np.iinfo(int).max)
+            first_counted[:len(self.first_counted[segment])] = self.first_counted[segment]
+            has_counted = counted.any(axis=0)
+            first_new = self.num_proteins + counted.argmax(axis=0)
+            first_counted = np.where((first_counted == np.iinfo(int).max) & has_counted, first_new, first_counted)
+            self.first_counted[segment] = first_counted
+
+            # entry names per position and amino acid
+            # (new dicts and sets, so statistics handed out before are not changed)
+            labels = list(columns)
+            for column in np.nonzero(has_counted)[0]:
+                position_proteins = dict(self.proteins_with_amino_acid.get(labels[column], {}))
+                column_codes = encoded[:, column]
+                # amino acids in the order they are first encountered at the position
+                codes, first_rows = np.unique(column_codes[column_codes >= 0], return_index=True)
+                for code in codes[np.argsort(first_rows)]:
+                    amino_acid = self.amino_acids[code]
+                    position_proteins[amino_acid] = position_proteins.get(amino_acid, set()).union(
+                        entry_names[column_codes == code].tolist())
+                self.proteins_with_amino_acid[labels[column]] = position_proteins
+
+        self.num_proteins += len(proteins)
+
+    def positions(self, segment):
+        """Counted positions of a segment with their count rows, in the order they were first counted"""
+        labels = list(self.columns[segment])
+        first_counted = self.first_counted[segment]
+        order = [column for column in np.lexsort((np.arange(len(labels)), first_counted))
+            if first_counted[column] != np.iinfo(int).max]
+        return [labels[column] for column in order], self.counts[segment][order]
+
+    def aa_count_with_protein(self):
+        """Entry names per position and amino acid (format of Alignment.aa_count_with_protein), with the positions in
+        the order they were first counted over all segments"""
+        first_counted = {}
+        for i, segment in enumerate(self.columns):
+            for label, column in self.columns[segment].items():
+                order = (self.first_counted[segment][column], i, column)
+                if label not in first_counted or order < first_counted[label]:
+                    first_counted[label] = order
+        positions = sorted(self.proteins_with_amino_acid, key=lambda x: first_counted[x])
+        return OrderedDict([(label, self.proteins_with_amino_acid[label]) for label in positions])
+
+    def aa_count(self):
+        """Amino acid counts per segment and position (format of Alignment.aa_count)"""
+        aa_count = OrderedDict()
+        for segment in self.columns:
+            labels, counts = self.positions(segment)
+            aa_count[segment] = OrderedDict([(label, OrderedDict(zip(self.amino_acids, row)))
+                for label, row in zip(labels, counts.tolist())])
+        return aa_count
+
+
+# display/alternative generic number objects of stored residues, shared by all alignments of this process
+generic_number_objects = {}
+
+
+def assign_alignment_positions(residues):
+    """Assign an alignment position label to each residue, returns a dict protein/state -> segment -> position -> residue
+
+    Aligned residues are keyed by their generic number. Unaligned residues get a label made of a prefix, the segment and
+    an index, where the prefix places the residue before (00-), after (zz-) or in (01-) the unaligned part of a segment,
+    so that the first half of an unaligned segment is "left aligned" and the second half "right aligned".
+    The labels of a residue only depend on the other residues of the same protein conformation and segment."""
+    proteins = {}
+    segment_counters = {}
+    aligned_residue_encountered = {}
+    for r in residues:
+        ps = r.protein_segment.slug
+
+        # identifiers for protein/state
+        pcid = r.protein_conformation.protein.entry_name + "-" + r.protein_conformation.state.slug
+
+        # update protein dict
+        if pcid not in proteins:
+            proteins[pcid] = {}
+        if ps not in proteins[pcid]:
+            proteins[pcid][ps] = {}
+
+        # update aligned residue tracker
+        if pcid not in aligned_residue_encountered:
+            aligned_residue_encountered[pcid] = {}
+        if ps not in aligned_residue_encountered[pcid]:
+            aligned_residue_encountered[pcid][ps] = False
+
+        # what part of the segment is this? There are 4 possibilities:
+        # 1. The aligned part (for both fully and partially aligned segments)
+        # 2. The part before the aligned part in a partially aligned segment
+        # 3. The part after the aligned part in a partially aligned segment
+        # 4. An unaligned segment (then there is only one part)
+        if r.generic_number:
+            segment_part = 1
+        elif ps in settings.REFERENCE_POSITIONS and not aligned_residue_encountered[pcid][ps]:
+            segment_part = 2
+        elif ps in settings.REFERENCE_POSITIONS and aligned_residue_encountered[pcid][ps]:
+            segment_part = 3
+        else:
+            segment_part = 4
+
+        # update segment counters
+        if pcid not in segment_counters:
+            segment_counters[pcid] = {}
+        if segment_part == 3:
+            part_ps = ps + '_after'
+        else:
+            part_ps = ps
+        if part_ps not in segment_counters[pcid]:
+            segment_counters[pcid][part_ps] = 1
+        else:
+            segment_counters[pcid][part_ps] += 1
+
+        # user generic numbers as keys for aligned segments
+        if r.generic_number:
+            proteins[pcid][ps][r.generic_number.label] = r
+
+            # register the presence of an aligned residue
+            aligned_residue_encountered[pcid][ps] = True
+        # use custom keys for non-aligned segments
+        else:
+            # label prefix + index
+            # Unaligned segments should be split in the middle, with the first part "left aligned", and the second
+            # "right aligned". If there is an aligned part of the segment, it goes in the middle.
+            if segment_part == 2:
+                prefix = '00-'
+            elif segment_part == 3:
+                prefix = 'zz-'
+            else:
+                prefix = '01-'
+
+            # Note that there is not enough information to assign correct indicies to "right aligned" residues, but
+            # those are corrected below
+            index = str("%04d" % (segment_counters[pcid][part_ps],))
+
+            # position label
+            pos_label =  prefix + ps + "-" + index
+
+            # residue
+            proteins[pcid][ps][pos_label] = r
+
+    # correct alignment of split segments
+    for pcid, segments in proteins.items():
+        for ps, positions in segments.items():
+            pos_num = 1
+            pos_num_after = 1
+            for pos_label in sorted(positions):
+                res_obj = proteins[pcid][ps][pos_label]
+                right_align = False
+                # In a "normal", non split, unaligned segment, is this past the middle?
+                if (pos_label.startswith('01-')
+                        and res_obj.protein_segment.category != 'terminus'
+                        and pos_num > (segment_counters[pcid][ps] / 2 + 0.5)):
+                    right_align = True
+                # In an partially aligned segment (prefixed with 00), where conserved residues are lacking, treat
+                # as an unaligned segment
+                elif (pos_label.startswith('00-')
+                      and not aligned_residue_encountered[pcid][ps]
+                      and pos_num > (segment_counters[pcid][ps] / 2 + 0.5)
+                      or res_obj.protein_segment.slug == 'N-term'):
+                    right_align = True
+                # In an N-terminus, always right align everything
+                elif pos_label.startswith('01-') and res_obj.protein_segment.slug == 'N-term':
+                    right_align = True
+
+                if right_align:
+                    # if so, "right align" from here using a zz prefixed label
+                    updated_index = 'zz' + pos_label[2:]
+                    proteins[pcid][ps][updated_index] = proteins[pcid][ps].pop(pos_label)
+                    pos_label = updated_index
+
+                if pos_label.startswith('zz-'):
+                    segment_label_after = ps + '_after' # parts after a partly aligned segment start with zz
+                    if segment_label_after in segment_counters[pcid]:
+                        segment_length = segment_counters[pcid][segment_label_after]
+                        counter = pos_num_after
+
+                    # this might be the "second part" of an unaligned segment, e.g.
+                    # AAAA----AAAAA
+                    # AAAAAAAAAAAAA
+                    else:
+                        segment_length = segment_counters[pcid][ps]
+                        counter = pos_num
+
+                    updated_index = pos_label[:-4] + str(9999 - (segment_length - counter))
+                    proteins[pcid][ps][updated_index] = proteins[pcid][ps].pop(pos_label)
+                    pos_label = updated_index
+                    pos_num_after += 1
+                pos_num += 1
+
+    return proteins
+
+
+def pack_aligned_residues(residues):
+    """Alignment positions of the residues of one protein conformation in the format stored in AlignedResidues
+
+    Returns a dict segment slug -> list of (position label, (amino acid, sequence number, generic number label,
+    display generic number id, alternative generic number ids))"""
+    packed = {}
+    for segments in assign_alignment_positions(residues).values():
+        for ps, positions in segments.items():
+            packed[ps] = []
+            for pos_label, r in positions.items():
+                if r.generic_number:
+                    record = (r.amino_acid, r.sequence_number, r.generic_number.label, r.display_generic_number_id,
+                        tuple(arn.id for arn in r.alternative_generic_numbers.all()))
+                else:
+                    record = (r.amino_acid, r.sequence_number, None, r.display_generic_number_id, ())
+                packed[ps].append((pos_label, record))
+    return packed
+
+
+class StoredGenericNumber:
+    """Generic number of a stored residue, only the label is used when building an alignment"""
+    __slots__ = ['label']
+
+    def __init__(self, label):
+        self.label = label
+
+    def __str__(self):
+        return self.label
+
+
+class StoredGenericNumberList(list):
+    """List of alternative generic numbers that can be used like a related manager"""
+    def all(self):
+        return self
+
+
+class StoredResidue:
+    """Light-weight residue rebuilt from the AlignedResidues store with the attributes used by build_alignment"""
+    __slots__ = ['amino_acid', 'sequence_number', 'generic_number', 'display_generic_number',
+        'alternative_generic_number_ids']
+
+    def __init__(self, record):
+        self.amino_acid, self.sequence_number, gn_label, display_gn_id, self.alternative_generic_number_ids = record
+        self.generic_number = StoredGenericNumber(gn_label) if gn_label else None
+        self.display_generic_number = generic_number_objects.get(display_gn_id)
+
+    def __str__(self):
+        return self.amino_acid + str(self.sequence_number)
+
+    @property
+    def alternative_generic_numbers(self):
+        return StoredGenericNumberList(generic_number_objects[gn_id] for gn_id in self.alternative_generic_number_ids)
+
+
+def load_generic_number_objects(records, alternatives=False):
+    """Fetch the display (and alternative) generic numbers of stored residue records that are not loaded yet"""
+    gn_ids = set()
+    for record in records:
+        gn_ids.add(record[3])
+        if alternatives:
+            gn_ids.update(record[4])
+    gn_ids.discard(None)
+    gn_ids.difference_update(generic_number_objects)
+    if gn_ids:
+        for gn in ResidueGenericNumber.objects.filter(id__in=gn_ids).select_related('scheme'):
+            generic_number_objects[gn.id] = gn
+
 
 class Alignment:
     """A class representing a protein sequence alignment, with or without a reference sequence"""
@@ -60,8 +467,6 @@ class Alignment:
         self.states = [settings.DEFAULT_PROTEIN_STATE] # inactive, active etc
         self.use_residue_groups = False
         self.ignore_alternative_residue_numbering_schemes = False # set to true if no numbering is to be displayed
-        self.residues_to_delete = []
-        self.normalized_scores = OrderedDict()
         self.stats_done = False
         self.zscales = OrderedDict()
 
@@ -154,34 +559,8 @@ class Alignment:
 
     def load_proteins_from_selection(self, simple_selection):
         """Read user selection and add selected proteins"""
-        # local protein list
-        proteins = []
-
-        # flatten the selection into individual proteins
-        for target in simple_selection.targets:
-            if target.type == 'protein':
-                proteins.append(target.item)
-            elif target.type == 'family':
-                # species filter
-                species_list = []
-                for species in simple_selection.species:
-                    species_list.append(species.item)
-
-                # annotation filter
-                protein_source_list = []
-                for protein_source in simple_selection.annotation:
-                    protein_source_list.append(protein_source.item)
-
-                if species_list:
-                    family_proteins = Protein.objects.filter(family__slug__startswith=target.item.slug,
-                                                             species__in=(species_list), source__in=(protein_source_list)).select_related(
-                        'residue_numbering_scheme', 'species')
-                else:
-                    family_proteins = Protein.objects.filter(family__slug__startswith=target.item.slug,
-                                                             source__in=(protein_source_list)).select_related('residue_numbering_scheme', 'species')
-
-                for fp in family_proteins:
-                    proteins.append(fp)
+        # flatten the selection into individual proteins (family targets through the in-memory family index)
+        proteins = get_selection_proteins(simple_selection)
 
         # load protein list
         self.load_proteins(proteins)
@@ -328,214 +707,132 @@ class Alignment:
 
         return hashlib.md5(hash_key.encode('utf-8')).hexdigest()
 
+    def load_stored_positions(self):
+        """Load the stored alignment positions of the selected protein conformations (see build_aligned_residues)
+        Returns a dict protein conformation id -> segment -> list of (position label, residue record)"""
+        stored = {}
+        pc_ids = set([pc.id for pc in self.proteins])
+        if pc_ids:
+            for pc_id, segments in AlignedResidues.objects.filter(protein_conformation__in=pc_ids).values_list(
+                    'protein_conformation', 'segments'):
+                stored[pc_id] = pickle.loads(bytes(segments))
+        return stored
+
+    def unique_stored_proteins(self, stored):
+        """The selected protein conformations that are present in the stored positions, without duplicates"""
+        unique = OrderedDict()
+        for pc in self.proteins:
+            if pc.id in stored and pc.id not in unique:
+                unique[pc.id] = pc
+        return list(unique.values())
+
     # AJK: point for optimization - primary bottleneck (#1 cleaning, #2 last for-loop in this function)
     def build_alignment(self):
         """Fetch selected residues from DB and build an alignment"""
 
-        # AJK: prevent prefetching all data for large alignments before checking #residues (DB + memory killer)
-        rs = Residue.objects.filter(protein_segment__slug__in=self.segments, protein_conformation__in=self.proteins)
+        # conformations in the AlignedResidues store are sliced from their stored positions, only the residues of the
+        # other conformations are fetched from the DB and aligned
+        stored = self.load_stored_positions()
+        missing_proteins = [pc for pc in self.proteins if pc.id not in stored]
 
-
-        self.number_of_residues_total = len(rs)
-        if self.number_of_residues_total>120000: #300 receptors, 400 residues limit
+        # AJK: prevent prefetching all data for large alignments before checking #residues (DB + memory killer)
+        # the limit only applies to residues fetched from the DB, stored conformations are sliced from arrays
+        number_of_fetched_residues = 0
+        if missing_proteins:
+            number_of_fetched_residues = Residue.objects.filter(protein_segment__slug__in=self.segments,
+                protein_conformation__in=missing_proteins).count()
+        if number_of_fetched_residues>120000: #300 receptors, 400 residues limit
             return "Too large"
+        self.number_of_residues_total = number_of_fetched_residues
+        for segments in stored.values():
+            self.number_of_residues_total += sum([len(positions) for ps, positions in segments.items() if ps in self.segments])
 
         # AJK: performance boost -> Internal caching (not for very small alignments)
-        # AJK: note -> ideally we would have fully cached alignments and only select the relevant segments afterwards.
         cache_key = "ALIGNMENTS_"+self.get_hash()
 
         #cache_alignments.set(cache_key, 0, 0)
         if self.number_of_residues_total < 2500 or not cache_alignments.has_key(cache_key):
-            # fetch segment residues
-            if not self.ignore_alternative_residue_numbering_schemes and len(self.numbering_schemes) > 1:
-                rs = Residue.objects.filter(
-                    protein_segment__slug__in=self.segments, protein_conformation__in=self.proteins).prefetch_related(
-                    'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
-                    'generic_number__scheme', 'display_generic_number__scheme', 'alternative_generic_numbers__scheme')
-            else:
-                rs = Residue.objects.filter(
-                    protein_segment__slug__in=self.segments, protein_conformation__in=self.proteins).prefetch_related(
-                    'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
-                    'generic_number__scheme', 'display_generic_number__scheme')
+            alternative_numbers = not self.ignore_alternative_residue_numbering_schemes and len(self.numbering_schemes) > 1
+            custom_segments = [segment for segment in self.segments
+                if segment == self.custom_segment_label or self.use_residue_groups]
 
-            # If segment flagged to only include the alignable residues, exclude the ones with no GN
-            for s in self.segments_only_alignable:
-                rs = rs.exclude(protein_segment__slug=s, generic_number=None)
-
-            # fetch individually selected residues (Custom segment)
+            # create a dict of proteins, segments and residues
+            proteins = {}
             crs = {}
-            for segment in self.segments:
-                if segment == self.custom_segment_label or self.use_residue_groups:
-                    if not self.ignore_alternative_residue_numbering_schemes and len(self.numbering_schemes) > 1:
+            if missing_proteins:
+                # fetch segment residues
+                if alternative_numbers:
+                    rs = Residue.objects.filter(
+                        protein_segment__slug__in=self.segments, protein_conformation__in=missing_proteins).prefetch_related(
+                        'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
+                        'generic_number__scheme', 'display_generic_number__scheme', 'alternative_generic_numbers__scheme')
+                else:
+                    rs = Residue.objects.filter(
+                        protein_segment__slug__in=self.segments, protein_conformation__in=missing_proteins).prefetch_related(
+                        'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
+                        'generic_number__scheme', 'display_generic_number__scheme')
+
+                # If segment flagged to only include the alignable residues, exclude the ones with no GN
+                for s in self.segments_only_alignable:
+                    rs = rs.exclude(protein_segment__slug=s, generic_number=None)
+
+                # fetch individually selected residues (Custom segment)
+                for segment in custom_segments:
+                    if alternative_numbers:
                         crs[segment] = Residue.objects.filter(
                             generic_number__label__in=self.segments[segment],
-                            protein_conformation__in=self.proteins).prefetch_related(
+                            protein_conformation__in=missing_proteins).prefetch_related(
                             'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
                             'generic_number__scheme', 'display_generic_number__scheme', 'alternative_generic_numbers__scheme')
                     else:
                         crs[segment] = Residue.objects.filter(
                             generic_number__label__in=self.segments[segment],
-                            protein_conformation__in=self.proteins).prefetch_related(
+                            protein_conformation__in=missing_proteins).prefetch_related(
                             'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
                             'generic_number__scheme', 'display_generic_number__scheme')
 
-            # create a dict of proteins, segments and residues
-            proteins = {}
-            segment_counters = {}
-            aligned_residue_encountered = {}
-            fusion_protein_inserted = {}
-            for r in rs:
-                ps = r.protein_segment.slug
-
-                # identifiers for protein/state
-                pcid = r.protein_conformation.protein.entry_name + "-" + r.protein_conformation.state.slug
-
-                # update protein dict
-                if pcid not in proteins:
-                    proteins[pcid] = {}
-                if ps not in proteins[pcid]:
-                    proteins[pcid][ps] = {}
-
-                # update aligned residue tracker
-                if pcid not in aligned_residue_encountered:
-                    aligned_residue_encountered[pcid] = {}
-                if ps not in aligned_residue_encountered[pcid]:
-                    aligned_residue_encountered[pcid][ps] = False
-
-                # what part of the segment is this? There are 4 possibilities:
-                # 1. The aligned part (for both fully and partially aligned segments)
-                # 2. The part before the aligned part in a partially aligned segment
-                # 3. The part after the aligned part in a partially aligned segment
-                # 4. An unaligned segment (then there is only one part)
-                if r.generic_number:
-                    segment_part = 1
-                elif ps in settings.REFERENCE_POSITIONS and not aligned_residue_encountered[pcid][ps]:
-                    segment_part = 2
-                elif ps in settings.REFERENCE_POSITIONS and aligned_residue_encountered[pcid][ps]:
-                    segment_part = 3
-                else:
-                    segment_part = 4
-
-                # update segment counters
-                if pcid not in segment_counters:
-                    segment_counters[pcid] = {}
-                if segment_part == 3:
-                    part_ps = ps + '_after'
-                else:
-                    part_ps = ps
-                if part_ps not in segment_counters[pcid]:
-                    segment_counters[pcid][part_ps] = 1
-                else:
-                    segment_counters[pcid][part_ps] += 1
-
-
-                # update fusion protein tracker
-                if pcid not in fusion_protein_inserted:
-                    fusion_protein_inserted[pcid] = {}
-                if ps not in fusion_protein_inserted[pcid]:
-                    fusion_protein_inserted[pcid][ps] = False
-
-                # user generic numbers as keys for aligned segments
-                if r.generic_number:
-                    proteins[pcid][ps][r.generic_number.label] = r
-
-                    # register the presence of an aligned residue
-                    aligned_residue_encountered[pcid][ps] = True
-                # use custom keys for non-aligned segments
-                else:
-                    # label prefix + index
-                    # Unaligned segments should be split in the middle, with the first part "left aligned", and the second
-                    # "right aligned". If there is an aligned part of the segment, it goes in the middle.
-                    if segment_part == 2:
-                        prefix = '00-'
-                    elif segment_part == 3:
-                        prefix = 'zz-'
-                    else:
-                        prefix = '01-'
-
-                    # Note that there is not enough information to assign correct indicies to "right aligned" residues, but
-                    # those are corrected below
-                    index = str("%04d" % (segment_counters[pcid][part_ps],))
-
-                    # position label
-                    pos_label =  prefix + ps + "-" + index
-
-                    # insert fusion protein FIXME add this
-                    # if not fusion_protein_inserted[pcid][ps] and aligned_residue_encountered[pcid][ps]:
-                    #     fp = ProteinFusionProtein.objects.get(protein=r.protein_conformation.protein,
-                    #         segment_after=r.protein_segment)
-                    #     fusion_pos_label = ps + "-" + str("%04d" % (segment_counters[pcid][ps]-1,)) + "-fusion"
-                    #     proteins[pcid][ps][fusion_pos_label] = Residue(amino_acid=fp.protein_fusion.name)
-                    #     if fusion_pos_label not in self.segments[ps]:
-                    #         self.segments[ps].append(fusion_pos_label)
-                    #     fusion_protein_inserted[pcid][ps] = True
-
-                    # residue
-                    proteins[pcid][ps][pos_label] = r
-
-            # correct alignment of split segments
+                proteins = assign_alignment_positions(rs)
+
+            # slice the stored positions to the selected segments and collect the stored individually selected residues
+            stored_positions = []
+            stored_custom = []
+            for pc in self.unique_stored_proteins(stored):
+                pcid = pc.protein.entry_name + "-" + pc.state.slug
+                for ps, positions in stored[pc.id].items():
+                    if ps in self.segments:
+                        alignable_only = ps in self.segments_only_alignable
+                        stored_positions.extend([(pcid, ps, pos_label, record) for pos_label, record in positions
+                            if record[2] or not alignable_only])
+                for segment in custom_segments:
+                    labels = set(self.segments[segment])
+                    for positions in stored[pc.id].values():
+                        stored_custom.extend([(pcid, segment, record[2], record) for pos_label, record in positions
+                            if record[2] in labels])
+            load_generic_number_objects([p[3] for p in stored_positions + stored_custom], alternative_numbers)
+            for pcid, ps, pos_label, record in stored_positions:
+                proteins.setdefault(pcid, {}).setdefault(ps, {})[pos_label] = StoredResidue(record)
+
+            # add the positions of all proteins to the segments
             for pcid, segments in proteins.items():
                 for ps, positions in segments.items():
-                    pos_num = 1
-                    pos_num_after = 1
+                    segment_positions = set(self.segments[ps])
                     for pos_label in sorted(positions):
-                        res_obj = proteins[pcid][ps][pos_label]
-                        right_align = False
-                        # In a "normal", non split, unaligned segment, is this past the middle?
-                        if (pos_label.startswith('01-')
-                                and res_obj.protein_segment.category != 'terminus'
-                                and pos_num > (segment_counters[pcid][ps] / 2 + 0.5)):
-                            right_align = True
-                        # In an partially aligned segment (prefixed with 00), where conserved residues are lacking, treat
-                        # as an unaligned segment
-                        elif (pos_label.startswith('00-')
-                              and not aligned_residue_encountered[pcid][ps]
-                              and pos_num > (segment_counters[pcid][ps] / 2 + 0.5)
-                              or res_obj.protein_segment.slug == 'N-term'):
-                            right_align = True
-                        # In an N-terminus, always right align everything
-                        elif pos_label.startswith('01-') and res_obj.protein_segment.slug == 'N-term':
-                            right_align = True
-
-                        if right_align:
-                            # if so, "right align" from here using a zz prefixed label
-                            updated_index = 'zz' + pos_label[2:]
-                            proteins[pcid][ps][updated_index] = proteins[pcid][ps].pop(pos_label)
-                            pos_label = updated_index
-
-                        if pos_label.startswith('zz-'):
-                            segment_label_after = ps + '_after' # parts after a partly aligned segment start with zz
-                            if segment_label_after in segment_counters[pcid]:
-                                segment_length = segment_counters[pcid][segment_label_after]
-                                counter = pos_num_after
-
-                            # this might be the "second part" of an unaligned segment, e.g.
-                            # AAAA----AAAAA
-                            # AAAAAAAAAAAAA
-                            else:
-                                segment_length = segment_counters[pcid][ps]
-                                counter = pos_num
-
-                            updated_index = pos_label[:-4] + str(9999 - (segment_length - counter))
-                            proteins[pcid][ps][updated_index] = proteins[pcid][ps].pop(pos_label)
-                            pos_label = updated_index
-                            pos_num_after += 1
-                        if pos_label not in self.segments[ps]:
+                        if pos_label not in segment_positions:
                             self.segments[ps].append(pos_label)
-                        pos_num += 1
+                            segment_positions.add(pos_label)
 
             # individually selected residues (Custom segment)
-            for segment in self.segments:
-                if segment == self.custom_segment_label or self.use_residue_groups:
-                    for r in crs[segment]:
-                        ps = segment
-                        pcid = r.protein_conformation.protein.entry_name + "-" + r.protein_conformation.state.slug
-                        if pcid not in proteins:
-                            proteins[pcid] = {}
-                        if ps not in proteins[pcid]:
-                            proteins[pcid][ps] = {}
-                        proteins[pcid][ps][r.generic_number.label] = r
-
+            for segment in crs:
+                for r in crs[segment]:
+                    ps = segment
+                    pcid = r.protein_conformation.protein.entry_name + "-" + r.protein_conformation.state.slug
+                    if pcid not in proteins:
+                        proteins[pcid] = {}
+                    if ps not in proteins[pcid]:
+                        proteins[pcid][ps] = {}
+                    proteins[pcid][ps][r.generic_number.label] = r
+            for pcid, ps, gn_label, record in stored_custom:
+                proteins.setdefault(pcid, {}).setdefault(ps, {})[gn_label] = StoredResidue(record)
             # remove split segments from segment list and order segment positions
             for segment, positions in self.segments.items():
                 s = segment.split("_")
@@ -787,236 +1084,124 @@ class Alignment:
         """Calculate consensus sequence and amino acid and feature frequency"""
 
         if not self.stats_done:
-            feature_count = OrderedDict()
-            most_freq_aa = OrderedDict()
-            amino_acids = OrderedDict([(a, 0) for a in AMINO_ACIDS]) # from common.definitions
-            self.amino_acids = list(AMINO_ACIDS.keys())
-
-            # AJK: optimized for speed - split into multiple steps
-            for i, p in enumerate(self.unique_proteins):
-                entry_name = p.protein.entry_name
-                # print(entry_name)
-                for j, s in p.alignment.items():
-                    if i == 0:
-                        self.aa_count[j] = OrderedDict()
-                    for p in s:
-                        generic_number = p[0]
-                        display_generic_number = p[1]
-                        amino_acid = p[2]
-
-                        ignore_list = ignore.get(generic_number, [])
-
-                        # Indicate gap and collect statistics
-                        if amino_acid in self.gaps:
-                            amino_acid = '-'
-
-                        # Skip when unknown amino acid type
-                        elif amino_acid == 'X':
-                            continue
-
-                        # skip when position is on the ignore list
-                        if entry_name in ignore_list:
-                            continue
-
-                        if ignore and amino_acid in self.gaps:
-                            continue
-
-                        # Init counters
-                        if generic_number not in self.aa_count[j]:
-                            self.aa_count[j][generic_number] = amino_acids.copy()
-                            #                        if generic_number in self.generic_number_objs:
-                            self.aa_count_with_protein[generic_number] = {}
-
-                        # update amino acid counter for this generic number
-                        self.aa_count[j][generic_number][amino_acid] += 1
-
-                        #if generic_number in self.generic_number_objs:
-                        if amino_acid not in self.aa_count_with_protein[generic_number]:
-                            self.aa_count_with_protein[generic_number][amino_acid] = {entry_name}
-                        elif entry_name not in self.aa_count_with_protein[generic_number][amino_acid]:
-                            self.aa_count_with_protein[generic_number][amino_acid].add(entry_name)
-
-
-            # AJK: Only need for update at the end of loop
-            # 1. Update most frequent amino_acids for this generic number
-            # 2. Update feature counter for this generic number
-            features = OrderedDict([(a, 0) for a in AMINO_ACID_GROUPS])
-            self.features_combo = [(x, y['display_name_short'], y['length']) for x,y in zip(list(AMINO_ACID_GROUP_NAMES.values()), list(AMINO_ACID_GROUP_PROPERTIES.values()))]
-            self.features = list(AMINO_ACID_GROUP_NAMES.values())
-
-            for j in self.aa_count:
-                most_freq_aa[j] = OrderedDict()
-                feature_count[j] = OrderedDict()
-                for generic_number in self.aa_count[j]:
-                    feature_count[j][generic_number] = features.copy()
-                    most_freq_aa[j][generic_number] = [[], 0]
-                    for amino_acid in self.aa_count[j][generic_number]:
-                        # Most frequent AA
-                        if self.aa_count[j][generic_number][amino_acid] > most_freq_aa[j][generic_number][1]:
-                            most_freq_aa[j][generic_number] = [[amino_acid], self.aa_count[j][generic_number][amino_acid]]
-                        elif self.aa_count[j][generic_number][amino_acid] == most_freq_aa[j][generic_number][1]:
-                            if amino_acid not in most_freq_aa[j][generic_number][0]:
-                                most_freq_aa[j][generic_number][0].append(amino_acid)
-
-                        # create property frequency
-                        if self.aa_count[j][generic_number][amino_acid] > 0:
-                            for feature in AMINO_ACID_GROUPS_AA[amino_acid]:
-                                feature_count[j][generic_number][feature] += self.aa_count[j][generic_number][amino_acid]
+            # count the amino acids of all positions (columnar, see AlignmentStatistics)
+            self.statistics = AlignmentStatistics(self.gaps, ignore)
+            self.statistics.add_proteins(self.unique_proteins)
+            self.update_statistics(bool(ignore))
+
+    def add_proteins_to_statistics(self, proteins, ignore={}):
+        """Add aligned protein conformations (with an alignment of the same segments) to the alignment and update
+        the statistics, only the new proteins are counted"""
+        if not hasattr(self, 'statistics'):
+            # no counts yet (or statistics from the cache), count the proteins already in the alignment first
+            self.stats_done = False
+            self.calculate_statistics(ignore)
+        for pc in proteins:
+            self.proteins.append(pc)
+            self.unique_proteins.append(pc)
+        self.statistics.add_proteins(proteins)
+        self.update_statistics(bool(self.statistics.ignore))
+
+    def update_statistics(self, ignore=False):
+        """Derive the consensus, amino acid, feature and Z-scale statistics from the amino acid counts"""
+        stats = self.statistics
+        num_proteins = stats.num_proteins
+        amino_acids = stats.amino_acids
+        self.amino_acids = list(AMINO_ACIDS.keys())
+        self.aa_count = stats.aa_count()
+        self.aa_count_with_protein = stats.aa_count_with_protein()
+        self.consensus = OrderedDict()
+        self.forced_consensus = OrderedDict()
+        self.full_consensus = []
+        self.amino_acid_stats = [[] for amino_acid in amino_acids]
+        self.feature_stats = [[] for feature in AMINO_ACID_GROUPS]
+        self.features_combo = [(x, y['display_name_short'], y['length']) for x,y in zip(list(AMINO_ACID_GROUP_NAMES.values()), list(AMINO_ACID_GROUP_PROPERTIES.values()))]
+        self.features = list(AMINO_ACID_GROUP_NAMES.values())
+
+        # feature membership of the amino acids (amino acids x features)
+        feature_members = np.zeros((len(amino_acids), len(AMINO_ACID_GROUPS)), dtype=int)
+        feature_index = dict([(feature, i) for i, feature in enumerate(AMINO_ACID_GROUPS)])
+        for i, amino_acid in enumerate(amino_acids):
+            for feature in AMINO_ACID_GROUPS_AA[amino_acid]:
+                feature_members[i, feature_index[feature]] = 1
+
+        # frequency (percentage) and color interval of every possible count
+        # the intervals are defined as 0-10, where 0 is 0-9, 1 is 10-19 etc. Used for colors.
+        percentages = np.array([round(c/max(num_proteins, 1)*100) for c in range(num_proteins + 1)], dtype='int')
+        frequencies = [[str(x), '0' if len(str(x)) == 1 else str(x)[:-1]] for x in percentages]
+
+        sequence_counter = 1
+        feats = OrderedDict()
+        for segment in stats.columns:
+            labels, counts = stats.positions(segment)
+            order = sorted(range(len(labels)), key=lambda x: labels[x])
+            labels = [labels[x] for x in order]
+            counts = counts[order]
+            feature_counts = counts @ feature_members
+
+            # most frequent amino acids, ties in the order of the amino acids
+            max_counts = counts.max(axis=1) if len(counts) else np.zeros(0, dtype=int)
+            most_frequent = counts == max_counts[:, None]
 
             # merge the amino acid counts into a consensus sequence
-            num_proteins = len(self.unique_proteins)
-            sequence_counter = 1
-            for i, s in most_freq_aa.items():
-                self.consensus[i] = OrderedDict()
-                self.forced_consensus[i] = OrderedDict()
-                if i == 'Custom' and s == 'x':
-                    sorted_res = sorted(s, key=lambda x: (x.split("x")[0], x.split("x")[1]))
-                elif i == 'Custom' and s == '.':
-                    sorted_res = sorted(s, key=lambda x: (x.split(".")[0], x.split(".")[1]))
+            self.consensus[segment] = OrderedDict()
+            self.forced_consensus[segment] = OrderedDict()
+            for k, p in enumerate(labels):
+                freq_aa = [amino_acids[x] for x in np.nonzero(most_frequent[k])[0]]
+                conservation, cons_interval = frequencies[max_counts[k]]
+
+                # forced consensus sequence uses the first residue to break ties
+                self.forced_consensus[segment][p] = freq_aa[0]
+
+                # consensus sequence displays + in tie situations
+                if len(freq_aa) == 1:
+                    self.consensus[segment][p] = [freq_aa[0], cons_interval, int(conservation), ""]
+                elif ignore:
+                    self.consensus[segment][p] = [freq_aa[0], cons_interval, int(conservation), ", ".join(freq_aa)]
                 else:
-                    sorted_res = sorted(s)
-                for p in sorted_res:
-                    r = s[p]
-                    conservation = str(round(r[1]/num_proteins*100))
-                    if len(conservation) == 1:
-                        cons_interval = '0'
-                    else:
-                        # the intervals are defined as 0-10, where 0 is 0-9, 1 is 10-19 etc. Used for colors.
-                        cons_interval = conservation[:-1]
-
-                    # forced consensus sequence uses the first residue to break ties
-                    self.forced_consensus[i][p] = r[0][0]
-
-                    # consensus sequence displays + in tie situations
-                    num_freq_aa = len(r[0])
-                    if num_freq_aa == 1:
-                        # Use raw data
-                        self.consensus[i][p] = [
-                            r[0][0],
-                            cons_interval,
-                            round(r[1]/num_proteins*100),
-                            ""
-                        ]
-                    elif num_freq_aa > 1 and ignore:
-                        self.consensus[i][p] = [
-                            r[0][0],
-                            cons_interval,
-                            round(r[1]/num_proteins*100),
-                            ", ".join(r[0])
-                        ]
-                    elif num_freq_aa > 1:
-                        self.consensus[i][p] = [
-                            '+',
-                            cons_interval,
-                            round(r[1]/num_proteins*100),
-                            ", ".join(r[0])
-                        ]
-
-                    # create a residue object full consensus
-                    res = Residue()
-                    res.sequence_number = sequence_counter
-                    if p in self.generic_number_objs:
-                        res.display_generic_number = self.generic_number_objs[p]
-                    res.family_generic_number = p
-                    res.segment_slug = i
-                    res.amino_acid = r[0][0]
-                    res.frequency = self.consensus[i][p][2]
-                    self.full_consensus.append(res)
-
-                    # update sequence counter
-                    sequence_counter += 1
-
-            # process amino acid frequency
-            for i, amino_acid in enumerate(AMINO_ACIDS):
-                self.amino_acid_stats.append([])
-                j = 0
-                for segment, segment_num in self.aa_count.items():
-                    self.amino_acid_stats[i].append([])
-                    k = 0
-                    if segment == 'Custom' and segment_num == 'x':
-                        sorted_res = sorted(segment_num, key=lambda x: (x.split("x")[0], x.split("x")[1]))
-                    elif segment == 'Custom' and segment_num == '.':
-                        sorted_res = sorted(segment_num, key=lambda x: (x.split(".")[0], x.split(".")[1]))
-                    else:
-                        sorted_res = sorted(segment_num)
-                    for gn in sorted_res:
-                        aas = segment_num[gn]
-                        self.amino_acid_stats[i][j].append([])
-                        for aa, freq in aas.items():
-                            if aa == amino_acid:
-                                frequency = str(round(freq/num_proteins*100))
-                                if len(frequency) == 1:
-                                    freq_interval = '0'
-                                else:
-                                    # intervals defined in the same way as for the consensus sequence
-                                    freq_interval = frequency[:-1]
-                                self.amino_acid_stats[i][j][k] = [frequency, freq_interval]
-                        k += 1
-                    j += 1
-
-            # create index and prepare stats array
-            index_AAG = {}
-            for i, feature in enumerate(AMINO_ACID_GROUPS):
-                index_AAG[feature] = i
-                self.feature_stats.append([])
-                for segment in feature_count:
-                    self.feature_stats[i].append([])
-
-            j = 0
-            for segment, segment_num in feature_count.items():
-                k = 0
-                if segment == 'Custom' and segment_num == 'x':
-                    sorted_res = sorted(segment_num, key=lambda x: (x.split("x")[0], x.split("x")[1]))
-                elif segment == 'Custom' and segment_num == '.':
-                    sorted_res = sorted(segment_num, key=lambda x: (x.split(".")[0], x.split(".")[1]))
-                else:
-                    sorted_res = sorted(segment_num)
-                for gn in sorted_res:
-                    fs = segment_num[gn]
-
-                    for f, freq in fs.items():
-                        # find feature key
-                        i = index_AAG[f]
+                    self.consensus[segment][p] = ['+', cons_interval, int(conservation), ", ".join(freq_aa)]
+
+                # create a residue object full consensus
+                res = Residue()
+                res.sequence_number = sequence_counter
+                if p in self.generic_number_objs:
+                    res.display_generic_number = self.generic_number_objs[p]
+                res.family_generic_number = p
+                res.segment_slug = segment
+                res.amino_acid = freq_aa[0]
+                res.frequency = self.consensus[segment][p][2]
+                self.full_consensus.append(res)
+
+                # update sequence counter
+                sequence_counter += 1
+
+            # process amino acid and feature frequency
+            for j, amino_acid in enumerate(amino_acids):
+                self.amino_acid_stats[j].append([list(frequencies[c]) for c in counts[:, j]])
+            for j, feature in enumerate(AMINO_ACID_GROUPS):
+                self.feature_stats[j].append([list(frequencies[c]) for c in feature_counts[:, j]])
+            feats[segment] = percentages[feature_counts.T]
+
+        # process feature frequency
+        self.feat_consensus = OrderedDict([(x, []) for x in self.segments])
+        for segment in self.segments:
+            if segment not in feats:
+                continue
+            feat_cons_tmp = feats[segment].argmax(axis=0)
+            feat_cons_tmp = self._assign_preferred_features(feat_cons_tmp, segment, feats)
+            for col, pos in enumerate(list(feat_cons_tmp)):
+                self.feat_consensus[segment].append([
+                    list(AMINO_ACID_GROUP_PROPERTIES.values())[pos]['display_name_short'],
+                    list(AMINO_ACID_GROUP_NAMES.values())[pos],
+                    feats[segment][pos][col],
+                    int(feats[segment][pos][col]/20)+5,
+                    list(AMINO_ACID_GROUP_PROPERTIES.values())[pos]['length'],
+                    list(AMINO_ACID_GROUPS.keys())[pos]
+                ])
 
-                        frequency = str(round(freq/num_proteins*100))
-                        if len(frequency) == 1:
-                            freq_interval = '0'
-                        else:
-                            # intervals defined in the same way as for the consensus sequence
-                            freq_interval = frequency[:-1]
-
-                        self.feature_stats[i][j].append([])
-                        self.feature_stats[i][j][k] = [frequency, freq_interval]
-                    k += 1
-                j += 1
-
-            # process feature frequency
-            feats = OrderedDict()
-            self.feat_consensus = OrderedDict([(x, []) for x in self.segments])
-            for sid, segment in enumerate(self.segments):
-                feats[segment] = np.array(
-                    [[x[0] for x in feat[sid]] for feat in self.feature_stats],
-                    dtype='int'
-                )
-                feat_cons_tmp = feats[segment].argmax(axis=0)
-                feat_cons_tmp = self._assign_preferred_features(feat_cons_tmp, segment, feats)
-                for col, pos in enumerate(list(feat_cons_tmp)):
-                    self.feat_consensus[segment].append([
-                        list(AMINO_ACID_GROUP_PROPERTIES.values())[pos]['display_name_short'],
-                        list(AMINO_ACID_GROUP_NAMES.values())[pos],
-                        feats[segment][pos][col],
-                        int(feats[segment][pos][col]/20)+5,
-                        list(AMINO_ACID_GROUP_PROPERTIES.values())[pos]['length'],
-                        list(AMINO_ACID_GROUPS.keys())[pos]
-                    ])
-                #print(self.feat_consensus[segment])
-
-            del feats
-            if 'feat_cons_tmp' in locals():
-                del feat_cons_tmp
-
-            self.calculate_zscales(True)
-            self.stats_done = True
+        self.stats_done = False
+        self.calculate_zscales(True)
+        self.stats_done = True
 
     def calculate_aa_count_per_generic_number(self):
         ''' Small function to return a dictionary of display_generic_number and the frequency of each AA '''
@@ -1034,49 +1219,72 @@ class Alignment:
 
     def calculate_similarity(self, normalized=False):
         """Calculate the sequence identity/similarity of every selected protein compared to a selected reference"""
+        # calculate identity, similarity and similarity score of all proteins to the reference (first row)
+        counts = pairwise_similarity_counts(encode_alignment(self.proteins, self.gaps), rows=[0])
         for i, protein in enumerate(self.proteins):
             # skip the first row, as it is the reference
             if i == 0:
                 continue
 
-            # calculate identity, similarity and similarity score to the reference
+            # normalized scores only consider positions where neither the reference nor the protein is gapped
             if not normalized:
-                calc_values = self.pairwise_similarity(self.proteins[0], self.proteins[i])
-                # update the protein
-                if calc_values:
-                    self.proteins[i].identity = calc_values[0]
-                    self.proteins[i].similarity = calc_values[1]
-                    self.proteins[i].similarity_score = calc_values[2]
+                calc_values = format_similarity(counts['identity'][0, i], counts['similarity'][0, i],
+                    counts['positive_score'][0, i], counts['total'][0, i])
             else:
-                self.pairwise_similarity_normalized(self.proteins[0], self.proteins[i])
-
-        # calculate normalized identity, similarity and similarity score, removes columns where reference is gapped, gaps in templates are removed from the specific pairwise alignment
-        if normalized:
-            i = 1
-            for protein_2, values in self.normalized_scores.items():
-                for j in range(0, 3):
-                    for gn in list(values[j].keys()):
-                        if gn in self.residues_to_delete:
-                            del self.normalized_scores[protein_2][j][gn]
-                identities = list(self.normalized_scores[protein_2][0].values())
-                similarities = list(self.normalized_scores[protein_2][1].values())
-                similarity_scores = list(self.normalized_scores[protein_2][2].values())
-                identity = "{:10.0f}".format(sum(identities) / len(identities) * 100)
-                similarity = "{:10.0f}".format(sum(similarities) / len(similarities) * 100)
-                similarity_score = sum(similarity_scores)
-                self.proteins[i].identity = identity
-                self.proteins[i].similarity = similarity
-                self.proteins[i].similarity_score = similarity_score
-                i+=1
+                calc_values = format_similarity(counts['identity'][0, i], counts['similarity'][0, i],
+                    counts['score'][0, i], counts['aligned'][0, i])
+
+            # update the protein
+            self.proteins[i].identity = calc_values[0]
+            self.proteins[i].similarity = calc_values[1]
+            self.proteins[i].similarity_score = calc_values[2]
+
+        self.order_by_similarity()
 
-        # order protein list by similarity score
+    def order_by_similarity(self):
+        """Order the proteins after the reference by similarity score (self.order_by)"""
         ref = self.proteins.pop(0)
         order_by_value = int(getattr(self.proteins[0], self.order_by))
         if order_by_value:
             self.proteins.sort(key=lambda x: getattr(x, self.order_by), reverse=True)
         self.proteins.insert(0, ref)
 
-    def calculate_similarity_matrix(self):
+    def load_similarity_from_store(self, normalized=False):
+        """Identity/similarity of every protein to the reference as calculate_similarity, from the ReceptorSimilarity
+        store (build_receptor_similarity) instead of the alignment, so that build_alignment is not needed for it.
+        Returns False, without changing the proteins, when the store does not cover the reference, the proteins or
+        the segments (residue positions and alignable-only segments are never covered)"""
+        if (not self.reference or len(self.proteins) < 2 or self.custom_segment_label in self.segments
+                or self.use_residue_groups or self.segments_only_alignable):
+            return False
+        try:
+            stored = ReceptorSimilarity.objects.get(protein_id=self.proteins[0].protein_id)
+        except ReceptorSimilarity.DoesNotExist:
+            return False
+        stored_segments = dict([(segment, i) for i, segment in enumerate(stored.get_segments())])
+        if any([segment not in stored_segments for segment in self.segments]):
+            return False
+        protein_ids, counts = stored.get_counts()
+        protein_index = dict([(protein_id, i) for i, protein_id in enumerate(protein_ids.tolist())])
+        columns = [protein_index.get(pc.protein_id) for pc in self.proteins[1:]]
+        if None in columns:
+            return False
+
+        # (counts x proteins) summed over the selected segments
+        totals = counts[[stored_segments[segment] for segment in self.segments]].sum(axis=0, dtype=np.int64)[:, columns]
+        count_index = dict([(key, i) for i, key in enumerate(ReceptorSimilarity.counts)])
+        score, total = ('score', 'aligned') if normalized else ('positive_score', 'total')
+        for i, protein in enumerate(self.proteins[1:]):
+            calc_values = format_similarity(totals[count_index['identity'], i], totals[count_index['similarity'], i],
+                totals[count_index[score], i], totals[count_index[total], i])
+            protein.identity = calc_values[0]
+            protein.similarity = calc_values[1]
+            protein.similarity_score = calc_values[2]
+
+        self.order_by_similarity()
+        return True
+
+    def calculate_similarity_matrix(self, chunk_size=128):
         """Calculate a matrix of sequence identity/similarity for every selected protein"""
 
         # Init results matrix
@@ -1086,14 +1294,15 @@ class Alignment:
             protein_name = "[" + protein.protein.species.common_name + "] " + protein.protein.name
             self.similarity_matrix[protein_key] = {'name': protein_name, 'values': [None] * len(self.proteins)}
 
-        # similarity comparisons
+        # similarity comparisons of all pairs
+        counts = pairwise_similarity_counts(encode_alignment(self.proteins, self.gaps), chunk_size=chunk_size)
         for i, protein in enumerate(self.proteins):
             protein_key = protein.protein.entry_name
             self.similarity_matrix[protein_key]['values'][i] = ['-', '-']
 
             for k in range(i+1, len(self.proteins)):
-                # calculate identity, similarity and similarity score to the reference
-                calc_values = self.pairwise_similarity(self.proteins[i], self.proteins[k])
+                calc_values = format_similarity(counts['identity'][i, k], counts['similarity'][i, k],
+                    counts['positive_score'][i, k], counts['total'][i, k])
 
                 # Identity
                 value = calc_values[1].strip()
@@ -1122,30 +1331,38 @@ class Alignment:
                 # Prepare Z-scales per segment/GN position
                 self.zscales = OrderedDict([ (zscale, OrderedDict()) for zscale in ZSCALES ])
 
-                # Calculates distribution per GN position
+                # Calculates distribution per GN position from the amino acid counts (positions x amino acids)
+                zscale_values = np.array([AA_ZSCALES.get(amino_acid, [0]*len(ZSCALES)) for amino_acid in AMINO_ACIDS])
+                has_zscale = np.array([amino_acid in AA_ZSCALES and amino_acid != "-" for amino_acid in AMINO_ACIDS])
                 for segment in self.aa_count:
                     for zscale in ZSCALES:
                         self.zscales[zscale][segment] = OrderedDict()
-                    for generic_number in self.aa_count[segment]:
-                        zscale_position = { zscale: [] for zscale in ZSCALES }
-
-                        for amino_acid in self.aa_count[segment][generic_number]:
-                            if amino_acid != "-" and self.aa_count[segment][generic_number][amino_acid] > 0:
-                                for key in range(len(ZSCALES)):
-                                    # Frequency AA at this position * value
-                                    if amino_acid in AA_ZSCALES:
-                                        zscale_position[ZSCALES[key]].extend([AA_ZSCALES[amino_acid][key]] * self.aa_count[segment][generic_number][amino_acid])
-
-                        # store average + stddev + count + display
-                        for zscale in ZSCALES:
-                            if len(zscale_position[zscale]) == 1:
-                                display = tooltip = str(round(zscale_position[zscale][0], 2)) + " ± " + str(0) + " (1)"
-                                self.zscales[zscale][segment][generic_number] = [zscale_position[zscale][0], 0, 1, display]
+                    positions = list(self.aa_count[segment])
+                    if not positions:
+                        continue
+                    counts = np.array([[self.aa_count[segment][gn].get(amino_acid, 0) for amino_acid in AMINO_ACIDS]
+                        for gn in positions]) * has_zscale
+                    z_counts = counts.sum(axis=1)
+
+                    # store average + stddev + count + display
+                    for k, generic_number in enumerate(positions):
+                        z_count = int(z_counts[k])
+                        if z_count == 1:
+                            z_values = zscale_values[counts[k].argmax()].tolist()
+                        else:
+                            # (Z-scales x residues) values in the order of the amino acids, same summation as per list
+                            residue_values = np.repeat(zscale_values, counts[k], axis=0).T.copy()
+                            with np.errstate(divide='ignore', invalid='ignore'):
+                                z_means = np.mean(residue_values, axis=1) if z_count else [np.nan]*len(ZSCALES)
+                                z_stds = np.std(residue_values, axis=1, ddof=1) if z_count else [np.nan]*len(ZSCALES)
+                        for key, zscale in enumerate(ZSCALES):
+                            if z_count == 1:
+                                display = str(round(z_values[key], 2)) + " ± " + str(0) + " (1)"
+                                self.zscales[zscale][segment][generic_number] = [z_values[key], 0, 1, display]
                             else:
-                                z_mean = np.mean(zscale_position[zscale])
-                                z_std = np.std(zscale_position[zscale], ddof=1)
-                                z_count = len(zscale_position[zscale])
-                                display = tooltip = str(round(z_mean,2)) + " ± " + str(round(z_std, 2)) + " (" + str(z_count) + ")"
+                                z_mean = z_means[key]
+                                z_std = z_stds[key]
+                                display = str(round(z_mean,2)) + " ± " + str(round(z_std, 2)) + " (" + str(z_count) + ")"
                                 self.zscales[zscale][segment][generic_number] = [z_mean, z_std, z_count, display]
 
     def evaluate_sites(self, request):
@@ -1208,88 +1425,54 @@ class Alignment:
 
     def pairwise_similarity(self, protein_1, protein_2):
         """Calculate the identity, similarity and similarity score between a pair of proteins"""
-        identityscore = 0
-        similarityscore = 0
-        totalcount = 0
-        totalsimilarity = 0
-        for j, s in protein_2.alignment.items():
-            for k, p in enumerate(s):
-                reference_residue = protein_1.alignment[j][k][2]
-                protein_residue = protein_2.alignment[j][k][2]
-                if not (reference_residue in self.gaps and protein_residue in self.gaps):
-                    totalcount += 1
-                    # identity
-                    if protein_residue == reference_residue:
-                        identityscore += 1
-
-                    # similarity
-                    if not (reference_residue in self.gaps or protein_residue in self.gaps):
-                        pair = (protein_residue, reference_residue)
-                        # Similarity lookup is slow -> disabling results in 1/3 reduction calc. time
-                        similarity = self.score_match(pair, MatrixInfo.blosum62)
-                        #                        similarity = 1
-                        if similarity > 0:
-                            similarityscore += 1
-                            totalsimilarity += similarity
-
-        # format the calculated values
-        #if identityscore and similarityscore:
-        if totalcount:
-            identity = "{:10.0f}".format(identityscore / totalcount * 100)
-            similarity = "{:10.0f}".format(similarityscore / totalcount * 100)
-            similarity_score = totalsimilarity
-
-            return identity, similarity, similarity_score
-        else:
-            # return False
-            # NOTE returning F results in fatal errors. No aligned residues: return -1
-            return "{:10.0f}".format(-1), "{:10.0f}".format(-1), 0
-
-    def pairwise_similarity_normalized(self, protein_1, protein_2):
-        """Calculate the identity, similarity and similarity score between a pair of proteins but delete gaps and normalize. Used for finding closest
-           receptor homologue with crystal structure."""
-        identities = OrderedDict()
-        similarities = OrderedDict()
-        similarity_scores = OrderedDict()
-        ref_seq, temp_seq = '',''
-        for j, s in protein_2.alignment.items():
-            for k, p in enumerate(s):
-                reference_residue = protein_1.alignment[j][k][2]
-                protein_residue = protein_2.alignment[j][k][2]
-                ref_seq+=reference_residue
-                temp_seq+=protein_residue
-                if not (reference_residue in self.gaps and protein_residue in self.gaps):
-                    # identity
-                    if protein_residue == reference_residue:
-                        identities[p[0]] = 1
-                    else:
-                        identities[p[0]] = 0
-
-                    # similarity
-                    if reference_residue in self.gaps:
-                        if p[0] not in self.residues_to_delete:
-                            self.residues_to_delete.append(p[0])
-                    elif protein_residue in self.gaps:
-                        del identities[p[0]]
-                        pass
-                    else:
-                        pair = (protein_residue, reference_residue)
-                        similarity = self.score_match(pair, MatrixInfo.blosum62)
-                        if similarity > 0:
-                            similarities[p[0]] = 1
-                        else:
-                            similarities[p[0]] = 0
-                        similarity_scores[p[0]] = similarity
+        counts = pairwise_similarity_counts(encode_alignment([protein_1, protein_2], self.gaps), rows=[0])
+        return format_similarity(counts['identity'][0, 1], counts['similarity'][0, 1], counts['positive_score'][0, 1],
+            counts['total'][0, 1])
+
+    def aligned_sequences(self):
+        """Generator of the entry name and aligned sequence of every protein in the alignment"""
+        for pc in self.proteins:
+            yield pc.protein.entry_name, "".join([r[2] for s in pc.alignment.values() for r in s])
+
+    def stream_fasta(self):
+        """Generator of the alignment in FASTA format, one record at a time"""
+        for entry_name, sequence in self.aligned_sequences():
+            yield ">" + entry_name + "\n" + sequence + "\n"
+
+    def stream_json(self, items=None):
+        """Generator of a JSON object written item by item, by default entry name -> aligned sequence
+        items is an iterable of (key, value) pairs"""
+        if items is None:
+            items = self.aligned_sequences()
+        yield "{"
+        separator = ""
+        for key, value in items:
+            yield separator + json.dumps(str(key)) + ": " + json.dumps(value)
+            separator = ", "
+        yield "}"
+
+    def stream_csv(self):
+        """Generator of the alignment in CSV format, one row at a time (the text is escaped as in the former
+        alignment_csv.html template)"""
+        prefix = ",,," if self.reference else ""
+
+        # segments and generic numbers
+        yield prefix + "".join(["," + s + "," * (len(num) - 1) if num else "," for s, num in self.segments.items()]) + "\n"
+        yield prefix + "".join(["," + escape(strip_tags(str(dn))) for segments in self.generic_numbers.values()
+            for num in segments.values() for dn in num.values()]) + "\n"
+
+        # aligned sequences
+        for i, p in enumerate(self.proteins):
+            row = "[" + escape(p.protein.species.common_name) + "] " + escape(strip_tags(p.protein.name))
+            if self.reference:
+                if i == 0:
+                    row += ",%I,%S,S"
                 else:
-                    if p[0] not in self.residues_to_delete:
-                        self.residues_to_delete.append(p[0])
-        self.normalized_scores[protein_2] = [identities, similarities, similarity_scores]
+                    row += "," + escape(p.identity) + "," + escape(p.similarity) + "," + escape(p.similarity_score)
+            yield row + "".join(["," + escape(r[2]) for s in p.alignment.values() for r in s]) + "\n"
 
-    def score_match(self, pair, matrix):
-        if pair not in matrix:
-            return matrix[(tuple(reversed(pair)))]
-        else:
-            return matrix[pair]
+        if self.consensus:
+            yield "CONSENSUS" + prefix + "".join(["," + escape(r[0]) for s in self.consensus.values() for r in s.values()])
 
 
 class AlignedReferenceTemplate(Alignment):
@@ -1342,7 +1525,8 @@ class AlignedReferenceTemplate(Alignment):
                 self.load_proteins_by_structure()
             self.load_segments(ProteinSegment.objects.filter(slug__in=segments))
             self.build_alignment()
-            self.calculate_similarity()
+            if not self.load_similarity_from_store():
+                self.calculate_similarity()
             self.reference_protein = self.proteins[0]
             self.main_template_protein = None
             self.ordered_proteins = []
@@ -1863,7 +2047,7 @@ class GProteinAlignment(Alignment):
 
 
 class ClosestReceptorHomolog():
-    ''' Finds the closest receptor homolog that has a structure. Uses the pairwise_similarity_normalized function that deletes gaps.
+    ''' Finds the closest receptor homolog that has a structure. Uses the pairwise similarity counts of the alignment.
     '''
     def __init__(self, protein, protein_segments=['TM1','TM2','TM3','TM4','TM5','TM6','TM7','H8'], normalized=True):
         self.protein = protein
@@ -1890,8 +2074,9 @@ class ClosestReceptorHomolog():
         structure_proteins = [i.protein_conformation.protein.parent for i in list(structures)]
         a.load_proteins(structure_proteins)
         a.load_segments(ProteinSegment.objects.filter(slug__in=self.protein_segments))
-        a.build_alignment()
-        a.calculate_similarity(normalized=self.normalized)
+        if not a.load_similarity_from_store(normalized=self.normalized):
+            a.build_alignment()
+            a.calculate_similarity(normalized=self.normalized)
         self.all_proteins = a.proteins
         max_sim, max_id, max_i = 0, 0, 1
         for i, p in enumerate(self.all_proteins):
@@ -0,0 +1,496 @@
+"""
+Cache backends for the project caches (see CACHES in protwis/settings.py)
+
+TieredCache keeps a bounded, size-aware LRU tier in the memory of each process in front of a persistent tier,
+which is either a sharded file store (ShardedFileCache) or a local SQLite database (SQLiteCache).
+Both persistent tiers can also be used as standalone Django cache backends.
+"""
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+from django.utils.module_loading import import_string
+
+from collections import OrderedDict
+
+import hashlib
+import os
+import pickle
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+
+class CacheStats:
+    """Per-process hit/miss counters of a cache tier"""
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.evictions = 0
+
+    def as_dict(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 3) if lookups else 0,
+            'sets': self.sets,
+            'evictions': self.evictions,
+        }
+
+
+class PersistentTierMixin:
+    """
+    Shared implementation of the Django cache API on top of raw entry access.
+    Subclasses implement get_raw(key) -> (expiry, data) or None, set_raw(key, data, expiry), delete_raw(key)
+    and clear(); keys are already made (prefixed/versioned) and data are pickled bytes.
+    """
+
+    def __init__(self, params):
+        options = params.get('OPTIONS', {})
+        self._compress = options.get('COMPRESS', True)
+        self.stats = CacheStats()
+
+    def _expiry(self, timeout):
+        timeout = self.get_backend_timeout(timeout)
+        return 0 if timeout is None else timeout
+
+    def encode(self, value):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if self._compress:
+            return b'z' + zlib.compress(data)
+        return b'p' + data
+
+    def decode(self, data):
+        if data[:1] == b'z':
+            return pickle.loads(zlib.decompress(data[1:]))
+        return pickle.loads(data[1:])
+
+    @staticmethod
+    def is_expired(expiry):
+        return expiry != 0 and expiry < time.time()
+
+    def get_entry(self, key):
+        entry = self.get_raw(key)
+        if entry is None or self.is_expired(entry[0]):
+            if entry is not None:
+                self.delete_raw(key)
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        return entry
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        if self.has_key(key, version):
+            return False
+        self.set(key, value, timeout, version)
+        return True
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        entry = self.get_entry(key)
+        if entry is None:
+            return default
+        return self.decode(entry[1])
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        self.stats.sets += 1
+        self.set_raw(key, self.encode(value), self._expiry(timeout))
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        entry = self.get_entry(key)
+        if entry is None:
+            return False
+        self.set_raw(key, entry[1], self._expiry(timeout))
+        return True
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return self.delete_raw(key)
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        entry = self.get_raw(key)
+        return entry is not None and not self.is_expired(entry[0])
+
+
+class ShardedFileCache(PersistentTierMixin, BaseCache):
+    """
+    File based cache spread over SHARDS subdirectories (<location>/<shard>/<md5>.djcache).
+    Culling only lists the shard that is written to and is size-aware: a shard is culled
+    when it exceeds MAX_ENTRIES/SHARDS entries or MAX_SIZE/SHARDS bytes (oldest files first).
+    Unlike FileBasedCache the limits are checked every CULL_INTERVAL writes instead of on every set.
+    """
+    cache_suffix = '.djcache'
+    header = struct.Struct('d')
+
+    def __init__(self, location, params):
+        BaseCache.__init__(self, params)
+        PersistentTierMixin.__init__(self, params)
+        options = params.get('OPTIONS', {})
+        self._dir = os.path.abspath(location)
+        self._shards = int(options.get('SHARDS', 256))
+        self._max_shard_entries = max(1, self._max_entries // self._shards)
+        max_size = options.get('MAX_SIZE')
+        self._max_shard_size = int(max_size) // self._shards if max_size else None
+        # only check the limits of a shard every CULL_INTERVAL writes (per process)
+        self._cull_interval = int(options.get('CULL_INTERVAL', 10))
+        self._writes = 0
+
+    def _key_to_file(self, key):
+        digest = hashlib.md5(key.encode()).hexdigest()
+        shard = '{:02x}'.format(int(digest[:4], 16) % self._shards)
+        return os.path.join(self._dir, shard, digest + self.cache_suffix)
+
+    def get_raw(self, key):
+        try:
+            with open(self._key_to_file(key), 'rb') as f:
+                expiry = self.header.unpack(f.read(self.header.size))[0]
+                return expiry, f.read()
+        except (FileNotFoundError, struct.error):
+            return None
+
+    def set_raw(self, key, data, expiry):
+        fname = self._key_to_file(key)
+        shard_dir = os.path.dirname(fname)
+        os.makedirs(shard_dir, exist_ok=True)
+        self._writes += 1
+        if self._writes % self._cull_interval == 0:
+            self._cull(shard_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=shard_dir)
+        try:
+            with open(fd, 'wb') as f:
+                f.write(self.header.pack(expiry))
+                f.write(data)
+            os.replace(tmp_path, fname)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def delete_raw(self, key):
+        try:
+            os.remove(self._key_to_file(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _cull(self, shard_dir):
+        entries = []
+        total_size = 0
+        with os.scandir(shard_dir) as it:
+            for entry in it:
+                if entry.name.endswith(self.cache_suffix):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total_size += stat.st_size
+
+        too_many = len(entries) >= self._max_shard_entries
+        too_big = self._max_shard_size is not None and total_size >= self._max_shard_size
+        if not too_many and not too_big:
+            return
+
+        # remove the oldest fraction (1/CULL_FREQUENCY) of the shard, 0 clears the shard
+        entries.sort()
+        if self._cull_frequency == 0:
+            to_remove = len(entries)
+        else:
+            to_remove = max(1, len(entries) // self._cull_frequency)
+        for _, size, path in entries[:to_remove]:
+            try:
+                os.remove(path)
+                self.stats.evictions += 1
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        if not os.path.exists(self._dir):
+            return
+        for root, _, files in os.walk(self._dir):
+            for name in files:
+                if name.endswith(self.cache_suffix):
+                    try:
+                        os.remove(os.path.join(root, name))
+                    except FileNotFoundError:
+                        pass
+
+    def size(self):
+        """Number of entries and bytes on disk"""
+        count = total = 0
+        for root, _, files in os.walk(self._dir):
+            for name in files:
+                if name.endswith(self.cache_suffix):
+                    count += 1
+                    total += os.path.getsize(os.path.join(root, name))
+        return count, total
+
+
+class SQLiteCache(PersistentTierMixin, BaseCache):
+    """
+    Cache stored in a local SQLite database file (LOCATION), a stand-in for a shared key/value store.
+    Least recently used entries are evicted once the table exceeds MAX_ENTRIES rows or MAX_SIZE bytes.
+    """
+    cull_check_interval = 100
+
+    def __init__(self, location, params):
+        BaseCache.__init__(self, params)
+        PersistentTierMixin.__init__(self, params)
+        options = params.get('OPTIONS', {})
+        self._path = location
+        max_size = options.get('MAX_SIZE')
+        self._max_size = int(max_size) if max_size else None
+        self._local = threading.local()
+        self._writes = 0
+
+    def _connection(self):
+        # connections cannot be shared between threads or forked processes
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+            conn = sqlite3.connect(self._path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires REAL, size INTEGER, accessed REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get_raw(self, key):
+        conn = self._connection()
+        row = conn.execute('SELECT expires, value FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        conn.execute('UPDATE cache SET accessed = ? WHERE key = ?', (time.time(), key))
+        return row[0], bytes(row[1])
+
+    def set_raw(self, key, data, expiry):
+        conn = self._connection()
+        conn.execute('INSERT OR REPLACE INTO cache (key, value, expires, size, accessed) VALUES (?, ?, ?, ?, ?)',
+            (key, sqlite3.Binary(data), expiry, len(data), time.time()))
+        self._writes += 1
+        if self._writes % self.cull_check_interval == 0:
+            self._cull(conn)
+
+    def delete_raw(self, key):
+        return self._connection().execute('DELETE FROM cache WHERE key = ?', (key,)).rowcount > 0
+
+    def _cull(self, conn):
+        now = time.time()
+        conn.execute('DELETE FROM cache WHERE expires != 0 AND expires < ?', (now,))
+        count, total = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache').fetchone()
+        too_big = self._max_size is not None and total > self._max_size
+        if count <= self._max_entries and not too_big:
+            return
+
+        if self._cull_frequency == 0:
+            self.stats.evictions += count
+            conn.execute('DELETE FROM cache')
+            return
+
+        # drop least recently used entries until both limits are met again, at least 1/CULL_FREQUENCY
+        target_count = min(count - count // self._cull_frequency, self._max_entries)
+        target_size = self._max_size if too_big else None
+        kept_size = 0
+        kept = 0
+        to_remove = []
+        for key, size in conn.execute('SELECT key, size FROM cache ORDER BY accessed DESC'):
+            if kept < target_count and (target_size is None or kept_size + size <= target_size):
+                kept += 1
+                kept_size += size
+            else:
+                to_remove.append((key,))
+        conn.executemany('DELETE FROM cache WHERE key = ?', to_remove)
+        self.stats.evictions += len(to_remove)
+
+    def clear(self):
+        self._connection().execute('DELETE FROM cache')
+
+    def size(self):
+        """Number of entries and bytes stored"""
+        return tuple(self._connection().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache').fetchone())
+
+
+class LRUTier:
+    """
+    Bounded in-process LRU, evicting on both entry count and total size. Values are kept as they are given
+    (bytes, or decoded objects with the size of their encoded form).
+    """
+    def __init__(self, max_entries, max_size):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = CacheStats()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            if PersistentTierMixin.is_expired(entry[0]):
+                self._remove(key)
+                self.stats.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats.hits += 1
+            return entry[:2]
+
+    def set(self, key, data, expiry, size=None):
+        size = len(data) if size is None else size
+        if size > self.max_size:
+            # never let a single entry flush the whole tier
+            self.delete(key)
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (expiry, data, size)
+            self.size += size
+            self.stats.sets += 1
+            while len(self.entries) > self.max_entries or self.size > self.max_size:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.stats.evictions += 1
+
+    def _remove(self, key):
+        expiry, data, size = self.entries.pop(key)
+        self.size -= size
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+                return True
+            return False
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class TieredCache(BaseCache):
+    """
+    Per-process LRU tier in front of a persistent tier.
+    By default the LRU tier keeps the decoded values, so memory hits skip decompression and unpickling; the same
+    object is then returned on every hit and callers must not modify values they get from the cache.
+    With LRU_PICKLED the LRU tier keeps uncompressed pickles instead and every hit returns a fresh copy, for
+    caches whose values are modified by their callers (e.g. the alignments).
+    Hit/miss counters are kept per process (see get_stats).
+
+    OPTIONS:
+        PERSISTENT          dotted path of the persistent backend (default common.cache.ShardedFileCache)
+        PERSISTENT_OPTIONS  OPTIONS passed on to the persistent backend
+        LRU_MAX_ENTRIES     maximum number of entries in memory (default 1000)
+        LRU_MAX_SIZE        maximum bytes in memory (default 256MB)
+        LRU_KEY_PREFIXES    only keys starting with one of these prefixes are kept in memory (default: all keys)
+        LRU_PICKLED         keep pickles in memory and unpickle on every hit (default False)
+    """
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        persistent_class = import_string(options.get('PERSISTENT', 'common.cache.ShardedFileCache'))
+        persistent_params = {
+            'TIMEOUT': params.get('TIMEOUT', 300),
+            'OPTIONS': options.get('PERSISTENT_OPTIONS', {}),
+        }
+        self.persistent = persistent_class(location, persistent_params)
+        self.lru = LRUTier(int(options.get('LRU_MAX_ENTRIES', 1000)), int(options.get('LRU_MAX_SIZE', 256*1024*1024)))
+        self.lru_prefixes = tuple(options.get('LRU_KEY_PREFIXES', ()))
+        self.lru_pickled = bool(options.get('LRU_PICKLED', False))
+
+    def _in_lru(self, key):
+        # made keys are <prefix>:<version>:<key>
+        return not self.lru_prefixes or key.split(':', 2)[-1].startswith(self.lru_prefixes)
+
+    def _expiry(self, timeout):
+        timeout = self.get_backend_timeout(timeout)
+        return 0 if timeout is None else timeout
+
+    def _lru_set(self, key, value, expiry, size):
+        if self.lru_pickled:
+            value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            size = len(value)
+        self.lru.set(key, value, expiry, size=size)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        if self.has_key(key, version):
+            return False
+        self.set(key, value, timeout, version)
+        return True
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        in_lru = self._in_lru(key)
+        entry = self.lru.get(key) if in_lru else None
+        if entry is not None:
+            return pickle.loads(entry[1]) if self.lru_pickled else entry[1]
+        entry = self.persistent.get_entry(key)
+        if entry is None:
+            return default
+        value = self.persistent.decode(entry[1])
+        if in_lru:
+            self._lru_set(key, value, entry[0], len(entry[1]))
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        data = self.persistent.encode(value)
+        expiry = self._expiry(timeout)
+        self.persistent.stats.sets += 1
+        self.persistent.set_raw(key, data, expiry)
+        if self._in_lru(key):
+            self._lru_set(key, value, expiry, len(data))
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.lru.delete(key)
+        entry = self.persistent.get_entry(key)
+        if entry is None:
+            return False
+        self.persistent.set_raw(key, entry[1], self._expiry(timeout))
+        return True
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        in_memory = self.lru.delete(key)
+        return self.persistent.delete_raw(key) or in_memory
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        if self._in_lru(key) and key in self.lru.entries and not self.persistent.is_expired(self.lru.entries[key][0]):
+            return True
+        entry = self.persistent.get_raw(key)
+        return entry is not None and not self.persistent.is_expired(entry[0])
+
+    def clear(self):
+        self.lru.clear()
+        self.persistent.clear()
+
+    def get_stats(self):
+        """
+        Hit/miss counters of both tiers and the current tier sizes. The counters and the LRU tier belong to the
+        calling process: they describe a web worker only when called inside it (not from a management command).
+        """
+        stats = {
+            'lru': self.lru.stats.as_dict(),
+            'persistent': self.persistent.stats.as_dict(),
+        }
+        stats['lru'].update({'entries': len(self.lru.entries), 'bytes': self.lru.size})
+        if hasattr(self.persistent, 'size'):
+            entries, size = self.persistent.size()
+            stats['persistent'].update({'entries': entries, 'bytes': size})
+        return stats
@@ -0,0 +1,203 @@
+"""
+Server-side data sources for the large browser tables
+
+The browsers (structures, biased signalling, couplings) used to render every row into the page, so the page size
+and build time grew with the tables. A DataSource describes the rows of a browser as a queryset and a list of
+Columns (ORM paths read with .values()), and answers DataTables server-side requests: one page of rows, sorted
+and filtered in the database. Counts of matching rows are cached per filter combination, as they are the same
+for every page and sort order. Rows can be extended with to-many data (e.g. the ligands of a structure) by
+overriding extend_rows, which only sees the rows of the page.
+
+Request parameters (GET) follow the DataTables protocol: draw, start, length, search[value], order[i][column],
+order[i][dir], columns[i][data] and columns[i][search][value], where the data of a DataTables column is the name
+of a Column (table columns without a Column, e.g. checkboxes, are ignored); columns can also be filtered by name
+(?state=Active) and sorted by name (?order=-resolution). Filter values of 'exact' columns may hold several values
+separated by '|', those of 'range' columns are 'min:max' (either side may be empty).
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+import hashlib
+import json
+import re
+
+
+RANGE_DELIMITERS = ('-yadcf_delim-', ':')
+
+
+class Column(object):
+    """
+    A browser column: name of the value in the rows, ORM path of the field (default the name), how it is
+    filtered ('icontains', 'exact' or 'range', None for not filterable) and an optional function that formats
+    the value of the rows and the labels of the filter options (sorting and filtering use the database value).
+    Columns of a to-many field (many=True) are only filtered in the database, extend_rows adds their values.
+    The filters can use another ORM path (filter_field, e.g. the numbers of a text field for a range), the
+    global search covers the 'icontains' columns and those with searchable=True.
+    """
+
+    def __init__(self, name, field=None, search='icontains', orderable=True, format=None, many=False,
+            filter_field=None, searchable=None):
+        self.name = name
+        self.field = field or name
+        self.search = search
+        self.orderable = orderable and not many
+        self.format = format
+        self.many = many
+        self.filter_field = filter_field or self.field
+        self.searchable = search == 'icontains' if searchable is None else searchable
+
+    def lookup(self, value):
+        """Q object of a filter value of the column"""
+        if self.search == 'range':
+            for delimiter in RANGE_DELIMITERS:
+                if delimiter in value:
+                    low, high = [v.strip() for v in value.split(delimiter, 1)]
+                    break
+            else:
+                low = high = value.strip()
+            q = Q()
+            if low:
+                q &= Q(**{self.filter_field + '__gte': low})
+            if high:
+                q &= Q(**{self.filter_field + '__lte': high})
+            return q
+        elif self.search == 'exact':
+            values = [v for v in value.split('|') if v]
+            if len(values) > 1:
+                return Q(**{self.filter_field + '__in': values})
+            return Q(**{self.filter_field: values[0]})
+        return Q(**{self.filter_field + '__icontains': value})
+
+
+class DataSource(object):
+    """
+    Rows of a browser table; subclasses set name, columns and get_queryset, optionally default_order and
+    extend_rows
+    """
+    name = None
+    columns = []
+    # ORM order of the rows without a requested order (the primary key is always added last)
+    default_order = []
+
+    def __init__(self):
+        self.columns_by_name = dict([(c.name, c) for c in self.columns])
+
+    def get_queryset(self):
+        raise NotImplementedError
+
+    def extend_rows(self, rows):
+        """Adds data that cannot be read with .values() to the rows of a page"""
+        pass
+
+    @staticmethod
+    def max_length():
+        return getattr(settings, 'DATASOURCE_MAX_LENGTH', 1000)
+
+    def parse(self, params):
+        """The global search, column filters and order of request parameters"""
+        search = params.get('search[value]', params.get('search', '')).strip()
+
+        values = dict([(c.name, params.get(c.name, '')) for c in self.columns])
+        i = 0
+        while 'columns[{}][data]'.format(i) in params:
+            name = params['columns[{}][data]'.format(i)]
+            if name in values:
+                values[name] = params.get('columns[{}][search][value]'.format(i), '') or values[name]
+            i += 1
+        filters = {}
+        for column in self.columns:
+            # yadcf sends multi-select filters as regular expressions, ^(a|b)$
+            value = re.sub(r'\\(.)', r'\1', re.sub(r'^\^\(?|\)?\$$', '', values[column.name].strip()))
+            if value and column.search:
+                filters[column.name] = value
+
+        order = []
+        i = 0
+        while 'order[{}][column]'.format(i) in params:
+            name = params.get('columns[{}][data]'.format(params['order[{}][column]'.format(i)]))
+            column = self.columns_by_name.get(name)
+            if column and column.orderable:
+                order.append(('-' if params.get('order[{}][dir]'.format(i)) == 'desc' else '') + column.field)
+            i += 1
+        names = params.getlist('order') if hasattr(params, 'getlist') else [params['order']] if 'order' in params else []
+        for name in names:
+            column = self.columns_by_name[name.lstrip('-')]
+            if column.orderable:
+                order.append(('-' if name.startswith('-') else '') + column.field)
+        return search, filters, order
+
+    def filter(self, queryset, search, filters):
+        # filters of to-many columns join several rows of the related table per row
+        many = any(self.columns_by_name[name].many for name in filters)
+        if search:
+            q = Q()
+            for column in self.columns:
+                if column.searchable:
+                    q |= Q(**{column.field + '__icontains': search})
+                    many |= column.many
+            queryset = queryset.filter(q)
+        for name, value in sorted(filters.items()):
+            queryset = queryset.filter(self.columns_by_name[name].lookup(value))
+        return queryset.distinct() if many else queryset
+
+    def cache_key(self, kind, *args):
+        key = hashlib.sha1(json.dumps(args, sort_keys=True).encode('utf-8')).hexdigest()
+        return 'datasource-{}-{}-{}'.format(self.name, kind, key)
+
+    def count(self, search, filters):
+        """Number of rows matching a search and filters (cached, DATASOURCE_COUNT_TIMEOUT seconds)"""
+        key = self.cache_key('count', search, filters)
+        count = cache.get(key)
+        if count is None:
+            count = self.filter(self.get_queryset(), search, filters).count()
+            cache.set(key, count, getattr(settings, 'DATASOURCE_COUNT_TIMEOUT', 60*60*24))
+        return count
+
+    def page(self, params):
+        """DataTables response (draw, recordsTotal, recordsFiltered, data) to request parameters"""
+        search, filters, order = self.parse(params)
+        start = max(int(params.get('start', 0)), 0)
+        length = int(params.get('length', 100))
+        if length < 0 or length > self.max_length():
+            length = self.max_length()
+
+        queryset = self.filter(self.get_queryset(), search, filters)
+        queryset = queryset.order_by(*(order + self.default_order + ['pk']))
+        columns = [c for c in self.columns if not c.many]
+        fields = ['pk'] + sorted(set([c.field for c in columns]))
+        rows = []
+        for values in queryset.values(*fields)[start:start+length]:
+            row = {'id': values['pk']}
+            for column in columns:
+                value = values[column.field]
+                row[column.name] = column.format(value) if column.format and value is not None else value
+            rows.append(row)
+        self.extend_rows(rows)
+
+        return {
+            'draw': int(params.get('draw', 0)),
+            'recordsTotal': self.count('', {}),
+            'recordsFiltered': self.count(search, filters),
+            'data': rows,
+        }
+
+    def options(self, name, params):
+        """
+        Distinct values of a column among the rows that match the other filters (for select filters), as
+        {value, label} options when the column is formatted
+        """
+        column = self.columns_by_name[name]
+        search, filters, _ = self.parse(params)
+        filters.pop(name, None)
+        key = self.cache_key('options', name, search, filters)
+        values = cache.get(key)
+        if values is None:
+            queryset = self.filter(self.get_queryset(), search, filters)
+            values = [v for v in queryset.order_by(column.field).values_list(column.field, flat=True).distinct()
+                if v is not None and v != '']
+            cache.set(key, values, getattr(settings, 'DATASOURCE_COUNT_TIMEOUT', 60*60*24))
+        if column.format:
+            # booleans as the filter values the database accepts (True, False)
+            values = [{'value': str(v) if isinstance(v, bool) else v, 'label': column.format(v)} for v in values]
+        return {'column': name, 'options': values}
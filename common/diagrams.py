@@ -1,5 +1,14 @@
-﻿from math import cos, sin, tan, pi, sqrt, pow
+﻿from django.conf import settings
+from django.core.cache import cache
+
+from math import cos, sin, tan, pi, sqrt, pow
 import string, time, math, random
+import hashlib, json, re
+
+# bump when the geometry of the diagrams changes, to invalidate the cached layouts
+LAYOUT_VERSION = 1
+# marks the place of a residue in the SVG of a layout that is being computed
+LAYOUT_SLOT = '\x00{}\x00'
 
 def uniqid(prefix='', more_entropy=False):
     m = time.time()
@@ -14,6 +23,47 @@ def uniqid(prefix='', more_entropy=False):
     return uniqid
 
 class Diagram:
+    # residues drawn while a layout is computed (see cachedLayout), None when residues are drawn directly
+    layout_residues = None
+
+    def cachedLayout(self, name, key_data, draw):
+        """
+        The layout of a diagram, cached by name and key_data (everything the geometry depends on): draw() computes
+        the geometry and returns the SVG and the size of the diagram. Residues drawn meanwhile are recorded in the
+        layout instead, so renderLayout can draw them with any colouring without repeating the geometry.
+        """
+        key = 'diagram-layout-{}-{}'.format(name, hashlib.sha1(json.dumps([LAYOUT_VERSION, key_data],
+            default=str).encode('utf-8')).hexdigest())
+        layout = cache.get(key)
+        if layout is None:
+            self.layout_residues = []
+            try:
+                svg, size = draw()
+                residues = self.layout_residues
+            finally:
+                self.layout_residues = None
+            # static SVG fragments alternating with the indices of the residues
+            layout = {'parts': re.split('\x00(\\d+)\x00', svg), 'residues': residues, 'size': size}
+            cache.set(key, layout, getattr(settings, 'DIAGRAM_LAYOUT_TIMEOUT', 60*60*24*30))
+        return layout
+
+    def renderLayout(self, layout, fills=None, classes=None):
+        """SVG of a layout, with residue fill colours and extra residue classes by residue number"""
+        fills = fills or {}
+        classes = classes or {}
+        residues = layout['residues']
+        output = []
+        for i, part in enumerate(layout['parts']):
+            if i % 2:
+                x, y, aa, residue_number, label, radius, resclass = residues[int(part)]
+                if residue_number in classes:
+                    resclass = (resclass + ' ' + classes[residue_number]).strip()
+                output.append(self.DrawResidue(x, y, aa, residue_number, label, radius, resclass,
+                    fills.get(residue_number, 'white')))
+            else:
+                output.append(part)
+        return ''.join(output)
+
     def create(self, content,sizex,sizey,name, nobuttons):
         #diagram_js = self.diagramJS()
         if nobuttons=='gprotein' or nobuttons=='arrestin':
@@ -136,6 +186,9 @@ class Diagram:
 
     #Draws a ring of a helical wheel
     def DrawResidue(self, x,y,aa,residue_number,label,radius, resclass = '',cfill="white", precolor = False):
+        if self.layout_residues is not None:
+            self.layout_residues.append((x, y, aa, residue_number, label, radius, resclass))
+            return LAYOUT_SLOT.format(len(self.layout_residues) - 1)
         id = residue_number
         idtext = str(id) + 't'
         tfill = 'black'
@@ -92,6 +92,19 @@ class DrawSnakePlot(Diagram):
         # margin between two helixes
         self.margin = 30
 
+        # the geometry only depends on the residues of each segment, see Diagram.cachedLayout
+        self.layout = self.cachedLayout('snakeplot', [self.family, list(self.segments.items())], self.drawLayout)
+
+    def __str__(self):
+        return self.render()
+
+    def render(self, fills=None, classes=None):
+        """SVG of the plot, residue fill colours and extra classes by sequence number are applied to the layout"""
+        width, height = self.layout['size']
+        return mark_safe(self.create(self.renderLayout(self.layout, fills, classes), width, height, "snakeplot", self.nobuttons))
+
+    def drawLayout(self):
+        """Computes the geometry of the plot, returns the SVG and its size"""
         # highest and lowest bound of this svg
         self.high =100
         self.low = 0
@@ -152,13 +165,11 @@ class DrawSnakePlot(Diagram):
                 print('error with helix',8,msg)
 
         self.drawSnakePlotLoops()
-        
-        self.drawSnakePlotTerminals()
 
-    def __str__(self):
+        self.drawSnakePlotTerminals()
 
-        self.output_final = "<g id=snake transform='translate(0, " + str(-self.low+ self.offsetY) + ")'>" + self.traceoutput+self.output+self.helixoutput+self.drawToolTip() + "</g>"; #for resizing height
-        return mark_safe(self.create(self.output_final,self.maxX['right']+30,self.high-self.low+self.offsetY*2,"snakeplot", self.nobuttons))
+        output = "<g id=snake transform='translate(0, " + str(-self.low+ self.offsetY) + ")'>" + self.traceoutput+self.output+self.helixoutput+self.drawToolTip() + "</g>"; #for resizing height
+        return output, (self.maxX['right']+30, self.high-self.low+self.offsetY*2)
 
     def drawSnakePlotHelix(self, helix_num):
         # helix_num = self.count
@@ -1216,6 +1227,27 @@ class DrawHelixBox(Diagram):
 
                 segment_lists[r.segment_slug].append(r)
 
+        self.segment_lists = segment_lists
+        layout_residues = []
+        for slug, residues in segment_lists.items():
+            layout_residues.append([slug, [[r.amino_acid, r.sequence_number,
+                r.generic_number.label if r.generic_number else getattr(r, 'family_generic_number', None),
+                r.display_generic_number.label if r.display_generic_number else None,
+                getattr(r, 'frequency', None)] for r in residues]])
+        # the geometry only depends on the residues of each helix, see Diagram.cachedLayout
+        self.layout = self.cachedLayout('helixbox', [self.family, layout_residues], self.drawLayout)
+
+    def __str__(self):
+        return self.render()
+
+    def render(self, fills=None, classes=None):
+        """SVG of the box, residue fill colours and extra classes by sequence number are applied to the layout"""
+        width, height = self.layout['size']
+        return mark_safe(self.create(self.renderLayout(self.layout, fills, classes), width, height, "helixbox", self.nobuttons))
+
+    def drawLayout(self):
+        """Computes the geometry of the box, returns the SVG and its size"""
+        segment_lists = self.segment_lists
         for i in range(1,len(self.plot_data[self.family]['coordinates'])):
             try:
                 self.residuelist = segment_lists['TM'+str(i)]
@@ -1233,8 +1265,7 @@ class DrawHelixBox(Diagram):
                 print('failed helix',i,msg)
                 pass
 
-    def __str__(self):
-        return mark_safe(self.create(self.output+self.drawToolTip(),595,430,"helixbox", self.nobuttons))
+        return self.output+self.drawToolTip(), (595, 430)
 
     def DrawHelix(self, startX,startY,residuelist,radius,direction,helixNum,helixTopResidue,rotation):
         sequence = {}
@@ -0,0 +1,150 @@
+"""
+Job queue for long-running analyses
+
+Analyses that take minutes (clustering of many structures, trees) used to run inside the request
+and tied up a web worker until they finished or timed out. A job function is registered under a name with
+register_job and takes a dict of parameters (strings when submitted from the browser), returning a JSON
+serialisable result. submit_job stores the request in the Job table, keyed by the hash of name and parameters,
+and hands it to a local process pool; identical requests share one Job, so a result is computed once and served
+from the table afterwards.
+The submit, status and result views in common.views expose this to the browser.
+
+Registered jobs: the structure clustering (contactnetwork.views.clustering_data, requested and polled by the
+clustering page) and the phylogenetic tree (phylogenetic_trees.views.phylogeny_data, submitted by the tree page,
+which waits for it). The sequence signature, the site search upload and the interaction calculation are not jobs:
+they work on the session selection or on an uploaded file and keep their results in the session.
+"""
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, close_old_connections
+from django.utils import timezone
+
+from common.models import Job
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+
+import django
+import hashlib
+import json
+import logging
+import multiprocessing
+import threading
+import traceback
+
+
+logger = logging.getLogger('jobs')
+
+# registered job functions by name
+job_functions = {}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def register_job(name):
+    """Decorator that makes a function available to submit_job under name"""
+    def decorator(function):
+        job_functions[name] = function
+        return function
+    return decorator
+
+
+def job_key(name, parameters):
+    return hashlib.sha256(json.dumps([name, parameters], sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _init_worker():
+    django.setup()
+
+
+def get_executor():
+    """Process pool of this (web) process, JOB_WORKERS processes (default 2)"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=getattr(settings, 'JOB_WORKERS', 2),
+                mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker)
+        return _executor
+
+
+def _reset_executor():
+    global _executor
+    with _executor_lock:
+        _executor = None
+
+
+def run_job(job_id, function):
+    """Runs a job in a worker process and stores its result (or the error)"""
+    close_old_connections()
+    Job.objects.filter(pk=job_id).update(status=Job.RUNNING, started=timezone.now())
+    job = Job.objects.get(pk=job_id)
+    try:
+        result = json.dumps(function(json.loads(job.parameters)), cls=DjangoJSONEncoder)
+    except (Exception, SystemExit):
+        logger.exception('Job {} ({}) failed'.format(job.key, job.name))
+        Job.objects.filter(pk=job_id).update(status=Job.FAILED, error=traceback.format_exc(), finished=timezone.now())
+    else:
+        Job.objects.filter(pk=job_id).update(status=Job.DONE, result=result, error=None, finished=timezone.now())
+
+
+def dispatch_job(job):
+    try:
+        get_executor().submit(run_job, job.pk, job_functions[job.name])
+    except BrokenProcessPool:
+        # a worker died (e.g. killed), start a new pool
+        _reset_executor()
+        get_executor().submit(run_job, job.pk, job_functions[job.name])
+
+
+def is_stale(job):
+    """
+    Failed jobs, jobs that were lost (queued or running for more than JOB_TIMEOUT seconds, default one hour)
+    and results older than JOB_RESULT_TIMEOUT seconds (default one week, None to keep results) are run again
+    """
+    now = timezone.now()
+    if job.status == Job.FAILED:
+        return True
+    elif job.status == Job.DONE:
+        timeout = getattr(settings, 'JOB_RESULT_TIMEOUT', 7*24*3600)
+        return timeout is not None and job.finished < now - timedelta(seconds=timeout)
+    return (job.started or job.created) < now - timedelta(seconds=getattr(settings, 'JOB_TIMEOUT', 3600))
+
+
+def submit_job(name, parameters):
+    """The Job for name and parameters, queued if there is no (current) job for the same input"""
+    if name not in job_functions:
+        raise KeyError('Unknown job {}'.format(name))
+
+    key = job_key(name, parameters)
+    try:
+        job, created = Job.objects.get_or_create(key=key,
+            defaults={'name': name, 'parameters': json.dumps(parameters, sort_keys=True)})
+    except IntegrityError:
+        job, created = Job.objects.get(key=key), False
+
+    if not created:
+        if not is_stale(job):
+            return job
+        # requeue, unless another process got there first
+        requeued = Job.objects.filter(pk=job.pk, status=job.status, started=job.started, finished=job.finished).update(
+            status=Job.QUEUED, created=timezone.now(), started=None, finished=None, result=None, error=None)
+        job.refresh_from_db()
+        if not requeued:
+            return job
+
+    dispatch_job(job)
+    return job
+
+
+def job_status(job):
+    return {
+        'key': job.key,
+        'name': job.name,
+        'status': job.status,
+        'created': job.created,
+        'started': job.started,
+        'finished': job.finished,
+        'error': job.error.strip().split('\n')[-1] if job.error else None,
+    }
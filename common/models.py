@@ -219,3 +219,28 @@ class ReleaseStatisticsType(models.Model):
     class Meta():
         db_table = 'release_statistics_type'
 
+
+
+class Job(models.Model):
+    """Long-running analysis submitted to the job queue (see common.jobs), identified by the hash of its input"""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = ((QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed'))
+
+    key = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=100)
+    parameters = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    result = models.TextField(null=True)
+    error = models.TextField(null=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return "{} {} ({})".format(self.name, self.key, self.status)
+
+    class Meta():
+        db_table = 'job'
@@ -1,9 +1,57 @@
 ﻿from django.conf import settings
+from django.apps import apps
+from django.core.cache import cache
+from django.db import models
 
 from protein.models import Species
 from protein.models import ProteinSource
 from residue.models import ResidueNumberingScheme
 
+import copy
+
+# Selection items are pickled (session) as type tags and primary keys, and rehydrated through the shared cache
+SELECTION_ITEM_CACHE_TIMEOUT = 60*60*24
+
+# attributes set on selected objects that are kept in the item properties
+SELECTION_ITEM_FLAGS = ('only_aligned_residues', )
+
+# primary keys of the default annotation and numbering scheme of new selections
+_default_item_pks = {}
+
+
+def selection_item_cache_key(reference):
+    return 'selection_item-{}-{}'.format(*reference)
+
+
+def load_selection_items(references):
+    """Objects for (model label, pk) references, from the shared cache or with one query per model"""
+    keys = {reference: selection_item_cache_key(reference) for reference in references}
+    cached = cache.get_many(list(keys.values()))
+
+    objects = {}
+    missing = {}
+    for reference, key in keys.items():
+        if key in cached:
+            objects[reference] = cached[key]
+        else:
+            missing.setdefault(reference[0], []).append(reference[1])
+
+    for label, pks in missing.items():
+        loaded = apps.get_model(label).objects.in_bulk(pks)
+        cache.set_many({selection_item_cache_key((label, pk)): obj for pk, obj in loaded.items()}, SELECTION_ITEM_CACHE_TIMEOUT)
+        for pk, obj in loaded.items():
+            objects[(label, pk)] = obj
+
+    return objects
+
+
+def default_selection_item(selection_type, model, **lookup):
+    """SelectionItem of a default object (looked up once per process)"""
+    key = (model._meta.label_lower, tuple(sorted(lookup.items())))
+    if key not in _default_item_pks:
+        _default_item_pks[key] = model.objects.values_list('pk', flat=True).get(**lookup)
+    return SelectionItem.from_reference(selection_type, model._meta.label_lower, _default_item_pks[key])
+
 
 class SimpleSelection:
     """A class representing the proteins and segments a user has selected. Can be serialized and stored in session"""
@@ -20,13 +68,11 @@ class SimpleSelection:
         self.g_proteins = []
 
         # annotation
-        ps = ProteinSource.objects.get(name='SWISSPROT') # Default protein source is SWISSPROT
-        o = SelectionItem('protein_source', ps)
+        o = default_selection_item('protein_source', ProteinSource, name='SWISSPROT') # Default protein source is SWISSPROT
         self.annotation = [o]
 
         # numbering schemes
-        gn = ResidueNumberingScheme.objects.get(slug=settings.DEFAULT_NUMBERING_SCHEME)
-        o = SelectionItem('numbering_schemes', gn)
+        o = default_selection_item('numbering_schemes', ResidueNumberingScheme, slug=settings.DEFAULT_NUMBERING_SCHEME)
         self.numbering_schemes = [o]
 
         # Default values for phylogenetic tree creation
@@ -39,6 +85,15 @@ class SimpleSelection:
     def __str__(self):
         return str(self.__dict__)
 
+    def __setstate__(self, state):
+        """Unpickled items are rehydrated together when the first one is used"""
+        self.__dict__.update(state)
+        items = [item for value in state.values() if isinstance(value, list) for item in value
+            if isinstance(item, SelectionItem) and item._item_ref is not None]
+        batch = SelectionItemBatch(items)
+        for item in items:
+            item._batch = batch
+
 
 class Selection(SimpleSelection):
     """A class that extends SimpleSelection, and adds methods to process the selection (these methods can not be
@@ -168,16 +223,77 @@ class Selection(SimpleSelection):
         }
 
 
+class SelectionItemBatch:
+    """Items of an unpickled selection that are rehydrated together"""
+    def __init__(self, items):
+        self.items = items
+
+    def load(self):
+        items = [item for item in self.items if item._item_ref is not None]
+        objects = load_selection_items({item._item_ref for item in items})
+        for item in items:
+            item.rehydrate(objects.get(item._item_ref))
+        self.items = []
+
+
 class SelectionItem:
-    """A wrapper class for selectable objects (protein, family, sequence segment etc.) that adds a type attribute"""
+    """A wrapper class for selectable objects (protein, family, sequence segment etc.) that adds a type attribute.
+        Model objects are pickled as a reference (model label and primary key) and loaded again when used"""
     def __init__(self, selection_type, selection_object, properties={}):
         self.type = selection_type
         self.type_title = selection_type.replace('_', ' ').capitalize()
         self.item = selection_object
         self.properties = properties
 
+    @classmethod
+    def from_reference(cls, selection_type, label, pk, properties={}):
+        """SelectionItem of the object with primary key pk of model label (e.g. 'protein.protein'), loaded when used"""
+        selection_item = cls(selection_type, None, properties)
+        selection_item._item_ref = (label, pk)
+        return selection_item
+
+    @property
+    def item(self):
+        if self._item_ref is not None:
+            (self._batch or SelectionItemBatch([self])).load()
+        return self._item
+
+    @item.setter
+    def item(self, selection_object):
+        self._item = selection_object
+        self._item_ref = None
+        self._batch = None
+
+    def rehydrate(self, selection_object):
+        """Sets the loaded object (a copy, as cached objects are shared) of a referenced item"""
+        self.item = copy.copy(selection_object)
+        if selection_object is not None:
+            for flag in SELECTION_ITEM_FLAGS:
+                if self.properties.get(flag):
+                    setattr(self._item, flag, self.properties[flag])
+
+    def __getstate__(self):
+        state = {'type': self.type, 'properties': self.properties}
+        if self._item_ref is not None:
+            state['item_ref'] = self._item_ref
+        elif isinstance(self._item, models.Model) and self._item.pk is not None:
+            state['item_ref'] = (self._item._meta.label_lower, self._item.pk)
+        else:
+            state['item'] = self._item
+        return state
+
+    def __setstate__(self, state):
+        # also reads items pickled in the previous format (with the full object)
+        self.type = state['type']
+        self.type_title = self.type.replace('_', ' ').capitalize()
+        self.properties = state['properties']
+        self.item = state.get('item')
+        if 'item_ref' in state:
+            self._item_ref = tuple(state['item_ref'])
+
     def __str__(self):
-        return str(self.__dict__)
+        return str({'type': self.type, 'type_title': self.type_title, 'item': self.item, 'properties': self.properties})
 
-    def __eq__(self, other): 
-        return self.__dict__ == other.__dict__
\ No newline at end of file
+    def __eq__(self, other):
+        return (self.type == other.type and self.properties == other.properties and
+            (self._item_ref == other._item_ref if self._item_ref is not None and other._item_ref is not None else self.item == other.item))
@@ -35,4 +35,7 @@ urlpatterns = [
     url(r'^exportexceldownload/(?P<ts>[^/]*?)/(?P<entry_name>.+)$', views.ExportExcelDownload, name='exportexceldownload'),
     url(r'^importexcel$', views.ImportExcel, name='importexcel'),
     url(r'^convertsvg$', views.ConvertSVG, name='convertsvg'),
+    url(r'^jobs/submit/(?P<name>[\w-]+)$', views.SubmitJob, name='submitjob'),
+    url(r'^jobs/(?P<key>[0-9a-f]{64})$', views.JobStatus, name='jobstatus'),
+    url(r'^jobs/(?P<key>[0-9a-f]{64})/result$', views.JobResult, name='jobresult'),
 ]
@@ -1,6 +1,6 @@
-﻿from django.http import HttpResponse
+﻿from django.http import HttpResponse, JsonResponse
 from django.shortcuts import render
-from django.views.generic import TemplateView
+from django.views.generic import TemplateView, View
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
 from django.db.models import Case, When
@@ -10,8 +10,11 @@ from common import definitions
 Alignment = getattr(__import__('common.alignment_' + settings.SITE_NAME, fromlist=['Alignment']), 'Alignment')
 
 from common.selection import SimpleSelection, Selection, SelectionItem
+from common.jobs import submit_job, job_status, job_functions
+from common.models import Job
 from structure.models import Structure, StructureModel, StructureComplexModel
 from protein.models import Protein, ProteinFamily, ProteinSegment, Species, ProteinSource, ProteinSet, ProteinGProtein, ProteinGProteinPair
+from protein.family_index import get_family_index
 from residue.models import ResidueGenericNumber, ResidueNumberingScheme, ResidueGenericNumberEquivalent, ResiduePositionSet, Residue
 from interaction.forms import PDBform
 from construct.tool import FileUploadForm
@@ -775,24 +778,22 @@ def ToggleFamilyTreeNode(request):
         for g_protein in selection.g_proteins:
             g_proteins_list.append(g_protein.item)
 
-        if species_list:
-            ps = Protein.objects.order_by('id').filter(family=ppf,
-                species__in=(species_list),
-                source__in=(protein_source_list)).order_by('source_id', 'id')
-        else:
-            ps = Protein.objects.order_by('id').filter(family=ppf,
-                source__in=(protein_source_list)).order_by('source_id', 'id')
+        # filter the proteins of the family on the in-memory family index
+        index = get_family_index()
+        mask = index.family_mask(ppf.pk) & index.species_mask(species_list) & index.source_mask(protein_source_list)
+        order = ('source_id', 'id')
 
         if pref_g_proteins_list:
-            proteins = [x.protein_id for x in ProteinGProteinPair.objects.filter(g_protein__in=g_proteins_list, transduction='primary')]
-            ps = Protein.objects.order_by('id').filter(pk__in=proteins).filter(pk__in=ps)
+            mask &= index.coupling_mask(g_proteins_list, primary=True)
+            order = ('id', )
 
         if g_proteins_list:
-            proteins = [x.protein_id for x in ProteinGProteinPair.objects.filter(g_protein__in=g_proteins_list)]
-            ps = Protein.objects.order_by('id').filter(pk__in=proteins).filter(pk__in=ps)
+            mask &= index.coupling_mask(g_proteins_list)
+            order = ('id', )
 
         # Excluding G protein Alpha subunit protein structure objects, e.g. 3sn6_a
-        ps = ps.exclude(accession__isnull=True, family__parent__parent__name='Alpha')
+        mask &= ~index.alpha_chains
+        ps = Protein.objects.filter(pk__in=index.protein_ids(mask)).order_by(*order)
 
         action = 'collapse'
     else:
@@ -1802,6 +1803,50 @@ def ConvertSVG(request, **response_kwargs):
     response.write(pdf_content)
     return response
 
+@csrf_exempt
+def SubmitJob(request, name):
+    """Queues the analysis name with the request parameters, returns the job key and status"""
+    if name not in job_functions:
+        return JsonResponse({'error': 'Unknown job {}'.format(name)}, status=404)
+    parameters = request.POST.dict() if request.method == 'POST' else request.GET.dict()
+    job = submit_job(name, parameters)
+    return JsonResponse(job_status(job), status=200 if job.status == Job.DONE else 202)
+
+def JobStatus(request, key):
+    try:
+        job = Job.objects.get(key=key)
+    except Job.DoesNotExist:
+        return JsonResponse({'error': 'Unknown job'}, status=404)
+    return JsonResponse(job_status(job))
+
+def JobResult(request, key):
+    """Stored result (JSON) of a finished job, the job status (202) while it is queued or running"""
+    try:
+        job = Job.objects.get(key=key)
+    except Job.DoesNotExist:
+        return JsonResponse({'error': 'Unknown job'}, status=404)
+    if job.status == Job.DONE:
+        return HttpResponse(job.result, content_type='application/json')
+    elif job.status == Job.FAILED:
+        return JsonResponse(job_status(job), status=500)
+    return JsonResponse(job_status(job), status=202)
+
+class DataSourceView(View):
+    """
+    JSON rows of a DataSource (see common.datasource): a page of rows in the DataTables server-side format,
+    or the distinct values of a column when the URL has a column
+    """
+    source = None
+
+    def get(self, request, column=None):
+        source = self.source()
+        try:
+            if column:
+                return JsonResponse(source.options(column, request.GET))
+            return JsonResponse(source.page(request.GET))
+        except (KeyError, IndexError, ValueError) as e:
+            return JsonResponse({'error': 'Invalid parameter: {}'.format(e)}, status=400)
+
 def get_gpcr_class(item):
     while item.parent.parent!=None:
         item = item.parent
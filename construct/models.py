@@ -165,6 +165,11 @@ class Construct(models.Model):
     def snake(self):
         ## Use cache if possible
         temp = self.snakecache
+        if temp!=None:
+            temp = pickle.loads(temp)
+            # plots pickled before the layouts were cached are drawn again
+            if not hasattr(temp, 'layout'):
+                temp = None
         if temp==None:
             print(self.name+'_snake no cache')
             residues = Residue.objects.filter(protein_conformation__protein=self.protein).order_by('sequence_number').prefetch_related(
@@ -172,8 +177,6 @@ class Construct(models.Model):
             temp = DrawSnakePlot(residues,self.protein.get_protein_class(),str(self.protein),nobuttons = True)
             self.snakecache = pickle.dumps(temp)
             self.save()
-        else:
-            temp = pickle.loads(temp)
         return temp
 
 class CrystalInfo(models.Model):
@@ -0,0 +1,332 @@
+"""
+Array based classification of residue-residue interactions
+
+InteractingPair classifies one residue pair at a time, testing every atom combination of the two residues with
+scalar vector math. InteractionClassifier does the same for all residue pairs of a structure at once: the atoms
+of the residues are put in one KD-tree that is queried a single time at the largest cutoff (the residue contact
+distance), after which every interaction type is a masked distance/angle test on the resulting atom pair arrays.
+The interactions are returned as the same CI objects (and in the same order) as InteractingPair.compute_interactions.
+"""
+from contactnetwork.interaction import *
+
+from scipy.spatial import cKDTree
+
+import numpy
+
+
+# Cutoff for residues to be in contact (see compute_interactions)
+CONTACT_CUTOFF = 6.6
+
+# Largest atom-atom distance of the interaction types (ionic and hydrophobic)
+ATOM_CUTOFF = 4.5
+
+
+def norms(vectors):
+    return numpy.sqrt(numpy.sum(vectors * vectors, axis=1))
+
+
+def unit_vectors(vectors):
+    return vectors / norms(vectors)[:, None]
+
+
+def angles_between(v1, v2):
+    """Row wise angle_between"""
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return numpy.arccos(numpy.clip(numpy.sum(unit_vectors(v1) * unit_vectors(v2), axis=1), -1.0, 1.0))
+
+
+def plane_normal_angles(v1, v2):
+    """Row wise angle_between_plane_normals in degrees"""
+    return numpy.degrees(numpy.minimum(angles_between(v1, v2), angles_between(v1, -v2)))
+
+
+class InteractionClassifier(object):
+    """Interactions between the residues of a structure, computed on the atom arrays of the residues"""
+
+    def __init__(self, residues):
+        self.residues = list(residues)
+        self.residue_index = {id(residue): index for index, residue in enumerate(self.residues)}
+
+        self.atoms = [atom for residue in self.residues for atom in residue.child_list]
+        self.atom_residue = numpy.repeat(numpy.arange(len(self.residues)), [len(residue.child_list) for residue in self.residues])
+        self.atom_names = numpy.array([atom.name for atom in self.atoms], dtype=object)
+        self.coords = numpy.array([atom.coord for atom in self.atoms], dtype='f').reshape(-1, 3)
+        self.atom_lookup = [{} for residue in self.residues]
+        for index, (residue, atom) in enumerate(zip(self.atom_residue.tolist(), self.atoms)):
+            self.atom_lookup[residue][atom.name] = index
+
+        elements = [atom.element for atom in self.atoms]
+        self.carbon_sulfur = numpy.array([element == 'C' or element == 'S' for element in elements], dtype=bool)
+        self.elements = elements
+
+        # residue properties
+        self.aromatic = numpy.array([is_aromatic_aa(residue) for residue in self.residues], dtype=bool)
+        self.pos_charged = numpy.array([is_pos_charged(residue) for residue in self.residues], dtype=bool)
+        self.neg_charged = numpy.array([is_neg_charged(residue) for residue in self.residues], dtype=bool)
+
+        # position of the atom in the lists that InteractingPair iterates (-1 if not in the list)
+        self.charge_rank = self.rank_atoms(get_charged_atom_names)
+        self.donor_rank = self.rank_atoms(lambda residue: list(get_hbond_donor_references(residue)) if is_hbd(residue) else [])
+        self.acceptor_rank = self.rank_atoms(lambda residue: list(get_hbond_acceptors(residue)) if is_hba(residue) else [])
+        self.prepare_donors()
+
+        self.tree = None
+        self.pairs = None
+        self.pairs_radius = 0
+        self.rings = {}
+
+    def rank_atoms(self, atom_names):
+        ranks = numpy.full(len(self.atoms), -1, dtype=int)
+        for residue_index, residue in enumerate(self.residues):
+            lookup = self.atom_lookup[residue_index]
+            for rank, name in enumerate(atom_names(residue)):
+                if name in lookup:
+                    ranks[lookup[name]] = rank
+        return ranks
+
+    def prepare_donors(self):
+        """
+        Hydrogen placement references of every donor atom (see InteractingPair.verify_hbond_angle) as flat arrays,
+        with donor_start/donor_count giving the references of each atom
+        """
+        self.donor_start = numpy.zeros(len(self.atoms), dtype=int)
+        self.donor_count = numpy.zeros(len(self.atoms), dtype=int)
+        base, internal, angle, length, secondary = [], [], [], [], []
+        for atom_index in numpy.flatnonzero(self.donor_rank >= 0).tolist():
+            residue_index = self.atom_residue[atom_index]
+            lookup = self.atom_lookup[residue_index]
+            name = self.atom_names[atom_index]
+            self.donor_start[atom_index] = len(base)
+            for donor_set in get_hbond_donor_references(self.residues[residue_index])[name]:
+                if donor_set[0] not in lookup or (len(donor_set) == 4 and donor_set[3] not in lookup):
+                    continue
+                # the reference of the backbone N is in the previous residue, which verify_hbond_angle never finds
+                if len(donor_set) == 4 and name == 'N':
+                    continue
+                base.append(lookup[donor_set[0]])
+                internal.append(lookup[donor_set[3]] if len(donor_set) == 4 else -1)
+                angle.append(donor_set[1])
+                length.append(donor_set[2])
+                secondary.append(len(donor_set) == 4)
+            self.donor_count[atom_index] = len(base) - self.donor_start[atom_index]
+
+        self.donor_base = numpy.array(base, dtype=int)
+        self.donor_internal = numpy.array(internal, dtype=int)
+        self.donor_angle = numpy.array(angle, dtype=float)
+        self.donor_length = numpy.array(length, dtype=float)
+        self.donor_secondary = numpy.array(secondary, dtype=bool)
+
+    def atom_pairs(self, radius):
+        """Atom index pairs (from different residues) within radius, from a single KD-tree query at the largest radius asked"""
+        if self.pairs is None or radius > self.pairs_radius:
+            if self.tree is None:
+                self.tree = cKDTree(self.coords)
+            pairs = self.tree.query_pairs(radius, output_type='ndarray').reshape(-1, 2)
+            self.pairs = pairs[self.atom_residue[pairs[:, 0]] != self.atom_residue[pairs[:, 1]]]
+            self.pairs_radius = radius
+            difference = self.coords[self.pairs[:, 0]].astype(float) - self.coords[self.pairs[:, 1]]
+            self.pair_distances = norms(difference)
+
+        if radius == self.pairs_radius:
+            return self.pairs
+        return self.pairs[self.pair_distances <= radius]
+
+    def neighbour_pairs(self, radius=CONTACT_CUTOFF):
+        """Residue pairs with atoms within radius, ordered like NeighborSearch.search_all(radius, "R")"""
+        pairs = self.atom_pairs(radius)
+        residue_pairs = numpy.unique(numpy.sort(self.atom_residue[pairs], axis=1), axis=0)
+        result = []
+        for index1, index2 in residue_pairs.tolist():
+            residue1, residue2 = self.residues[index1], self.residues[index2]
+            result.append((residue1, residue2) if residue1 < residue2 else (residue2, residue1))
+        return result
+
+    def ring_descriptors(self, residue_index):
+        if residue_index not in self.rings:
+            self.rings[residue_index] = get_ring_descriptors(self.residues[residue_index])
+        return self.rings[residue_index]
+
+    def classify(self, residue_pairs):
+        """List of interactions (CI objects) for each (residue1, residue2) pair, as InteractingPair(residue1, residue2)"""
+        num_residues = len(self.residues)
+        pair_residues = numpy.array([[self.residue_index[id(residue1)], self.residue_index[id(residue2)]]
+            for residue1, residue2 in residue_pairs], dtype=int).reshape(-1, 2)
+        pair_keys = pair_residues[:, 0] * num_residues + pair_residues[:, 1]
+        key_order = numpy.argsort(pair_keys)
+        sorted_keys = pair_keys[key_order]
+
+        # orient the atom pairs of the requested residue pairs: first atom in residue 1
+        # (reusing the pairs of the contact search when that has been done)
+        candidates = self.atom_pairs(max(self.pairs_radius, ATOM_CUTOFF))
+        candidates = candidates[self.pair_distances <= ATOM_CUTOFF]
+        atoms1, atoms2, pair_index = [], [], []
+        for first, second in ((0, 1), (1, 0)):
+            keys = self.atom_residue[candidates[:, first]] * num_residues + self.atom_residue[candidates[:, second]]
+            positions = numpy.minimum(numpy.searchsorted(sorted_keys, keys), max(len(sorted_keys) - 1, 0))
+            found = sorted_keys[positions] == keys if len(sorted_keys) else numpy.zeros(len(keys), dtype=bool)
+            atoms1.append(candidates[found, first])
+            atoms2.append(candidates[found, second])
+            pair_index.append(key_order[positions[found]])
+        a = numpy.concatenate(atoms1)
+        b = numpy.concatenate(atoms2)
+        k = numpy.concatenate(pair_index)
+        distances = norms(self.coords[a] - self.coords[b])
+
+        self.found = []
+        self.ionic_interactions(a, b, k, distances)
+        self.hbond_interactions(a, b, k, distances, len(residue_pairs))
+        self.aromatic_interactions(pair_residues)
+        self.hydrophobic_interactions(a, b, k, distances)
+        self.van_der_waals_interactions(a, b, k, distances, pair_residues)
+
+        interactions = [[] for pair in residue_pairs]
+        if self.found:
+            k = numpy.concatenate([found[0] for found in self.found])
+            block = numpy.concatenate([numpy.full(len(found[0]), number) for number, found in enumerate(self.found)])
+            key1 = numpy.concatenate([found[1] for found in self.found])
+            key2 = numpy.concatenate([found[2] for found in self.found])
+            names1 = [name for found in self.found for name in found[3]]
+            names2 = [name for found in self.found for name in found[4]]
+            classes = [found[5] for found in self.found]
+            order = numpy.lexsort((key2, key1, block, k)).tolist()
+            k, block = k.tolist(), block.tolist()
+            for row in order:
+                interactions[k[row]].append(classes[block[row]](names1[row], names2[row]))
+        self.found = None
+        return interactions
+
+    def add_found(self, interaction_class, k, key1, key2, names1, names2):
+        """Store interactions of one type, they are sorted by pair, type (in order of adding) and the keys"""
+        self.found.append((k, key1, key2, list(names1), list(names2), interaction_class))
+
+    def ionic_interactions(self, a, b, k, distances):
+        residues1, residues2 = self.atom_residue[a], self.atom_residue[b]
+        charged = (self.charge_rank[a] >= 0) & (self.charge_rank[b] >= 0) & (distances <= 4.5)
+        for interaction_class, sign1, sign2 in ((PosNegIonicInteraction, self.pos_charged, self.neg_charged),
+                (NegPosIonicInteraction, self.neg_charged, self.pos_charged)):
+            mask = charged & sign1[residues1] & sign2[residues2]
+            self.add_found(interaction_class, k[mask], self.charge_rank[a[mask]], self.charge_rank[b[mask]],
+                self.atom_names[a[mask]], self.atom_names[b[mask]])
+
+    def hbond_angles(self, donors, acceptors):
+        """Row wise InteractingPair.verify_hbond_angle for donor/acceptor atom indices"""
+        counts = self.donor_count[donors]
+        rows = numpy.repeat(numpy.arange(len(donors)), counts)
+        if not len(rows):
+            return numpy.zeros(len(donors), dtype=bool)
+        offsets = numpy.arange(len(rows)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        sets = numpy.repeat(self.donor_start[donors], counts) + offsets
+        secondary = self.donor_secondary[sets]
+
+        p1 = self.coords[self.donor_base[sets]]
+        p2 = self.coords[donors[rows]]
+        acceptor_coords = self.coords[acceptors[rows]]
+        p3 = numpy.where(secondary[:, None], self.coords[numpy.maximum(self.donor_internal[sets], 0)], acceptor_coords)
+
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            d = unit_vectors(p2 - p1)
+            t = numpy.sum((p3 - p1) * d, axis=1)
+            p4 = p1 + t[:, None] * d
+            best_vector = unit_vectors(p3 - p4)
+            best_vector[secondary] *= -1
+
+            angle = numpy.radians(self.donor_angle[sets] - 90)
+            x = numpy.abs(numpy.cos(angle) * self.donor_length[sets]).astype('f')
+            y = numpy.abs(numpy.sin(angle) * self.donor_length[sets]).astype('f')
+            hydrogen = p2 + y[:, None] * d + x[:, None] * best_vector
+
+            valid = 180 - numpy.degrees(angles_between(hydrogen - p2, acceptor_coords - hydrogen)) >= 120
+        return numpy.bincount(rows[valid], minlength=len(donors)) > 0
+
+    def hbond_interactions(self, a, b, k, distances, num_pairs):
+        # donor in residue 1 (DA) and donor in residue 2 (AD)
+        directions = ((a, b, HydrogenBondDAInteraction, LooseHydrogenBondDAInteraction, False),
+            (b, a, HydrogenBondADInteraction, LooseHydrogenBondADInteraction, True))
+
+        found = numpy.zeros(num_pairs, dtype=bool)
+        loose = []
+        for donors, acceptors, strict_class, loose_class, switch in directions:
+            mask = (self.donor_rank[donors] >= 0) & (self.acceptor_rank[acceptors] >= 0) & (distances <= 4)
+            donors, acceptors, pairs, donor_distances = donors[mask], acceptors[mask], k[mask], distances[mask]
+            loose.append((donors, acceptors, pairs, loose_class, switch))
+
+            close = donor_distances <= 3.5
+            strict = numpy.flatnonzero(close)[self.hbond_angles(donors[close], acceptors[close])]
+            found[pairs[strict]] = True
+            self.add_hbonds(strict_class, donors[strict], acceptors[strict], pairs[strict], switch)
+
+        # the loose definition (4A, no angle) for pairs without a strict H-bond
+        for donors, acceptors, pairs, loose_class, switch in loose:
+            mask = ~found[pairs]
+            self.add_hbonds(loose_class, donors[mask], acceptors[mask], pairs[mask], switch)
+
+    def add_hbonds(self, interaction_class, donors, acceptors, pairs, switch):
+        names = (self.atom_names[acceptors], self.atom_names[donors]) if switch else (self.atom_names[donors], self.atom_names[acceptors])
+        self.add_found(interaction_class, pairs, self.donor_rank[donors], self.acceptor_rank[acceptors], *names)
+
+    def aromatic_interactions(self, pair_residues):
+        aromatic_count = self.aromatic[pair_residues[:, 0]].astype(int) + self.aromatic[pair_residues[:, 1]]
+
+        # pi-cation: ring centroid of the aromatic residue and the positively charged atoms of the other residue
+        for switch, interaction_class in ((False, PiCationInteraction), (True, CationPiInteraction)):
+            rows = []
+            for pair in numpy.flatnonzero(aromatic_count == 1).tolist():
+                aromatic, cation = pair_residues[pair][::-1] if switch else pair_residues[pair]
+                if not self.aromatic[aromatic] or not self.pos_charged[cation]:
+                    continue
+                cation_atoms = [self.atom_lookup[cation][name] for name in get_pos_charged_atom_names(self.residues[cation])]
+                for ring, (center, normal) in enumerate(self.ring_descriptors(aromatic)):
+                    for rank, atom in enumerate(cation_atoms):
+                        rows.append((pair, ring, rank, atom, center, normal))
+            if not rows:
+                continue
+            pairs, rings, ranks, atoms = [numpy.array([row[i] for row in rows], dtype=int) for i in range(4)]
+            centers = numpy.array([row[4] for row in rows])
+            normals = numpy.array([row[5] for row in rows])
+            offsets = self.coords[atoms] - centers
+            mask = (norms(offsets) <= 6.6) & (numpy.abs(plane_normal_angles(normals, offsets)) <= 30)
+            ring_names = ['RN' + str(ring + 1) for ring in rings[mask].tolist()]
+            names = (ring_names, self.atom_names[atoms[mask]]) if switch else (self.atom_names[atoms[mask]], ring_names)
+            self.add_found(interaction_class, pairs[mask], rings[mask], ranks[mask], *names)
+
+        # ring-ring: face-to-face, edge-to-face (both ways) and the loose definition
+        rows = []
+        for pair in numpy.flatnonzero(aromatic_count == 2).tolist():
+            residue1, residue2 = pair_residues[pair]
+            for ring1, (center1, normal1) in enumerate(self.ring_descriptors(residue1)):
+                for ring2, (center2, normal2) in enumerate(self.ring_descriptors(residue2)):
+                    rows.append((pair, ring1, ring2, center1, normal1, center2, normal2))
+        if not rows:
+            return
+        pairs, rings1, rings2 = [numpy.array([row[i] for row in rows], dtype=int) for i in range(3)]
+        centers1, normals1, centers2, normals2 = [numpy.array([row[i] for row in rows]) for i in range(3, 7)]
+        center_distances = norms(centers1 - centers2)
+        names1 = numpy.array(['RN' + str(ring + 1) for ring in rings1.tolist()], dtype=object)
+        names2 = numpy.array(['RN' + str(ring + 1) for ring in rings2.tolist()], dtype=object)
+
+        mask = (center_distances <= 4.4) & (plane_normal_angles(normals1, centers2) <= 30)
+        self.add_found(FaceToFaceInteraction, pairs[mask], rings1[mask], rings2[mask], names1[mask], names2[mask])
+
+        mask = (center_distances <= 5.5) & (plane_normal_angles(normals1, normals2) > 30) & \
+            (numpy.abs(90 - plane_normal_angles(normals1, centers2 - centers1)) <= 30)
+        self.add_found(EdgeToFaceInteraction, pairs[mask], rings1[mask], rings2[mask], names1[mask], names2[mask])
+
+        mask = (center_distances <= 5.5) & (plane_normal_angles(normals2, normals1) > 30) & \
+            (numpy.abs(90 - plane_normal_angles(normals2, centers1 - centers2)) <= 30)
+        self.add_found(FaceToEdgeInteraction, pairs[mask], rings2[mask], rings1[mask], names2[mask], names1[mask])
+
+        # InteractingPair.aromatic_interactions always adds these, as the face/edge checks do not return found
+        mask = center_distances <= 5.5
+        self.add_found(LooseAromaticInteraction, pairs[mask], rings1[mask], rings2[mask], names1[mask], names2[mask])
+
+    def hydrophobic_interactions(self, a, b, k, distances):
+        mask = self.carbon_sulfur[a] & self.carbon_sulfur[b] & (distances <= 4.5)
+        self.add_found(HydrophobicInteraction, k[mask], a[mask], b[mask], self.atom_names[a[mask]], self.atom_names[b[mask]])
+
+    def van_der_waals_interactions(self, a, b, k, distances, pair_residues):
+        # like InteractingPair, elements without a radius are an error for the residues that are compared
+        radii = numpy.full(len(self.atoms), numpy.nan)
+        for atom in numpy.flatnonzero(numpy.isin(self.atom_residue, pair_residues)).tolist():
+            radii[atom] = VDW_RADII[self.elements[atom]]
+        mask = distances <= (radii[a] + radii[b]) * VDW_TRESHOLD_FACTOR
+        self.add_found(VanDerWaalsInteraction, k[mask], a[mask], b[mask], self.atom_names[a[mask]], self.atom_names[b[mask]])
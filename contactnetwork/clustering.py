@@ -0,0 +1,124 @@
+import numpy as np
+import scipy.cluster.hierarchy as sch
+import scipy.spatial.distance as ssd
+
+
+def seriation(Z):
+    """
+    Leaf order implied by the hierarchical tree Z (dendrogram), left branches first.
+    Iterative replacement of the recursive seriation borrowed from
+    https://gmarti.gitlab.io/ml/2017/09/07/how-to-sort-distance-matrix.html
+    """
+    N = len(Z) + 1
+    order = []
+    stack = [2*N - 2]
+    while stack:
+        node = stack.pop()
+        if node < N:
+            order.append(node)
+        else:
+            # push right first so the left branch is visited first
+            stack.append(int(Z[node-N, 1]))
+            stack.append(int(Z[node-N, 0]))
+    return order
+
+
+def cluster_ranges(Z):
+    """
+    For every node of the tree Z the [start, end) range of its leaves in the seriated order.
+    Returns an array of shape (2N-1, 2) indexed by node id.
+    """
+    N = len(Z) + 1
+    ranges = np.zeros((2*N - 1, 2), dtype=int)
+    ranges[2*N - 2] = [0, N]
+    # parents have higher ids than their children, so walking down from the root covers every node
+    for node in range(2*N - 2, N - 1, -1):
+        start, end = ranges[node]
+        left, right = int(Z[node-N, 0]), int(Z[node-N, 1])
+        left_size = 1 if left < N else int(Z[left-N, 3])
+        ranges[left] = [start, start + left_size]
+        ranges[right] = [start + left_size, end]
+    return ranges
+
+
+def silhouette_indices(Z, distance_matrix, order=None):
+    """
+    Average silhouette index of every internal node against its sibling cluster
+    Implementation based on Rousseeuw, P.J. J. Comput. Appl. Math. 20 (1987): 53-65
+
+    Every cluster is a contiguous block of the seriated matrix, so the within and between cluster
+    sums for each member are differences of row-wise prefix sums. The total cost is the sum of the
+    cluster sizes, O(N log N) for balanced trees, instead of a quadratic loop per node.
+    Returns a dict node id -> silhouette index (root set to 0, leaves are omitted).
+    """
+    N = len(Z) + 1
+    if order is None:
+        order = seriation(Z)
+    order = np.asarray(order)
+    ranges = cluster_ranges(Z)
+
+    # prefix[i, k] = sum of the distances from seriated position i to positions < k
+    seriated = np.asarray(distance_matrix, dtype=float)[np.ix_(order, order)]
+    prefix = np.zeros((N, N + 1))
+    np.cumsum(seriated, axis=1, out=prefix[:, 1:])
+
+    results = {2*N - 2: 0}
+    for node in range(N, 2*N - 1):
+        left, right = int(Z[node-N, 0]), int(Z[node-N, 1])
+        for cluster, sibling in ((left, right), (right, left)):
+            if cluster < N:
+                continue
+            start, end = ranges[cluster]
+            sib_start, sib_end = ranges[sibling]
+            members = np.arange(start, end)
+
+            ai = (prefix[members, end] - prefix[members, start]) / (end - start - 1)
+            bi = (prefix[members, sib_end] - prefix[members, sib_start]) / (sib_end - sib_start)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                results[cluster] = np.sum((bi - ai) / np.maximum(ai, bi) / len(members))
+    return results
+
+
+def newick(Z, leaf_names, silhouette_coefficient):
+    """
+    Newick string of the tree Z with the silhouette index as internal node label.
+    Iterative version of the former recursive getNewick (same output: right branch first).
+    """
+    N = len(Z) + 1
+    root = 2*N - 2
+    dist = lambda node: 0.0 if node < N else Z[node-N, 2]
+
+    parts = []
+    stack = [(root, dist(root))]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            parts.append(item)
+            continue
+
+        node, parentdist = item
+        if node < N:
+            parts.append("%s:%.2f" % (leaf_names[node], parentdist - dist(node)))
+        else:
+            if node == root:
+                closing = ");"
+            else:
+                closing = ")%.2f:%.2f" % (silhouette_coefficient[node], parentdist - dist(node))
+            left, right = int(Z[node-N, 0]), int(Z[node-N, 1])
+            stack.append(closing)
+            stack.append((left, dist(node)))
+            stack.append(",")
+            stack.append((right, dist(node)))
+            parts.append("(")
+    return "".join(parts)
+
+
+def annotate_tree(distance_matrix, leaf_names, method='average'):
+    """
+    Cluster a square distance matrix and annotate the tree.
+    Returns the linkage, the Newick string (with silhouette indices) and the seriated leaf order.
+    """
+    hclust = sch.linkage(ssd.squareform(distance_matrix), method=method)
+    order = seriation(hclust)
+    silhouette_coefficient = silhouette_indices(hclust, distance_matrix, order)
+    return hclust, newick(hclust, leaf_names, silhouette_coefficient), order
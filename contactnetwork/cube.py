@@ -2,6 +2,8 @@ from Bio.PDB import Selection, PDBParser
 from Bio.PDB.NeighborSearch import NeighborSearch
 
 from contactnetwork.interaction import *
+from contactnetwork.classifier import InteractionClassifier, CONTACT_CUTOFF
+from contactnetwork.interaction_cube import build_interaction_cube
 from contactnetwork.pdb import *
 from contactnetwork.models import *
 from io import StringIO
@@ -17,7 +19,7 @@ import copy
 # Distance between residues in peptide
 NUM_SKIP_RESIDUES = 0
 
-def compute_interactions(pdb_name,save_to_db = False):
+def compute_interactions(pdb_name,save_to_db = False, writer = None):
 
     do_distances = False ## Distance calculation moved to build_structure_angles
     do_interactions = True
@@ -31,12 +33,11 @@ def compute_interactions(pdb_name,save_to_db = False):
 
     # Get the pdb structure
     struc = Structure.objects.get(protein_conformation__protein__entry_name=pdb_name)
-    pdb_io = StringIO(struc.pdb_data.pdb)
     # Get the preferred chain
     preferred_chain = struc.preferred_chain.split(',')[0]
 
-    # Get the Biopython structure for the PDB
-    s = PDBParser(PERMISSIVE=True, QUIET=True).get_structure('ref', pdb_io)[0]
+    # Get the Biopython structure for the PDB (from the stored coordinate arrays)
+    s = struc.pdb_data.get_structure('ref')[0]
     #s = pdb_get_structure(pdb_name)[0]
     chain = s[preferred_chain]
     #return classified, distances
@@ -67,18 +68,19 @@ def compute_interactions(pdb_name,save_to_db = False):
     if do_interactions:
         atom_list = Selection.unfold_entities(s[preferred_chain], 'A')
 
-        # Search for all neighbouring residues
+        # Used for the water-mediated interactions
         ns = NeighborSearch(atom_list)
-        all_neighbors = ns.search_all(6.6, "R")
 
-        # Filter all pairs containing non AA residues
-        all_aa_neighbors = [pair for pair in all_neighbors if is_aa(pair[0]) and is_aa(pair[1])]
+        # Search for all neighbouring AA residues (one KD-tree query on the atom arrays)
+        classifier = InteractionClassifier([residue for residue in s[preferred_chain] if is_aa(residue)])
+        all_aa_neighbors = classifier.neighbour_pairs(CONTACT_CUTOFF)
 
         # Only include contacts between residues more than NUM_SKIP_RESIDUES sequence steps apart
         all_aa_neighbors = [pair for pair in all_aa_neighbors if abs(pair[0].id[1] - pair[1].id[1]) > NUM_SKIP_RESIDUES]
 
         # For each pair of interacting residues, determine the type of interaction
-        interactions = [InteractingPair(res_pair[0], res_pair[1], dbres[res_pair[0].id[1]], dbres[res_pair[1].id[1]], struc) for res_pair in all_aa_neighbors if not is_water(res_pair[0]) and not is_water(res_pair[1]) ]
+        pair_interactions = classifier.classify(all_aa_neighbors)
+        interactions = [InteractingPair(res_pair[0], res_pair[1], dbres[res_pair[0].id[1]], dbres[res_pair[1].id[1]], struc, found) for res_pair, found in zip(all_aa_neighbors, pair_interactions)]
 
         # Split unto classified and unclassified.
         classified = [interaction for interaction in interactions if len(interaction.get_interactions()) > 0]
@@ -117,7 +119,10 @@ def compute_interactions(pdb_name,save_to_db = False):
                 dblabel_sign[r.sequence_number] = r.generic_number.label
 
             # Find interactions
-            interactions = [InteractingPair(res_pair[0], res_pair[1], dbres[res_pair[0].id[1]], dbres_sign[res_pair[1].id[1]], struc) for res_pair in all_neighbors if res_pair[0].id[1] in dbres and res_pair[1].id[1] in dbres_sign ]
+            complex_pairs = [res_pair for res_pair in all_neighbors if res_pair[0].id[1] in dbres and res_pair[1].id[1] in dbres_sign]
+            classifier = InteractionClassifier(dict.fromkeys(residue for res_pair in complex_pairs for residue in res_pair))
+            pair_interactions = classifier.classify(complex_pairs)
+            interactions = [InteractingPair(res_pair[0], res_pair[1], dbres[res_pair[0].id[1]], dbres_sign[res_pair[1].id[1]], struc, found) for res_pair, found in zip(complex_pairs, pair_interactions)]
 
             # Filter unclassified interactions
             classified_complex = [interaction for interaction in interactions if len(interaction.get_interactions()) > 0]
@@ -176,10 +181,13 @@ def compute_interactions(pdb_name,save_to_db = False):
 #            log = "No protein conformation definition found for signaling protein of " + pdb_name
 
     if save_to_db:
+        # Collect all pairs and store them in one go (the previous pairs are removed in the same transaction)
+        if writer is None:
+            writer = InteractionBatchWriter(struc)
+        else:
+            writer.structure = struc
 
         if do_interactions:
-            # Delete previous for faster load in
-            InteractingResiduePair.objects.filter(referenced_structure=struc).all().delete()
 
             # bulk_pair = []
             # for d in distances:
@@ -226,12 +234,16 @@ def compute_interactions(pdb_name,save_to_db = False):
                                 # HACK: store water ID as part of first atom name
                                 interaction_pairs[key].interactions.append(WaterMediated(a + "|" + str(water_pair_one[0].get_parent().get_id()[1]), b))
 
-            for p in classified:
-                p.save_into_database()
+            writer.add_all(classified)
 
         if do_complexes:
-            for pair in classified_complex:
-                pair.save_into_database()
+            writer.add_all(classified_complex)
+
+        writer.write(replace=do_interactions)
+
+        # Refresh the aggregated interactions of the interaction browser
+        if do_interactions:
+            build_interaction_cube(struc)
 
         # if do_distances:
         #     # Distance.objects.filter(structure=struc).all().delete()
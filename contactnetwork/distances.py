@@ -9,8 +9,12 @@ from residue.models import Residue, ResidueGenericNumber
 from collections import OrderedDict
 
 import numpy as np
+import scipy.spatial.distance as ssd
 
 
+# GN label parts excluded from the TM distance sets (H8 and loops)
+excluded_gn_parts = ['8x', '12x', '23x', '34x', '45x']
+
 class Distances():
     """A class to do distances"""
     def __init__(self):
@@ -72,6 +76,17 @@ class Distances():
             # continue
         print(len(self.stats))
 
+    def load_distance_matrices(self):
+        """Packed distance matrices for the loaded structures, None when not all structures have been converted"""
+        return load_distance_matrices(self.structures)
+
+    def filter_tm_gns(self, gns, filtered = True):
+        """Apply the TM (and optional lower membrane) GN filter used by the distance queries"""
+        gns = [gn for gn in gns if not any(part in gn for part in excluded_gn_parts)]
+        if filtered and self.filtered_gns:
+            gns = [gn for gn in gns if gn in self.filter_gns]
+        return gns
+
     def fetch_and_calculate(self, with_arr = False):
         ## REQUIRES PSQL SETTINGS TO HAVE MORE MEMORY
         # sudo nano /etc/postgresql/9.3/main/postgresql.conf
@@ -80,7 +95,12 @@ class Distances():
         # temp_buffers = 500MB
         # sudo /etc/init.d/postgresql restart
         ds_with_key = {}
-        if with_arr:
+        matrices = self.load_distance_matrices()
+        if matrices is not None:
+            ds = self.calculate_from_matrices(matrices, with_arr)
+            for d in ds:
+                ds_with_key[d[0]] = d
+        elif with_arr:
             ds = list(Distance.objects.filter(structure__in=self.structures).exclude(gns_pair__contains='8x').exclude(gns_pair__contains='12x').exclude(gns_pair__contains='23x').exclude(gns_pair__contains='34x').exclude(gns_pair__contains='45x') \
                             .values('gns_pair') \
                             .annotate(mean = Avg('distance'), std = StdDev('distance'), c = Count('distance'), dis = Count('distance'),arr=ArrayAgg('distance'),arr2=ArrayAgg('structure__pdb_code__index'),arr3=ArrayAgg('gns_pair')).values_list('gns_pair','mean','std','c','dis','arr','arr2','arr3').filter(c__gte=int(0.8*len(self.structures))))
@@ -110,6 +130,41 @@ class Distances():
         self.stats_key = ds_with_key
         self.stats = stats_sorted
 
+    def calculate_from_matrices(self, matrices, with_arr = False):
+        """Same output as the aggregation queries in fetch_and_calculate, but computed from the packed matrices"""
+        gns = set()
+        for m in matrices:
+            gns.update(m.get_gns())
+        gns = sorted(self.filter_tm_gns(gns, filtered = False), key=gn_order_key)
+        a, b = np.triu_indices(len(gns), 1)
+
+        # structures x GN pairs, NaN where a pair is missing
+        stacked = np.full((len(matrices), len(a)), np.nan, dtype=np.float32)
+        for i, m in enumerate(matrices):
+            stacked[i] = m.get_submatrix(gns)[a, b]
+
+        present = ~np.isnan(stacked)
+        counts = present.sum(axis=0)
+        selected = np.where(counts >= max(1, int(0.8*len(self.structures))))[0]
+
+        values = stacked[:, selected].astype(float)
+        means = np.nanmean(values, axis=0)
+        # Population standard deviation like the StdDev aggregate
+        stds = np.nanstd(values, axis=0)
+
+        ds = []
+        for k, pair in enumerate(selected):
+            label = gns[a[pair]] + "_" + gns[b[pair]]
+            mean, std, c = float(means[k]), float(stds[k]), int(counts[pair])
+            if with_arr:
+                rows = np.where(present[:, pair])[0]
+                arr = [float(x) / distance_scaling_factor for x in values[rows, k]]
+                arr2 = [self.pdbs[r] for r in rows]
+                ds.append([label, mean / distance_scaling_factor, std / distance_scaling_factor, std/mean, c, arr, arr2, [label]*c])
+            else:
+                ds.append((label, mean, std, c, std/mean))
+        return ds
+
     def fetch_common_gns_tm(self):
 
         # ds = list(Distance.objects.filter(structure__in=self.structures).exclude(gns_pair__contains='8x').exclude(gns_pair__contains='12x').exclude(gns_pair__contains='23x').exclude(gns_pair__contains='34x').exclude(gns_pair__contains='45x') \
@@ -356,6 +411,24 @@ class Distances():
         # ds = Distance.objects.filter(structure__in=self.structures) \
         #         .exclude(gns_pair__contains='8x').exclude(gns_pair__contains='12x').exclude(gns_pair__contains='23x').exclude(gns_pair__contains='34x').exclude(gns_pair__contains='45x')
 
+        matrices = self.load_distance_matrices()
+        if matrices is not None:
+            self.data = {}
+            for m in matrices:
+                gns = m.get_gns()
+                keep_gns = set(self.filter_tm_gns(gns))
+                keep = np.array([i for i, gn in enumerate(gns) if gn in keep_gns], dtype=int)
+                a, b = np.triu_indices(len(keep), 1)
+                distances = m.get_condensed(distance_type)[m.condensed_index(keep[a], keep[b])]
+                for i, j, distance in zip(keep[a], keep[b], distances):
+                    if np.isnan(distance):
+                        continue
+                    label = gns[i] + "_" + gns[j]
+                    if label not in self.data:
+                        self.data[label] = []
+                    self.data[label].append(distance/distance_scaling_factor)
+            return
+
         if distance_type == "HC":
             ds = Distance.objects.filter(structure__in=self.structures) \
                 .exclude(gns_pair__contains='8x').exclude(gns_pair__contains='12x').exclude(gns_pair__contains='23x').exclude(gns_pair__contains='34x').exclude(gns_pair__contains='45x') \
@@ -413,89 +486,130 @@ class Distances():
             all_gns = all_gns.filter(label__in=self.filter_gns)
 
         all_gns = sorted(list(all_gns))
+        all_gn_index = {gn: i for i, gn in enumerate(all_gns)}
+
+        # Filtering indices to map to common_gns
+        gn_indices = np.array([ all_gn_index[residue] for residue in common_gn ], dtype=int)
 
-        pdb_distance_maps = {}
+        # Grab cached maps, the missing ones are built in batch below
+        distance_maps = {}
         pdb_gns = {}
         for pdb in self.pdbs:
             cache_key = "distanceMap-" + pdb
-
-            # Cached?
-            if cache.has_key(cache_key) and cache_enabled:
+            if cache_enabled and cache.has_key(cache_key):
                 cached_data = cache.get(cache_key)
-                distance_map = cached_data["map"]
-                structure_gn = cached_data["gns"]
-            else:
-                # grab raw distance data per structure
-                temp = Distances()
-                temp.load_pdbs([pdb])
-                temp.fetch_distances_tm()
+                distance_maps[pdb] = cached_data["map"]
+                pdb_gns[pdb] = cached_data["gns"]
+
+        missing = [s for s in self.structures if s.pdb_code.index not in distance_maps]
+        if missing:
+            structure_gns = self.fetch_structure_gns(missing)
+            matrices = {m.structure_id: m for m in DistanceMatrix.objects.filter(structure__in=missing)}
+            for s in missing:
+                pdb = s.pdb_code.index
+                if s.pk in matrices:
+                    distance_map = np.nan_to_num(np.triu(matrices[s.pk].get_submatrix(all_gns), 1) / distance_scaling_factor)
+                else:
+                    distance_map = self.build_distance_map(pdb, all_gn_index)
 
-#                    .filter(generic_number__label__in=self.filter_gns) \
-                structure_gn = Residue.objects.filter(protein_conformation__in=temp.pconfs) \
-                    .exclude(generic_number=None) \
-                    .exclude(generic_number__label__startswith='8x') \
-                    .exclude(generic_number__label__startswith='12x') \
-                    .exclude(generic_number__label__startswith='23x') \
-                    .exclude(generic_number__label__startswith='34x') \
-                    .exclude(generic_number__label__startswith='45x') \
-                    .values_list('generic_number__label',flat=True)
-
-                if self.filtered_gns:
-                    structure_gn = structure_gn.filter(generic_number__label__in=self.filter_gns)
-
-                structure_gn = list(structure_gn)
-
-                # create distance map
-                distance_map = np.full((len(all_gns), len(all_gns)), 0.0)
-
-                for i,res1 in enumerate(all_gns):
-                    for j in range(i+1, len(all_gns)):
-                        # grab average value
-                        res2 = all_gns[j]
-                        if res1+"_"+res2 in temp.data:
-                            distance_map[i][j] = temp.data[res1+"_"+res2][0]
+                distance_maps[pdb] = distance_map
+                pdb_gns[pdb] = structure_gns[s.protein_conformation_id]
 
                 # store in cache
                 if cache_enabled:
                     store = {
                         "map" : distance_map,
-                        "gns" : structure_gn
+                        "gns" : pdb_gns[pdb]
                         }
-                    cache.set(cache_key, store, 60*60*24*14)
-
-            pdb_gns[pdb] = structure_gn
-
-            # Filtering indices to map to common_gns
-            gn_indices = np.array([ all_gns.index(residue) for residue in common_gn ])
-            pdb_distance_maps[pdb] = distance_map[gn_indices,:][:, gn_indices]
-
-            if "average" in pdb_distance_maps:
-                pdb_distance_maps["average"] +=  pdb_distance_maps[pdb]/len(self.pdbs)
-            else:
-                pdb_distance_maps["average"] =  pdb_distance_maps[pdb]/len(self.pdbs)
+                    cache.set("distanceMap-" + pdb, store, 60*60*24*14)
+
+        # Stack all maps (pdbs x common GNs x common GNs), masking cells of GNs missing in a structure
+        common_gn_set = set(common_gn)
+        presence = np.zeros((len(self.pdbs), len(common_gn)), dtype=bool)
+        maps = np.zeros((len(self.pdbs), len(common_gn), len(common_gn)))
+        common_gn_index = {gn: i for i, gn in enumerate(common_gn)}
+        for i, pdb in enumerate(self.pdbs):
+            maps[i] = distance_maps[pdb][np.ix_(gn_indices, gn_indices)]
+            presence[i, [common_gn_index[gn] for gn in set(pdb_gns[pdb]) if gn in common_gn_set]] = True
+        maps = np.ma.masked_array(maps, mask=~(presence[:, :, None] & presence[:, None, :]))
 
         # store distance map
         if normalize:
-            for pdb in self.pdbs:
-                pdb_distance_maps[pdb] = np.nan_to_num(pdb_distance_maps[pdb]/pdb_distance_maps["average"])
+            average = maps.data.sum(axis=0)/len(self.pdbs)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                maps.data[:] = np.nan_to_num(maps.data/average)
 
         # calculate distance matrix
-        distance_matrix = np.full((len(self.pdbs), len(self.pdbs)), 0.0)
-        for i, pdb1 in enumerate(self.pdbs):
-            for j in range(i+1, len(self.pdbs)):
-                pdb2 = self.pdbs[j]
+        return masked_pairwise_distances(maps)
 
-                # Get common GNs between two PDBs
-                common_between_pdbs = sorted(list(set(pdb_gns[pdb1]).intersection(pdb_gns[pdb2])))
-
-                # Get common between above set and the overall common set of GNs
-                common_with_query_gns = sorted(list(set(common_gn).intersection(common_between_pdbs)))
-
-                # Get the indices of positions that are shared between two PDBs
-                gn_indices = np.array([ common_gn.index(residue) for residue in common_with_query_gns ])
-
-                # Get distance between cells that have both GNs.
-                distance = np.sum(np.absolute(pdb_distance_maps[pdb1][gn_indices,:][:, gn_indices] - pdb_distance_maps[pdb2][gn_indices,:][:, gn_indices]))
-                distance_matrix[i, j] = distance_matrix[j, i] = distance * distance/(len(gn_indices)*len(gn_indices))
+    def fetch_structure_gns(self, structures):
+        """GN labels (TM only, optionally lower membrane) per protein conformation of the structures - in one query"""
+#                    .filter(generic_number__label__in=self.filter_gns) \
+        structure_gn = Residue.objects.filter(protein_conformation__in=[s.protein_conformation_id for s in structures]) \
+            .exclude(generic_number=None) \
+            .exclude(generic_number__label__startswith='8x') \
+            .exclude(generic_number__label__startswith='12x') \
+            .exclude(generic_number__label__startswith='23x') \
+            .exclude(generic_number__label__startswith='34x') \
+            .exclude(generic_number__label__startswith='45x') \
+            .values_list('protein_conformation_id', 'generic_number__label')
 
-        return distance_matrix
+        if self.filtered_gns:
+            structure_gn = structure_gn.filter(generic_number__label__in=self.filter_gns)
+
+        gns = {s.protein_conformation_id: [] for s in structures}
+        for pconf, label in structure_gn:
+            gns[pconf].append(label)
+        return gns
+
+    def build_distance_map(self, pdb, all_gn_index):
+        """Upper triangular CA distance map over all GNs from the Distance rows of a single structure"""
+        # grab raw distance data per structure
+        temp = Distances()
+        temp.load_pdbs([pdb])
+        temp.fetch_distances_tm()
+
+        # create distance map
+        distance_map = np.full((len(all_gn_index), len(all_gn_index)), 0.0)
+        for label, values in temp.data.items():
+            res1, res2 = label.split("_")
+            if res1 in all_gn_index and res2 in all_gn_index and all_gn_index[res1] < all_gn_index[res2]:
+                distance_map[all_gn_index[res1], all_gn_index[res2]] = values[0]
+
+        return distance_map
+
+
+def masked_pairwise_distances(maps):
+    """
+    Distance between all pairs of stacked upper triangular maps (masked array: structures x GNs x GNs)
+
+    For each pair only the GNs present (unmasked) in both structures are compared and the summed absolute
+    difference is squared and normalized by the number of shared GNs squared. Structures are grouped by
+    their GN presence pattern so that each group pair is computed in a single vectorised cdist call.
+    """
+    n_pdbs, n_gns = maps.shape[0], maps.shape[1]
+    a, b = np.triu_indices(n_gns, 1)
+    values = maps.data[:, a, b]
+
+    # the diagonal mask encodes the presence of each GN
+    presence = ~np.ma.getmaskarray(maps)[:, np.arange(n_gns), np.arange(n_gns)]
+    patterns, inverse = np.unique(presence, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    groups = [np.where(inverse == g)[0] for g in range(len(patterns))]
+
+    distance_matrix = np.full((n_pdbs, n_pdbs), 0.0)
+    for g1 in range(len(patterns)):
+        for g2 in range(g1, len(patterns)):
+            shared = patterns[g1] & patterns[g2]
+            n_shared = shared.sum()
+            cells = shared[a] & shared[b]
+
+            block = ssd.cdist(values[groups[g1]][:, cells], values[groups[g2]][:, cells], 'cityblock')
+            with np.errstate(divide='ignore', invalid='ignore'):
+                block = block * block / (n_shared * n_shared)
+
+            distance_matrix[np.ix_(groups[g1], groups[g2])] = block
+            distance_matrix[np.ix_(groups[g2], groups[g1])] = block.T
+
+    np.fill_diagonal(distance_matrix, 0.0)
+    return distance_matrix
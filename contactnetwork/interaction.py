@@ -4,7 +4,11 @@ from contactnetwork.models import *
 
 from residue.models import Residue
 
+from django.db import connection, transaction
+
+from io import StringIO
 import math
+import time
 
 class InteractingPair:
 
@@ -12,14 +16,18 @@ class InteractingPair:
     NUM_SKIP_BB_INTERACTIONS = 4
 
     'Common base class for all interactions'
-    def __init__(self, res1, res2, dbres1, dbres2, structure):
+    def __init__(self, res1, res2, dbres1, dbres2, structure, interactions = None):
         self.res1 = res1
         self.res2 = res2
         self.dbres1 = dbres1
         self.dbres2 = dbres2
         self.structure = structure
-        self.interactions = []
-        self.compute_interactions()
+        # interactions can be given when already classified (see contactnetwork.classifier)
+        if interactions is None:
+            self.interactions = []
+            self.compute_interactions()
+        else:
+            self.interactions = list(interactions)
 
     def add_interactions(self, interaction):
         self.interactions.append(interaction)
@@ -103,17 +111,6 @@ class InteractingPair:
 
         return text
 
-    def save_into_database(self):
-        # Save the pair
-        pair,created = InteractingResiduePair.objects.get_or_create(res1=self.dbres1, res2=self.dbres2, referenced_structure=self.structure)
-
-        # Add the interactions to the pair'
-        bulk = []
-        for i in self.get_interactions():
-            ni = Interaction(interaction_type=i.get_type(),specific_type=i.get_details(), interacting_pair=pair, atomname_residue1=i.atomname_residue1, atomname_residue2=i.atomname_residue2, interaction_level = i.get_level())
-            bulk.append(ni)
-        Interaction.objects.bulk_create(bulk)
-
     def ionic_interactions(self):
         # Only oppositely charged residues
         if (is_pos_charged(self.res1) and is_neg_charged(self.res2)) or (is_neg_charged(self.res1) and is_pos_charged(self.res2)):
@@ -374,6 +371,96 @@ class InteractingPair:
         for match1, match2 in [[a1, a2] for a1 in res1_atoms for a2 in res2_atoms if distance_between(a1.coord, a2.coord) <= ((VDW_RADII[a1.element] + VDW_RADII[a2.element]) * VDW_TRESHOLD_FACTOR)]:
             self.add_interactions(VanDerWaalsInteraction(match1.name, match2.name))
 
+def copy_rows(cursor, table, columns, rows):
+    """Insert rows with a PostgreSQL COPY (text format) on a Django cursor"""
+    def escape(value):
+        if value is None:
+            return '\\N'
+        return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+    data = StringIO()
+    for row in rows:
+        data.write('\t'.join([escape(value) for value in row]))
+        data.write('\n')
+    data.seek(0)
+    cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(connection.ops.quote_name(table),
+        ', '.join([connection.ops.quote_name(column) for column in columns])), data)
+
+
+class InteractionBatchWriter:
+    """
+    Collects the InteractingPairs of a structure and stores them with one set-based statement per table,
+    instead of a get_or_create and bulk_create for every pair.
+    On PostgreSQL the rows are written with COPY (the pair ids are reserved from the sequence first),
+    otherwise with bulk_create. Pairs with the same residues are stored once, like get_or_create did.
+    """
+    def __init__(self, structure, use_copy=True):
+        self.structure = structure
+        self.use_copy = use_copy
+        self.pairs = {}
+        self.pairs_written = 0
+        self.interactions_written = 0
+        self.write_time = 0
+
+    def add(self, interacting_pair):
+        key = (interacting_pair.dbres1.pk, interacting_pair.dbres2.pk)
+        self.pairs.setdefault(key, []).extend(interacting_pair.get_interactions())
+
+    def add_all(self, interacting_pairs):
+        for interacting_pair in interacting_pairs:
+            self.add(interacting_pair)
+
+    @staticmethod
+    def interaction_row(interaction):
+        return (interaction.get_type(), interaction.get_details(), interaction.get_level(),
+            interaction.atomname_residue1, interaction.atomname_residue2)
+
+    def write(self, replace=False):
+        """Store the collected pairs (replace: delete the existing pairs of the structure first)"""
+        start = time.time()
+        with transaction.atomic():
+            if replace:
+                InteractingResiduePair.objects.filter(referenced_structure=self.structure).delete()
+            if self.pairs:
+                if self.use_copy and connection.vendor == 'postgresql':
+                    self.copy_rows()
+                else:
+                    self.bulk_create_rows()
+
+        self.pairs_written += len(self.pairs)
+        self.interactions_written += sum([len(interactions) for interactions in self.pairs.values()])
+        self.pairs = {}
+        self.write_time += time.time() - start
+
+    def copy_rows(self):
+        pair_table = InteractingResiduePair._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)", [pair_table, len(self.pairs)])
+            pair_ids = [row[0] for row in cursor.fetchall()]
+
+            copy_rows(cursor, pair_table, ['id', 'referenced_structure_id', 'res1_id', 'res2_id'],
+                [(pair_id, self.structure.pk, res1, res2) for pair_id, (res1, res2) in zip(pair_ids, self.pairs)])
+            copy_rows(cursor, Interaction._meta.db_table,
+                ['interacting_pair_id', 'interaction_type', 'specific_type', 'interaction_level', 'atomname_residue1', 'atomname_residue2'],
+                [(pair_id,) + self.interaction_row(i) for pair_id, interactions in zip(pair_ids, self.pairs.values()) for i in interactions])
+
+    def bulk_create_rows(self):
+        pairs = [InteractingResiduePair(res1_id=res1, res2_id=res2, referenced_structure=self.structure) for res1, res2 in self.pairs]
+        if getattr(connection.features, 'can_return_rows_from_bulk_insert', False) or getattr(connection.features, 'can_return_ids_from_bulk_insert', False):
+            InteractingResiduePair.objects.bulk_create(pairs)
+        else:
+            for pair in pairs:
+                pair.save()
+
+        bulk = []
+        for pair, interactions in zip(pairs, self.pairs.values()):
+            for i in interactions:
+                interaction_type, specific_type, interaction_level, atomname_residue1, atomname_residue2 = self.interaction_row(i)
+                bulk.append(Interaction(interaction_type=interaction_type, specific_type=specific_type, interacting_pair=pair,
+                    atomname_residue1=atomname_residue1, atomname_residue2=atomname_residue2, interaction_level=interaction_level))
+        Interaction.objects.bulk_create(bulk, batch_size=5000)
+
+
 # Make type and detail variables and default functions
 class CI(object):
     def __init__(self, name1, name2):
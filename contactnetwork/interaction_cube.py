@@ -0,0 +1,226 @@
+"""
+Materialised interaction cube for the interaction browser
+
+InteractionBrowserData used to aggregate the Interaction rows of the selected structures on every request,
+grouping them per structure, residue pair and interaction type with filters on the interaction level and on
+the backbone/side chain atoms of the atom pairs. The cube stores the outcome of that aggregation per structure
+(InteractionCube, refreshed by compute_interactions): one row per (residue pair, interaction type) with the
+count of atom pairs for every (level, atom category 1, atom category 2) class. Any combination of browser
+settings is then a mask over these count columns, and a set of structures a mask over the structure column,
+so single-set, two-set and class-wide selections are answered with a few array reductions.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from common.cache import LRUTier
+from contactnetwork.models import Interaction, InteractionCube
+
+from collections import OrderedDict
+
+import numpy
+
+
+# Interaction types in browser order
+INTERACTION_TYPES = ['ionic', 'polar', 'aromatic', 'hydrophobic', 'van-der-waals']
+
+# Atom categories of the backbone/side chain options: pure backbone, CA (counts as both) and side chain
+BACKBONE_ATOMS = ["C", "O", "N", "CA"]
+PURE_BACKBONE_ATOMS = ["C", "O", "N"]
+ATOM_BACKBONE, ATOM_CA, ATOM_SIDECHAIN = 0, 1, 2
+NUM_ATOM_CATEGORIES = 3
+NUM_LEVELS = 2
+NUM_CLASSES = NUM_LEVELS * NUM_ATOM_CATEGORIES * NUM_ATOM_CATEGORIES
+
+ROW_DTYPE = numpy.dtype([
+    ('res1', '<i8'),
+    ('res2', '<i8'),
+    ('gn1', '<i4'),
+    ('gn2', '<i4'),
+    ('aa1', 'S1'),
+    ('aa2', 'S1'),
+    ('type', 'u1'),
+    ('intra', '?'),
+    ('counts', '<u2', (NUM_CLASSES,)),
+])
+
+interaction_cube_cache = LRUTier(getattr(settings, 'INTERACTION_CUBE_CACHE_ENTRIES', 4096),
+                                 getattr(settings, 'INTERACTION_CUBE_CACHE_SIZE', 256*1024*1024))
+
+
+def atom_category(atom_name):
+    if atom_name == "CA":
+        return ATOM_CA
+    elif atom_name in PURE_BACKBONE_ATOMS:
+        return ATOM_BACKBONE
+    return ATOM_SIDECHAIN
+
+
+def class_index(level, atom_name1, atom_name2):
+    level = min(max(level, 0), NUM_LEVELS-1)
+    return (level * NUM_ATOM_CATEGORIES + atom_category(atom_name1)) * NUM_ATOM_CATEGORIES + atom_category(atom_name2)
+
+
+def build_interaction_cube(structure):
+    """(Re)creates the InteractionCube of a structure from its stored receptor interactions"""
+    interactions = Interaction.objects.filter(
+        interacting_pair__referenced_structure=structure
+    ).filter(
+        interacting_pair__res1__protein_conformation_id=F('interacting_pair__res2__protein_conformation_id')
+    ).filter(
+        interacting_pair__res1__pk__lt=F('interacting_pair__res2__pk')
+    ).exclude(
+        specific_type='water-mediated'
+    ).values_list(
+        'interacting_pair__res1__pk', 'interacting_pair__res2__pk', 'interaction_type', 'interaction_level',
+        'atomname_residue1', 'atomname_residue2',
+        'interacting_pair__res1__generic_number__label', 'interacting_pair__res2__generic_number__label',
+        'interacting_pair__res1__amino_acid', 'interacting_pair__res2__amino_acid',
+        'interacting_pair__res1__protein_segment_id', 'interacting_pair__res2__protein_segment_id',
+    )
+
+    gn_index = OrderedDict()
+    rows = OrderedDict()
+    for res1, res2, i_type, level, atom1, atom2, gn1, gn2, aa1, aa2, segment1, segment2 in interactions:
+        if i_type not in INTERACTION_TYPES or gn1 is None or gn2 is None:
+            continue
+        key = (res1, res2, INTERACTION_TYPES.index(i_type))
+        if key not in rows:
+            rows[key] = [gn_index.setdefault(gn1, len(gn_index)), gn_index.setdefault(gn2, len(gn_index)),
+                aa1, aa2, segment1 is not None and segment1 == segment2, numpy.zeros(NUM_CLASSES, dtype=int)]
+        rows[key][5][class_index(level, atom1, atom2)] += 1
+
+    cube_rows = numpy.zeros(len(rows), dtype=ROW_DTYPE)
+    for index, ((res1, res2, i_type), (gn1, gn2, aa1, aa2, intra, counts)) in enumerate(rows.items()):
+        cube_rows[index] = (res1, res2, gn1, gn2, aa1 or '', aa2 or '', i_type, intra,
+            numpy.minimum(counts, numpy.iinfo(numpy.uint16).max))
+
+    with transaction.atomic():
+        InteractionCube.objects.filter(structure=structure).delete()
+        return InteractionCube.objects.create(structure=structure, gns=",".join(gn_index), data=cube_rows.tobytes())
+
+
+def load_interaction_cubes(structure_ids):
+    """
+    Cube rows of the structures as one record array plus the structure and GN label of every row,
+    or None if any structure has no InteractionCube. Cube data is kept in a bounded in-process LRU.
+    """
+    cubes = {structure_id: (pk, gns) for structure_id, pk, gns in
+        InteractionCube.objects.filter(structure_id__in=structure_ids).values_list('structure_id', 'pk', 'gns')}
+    if any(structure_id not in cubes for structure_id in structure_ids):
+        return None
+
+    data = {}
+    for structure_id in structure_ids:
+        entry = interaction_cube_cache.get(cubes[structure_id][0])
+        if entry is not None:
+            data[cubes[structure_id][0]] = entry[1]
+    missing = [pk for pk, gns in cubes.values() if pk not in data]
+    for pk, blob in InteractionCube.objects.filter(pk__in=missing).values_list('pk', 'data'):
+        data[pk] = bytes(blob)
+        interaction_cube_cache.set(pk, data[pk], 0)
+
+    rows, structures, gn1, gn2 = [], [], [], []
+    for structure_id in structure_ids:
+        pk, gns = cubes[structure_id]
+        structure_rows = numpy.frombuffer(data[pk], dtype=ROW_DTYPE)
+        gns = numpy.array(gns.split(",") if gns else [], dtype=object)
+        rows.append(structure_rows)
+        structures.append(numpy.full(len(structure_rows), structure_id, dtype=int))
+        gn1.append(gns[structure_rows['gn1']])
+        gn2.append(gns[structure_rows['gn2']])
+
+    if not rows:
+        return numpy.zeros(0, dtype=ROW_DTYPE), numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=object), numpy.zeros(0, dtype=object)
+    return numpy.concatenate(rows), numpy.concatenate(structures), numpy.concatenate(gn1), numpy.concatenate(gn2)
+
+
+def accepted_classes(i_types, strict_interactions, contact_options):
+    """
+    Boolean (type, intra, class) table of the atom pair classes that pass the browser settings, with the minimum
+    number of atom pairs per type; mirrors the interaction type, strict and inter/intra segment filters of the view
+    """
+    categories = numpy.zeros((2, NUM_ATOM_CATEGORIES, NUM_ATOM_CATEGORIES), dtype=bool)
+    backbone = numpy.array([True, True, False])      # in BACKBONE_ATOMS
+    not_pure_backbone = numpy.array([False, True, True])
+    for intra, prefix in ((0, 'inter_'), (1, 'intra_')):
+        if prefix + 'bbbb' in contact_options:
+            categories[intra] |= backbone[:, None] & backbone[None, :]
+        if prefix + 'scbb' in contact_options:
+            categories[intra] |= (backbone[:, None] & not_pure_backbone[None, :]) | (not_pure_backbone[:, None] & backbone[None, :])
+        if prefix + 'scsc' in contact_options:
+            categories[intra] |= not_pure_backbone[:, None] & not_pure_backbone[None, :]
+
+    accepted = numpy.zeros((len(INTERACTION_TYPES), 2, NUM_LEVELS, NUM_ATOM_CATEGORIES, NUM_ATOM_CATEGORIES), dtype=bool)
+    min_count = numpy.ones(len(INTERACTION_TYPES), dtype=int)
+    for type_index, i_type in enumerate(INTERACTION_TYPES):
+        if i_type not in i_types:
+            continue
+        levels = numpy.ones(NUM_LEVELS, dtype=bool)
+        if strict_interactions and i_type in strict_interactions:
+            if i_type == 'polar' or i_type == 'aromatic':
+                levels[1:] = False
+            elif i_type == 'hydrophobic' or i_type == 'van-der-waals':
+                min_count[type_index] = 4
+            else:
+                # strict setting without a definition, the view does not return these
+                continue
+        accepted[type_index] = levels[None, :, None, None] & categories[:, None, :, :]
+
+    return accepted.reshape(len(INTERACTION_TYPES), 2, NUM_CLASSES), min_count
+
+
+def select_cube_interactions(cube, i_types, strict_interactions, contact_options):
+    """
+    Grouped interactions of the cube rows that pass the browser settings, as the .values() rows of the
+    Interaction query in InteractionBrowserData (ordered by type, structure and residues) with the class A GN
+    labels and amino acids of the residues added
+    """
+    rows, structures, gn1, gn2 = cube
+    accepted, min_count = accepted_classes(i_types, strict_interactions, contact_options)
+
+    types = rows['type'].astype(int)
+    counts = numpy.sum(rows['counts'] * accepted[types, rows['intra'].astype(int)], axis=1)
+    selected = numpy.flatnonzero(counts >= min_count[types])
+    selected = selected[numpy.lexsort((rows['res2'][selected], rows['res1'][selected], structures[selected], types[selected]))]
+
+    interactions = []
+    for index in selected.tolist():
+        row = rows[index]
+        interactions.append({
+            'interaction_type': INTERACTION_TYPES[row['type']],
+            'interacting_pair__referenced_structure__pk': int(structures[index]),
+            'interacting_pair__res1__pk': int(row['res1']),
+            'interacting_pair__res2__pk': int(row['res2']),
+            'atompaircount': int(counts[index]),
+            'gn1': gn1[index],
+            'gn2': gn2[index],
+            'aa1': row['aa1'].decode(),
+            'aa2': row['aa2'].decode(),
+        })
+    return interactions
+
+
+def cube_aa_pair_rows(interactions, s_lookup, pdbs):
+    """
+    Rows of the per amino acid pair (tab 2) query of InteractionBrowserData, computed from the selected cube
+    interactions of the structures in pdbs; every atom pair contributes one type/structure entry like the
+    ArrayAgg over the Interaction rows
+    """
+    groups = OrderedDict()
+    for i in interactions:
+        protein, pdb_name, pf = s_lookup[i['interacting_pair__referenced_structure__pk']]
+        if pdb_name not in pdbs:
+            continue
+        key = (i['gn1'], i['gn2'], i['aa1'], i['aa2'])
+        if key not in groups:
+            groups[key] = {'gn1': key[0], 'gn2': key[1], 'aa1': key[2], 'aa2': key[3], 'i_types': [], 'structures': [], 'pfs': []}
+        group = groups[key]
+        group['i_types'] += [i['interaction_type']] * i['atompaircount']
+        group['structures'] += [pdb_name.upper()] * i['atompaircount']
+        group['pfs'] += [pf] * i['atompaircount']
+
+    for group in groups.values():
+        group['structuresC'] = len(set(group['structures']))
+        group['pfsC'] = len(set(group['pfs']))
+    return list(groups.values())
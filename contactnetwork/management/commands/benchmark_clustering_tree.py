@@ -0,0 +1,120 @@
+from django.core.management.base import BaseCommand
+
+from contactnetwork.clustering import *
+from structure.models import Structure
+
+import sys
+import time
+
+
+class Command(BaseCommand):
+
+    help = "Benchmark the tree annotation (silhouette index + Newick) used by the structure clustering"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes',
+            type=int,
+            nargs='+',
+            action='store',
+            dest='sizes',
+            default=[50, 100, 200, 400],
+            help='Number of structures (random distance matrices) to benchmark')
+        parser.add_argument('--all',
+            action='store_true',
+            dest='all',
+            default=False,
+            help='Also benchmark a matrix the size of all (non-refined) structures in the database')
+        parser.add_argument('--reference-limit',
+            type=int,
+            action='store',
+            dest='reference_limit',
+            default=400,
+            help='Largest size for which the former recursive implementation is run and compared')
+
+    def handle(self, *args, **options):
+        sizes = list(options['sizes'])
+        if options['all']:
+            sizes.append(Structure.objects.filter(refined=False).count())
+
+        # the recursive reference needs a deep stack for unbalanced trees
+        sys.setrecursionlimit(max(sys.getrecursionlimit(), 10*max(sizes)))
+
+        for size in sizes:
+            distance_matrix = self.random_distance_matrix(size)
+            names = ["S{}".format(i) for i in range(size)]
+
+            start = time.time()
+            hclust = sch.linkage(ssd.squareform(distance_matrix), method='average')
+            linkage_time = time.time() - start
+
+            start = time.time()
+            order = seriation(hclust)
+            si = silhouette_indices(hclust, distance_matrix, order)
+            tree = newick(hclust, names, si)
+            new_time = time.time() - start
+
+            line = "{} structures: linkage {:.3f}s, annotation {:.3f}s".format(size, linkage_time, new_time)
+            if size <= options['reference_limit']:
+                start = time.time()
+                ref_si, ref_tree, ref_order = self.reference(hclust, distance_matrix, names)
+                ref_time = time.time() - start
+                identical = ref_tree == tree and ref_order == order and all(np.isclose(ref_si[k], si[k]) for k in ref_si)
+                line += ", recursive {:.3f}s ({:.1f}x), identical: {}".format(ref_time, ref_time/max(new_time, 1e-9), identical)
+            print(line)
+
+    def random_distance_matrix(self, size):
+        coordinates = np.random.rand(size, 10)
+        return ssd.squareform(ssd.pdist(coordinates))
+
+    def reference(self, hclust, distance_matrix, names):
+        """Former recursive implementation from contactnetwork.views"""
+        def seriation_ref(Z, N, cur_index):
+            if cur_index < N:
+                return [cur_index]
+            left = int(Z[cur_index-N, 0])
+            right = int(Z[cur_index-N, 1])
+            return seriation_ref(Z, N, left) + seriation_ref(Z, N, right)
+
+        def getNewick(node, newick, parentdist, leaf_names, silhouette_coefficient):
+            if node.is_leaf():
+                return "%s:%.2f%s" % (leaf_names[node.id], parentdist - node.dist, newick)
+            si_node = silhouette_coefficient[node.id]
+            if len(newick) > 0:
+                newick = ")%.2f:%.2f%s" % (si_node, parentdist - node.dist, newick)
+            else:
+                newick = ");"
+            newick = getNewick(node.get_left(), newick, node.dist, leaf_names, silhouette_coefficient)
+            newick = getNewick(node.get_right(), ",%s" % (newick), node.dist, leaf_names, silhouette_coefficient)
+            return "(%s" % (newick)
+
+        def calculateSilhouetteIndex(distance_matrix, a, b):
+            si = 0
+            for i in a:
+                ai = 0
+                for j in a:
+                    if i != j:
+                        ai += distance_matrix[i,j]/(len(a)-1)
+                bi = 0
+                for j in b:
+                    bi += distance_matrix[i,j]/len(b)
+                si += (bi-ai)/max(ai,bi)/len(a)
+            return si
+
+        def getSilhouetteIndex(node, distance_matrix, results):
+            if node.id not in results:
+                results[node.id] = 0
+            if not node.is_leaf():
+                a = node.get_left().pre_order(lambda x: x.id)
+                b = node.get_right().pre_order(lambda x: x.id)
+                if len(a) > 1:
+                    results[node.get_left().id] = calculateSilhouetteIndex(distance_matrix, a, b)
+                    getSilhouetteIndex(node.get_left(), distance_matrix, results)
+                if len(b) > 1:
+                    results[node.get_right().id] = calculateSilhouetteIndex(distance_matrix, b, a)
+                    getSilhouetteIndex(node.get_right(), distance_matrix, results)
+
+        tree = sch.to_tree(hclust, False)
+        results = {}
+        getSilhouetteIndex(tree, distance_matrix, results)
+        N = len(distance_matrix)
+        return results, getNewick(tree, "", tree.dist, names, results), seriation_ref(hclust, N, 2*N - 2)
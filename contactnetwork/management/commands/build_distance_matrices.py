@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from contactnetwork.models import *
+
+import time
+
+
+class Command(BaseCommand):
+
+    help = "Convert the per-pair Distance rows into packed DistanceMatrix objects (one per structure)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dtype',
+            choices=['int32', 'float16'],
+            action='store',
+            dest='dtype',
+            default='int32',
+            help='Value type of the packed distance matrices')
+        parser.add_argument('--overwrite',
+            action='store_true',
+            dest='overwrite',
+            default=False,
+            help='Rebuild matrices for structures that have already been converted')
+        parser.add_argument('--purge',
+            action='store_true',
+            dest='purge',
+            default=False,
+            help='Delete the Distance rows of each structure after conversion')
+
+    def handle(self, *args, **options):
+        structure_ids = Distance.objects.values_list('structure_id', flat=True).distinct()
+        if not options['overwrite']:
+            structure_ids = structure_ids.exclude(structure_id__in=DistanceMatrix.objects.values('structure_id'))
+        structure_ids = list(structure_ids)
+
+        print(len(structure_ids), 'structures to convert')
+        start = time.time()
+        for i, structure_id in enumerate(structure_ids):
+            self.convert_structure(structure_id, options['dtype'], options['purge'])
+            if (i+1) % 50 == 0:
+                print(i+1, 'structures converted', round(time.time()-start, 1), 's')
+        print('Converted', len(structure_ids), 'structures in', round(time.time()-start, 1), 's')
+
+    def convert_structure(self, structure_id, dtype, purge):
+        rows = Distance.objects.filter(structure_id=structure_id) \
+                    .values_list('gn1', 'gn2', 'distance', 'distance_cb', 'distance_helix_center', 'res1__amino_acid', 'res2__amino_acid')
+
+        amino_acids = {}
+        for gn1, gn2, _, _, _, aa1, aa2 in rows:
+            amino_acids[gn1] = aa1
+            amino_acids[gn2] = aa2
+        gns = sorted(amino_acids, key=gn_order_key)
+        gn_index = {gn: i for i, gn in enumerate(gns)}
+
+        n = len(gns)
+        planes = np.full((3, n, n), np.nan)
+        for gn1, gn2, ca, cb, hc, _, _ in rows:
+            i, j = gn_index[gn1], gn_index[gn2]
+            for plane, value in enumerate((ca, cb, hc)):
+                if value is not None:
+                    planes[plane, i, j] = planes[plane, j, i] = value
+
+        a, b = np.triu_indices(n, 1)
+        with transaction.atomic():
+            DistanceMatrix.objects.filter(structure_id=structure_id).delete()
+            dm = DistanceMatrix(structure_id=structure_id)
+            dm.set_matrices(gns, [amino_acids[gn] for gn in gns], planes[0][a, b], planes[1][a, b], planes[2][a, b], dtype)
+            dm.save()
+            if purge:
+                Distance.objects.filter(structure_id=structure_id).delete()
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from contactnetwork.models import *
+from contactnetwork.interaction_cube import build_interaction_cube
+
+import time
+
+
+class Command(BaseCommand):
+
+    help = "Aggregate the stored interactions of every structure into an InteractionCube for the interaction browser"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--overwrite',
+            action='store_true',
+            dest='overwrite',
+            default=False,
+            help='Rebuild cubes for structures that already have one')
+
+    def handle(self, *args, **options):
+        structures = Structure.objects.filter(refined=False)
+        if not options['overwrite']:
+            structures = structures.exclude(pk__in=InteractionCube.objects.values('structure_id'))
+        structures = list(structures)
+
+        print(len(structures), 'structures to aggregate')
+        start = time.time()
+        for i, structure in enumerate(structures):
+            build_interaction_cube(structure)
+            if (i+1) % 50 == 0:
+                print(i+1, 'structures aggregated', round(time.time()-start, 1), 's')
+        print('Aggregated', len(structures), 'structures in', round(time.time()-start, 1), 's')
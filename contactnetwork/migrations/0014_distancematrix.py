@@ -0,0 +1,28 @@
+# Generated by Django 2.0.8 on 2026-10-16 10:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('structure', '0029_auto_20200831_1835'),
+        ('contactnetwork', '0013_auto_20200602_1710'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DistanceMatrix',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gns', models.TextField()),
+                ('amino_acids', models.TextField()),
+                ('data', models.BinaryField()),
+                ('structure', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='distance_matrix', to='structure.Structure')),
+            ],
+            options={
+                'db_table': 'distance_matrix',
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.0.8 on 2026-10-16 10:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('structure', '0030_pdbdata_parsed'),
+        ('contactnetwork', '0014_distancematrix'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InteractionCube',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gns', models.TextField()),
+                ('data', models.BinaryField()),
+                ('structure', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='interaction_cube', to='structure.Structure')),
+            ],
+            options={
+                'db_table': 'interaction_cube',
+            },
+        ),
+    ]
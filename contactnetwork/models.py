@@ -1,6 +1,7 @@
 from structure.models import Structure
 
 from django.db import models
+import io
 import numpy as np
 import statistics
 
@@ -75,6 +76,153 @@ class Distance(models.Model):
     class Meta():
         db_table = 'distance'
 
+
+def gn_order_key(gn):
+    """Sort key placing GPCRdb numbers in the order used when building distances (bulges after their parent)"""
+    part1, part2 = gn.split("x")
+    multiply1 = 10000
+    if len(part1)>=2:
+        multiply1 = 1000
+
+    multiply2 = 1
+    if len(part2)<=2:
+        multiply2 = 10
+
+    return int(part1)*multiply1 + int(part2)*multiply2
+
+
+class DistanceMatrix(models.Model):
+    """Packed per-structure distance matrices (CA, CB and helix center) as an alternative to the Distance rows.
+
+    The matrices are stored as condensed upper triangles (scipy pdist order) following the GN order in gns.
+    Values are either int32 in distance_scaling_factor units or float16 in Angstrom, missing values are -1.
+    """
+    structure = models.OneToOneField('structure.Structure', related_name='distance_matrix', on_delete=models.CASCADE)
+    gns = models.TextField() # comma separated GN labels in matrix order
+    amino_acids = models.TextField() # one letter code per GN in matrix order
+    data = models.BinaryField()
+
+    planes = {"CA": "ca", "CB": "cb", "HC": "hc"}
+
+    @classmethod
+    def truncate(cls):
+        from django.db import connection
+        with connection.cursor() as cursor:
+            cursor.execute('TRUNCATE TABLE "{0}" RESTART IDENTITY CASCADE'.format(cls._meta.db_table))
+
+    @staticmethod
+    def pack(ca, cb, hc=None, dtype="int32"):
+        """Pack condensed distance vectors (in distance_scaling_factor units, NaN when missing) into bytes"""
+        store = {}
+        for plane, values in (("ca", ca), ("cb", cb), ("hc", hc)):
+            if values is None:
+                values = np.full(len(ca), np.nan)
+            values = np.asarray(values, dtype=float)
+            missing = np.isnan(values)
+            if dtype == "float16":
+                packed = (values / distance_scaling_factor).astype(np.float16)
+            else:
+                packed = np.nan_to_num(values).astype(np.int32)
+            packed[missing] = -1
+            store[plane] = packed
+
+        with io.BytesIO() as f:
+            np.savez(f, **store)
+            return f.getvalue()
+
+    def set_matrices(self, gns, amino_acids, ca, cb, hc=None, dtype="int32"):
+        self.gns = ",".join(gns)
+        self.amino_acids = "".join(amino_acids)
+        self.data = self.pack(ca, cb, hc, dtype)
+        self._unpacked = None
+
+    def get_gns(self):
+        return self.gns.split(",") if self.gns else []
+
+    def get_gn_index(self):
+        if getattr(self, "_gn_index", None) is None:
+            self._gn_index = {gn: i for i, gn in enumerate(self.get_gns())}
+        return self._gn_index
+
+    def get_condensed(self, distance_type="CA"):
+        """Condensed distances in distance_scaling_factor units with NaN for missing values"""
+        if getattr(self, "_unpacked", None) is None:
+            self._unpacked = {}
+            with io.BytesIO(bytes(self.data)) as f:
+                store = np.load(f)
+                for plane in store.files:
+                    packed = store[plane]
+                    values = packed.astype(float)
+                    if packed.dtype == np.float16:
+                        values *= distance_scaling_factor
+                    values[packed == -1] = np.nan
+                    self._unpacked[plane] = values
+        return self._unpacked[self.planes.get(distance_type, "ca")]
+
+    def condensed_index(self, i, j):
+        """Position of the pairs (i, j), with i < j, in the condensed vectors"""
+        n = len(self.get_gns())
+        i = np.asarray(i, dtype=int)
+        j = np.asarray(j, dtype=int)
+        return n*i - i*(i+1)//2 + (j-i-1)
+
+    def get_matrix(self, distance_type="CA"):
+        """Square symmetric distance matrix in distance_scaling_factor units with NaN on missing values and diagonal"""
+        condensed = self.get_condensed(distance_type)
+        n = len(self.get_gns())
+        matrix = np.full((n, n), np.nan)
+        a, b = np.triu_indices(n, 1)
+        matrix[a, b] = condensed
+        matrix[b, a] = condensed
+        return matrix
+
+    def get_submatrix(self, gns, distance_type="CA"):
+        """Distance matrix re-indexed to the given GN list, GNs absent in this structure are NaN"""
+        gn_index = self.get_gn_index()
+        source = np.array([gn_index.get(gn, -1) for gn in gns], dtype=int)
+        present = np.where(source >= 0)[0]
+        matrix = np.full((len(gns), len(gns)), np.nan)
+        matrix[np.ix_(present, present)] = self.get_matrix(distance_type)[np.ix_(source[present], source[present])]
+        return matrix
+
+    class Meta():
+        db_table = 'distance_matrix'
+
+
+class InteractionCube(models.Model):
+    """Interactions of a structure aggregated for the interaction browser (see contactnetwork.interaction_cube).
+
+    One row per (residue pair, interaction type) of the receptor, with the number of interacting atom pairs
+    for every combination of interaction level and backbone/side chain atoms, stored as a NumPy record array.
+    """
+    structure = models.OneToOneField('structure.Structure', related_name='interaction_cube', on_delete=models.CASCADE)
+    gns = models.TextField() # comma separated (class A) GN labels referenced by the rows
+    data = models.BinaryField()
+
+    @classmethod
+    def truncate(cls):
+        from django.db import connection
+        with connection.cursor() as cursor:
+            cursor.execute('TRUNCATE TABLE "{0}" RESTART IDENTITY CASCADE'.format(cls._meta.db_table))
+
+    def get_gns(self):
+        return self.gns.split(",") if self.gns else []
+
+    class Meta():
+        db_table = 'interaction_cube'
+
+
+def load_distance_matrices(structures):
+    """Returns the DistanceMatrix objects for the structures (in the same order) or None if any structure lacks one"""
+    matrices = {m.structure_id: m for m in DistanceMatrix.objects.filter(structure__in=structures)}
+    ordered = []
+    for s in structures:
+        s_id = s if isinstance(s, int) else s.pk
+        if s_id not in matrices:
+            return None
+        ordered.append(matrices[s_id])
+    return ordered
+
 def get_distance_averages(pdbs,s_lookup, interaction_keys,normalized = False, standard_deviation = False, split_by_amino_acid = False):
     ## Returned dataset is in ClassA GNs...
     matrix = {}
@@ -84,8 +232,13 @@ def get_distance_averages(pdbs,s_lookup, interaction_keys,normalized = False, st
         # Never get SD when only looking at a single pdb...
         standard_deviation = False
 
-    ds = list(Distance.objects.filter(structure__pdb_code__index__in=[ pdb.upper() for pdb in pdbs], gns_pair__in=interaction_keys) \
-                         .values('gns_pair','distance','res1__amino_acid','res2__amino_acid','structure__pk'))
+    structures = list(Structure.objects.filter(pdb_code__index__in=[ pdb.upper() for pdb in pdbs]))
+    matrices = load_distance_matrices(structures)
+    if matrices is not None:
+        ds = get_distance_rows_from_matrices(matrices, interaction_keys)
+    else:
+        ds = list(Distance.objects.filter(structure__in=structures, gns_pair__in=interaction_keys) \
+                             .values('gns_pair','distance','res1__amino_acid','res2__amino_acid','structure__pk'))
     if not normalized:
         for d in ds:
             if split_by_amino_acid:
@@ -140,3 +293,20 @@ def get_distance_averages(pdbs,s_lookup, interaction_keys,normalized = False, st
                 group_distances[key] = meanofmeans/distance_scaling_factor
 
     return group_distances
+
+def get_distance_rows_from_matrices(matrices, interaction_keys):
+    """Mimics the Distance .values() rows used by get_distance_averages by slicing the packed matrices"""
+    keys = [key.split("_") for key in interaction_keys]
+    ds = []
+    for m in matrices:
+        gn_index = m.get_gn_index()
+        pairs = [(gn1, gn2, gn_index[gn1], gn_index[gn2]) for gn1, gn2 in keys if gn1 in gn_index and gn2 in gn_index and gn_index[gn1] < gn_index[gn2]]
+        if not pairs:
+            continue
+
+        distances = m.get_condensed()[m.condensed_index([p[2] for p in pairs], [p[3] for p in pairs])]
+        for (gn1, gn2, i, j), distance in zip(pairs, distances):
+            if np.isnan(distance):
+                continue
+            ds.append({'gns_pair': gn1 + "_" + gn2, 'distance': int(distance), 'res1__amino_acid': m.amino_acids[i], 'res2__amino_acid': m.amino_acids[j], 'structure__pk': m.structure_id})
+    return ds
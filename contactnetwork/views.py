@@ -14,8 +14,11 @@ import functools
 import hashlib
 import copy
 
+from common.jobs import register_job
 from contactnetwork.models import *
 from contactnetwork.distances import *
+from contactnetwork.clustering import annotate_tree
+from contactnetwork.interaction_cube import load_interaction_cubes, select_cube_interactions, cube_aa_pair_rows
 from contactnetwork.functions import *
 from structure.models import Structure, StructureVectors, StructureExtraProteins
 from structure.templatetags.structure_extras import *
@@ -842,46 +845,54 @@ def InteractionBrowserData(request):
             class_mutations = {key: len(value) for key, value in class_mutations.items()}
             cache.set(cache_key, class_mutations, 3600 * 24 * 7)
 
-        # Get the relevant interactions
-        # TODO MAKE SURE ITs only gpcr residues..
-        interactions = Interaction.objects.filter(
-            interacting_pair__referenced_structure__pdb_code__index__in=pdbs_upper
-        ).filter(
-            interacting_pair__res1__protein_conformation_id=F('interacting_pair__res2__protein_conformation_id') # Filter interactions with other proteins
-        ).filter(
-            interacting_pair__res1__pk__lt=F('interacting_pair__res2__pk')
-        ).filter(
-            segment_filter_res1 & segment_filter_res2
-        ).values(
-            'interaction_type',
-            'interacting_pair__referenced_structure__pk',
-            'interacting_pair__res1__pk',
-            'interacting_pair__res2__pk',
-        ).distinct(
-        ).annotate(
-             atompaircount=Count('interaction_type'),
-             arr=ArrayAgg('pk')
-        ).exclude(
-            specific_type='water-mediated'
-        ).filter(
-            i_types_filter
-        ).filter(
-            i_options_filter
-        ).order_by(
-            'interaction_type',
-            'interacting_pair__referenced_structure__pk',
-            'interacting_pair__res1__pk',
-            'interacting_pair__res2__pk'
-        )
+        # Get the relevant interactions, from the interaction cube when all structures have one
+        structure_ids = list(Structure.objects.filter(pdb_code__index__in=pdbs_upper).values_list('pk', flat=True))
+        interaction_cube = load_interaction_cubes(structure_ids)
+        cube_interactions = None
+        if interaction_cube is not None:
+            cube_interactions = select_cube_interactions(interaction_cube, i_types, strict_interactions, contact_options)
+            interactions = cube_interactions
+        else:
+            # TODO MAKE SURE ITs only gpcr residues..
+            interactions = Interaction.objects.filter(
+                interacting_pair__referenced_structure__pdb_code__index__in=pdbs_upper
+            ).filter(
+                interacting_pair__res1__protein_conformation_id=F('interacting_pair__res2__protein_conformation_id') # Filter interactions with other proteins
+            ).filter(
+                interacting_pair__res1__pk__lt=F('interacting_pair__res2__pk')
+            ).filter(
+                segment_filter_res1 & segment_filter_res2
+            ).values(
+                'interaction_type',
+                'interacting_pair__referenced_structure__pk',
+                'interacting_pair__res1__pk',
+                'interacting_pair__res2__pk',
+            ).distinct(
+            ).annotate(
+                 atompaircount=Count('interaction_type'),
+                 arr=ArrayAgg('pk')
+            ).exclude(
+                specific_type='water-mediated'
+            ).filter(
+                i_types_filter
+            ).filter(
+                i_options_filter
+            ).order_by(
+                'interaction_type',
+                'interacting_pair__referenced_structure__pk',
+                'interacting_pair__res1__pk',
+                'interacting_pair__res2__pk'
+            )
 
-        # FOR DEBUGGING interaction + strict filters
-        # print(interactions.query)
-        interactions = list(interactions)
+            # FOR DEBUGGING interaction + strict filters
+            # print(interactions.query)
+            interactions = list(interactions)
 
-        # Grab unique interaction_IDs
+        # Grab unique interaction_IDs (not needed with the cube, the tab 2 rows are derived from it)
         interaction_ids = []
-        for entry in interactions:
-            interaction_ids.extend(entry['arr'])
+        if cube_interactions is None:
+            for entry in interactions:
+                interaction_ids.extend(entry['arr'])
 
         # Interaction type sort - optimize by statically defining interaction type order
         order = ['ionic', 'polar', 'aromatic', 'hydrophobic', 'van-der-waals','None']
@@ -990,10 +1001,10 @@ def InteractionBrowserData(request):
                 'interacting_pair__res2__generic_number__label',
             ).filter(interacting_pair__res1__pk__lt=F('interacting_pair__res2__pk')).distinct())
 
-            all_interaction_pairs = []
+            all_interaction_pairs = set()
             all_interaction_residues = set()
             for i in pos_interactions:
-                all_interaction_pairs.append('{},{}'.format(i[0],i[1]))
+                all_interaction_pairs.add('{},{}'.format(i[0],i[1]))
                 all_interaction_residues.add(i[0])
                 all_interaction_residues.add(i[1])
             all_interaction_residues = sorted(list(all_interaction_residues), key=functools.cmp_to_key(gpcrdb_number_comparator))
@@ -1681,30 +1692,33 @@ def InteractionBrowserData(request):
 
             set_id = 'set1'
             aa_pair_data = data['tab2']
-            interactions = list(Interaction.objects.filter(
-                    interacting_pair__referenced_structure__pdb_code__index__in=[ pdb.upper() for pdb in data['pdbs1']]
-                ).filter(
-                    id__in=interaction_ids
-                ).exclude(
-                    interacting_pair__res1__generic_number=None,
-                    interacting_pair__res2__generic_number=None
-                ).annotate(
-                    gn1=F('interacting_pair__res1__generic_number__label'),
-                    gn2=F('interacting_pair__res2__generic_number__label'),
-                    aa1=F('interacting_pair__res1__amino_acid'),
-                    aa2=F('interacting_pair__res2__amino_acid'),
-                ).values(
-                    'gn1',
-                    'gn2',
-                    'aa1',
-                    'aa2',
-                ).distinct().annotate(
-                    i_types=ArrayAgg('interaction_type'),
-                    structures=ArrayAgg('interacting_pair__referenced_structure__pdb_code__index'),
-                    pfs=ArrayAgg('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__slug'),
-                    structuresC=Count('interacting_pair__referenced_structure',distinct=True),
-                    pfsC=Count('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__name',distinct=True)
-                ))
+            if cube_interactions is not None:
+                interactions = cube_aa_pair_rows(cube_interactions, s_lookup, data['pdbs1'])
+            else:
+                interactions = list(Interaction.objects.filter(
+                        interacting_pair__referenced_structure__pdb_code__index__in=[ pdb.upper() for pdb in data['pdbs1']]
+                    ).filter(
+                        id__in=interaction_ids
+                    ).exclude(
+                        interacting_pair__res1__generic_number=None,
+                        interacting_pair__res2__generic_number=None
+                    ).annotate(
+                        gn1=F('interacting_pair__res1__generic_number__label'),
+                        gn2=F('interacting_pair__res2__generic_number__label'),
+                        aa1=F('interacting_pair__res1__amino_acid'),
+                        aa2=F('interacting_pair__res2__amino_acid'),
+                    ).values(
+                        'gn1',
+                        'gn2',
+                        'aa1',
+                        'aa2',
+                    ).distinct().annotate(
+                        i_types=ArrayAgg('interaction_type'),
+                        structures=ArrayAgg('interacting_pair__referenced_structure__pdb_code__index'),
+                        pfs=ArrayAgg('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__slug'),
+                        structuresC=Count('interacting_pair__referenced_structure',distinct=True),
+                        pfsC=Count('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__name',distinct=True)
+                    ))
             for i in interactions:
                 key = '{},{}{}{}'.format(r_class_translate_from_classA[i['gn1']],r_class_translate_from_classA[i['gn2']],i['aa1'],i['aa2'])
                 if key not in aa_pair_data:
@@ -1723,30 +1737,33 @@ def InteractionBrowserData(request):
             print('Gotten first set occurance calcs',time.time()-start_time)
 
             set_id = 'set2'
-            interactions = list(Interaction.objects.filter(
-                    interacting_pair__referenced_structure__pdb_code__index__in=[ pdb.upper() for pdb in data['pdbs2']]
-                ).filter(
-                    id__in=interaction_ids
-                ).exclude(
-                    interacting_pair__res1__generic_number=None,
-                    interacting_pair__res2__generic_number=None
-                ).annotate(
-                    gn1=F('interacting_pair__res1__generic_number__label'),
-                    gn2=F('interacting_pair__res2__generic_number__label'),
-                    aa1=F('interacting_pair__res1__amino_acid'),
-                    aa2=F('interacting_pair__res2__amino_acid'),
-                ).values(
-                    'gn1',
-                    'gn2',
-                    'aa1',
-                    'aa2',
-                ).distinct().annotate(
-                    i_types=ArrayAgg('interaction_type'),
-                    structures=ArrayAgg('interacting_pair__referenced_structure__pdb_code__index'),
-                    pfs=ArrayAgg('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__slug'),
-                    structuresC=Count('interacting_pair__referenced_structure',distinct=True),
-                    pfsC=Count('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__name',distinct=True)
-                ))
+            if cube_interactions is not None:
+                interactions = cube_aa_pair_rows(cube_interactions, s_lookup, data['pdbs2'])
+            else:
+                interactions = list(Interaction.objects.filter(
+                        interacting_pair__referenced_structure__pdb_code__index__in=[ pdb.upper() for pdb in data['pdbs2']]
+                    ).filter(
+                        id__in=interaction_ids
+                    ).exclude(
+                        interacting_pair__res1__generic_number=None,
+                        interacting_pair__res2__generic_number=None
+                    ).annotate(
+                        gn1=F('interacting_pair__res1__generic_number__label'),
+                        gn2=F('interacting_pair__res2__generic_number__label'),
+                        aa1=F('interacting_pair__res1__amino_acid'),
+                        aa2=F('interacting_pair__res2__amino_acid'),
+                    ).values(
+                        'gn1',
+                        'gn2',
+                        'aa1',
+                        'aa2',
+                    ).distinct().annotate(
+                        i_types=ArrayAgg('interaction_type'),
+                        structures=ArrayAgg('interacting_pair__referenced_structure__pdb_code__index'),
+                        pfs=ArrayAgg('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__slug'),
+                        structuresC=Count('interacting_pair__referenced_structure',distinct=True),
+                        pfsC=Count('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__name',distinct=True)
+                    ))
 
             for i in interactions:
                 key = '{},{}{}{}'.format(r_class_translate_from_classA[i['gn1']],r_class_translate_from_classA[i['gn2']],i['aa1'],i['aa2'])
@@ -1846,28 +1863,31 @@ def InteractionBrowserData(request):
             # Single set!
             # TODO: fix the interaction filter subselection
             aa_pair_data = data['tab2']
-            interactions = list(Interaction.objects.filter(
-                    id__in=interaction_ids
-                ).exclude(
-                    interacting_pair__res1__generic_number=None,
-                    interacting_pair__res2__generic_number=None
-                ).annotate(
-                    gn1=F('interacting_pair__res1__generic_number__label'),
-                    gn2=F('interacting_pair__res2__generic_number__label'),
-                    aa1=F('interacting_pair__res1__amino_acid'),
-                    aa2=F('interacting_pair__res2__amino_acid'),
-                ).values(
-                    'gn1',
-                    'gn2',
-                    'aa1',
-                    'aa2',
-                ).distinct().annotate(
-                    i_types=ArrayAgg('interaction_type'),
-                    structures=ArrayAgg('interacting_pair__referenced_structure__pdb_code__index'),
-                    pfs=ArrayAgg('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__slug'),
-                    structuresC=Count('interacting_pair__referenced_structure',distinct=True),
-                    pfsC=Count('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__name',distinct=True)
-                ))
+            if cube_interactions is not None:
+                interactions = cube_aa_pair_rows(cube_interactions, s_lookup, data['pdbs'])
+            else:
+                interactions = list(Interaction.objects.filter(
+                        id__in=interaction_ids
+                    ).exclude(
+                        interacting_pair__res1__generic_number=None,
+                        interacting_pair__res2__generic_number=None
+                    ).annotate(
+                        gn1=F('interacting_pair__res1__generic_number__label'),
+                        gn2=F('interacting_pair__res2__generic_number__label'),
+                        aa1=F('interacting_pair__res1__amino_acid'),
+                        aa2=F('interacting_pair__res2__amino_acid'),
+                    ).values(
+                        'gn1',
+                        'gn2',
+                        'aa1',
+                        'aa2',
+                    ).distinct().annotate(
+                        i_types=ArrayAgg('interaction_type'),
+                        structures=ArrayAgg('interacting_pair__referenced_structure__pdb_code__index'),
+                        pfs=ArrayAgg('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__slug'),
+                        structuresC=Count('interacting_pair__referenced_structure',distinct=True),
+                        pfsC=Count('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__name',distinct=True)
+                    ))
 
             for i in interactions:
                 key = '{},{}{}{}'.format(r_class_translate_from_classA[i['gn1']],r_class_translate_from_classA[i['gn2']],i['aa1'],i['aa2'])
@@ -2772,9 +2792,14 @@ def stableResMatrix(pdbs):
     return [distance_matrix, pdbs]
 
 def ClusteringData(request):
+    return JsonResponse(clustering_data(request.GET.dict()))
+
+@register_job('clustering')
+def clustering_data(parameters):
+    """Structure clustering tree and distance matrix (also run as job, see common.jobs)"""
     # PDB files
     try:
-        pdbs = request.GET.get('pdbs').split(',')
+        pdbs = parameters.get('pdbs').split(',')
     except IndexError:
         pdbs = []
 
@@ -2788,8 +2813,8 @@ def ClusteringData(request):
 
     # load all
     cluster_method = 0
-    if 'cluster-method' in request.GET:
-        cluster_method = request.GET.get('cluster-method')
+    if 'cluster-method' in parameters:
+        cluster_method = parameters.get('cluster-method')
 
     # DEBUG set clustering method hardcoded:
     # cluster_method = '7'
@@ -2872,19 +2897,11 @@ def ClusteringData(request):
 
     data['Gprot_coupling'] = selectivitydata
 
-    # hierarchical clustering
-    hclust = sch.linkage(ssd.squareform(distance_matrix), method='average')
-    tree = sch.to_tree(hclust, False)
-
-    #inconsistency = sch.inconsistent(hclust)
-    #inconsistency = sch.maxinconsts(hclust, inconsistency)
-    silhouette_coefficient = {}
-    getSilhouetteIndex(tree, distance_matrix, silhouette_coefficient)
-    data['tree'] = getNewick(tree, "", tree.dist, pdbs, silhouette_coefficient)
+    # hierarchical clustering + silhouette index per node
+    hclust, data['tree'], res_order = annotate_tree(distance_matrix, pdbs)
 
     # Order distance_matrix by hclust
     N = len(distance_matrix)
-    res_order = seriation(hclust, N, N + N-2)
     seriated_dist = np.zeros((N,N))
     a,b = np.triu_indices(N,k=1)
     seriated_dist[a,b] = distance_matrix[ [res_order[i] for i in a], [res_order[j] for j in b]]
@@ -2893,88 +2910,7 @@ def ClusteringData(request):
     data['distance_matrix'] = seriated_dist.tolist()
     data['dm_labels'] = [pdbs[i] for i in res_order]
 
-    return JsonResponse(data)
-
-# For reordering matrix based on h-tree
-# Borrowed from https://gmarti.gitlab.io/ml/2017/09/07/how-to-sort-distance-matrix.html
-def seriation(Z,N,cur_index):
-    '''
-        input:
-            - Z is a hierarchical tree (dendrogram)
-            - N is the number of points given to the clustering process
-            - cur_index is the position in the tree for the recursive traversal
-        output:
-            - order implied by the hierarchical tree Z
-
-        seriation computes the order implied by a hierarchical tree (dendrogram)
-    '''
-    if cur_index < N:
-        return [cur_index]
-    else:
-        left = int(Z[cur_index-N,0])
-        right = int(Z[cur_index-N,1])
-        return (seriation(Z,N,left) + seriation(Z,N,right))
-
-def getNewick(node, newick, parentdist, leaf_names, silhouette_coefficient):
-    if node.is_leaf():
-        return "%s:%.2f%s" % (leaf_names[node.id], parentdist - node.dist, newick)
-    else:
-        si_node = silhouette_coefficient[node.id]
-        if len(newick) > 0:
-            newick = ")%.2f:%.2f%s" % (si_node, parentdist - node.dist, newick)
-        else:
-            newick = ");"
-        newick = getNewick(node.get_left(), newick, node.dist, leaf_names, silhouette_coefficient)
-        newick = getNewick(node.get_right(), ",%s" % (newick), node.dist, leaf_names, silhouette_coefficient)
-        newick = "(%s" % (newick)
-        return newick
-
-def getSilhouetteIndex(node, distance_matrix, results):
-    # set rootnode (DEBUG purposes)
-    if node.id not in results:
-        results[node.id] = 0
-
-    if not node.is_leaf():
-        # get list of indices cluster left (A)
-        a = node.get_left().pre_order(lambda x: x.id)
-
-        # get list of indices cluster right (B)
-        b = node.get_right().pre_order(lambda x: x.id)
-
-        if len(a) > 1:
-            # calculate average Si - cluster A
-            si_a = calculateSilhouetteIndex(distance_matrix, a, b)
-            results[node.get_left().id] = si_a
-
-            getSilhouetteIndex(node.get_left(), distance_matrix, results)
-
-        if len(b) > 1:
-            # calculate average Si - cluster B
-            si_b = calculateSilhouetteIndex(distance_matrix, b, a)
-            results[node.get_right().id] = si_b
-
-            getSilhouetteIndex(node.get_right(), distance_matrix, results)
-
-# Implementation based on Rousseeuw, P.J. J. Comput. Appl. Math. 20 (1987): 53-65
-def calculateSilhouetteIndex(distance_matrix, a, b):
-    si = 0
-    for i in a:
-        # calculate ai - avg distance within cluster
-        ai = 0
-        for j in a:
-            if i != j:
-                ai += distance_matrix[i,j]/(len(a)-1)
-
-        # calculate bi - avg distance to closest cluster
-        bi = 0
-        for j in b:
-            bi += distance_matrix[i,j]/len(b)
-
-        # silhouette index (averaged)
-        si += (bi-ai)/max(ai,bi)/len(a)
-
-    return si
-
+    return data
 
 def DistanceData(request):
     def gpcrdb_number_comparator(e1, e2):
@@ -3398,7 +3334,7 @@ def InteractionData(request):
     return JsonResponse(data)
 
 def ServePDB(request, pdbname):
-    structure=Structure.objects.filter(pdb_code__index=pdbname.upper())
+    structure=Structure.objects.filter(pdb_code__index=pdbname.upper()).select_related('pdb_data').defer('pdb_data__parsed')
     if structure.exists():
         structure=structure.get()
     else:
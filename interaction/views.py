@@ -1202,7 +1202,7 @@ def pdb(request):
 
         structure = Structure.objects.filter(pdb_code=web_link)
         if structure.exists():
-            structure = Structure.objects.get(pdb_code=web_link)
+            structure = Structure.objects.select_related('pdb_data').defer('pdb_data__parsed').get(pdb_code=web_link)
         else:
             quit()  # quit!
 
@@ -0,0 +1,248 @@
+"""
+Chemical similarity and substructure search of the ligands
+
+The Morgan fingerprints (radius 2, 2048 bits) of all LigandProperities with a SMILES are computed at build time
+(build_ligand_fingerprints) and stored as a packed NumPy bit matrix, one row of 256 bytes per compound, together
+with the number of bits set in every row. A similarity search is then a bitwise AND of the query with the whole
+matrix and a population count per row, giving the Tanimoto coefficients of all compounds at once; with a minimum
+similarity, rows whose bit count alone rules them out are skipped first.
+Morgan fingerprints of a substructure are not contained in the fingerprints of the molecules that contain it,
+so substructure searches are screened with RDKit pattern fingerprints (a second matrix): only compounds that
+have every bit of the query set are matched atom by atom.
+"""
+from django.conf import settings
+
+from ligand.models import Ligand, LigandProperities
+
+from rdkit import Chem, DataStructs
+from rdkit.Chem import AllChem
+
+import logging
+import os
+import threading
+import time
+
+import numpy
+
+
+FINGERPRINT_BITS = 2048
+MORGAN_RADIUS = 2
+
+# rows per block of the matrix operations (bounds the size of the temporary arrays)
+BLOCK_SIZE = 65536
+
+SIMILARITY = 'similarity'
+SUBSTRUCTURE = 'substructure'
+
+logger = logging.getLogger(__name__)
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def fingerprint_file():
+    return getattr(settings, 'LIGAND_FINGERPRINT_FILE',
+        os.sep.join([settings.STATICFILES_DIRS[0], 'ligand_search', 'fingerprints.npz']))
+
+
+def pack_fingerprint(fingerprint):
+    """Packed bits (uint8 array of FINGERPRINT_BITS/8 bytes) of an RDKit bit vector"""
+    bits = numpy.zeros((fingerprint.GetNumBits(),), dtype=numpy.uint8)
+    DataStructs.ConvertToNumpyArray(fingerprint, bits)
+    return numpy.packbits(bits)
+
+
+def morgan_fingerprint(mol):
+    return pack_fingerprint(AllChem.GetMorganFingerprintAsBitVect(mol, MORGAN_RADIUS, nBits=FINGERPRINT_BITS))
+
+
+def pattern_fingerprint(mol):
+    return pack_fingerprint(Chem.PatternFingerprint(mol, fpSize=FINGERPRINT_BITS))
+
+
+if hasattr(numpy, 'bitwise_count'):
+    def popcount(rows):
+        """Number of bits set in every row of a packed bit matrix"""
+        return numpy.bitwise_count(rows.view(numpy.uint64)).sum(axis=1, dtype=numpy.int32)
+else:
+    _POPCOUNT_16 = numpy.array([bin(i).count('1') for i in range(1 << 16)], dtype=numpy.uint8)
+
+    def popcount(rows):
+        """Number of bits set in every row of a packed bit matrix"""
+        return _POPCOUNT_16[rows.view(numpy.uint16)].sum(axis=1, dtype=numpy.int32)
+
+
+def build_fingerprints(compounds):
+    """
+    Fingerprint matrices of (id, SMILES) pairs, as the arrays stored in fingerprint_file: ids, morgan,
+    morgan_counts and pattern (compounds whose SMILES RDKit cannot parse are left out)
+    """
+    ids, morgan, pattern = [], [], []
+    for compound_id, smiles in compounds:
+        mol = Chem.MolFromSmiles(smiles) if smiles else None
+        if mol is None:
+            continue
+        ids.append(compound_id)
+        morgan.append(morgan_fingerprint(mol))
+        pattern.append(pattern_fingerprint(mol))
+
+    width = FINGERPRINT_BITS // 8
+    morgan = numpy.array(morgan, dtype=numpy.uint8).reshape(-1, width)
+    return {
+        'ids': numpy.array(ids, dtype=numpy.int64),
+        'morgan': morgan,
+        'morgan_counts': popcount(morgan),
+        'pattern': numpy.array(pattern, dtype=numpy.uint8).reshape(-1, width),
+    }
+
+
+class FingerprintIndex(object):
+    """Fingerprint matrices of the ligands in memory, with the vectorised searches"""
+
+    def __init__(self, ids, morgan, morgan_counts, pattern, version=None):
+        self.ids = ids
+        self.morgan = numpy.ascontiguousarray(morgan)
+        self.morgan_counts = morgan_counts
+        self.pattern = numpy.ascontiguousarray(pattern)
+        self.version = version
+
+    @classmethod
+    def load(cls, path):
+        stat = os.stat(path)
+        with numpy.load(path) as data:
+            return cls(data['ids'], data['morgan'], data['morgan_counts'], data['pattern'],
+                version=(stat.st_mtime_ns, stat.st_size))
+
+    def tanimoto(self, query, rows=None):
+        """Tanimoto coefficients of the query (packed Morgan bits) and all compounds (or the given rows)"""
+        counts = self.morgan_counts if rows is None else self.morgan_counts[rows]
+        query_count = int(popcount(query[None, :])[0])
+        common = numpy.empty(len(counts), dtype=numpy.int32)
+        for start in range(0, len(counts), BLOCK_SIZE):
+            block = self.morgan[start:start+BLOCK_SIZE] if rows is None else self.morgan[rows[start:start+BLOCK_SIZE]]
+            common[start:start+BLOCK_SIZE] = popcount(block & query)
+        union = counts + query_count - common
+        return numpy.where(union > 0, common / numpy.maximum(union, 1), 0.0)
+
+    def similar(self, query, limit=100, threshold=0.0):
+        """(id, similarity) of the limit compounds most similar to the query, best first"""
+        rows = None
+        if threshold > 0:
+            # Tanimoto <= min(a, b) / max(a, b) for bit counts a and b
+            query_count = int(popcount(query[None, :])[0])
+            bound = numpy.minimum(self.morgan_counts, query_count) / numpy.maximum(numpy.maximum(self.morgan_counts, query_count), 1)
+            rows = numpy.flatnonzero(bound >= threshold)
+        scores = self.tanimoto(query, rows)
+        if rows is None:
+            rows = numpy.arange(len(scores))
+        keep = numpy.flatnonzero(scores >= threshold) if threshold > 0 else numpy.arange(len(scores))
+        if len(keep) > limit:
+            # all compounds as similar as the limit-th one, the ties are broken by id below
+            cutoff = scores[keep][numpy.argpartition(-scores[keep], limit - 1)[limit - 1]]
+            keep = keep[scores[keep] >= cutoff]
+        keep = keep[numpy.lexsort((self.ids[rows[keep]], -scores[keep]))][:limit]
+        return [(int(self.ids[rows[i]]), float(scores[i])) for i in keep]
+
+    def screen(self, query):
+        """Ids of the compounds that have all bits of the query pattern fingerprint (substructure candidates)"""
+        columns = numpy.flatnonzero(query)
+        if not len(columns):
+            return self.ids
+        query = query[columns]
+        candidates = []
+        for start in range(0, len(self.ids), BLOCK_SIZE):
+            block = self.pattern[start:start+BLOCK_SIZE, columns]
+            candidates.append(start + numpy.flatnonzero(((block & query) == query).all(axis=1)))
+        return self.ids[numpy.concatenate(candidates)] if candidates else self.ids[:0]
+
+
+def get_index():
+    """The FingerprintIndex of fingerprint_file (loaded once per process and again when the file is rebuilt)"""
+    global _index
+    path = fingerprint_file()
+    try:
+        stat = os.stat(path)
+    except OSError:
+        raise FileNotFoundError('No ligand fingerprints at {}, run build_ligand_fingerprints'.format(path))
+    with _index_lock:
+        if _index is None or _index.version != (stat.st_mtime_ns, stat.st_size):
+            _index = FingerprintIndex.load(path)
+        return _index
+
+
+def parse_query(smiles):
+    mol = Chem.MolFromSmiles(smiles) if smiles else None
+    if mol is None:
+        raise ValueError('Invalid SMILES: {}'.format(smiles))
+    return mol
+
+
+def substructure_matches(mol, candidates, limit=100, batch_size=500):
+    """
+    Ids of the first limit candidates (in order) that contain the query molecule. At most
+    LIGAND_SUBSTRUCTURE_MAX_CANDIDATES candidates (default 20000) are matched, for at most
+    LIGAND_SUBSTRUCTURE_TIMEOUT seconds (default 10); the matches found until then are returned.
+    """
+    candidates = candidates[:getattr(settings, 'LIGAND_SUBSTRUCTURE_MAX_CANDIDATES', 20000)]
+    deadline = time.time() + getattr(settings, 'LIGAND_SUBSTRUCTURE_TIMEOUT', 10)
+    matches = []
+    for start in range(0, len(candidates), batch_size):
+        if time.time() > deadline:
+            logger.warning('Substructure search stopped after {} of {} candidates'.format(start, len(candidates)))
+            break
+        batch = [int(c) for c in candidates[start:start+batch_size]]
+        smiles = dict(LigandProperities.objects.filter(pk__in=batch).values_list('pk', 'smiles'))
+        for compound_id in batch:
+            target = Chem.MolFromSmiles(smiles[compound_id]) if smiles.get(compound_id) else None
+            if target is not None and target.HasSubstructMatch(mol):
+                matches.append(compound_id)
+                if len(matches) == limit:
+                    return matches
+    return matches
+
+
+def search_ligands(smiles, mode=SIMILARITY, limit=100, threshold=0.0):
+    """
+    Ligands matching a SMILES query, the most similar first (similarity) or in database order (substructure):
+    a list of dicts with the ligand name, ChEMBL id, SMILES and (for similarity searches) the Tanimoto coefficient
+    """
+    mol = parse_query(smiles)
+    index = get_index()
+    if mode == SUBSTRUCTURE:
+        hits = [(compound_id, None) for compound_id in
+            substructure_matches(mol, index.screen(pattern_fingerprint(mol)), limit)]
+    else:
+        hits = index.similar(morgan_fingerprint(mol), limit, threshold)
+
+    # the canonical name of each compound, or any of its names
+    ligands = {}
+    for ligand in Ligand.objects.filter(properities__in=[h[0] for h in hits]).values(
+            'name', 'canonical', 'properities_id', 'properities__smiles', 'properities__inchikey'):
+        if ligand['properities_id'] not in ligands or ligand['canonical']:
+            ligands[ligand['properities_id']] = ligand
+    chembl_ids = dict(LigandProperities.objects.filter(pk__in=[h[0] for h in hits],
+        web_links__web_resource__slug='chembl_ligand').values_list('pk', 'web_links__index'))
+
+    results = []
+    for compound_id, similarity in hits:
+        ligand = ligands.get(compound_id)
+        if not ligand:
+            continue
+        results.append({
+            'name': ligand['name'],
+            'chembl_id': chembl_ids.get(compound_id),
+            'smiles': ligand['properities__smiles'],
+            'inchikey': ligand['properities__inchikey'],
+            'similarity': round(similarity, 4) if similarity is not None else None,
+            })
+    return results
+
+
+def search_parameters(params, mode=None):
+    """smiles, mode, limit and threshold of a search from request parameters (ValueError if invalid)"""
+    mode = mode or params.get('mode', SIMILARITY)
+    if mode not in (SIMILARITY, SUBSTRUCTURE):
+        raise ValueError('Unknown search mode: {}'.format(mode))
+    limit = min(max(int(params.get('limit', 100)), 1), getattr(settings, 'LIGAND_SEARCH_MAX_RESULTS', 1000))
+    threshold = float(params.get('threshold', 0))
+    return params.get('smiles', '').strip(), mode, limit, threshold
@@ -0,0 +1,41 @@
+# Generated by Django 3.0.3 on 2026-10-16 10:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('protein', '0009_auto_20200511_1818'),
+        ('ligand', '0008_ligandpeptidestructure'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LigandActivitySummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('assay_type', models.CharField(max_length=10)),
+                ('family_slug', models.CharField(max_length=100)),
+                ('chembl_id', models.CharField(max_length=100, null=True)),
+                ('record_count', models.IntegerField()),
+                ('value_count', models.IntegerField()),
+                ('min_value', models.FloatField(null=True)),
+                ('mean_value', models.FloatField(null=True)),
+                ('max_value', models.FloatField(null=True)),
+                ('standard_units', models.TextField()),
+                ('purchasable', models.BooleanField(default=False)),
+                ('ligand', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ligand.Ligand')),
+                ('protein', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='protein.Protein')),
+            ],
+            options={
+                'db_table': 'ligand_activity_summary',
+                'unique_together': {('ligand', 'protein', 'assay_type')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='ligandactivitysummary',
+            index=models.Index(fields=['family_slug'], name='ligand_act_family_slug_idx', opclasses=['varchar_pattern_ops']),
+        ),
+    ]
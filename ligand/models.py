@@ -365,6 +365,45 @@ class LigandVendorLink(models.Model):
     vendor_external_id = models.CharField(max_length=300) #RegistryID
     sid = models.CharField(max_length=200, unique=True) #SID
 
+
+# sources listed among the vendors of a ligand that do not sell it
+NON_PURCHASABLE_SOURCES = ['ZINC', 'ChEMBL', 'BindingDB', 'SureChEMBL', 'eMolecules', 'MolPort', 'PubChem']
+
+class LigandActivitySummary(models.Model):
+    """AssayExperiment rows of a ligand, target and assay type aggregated at build time (build_ligand_activity_summary).
+
+    The pchembl values are summarised as numbers (count, min, mean, max, only non-zero values as on the target
+    pages) and the family slug of the target is copied so that all targets of a family are a prefix range scan.
+    """
+    ligand = models.ForeignKey('Ligand', on_delete=models.CASCADE)
+    protein = models.ForeignKey('protein.Protein', on_delete=models.CASCADE)
+    assay_type = models.CharField(max_length=10)
+    family_slug = models.CharField(max_length=100)
+    chembl_id = models.CharField(max_length=100, null=True) # index of the chembl_ligand web link
+    record_count = models.IntegerField()
+    value_count = models.IntegerField()
+    min_value = models.FloatField(null=True)
+    mean_value = models.FloatField(null=True)
+    max_value = models.FloatField(null=True)
+    standard_units = models.TextField() # comma separated
+    purchasable = models.BooleanField(default=False)
+
+    @classmethod
+    def truncate(cls):
+        from django.db import connection
+        with connection.cursor() as cursor:
+            cursor.execute('TRUNCATE TABLE "{0}" RESTART IDENTITY CASCADE'.format(cls._meta.db_table))
+
+    def __str__(self):
+        return "{} {} {}".format(self.ligand_id, self.protein_id, self.assay_type)
+
+    class Meta():
+        db_table = 'ligand_activity_summary'
+        unique_together = ('ligand', 'protein', 'assay_type')
+        indexes = [
+            models.Index(fields=['family_slug'], name='ligand_act_family_slug_idx', opclasses=['varchar_pattern_ops']),
+        ]
+
 #Biased Signalling - start
 class BiasedExperiment(models.Model):
     submission_author = models.CharField(max_length=50)
@@ -1,6 +1,7 @@
 from django.conf.urls import url
 from django.views.decorators.cache import cache_page
 from django.views.generic import TemplateView
+from common.views import DataSourceView
 from ligand.views import *
 
 urlpatterns = [
@@ -10,16 +11,23 @@ urlpatterns = [
     url(r'^targets$',TargetDetails, name='ligand_target_detail'),
     url(r'^targets_compact',TargetDetailsCompact, name='ligand_target_detail_compact'),
     url(r'^targets_purchasable',TargetPurchasabilityDetails, name='ligand_target_detail_purchasable'),
+    url(r'^search$', LigandSearch, name='ligand_search'),
     url(r'^(?P<ligand_id>[-\w]+)/$',LigandDetails, name='ligand_detail'),
     url(r'^statistics', cache_page(3600*24*7)(LigandStatistics.as_view()), name='ligand_statistics'),
     url(r'^experiment/(?P<pk>[-\w]+)/detail$', ExperimentEntryView.as_view()),
     url(r'^vendors$', test_link, name='test'),
     url(r'^biasedbrowser$', cache_page(3600*24*7)(BiasBrowser.as_view()), name='bias_browser'),
+    url(r'^biasedbrowser/data$', DataSourceView.as_view(source=BiasBrowserData), name='bias_browser_data'),
+    url(r'^biasedbrowser/data/(?P<column>\w+)$', DataSourceView.as_view(source=BiasBrowserData), name='bias_browser_data'),
     url(r'^biasedgbrowser$', cache_page(3600*24*7)(BiasBrowserGSubbtype.as_view()), name='bias_g_browser'),
-    # url(r'^biasedbrowser$', BiasBrowser.as_view(), name='bias_browser'),
-    # url(r'^biasedgbrowser$', BiasBrowserGSubbtype.as_view(), name='bias_g_browser'),
-    url(r'^browserchembl$', BiasBrowserChembl.as_view(), name='bias_chembl_browser'),
+    url(r'^biasedgbrowser/data$', DataSourceView.as_view(source=BiasBrowserGSubtypeData), name='bias_g_browser_data'),
+    url(r'^biasedgbrowser/data/(?P<column>\w+)$', DataSourceView.as_view(source=BiasBrowserGSubtypeData), name='bias_g_browser_data'),
+    url(r'^browserchembl$', cache_page(3600*24*7)(BiasBrowserChembl.as_view()), name='bias_chembl_browser'),
+    url(r'^browserchembl/data$', DataSourceView.as_view(source=BiasBrowserChemblData), name='bias_chembl_browser_data'),
+    url(r'^browserchembl/data/(?P<column>\w+)$', DataSourceView.as_view(source=BiasBrowserChemblData), name='bias_chembl_browser_data'),
     url(r'^browservendors$', BiasVendorBrowser.as_view(), name='browservendor'),
-    url(r'^biasedpathways$', BiasPathways.as_view(), name='pathways'),
+    url(r'^biasedpathways$', cache_page(3600*24*7)(BiasPathways.as_view()), name='pathways'),
+    url(r'^biasedpathways/data$', DataSourceView.as_view(source=BiasPathwaysData), name='pathways_data'),
+    url(r'^biasedpathways/data/(?P<column>\w+)$', DataSourceView.as_view(source=BiasPathwaysData), name='pathways_data'),
     url(r'^pathwaydata/(?P<pk>[-\w]+)/detail$', PathwayExperimentEntryView.as_view()),
 ]
@@ -1,18 +1,22 @@
-from django.db.models import Count, Avg, Min, Max
-from collections import defaultdict
+from django.db.models import Count, Avg, Min, Max, Q, Case, When, FloatField, FilteredRelation
+from django.db.models.functions import Cast, Substr
+from collections import defaultdict, OrderedDict
 from django.shortcuts import render
 from django.http import HttpResponse, HttpResponseRedirect
 from django.views.generic import TemplateView, View, DetailView, ListView
 
 from common.models import ReleaseNotes
+from common.datasource import Column, DataSource
 from common.phylogenetic_tree import PhylogeneticTreeGenerator
 from common.selection import Selection, SelectionItem
 from ligand.models import *
+from ligand.fingerprints import search_ligands, search_parameters, SIMILARITY
 from protein.models import Protein, Species, ProteinFamily
 
 from django.views.decorators.csrf import csrf_exempt
 
 from copy import deepcopy
+from string import Template
 import itertools
 import json
 
@@ -98,39 +102,50 @@ def LigandDetails(request, ligand_id):
     return render(request, 'ligand_details.html', context)
 
 
-def TargetDetailsCompact(request, **kwargs):
-    if 'slug' in kwargs:
-        slug = kwargs['slug']
-        if slug.count('_') == 0 :
-            ps = AssayExperiment.objects.filter(protein__family__parent__parent__parent__slug=slug, ligand__properities__web_links__web_resource__slug = 'chembl_ligand')
-        elif slug.count('_') == 1 and len(slug) == 7:
-            ps = AssayExperiment.objects.filter(protein__family__parent__parent__slug=slug, ligand__properities__web_links__web_resource__slug = 'chembl_ligand')
-        elif slug.count('_') == 2:
-            ps = AssayExperiment.objects.filter(protein__family__parent__slug=slug, ligand__properities__web_links__web_resource__slug = 'chembl_ligand')
-        #elif slug.count('_') == 3:
-        elif slug.count('_') == 1 and len(slug) != 7:
-            ps = AssayExperiment.objects.filter(protein__entry_name = slug, ligand__properities__web_links__web_resource__slug = 'chembl_ligand')
-
-        if slug.count('_') == 1 and len(slug) == 7:
-            f = ProteinFamily.objects.get(slug=slug)
-        else:
-            f = slug
-
-        context = {
-            'target':f
-            }
-    else:
-        simple_selection = request.session.get('selection', False)
-        selection = Selection()
-        if simple_selection:
-            selection.importer(simple_selection)
-        if selection.targets != []:
-            prot_ids = [x.item.id for x in selection.targets]
-            ps = AssayExperiment.objects.filter(protein__in=prot_ids, ligand__properities__web_links__web_resource__slug = 'chembl_ligand')
-            context = {
-                'target': ', '.join([x.item.entry_name for x in selection.targets])
-                }
-
+def target_summary_filter(slug):
+    """Q object selecting the LigandActivitySummary rows of a target page slug (family slug or entry name)"""
+    if slug.count('_') == 1 and len(slug) != 7:
+        return Q(protein__entry_name=slug)
+    # all targets of a class, receptor family or ligand type, a range scan of the family slug index
+    return Q(family_slug__startswith=slug + '_')
+
+def summary_ligand_data(summaries):
+    """Rows of target_details_compact.html from the activity summaries, merging the assay types of a ligand and target"""
+    summaries = summaries.order_by('ligand_id', 'protein_id', 'assay_type').values(
+        'ligand_id', 'chembl_id', 'protein_id', 'protein__entry_name', 'protein__species__common_name', 'assay_type',
+        'record_count', 'value_count', 'min_value', 'mean_value', 'max_value', 'standard_units', 'purchasable',
+        'ligand__properities__smiles', 'ligand__properities__mw', 'ligand__properities__rotatable_bonds',
+        'ligand__properities__hdon', 'ligand__properities__hacc', 'ligand__properities__logp')
+    ligand_data = []
+    for key, rows in itertools.groupby(summaries, key=lambda r: (r['ligand_id'], r['protein_id'])):
+        rows = list(rows)
+        first = rows[0]
+        measured = [r for r in rows if r['value_count']]
+        if not measured:
+            continue
+        value_count = sum([r['value_count'] for r in measured])
+        ligand_data.append({
+            'ligand_id': first['chembl_id'],
+            'protein_name': first['protein__entry_name'],
+            'species': first['protein__species__common_name'],
+            'record_count': sum([r['record_count'] for r in rows]),
+            'assay_type': ', '.join(OrderedDict.fromkeys(["Bind" if r['assay_type'] == 'b' else "Funct" for r in rows])),
+            'purchasability': 'Yes' if first['purchasable'] else 'No',
+            'low_value': min([r['min_value'] for r in measured]),
+            'average_value': sum([r['mean_value']*r['value_count'] for r in measured])/value_count,
+            'high_value': max([r['max_value'] for r in measured]),
+            'standard_units': ', '.join(sorted(set([u for r in rows for u in r['standard_units'].split(', ') if u]))),
+            'smiles': first['ligand__properities__smiles'],
+            'mw': first['ligand__properities__mw'],
+            'rotatable_bonds': first['ligand__properities__rotatable_bonds'],
+            'hdon': first['ligand__properities__hdon'],
+            'hacc': first['ligand__properities__hacc'],
+            'logp': first['ligand__properities__logp'],
+            })
+    return ligand_data
+
+def assay_ligand_data(ps):
+    """Rows of target_details_compact.html aggregated from the AssayExperiment rows (without activity summaries)"""
     ps = ps.prefetch_related('protein','ligand__properities__web_links__web_resource','ligand__properities__vendors__vendor')
     d = {}
     for p in ps:
@@ -148,7 +163,7 @@ def TargetDetailsCompact(request, **kwargs):
         vendors = lig.properities.vendors.all()
         purchasability = 'No'
         for v in vendors:
-            if v.vendor.name not in ['ZINC', 'ChEMBL', 'BindingDB', 'SureChEMBL', 'eMolecules', 'MolPort', 'PubChem']:
+            if v.vendor.name not in NON_PURCHASABLE_SOURCES:
                 purchasability = 'Yes'
 
         for record, vals in records.items():
@@ -190,7 +205,48 @@ def TargetDetailsCompact(request, **kwargs):
                     'hacc': lig.properities.hacc,
                     'logp': lig.properities.logp,
                     })
-    context['ligand_data'] = ligand_data
+    return ligand_data
+
+def TargetDetailsCompact(request, **kwargs):
+    if 'slug' in kwargs:
+        slug = kwargs['slug']
+        if slug.count('_') == 0 :
+            ps = AssayExperiment.objects.filter(protein__family__parent__parent__parent__slug=slug, ligand__properities__web_links__web_resource__slug = 'chembl_ligand')
+        elif slug.count('_') == 1 and len(slug) == 7:
+            ps = AssayExperiment.objects.filter(protein__family__parent__parent__slug=slug, ligand__properities__web_links__web_resource__slug = 'chembl_ligand')
+        elif slug.count('_') == 2:
+            ps = AssayExperiment.objects.filter(protein__family__parent__slug=slug, ligand__properities__web_links__web_resource__slug = 'chembl_ligand')
+        #elif slug.count('_') == 3:
+        elif slug.count('_') == 1 and len(slug) != 7:
+            ps = AssayExperiment.objects.filter(protein__entry_name = slug, ligand__properities__web_links__web_resource__slug = 'chembl_ligand')
+
+        summaries = LigandActivitySummary.objects.filter(target_summary_filter(slug), chembl_id__isnull=False)
+
+        if slug.count('_') == 1 and len(slug) == 7:
+            f = ProteinFamily.objects.get(slug=slug)
+        else:
+            f = slug
+
+        context = {
+            'target':f
+            }
+    else:
+        simple_selection = request.session.get('selection', False)
+        selection = Selection()
+        if simple_selection:
+            selection.importer(simple_selection)
+        if selection.targets != []:
+            prot_ids = [x.item.id for x in selection.targets]
+            ps = AssayExperiment.objects.filter(protein__in=prot_ids, ligand__properities__web_links__web_resource__slug = 'chembl_ligand')
+            summaries = LigandActivitySummary.objects.filter(protein__in=prot_ids, chembl_id__isnull=False)
+            context = {
+                'target': ', '.join([x.item.entry_name for x in selection.targets])
+                }
+
+    if LigandActivitySummary.objects.exists():
+        context['ligand_data'] = summary_ligand_data(summaries)
+    else:
+        context['ligand_data'] = assay_ligand_data(ps)
 
     return render(request, 'target_details_compact.html', context)
 
@@ -208,6 +264,8 @@ def TargetDetails(request, **kwargs):
         elif slug.count('_') == 1 and len(slug) != 7:
             ps = AssayExperiment.objects.filter(protein__entry_name = slug, ligand__properities__web_links__web_resource__slug = 'chembl_ligand')
 
+        summaries = LigandActivitySummary.objects.filter(target_summary_filter(slug), chembl_id__isnull=False)
+
         if slug.count('_') == 1 and len(slug) == 7:
             f = ProteinFamily.objects.get(slug=slug)
         else:
@@ -224,6 +282,7 @@ def TargetDetails(request, **kwargs):
         if selection.targets != []:
             prot_ids = [x.item.id for x in selection.targets]
             ps = AssayExperiment.objects.filter(protein__in=prot_ids, ligand__properities__web_links__web_resource__slug = 'chembl_ligand')
+            summaries = LigandActivitySummary.objects.filter(protein__in=prot_ids, chembl_id__isnull=False)
             context = {
                 'target': ', '.join([x.item.entry_name for x in selection.targets])
                 }
@@ -247,8 +306,13 @@ def TargetDetails(request, **kwargs):
                 'ligand__properities__hdon',
                 'ligand__properities__hacc','protein'
                 ).annotate(num_targets = Count('protein__id', distinct=True))
-    for record in ps:
-        record['purchasability'] = 'Yes' if len(LigandVendorLink.objects.filter(lp=record['ligand__properities_id']).exclude(vendor__name__in=['ZINC', 'ChEMBL', 'BindingDB', 'SureChEMBL', 'eMolecules', 'MolPort', 'PubChem'])) > 0 else 'No'
+    if LigandActivitySummary.objects.exists():
+        purchasable = set(summaries.filter(purchasable=True).values_list('ligand_id', flat=True))
+        for record in ps:
+            record['purchasability'] = 'Yes' if record['ligand__id'] in purchasable else 'No'
+    else:
+        for record in ps:
+            record['purchasability'] = 'Yes' if len(LigandVendorLink.objects.filter(lp=record['ligand__properities_id']).exclude(vendor__name__in=NON_PURCHASABLE_SOURCES)) > 0 else 'No'
 
     context['proteins'] = ps
 
@@ -319,16 +383,22 @@ class LigandStatistics(TemplateView):
     def get_context_data (self, **kwargs):
 
         context = super().get_context_data(**kwargs)
-        assays = AssayExperiment.objects.all().prefetch_related('protein__family__parent__parent__parent', 'protein__family')
-
         lig_count_dict = {}
-        assays_lig = list(AssayExperiment.objects.all().values('protein__family__parent__parent__parent__name').annotate(c=Count('ligand',distinct=True)))
-        for a in assays_lig:
-            lig_count_dict[a['protein__family__parent__parent__parent__name']] = a['c']
         target_count_dict = {}
-        assays_target = list(AssayExperiment.objects.all().values('protein__family__parent__parent__parent__name').annotate(c=Count('protein__family',distinct=True)))
-        for a in assays_target:
-            target_count_dict[a['protein__family__parent__parent__parent__name']] = a['c']
+        if LigandActivitySummary.objects.exists():
+            # per class counts from the activity summaries, without joining the assays to the family tree
+            assays_class = LigandActivitySummary.objects.annotate(class_slug=Substr('family_slug', 1, 3)).values(
+                'class_slug').annotate(ligands=Count('ligand', distinct=True), targets=Count('family_slug', distinct=True))
+            for a in assays_class:
+                lig_count_dict[a['class_slug']] = a['ligands']
+                target_count_dict[a['class_slug']] = a['targets']
+        else:
+            assays_lig = list(AssayExperiment.objects.all().values('protein__family__parent__parent__parent__slug').annotate(c=Count('ligand',distinct=True)))
+            for a in assays_lig:
+                lig_count_dict[a['protein__family__parent__parent__parent__slug']] = a['c']
+            assays_target = list(AssayExperiment.objects.all().values('protein__family__parent__parent__parent__slug').annotate(c=Count('protein__family',distinct=True)))
+            for a in assays_target:
+                target_count_dict[a['protein__family__parent__parent__parent__slug']] = a['c']
 
         prot_count_dict = {}
         proteins_count = list(Protein.objects.all().values('family__parent__parent__parent__name').annotate(c=Count('family',distinct=True)))
@@ -340,9 +410,9 @@ class LigandStatistics(TemplateView):
         ligands = []
 
         for fam in classes:
-            if fam.name in lig_count_dict:
-                lig_count = lig_count_dict[fam.name]
-                target_count = target_count_dict[fam.name]
+            if fam.slug in lig_count_dict:
+                lig_count = lig_count_dict[fam.slug]
+                target_count = target_count_dict[fam.slug]
             else:
                 lig_count = 0
                 target_count = 0
@@ -422,6 +492,22 @@ class LigandStatistics(TemplateView):
 
         return context
 
+def LigandSearch(request):
+    """
+    Chemical similarity (Tanimoto of Morgan fingerprints) or substructure search of the ligands by SMILES.
+    """
+    context = {'smiles': request.GET.get('smiles', ''), 'mode': request.GET.get('mode', SIMILARITY)}
+    if context['smiles']:
+        try:
+            smiles, mode, limit, threshold = search_parameters(request.GET)
+            context['results'] = search_ligands(smiles, mode, limit, threshold)
+        except ValueError as msg:
+            context['error'] = str(msg)
+        except FileNotFoundError:
+            context['error'] = 'The ligand search is not available'
+
+    return render(request, 'ligand_search.html', context)
+
 #Biased Ligands part
 
 class ExperimentEntryView(DetailView):
@@ -491,461 +577,200 @@ class BiasVendorBrowser(TemplateView):
 
 '''
 Bias browser between families
-access data from db, fill empty fields with empty parse_children
+the rows are loaded page by page from BiasBrowserData
 '''
 class BiasBrowser(TemplateView):
 
     template_name = 'bias_browser.html'
-    #@cache_page(50000)
-    def get_context_data(self, *args, **kwargs  ):
-
-        content = AnalyzedExperiment.objects.filter(source='different_family').prefetch_related(
-        'analyzed_data', 'ligand','ligand__reference_ligand','reference_ligand',
-        'endogenous_ligand' ,'ligand__properities','receptor','receptor','receptor__family',
-        'receptor__family__parent','receptor__family__parent__parent__parent',
-        'receptor__family__parent__parent','receptor__family', 'receptor__species',
-        'publication', 'publication__web_link', 'publication__web_link__web_resource',
-        'publication__journal', 'ligand__ref_ligand_bias_analyzed',
-        'analyzed_data__emax_ligand_reference')
-        context = dict()
-        prepare_data = self.process_data(content)
-
-        keys = [k for k, v in prepare_data.items() if len(v['biasdata']) < 2]
-        for x in keys:
-            del prepare_data[x]
 
-        self.multply_assay(prepare_data)
-        context.update({'data': prepare_data})
-
-        return context
-
-    def process_data(self, content):
-        '''
-        Merge BiasedExperiment with its children
-        and pass it back to loop through dublicates
-        '''
-        rd = dict()
-        increment = 0
-
-        for instance in content:
-            fin_obj = {}
-            fin_obj['main'] = instance
-            temp = dict()
-            doubles = []
-            temp['experiment_id'] = instance.id
-            temp['publication'] = instance.publication
-            temp['ligand'] = instance.ligand
-            temp['source'] = instance.source
-            temp['chembl'] = instance.chembl
-            temp['endogenous_ligand'] = instance.endogenous_ligand
-            temp['vendor_quantity'] = instance.vendor_quantity
-            temp['publication_quantity'] = instance.article_quantity
-            temp['lab_quantity'] = instance.labs_quantity
-            temp['reference_ligand'] = instance.reference_ligand
-            temp['primary'] = instance.primary.replace(' family,','')
-            temp['secondary'] = instance.secondary.replace(' family,','')
-
-            if instance.receptor:
-                temp['class'] = instance.receptor.family.parent.parent.parent.name.replace('Class','').strip()
-                temp['receptor'] = instance.receptor
-                temp['uniprot'] = instance.receptor.entry_short
-                temp['IUPHAR'] = instance.receptor.name.split(' ', 1)[0].split('-adrenoceptor', 1)[0].strip()
-            else:
-                temp['receptor'] = 'Error appeared'
-            temp['biasdata'] = list()
-            increment_assay = 0
-            for entry in instance.analyzed_data.all():
-                if entry.order_no < 5:
-
-                    temp_dict = dict()
-                    temp_dict['emax_reference_ligand'] = entry.emax_ligand_reference
-                    temp_dict['family'] = entry.family
-                    temp_dict['show_family'] = entry.signalling_protein
-                    temp_dict['signalling_protein'] = entry.signalling_protein
-                    temp_dict['cell_line'] = entry.cell_line
-                    temp_dict['assay_type'] = entry.assay_type
-                    temp_dict['assay_measure'] = entry.assay_measure
-                    temp_dict['assay_time_resolved'] = entry.assay_time_resolved
-                    temp_dict['ligand_function'] = entry.ligand_function
-                    temp_dict['quantitive_measure_type'] = entry.quantitive_measure_type
-                    temp_dict['quantitive_activity'] = entry.quantitive_activity
-                    temp_dict['quantitive_activity_initial'] = entry.quantitive_activity_initial
-                    temp_dict['quantitive_unit'] = entry.quantitive_unit
-                    temp_dict['qualitative_activity'] = entry.qualitative_activity
-                    temp_dict['quantitive_efficacy'] = entry.quantitive_efficacy
-                    temp_dict['efficacy_measure_type'] = entry.efficacy_measure_type
-                    temp_dict['efficacy_unit'] = entry.efficacy_unit
-                    temp_dict['order_no'] =  int(entry.order_no)
-                    temp_dict['t_coefficient'] = entry.t_coefficient
-                    if entry.t_value != None and entry.t_value !='None':
-                        temp_dict['t_value'] = entry.t_value
-                    else:
-                        temp_dict['t_value'] = ''
-
-                    if entry.t_factor != None and entry.t_factor !='None':
-                        temp_dict['t_factor'] = entry.t_factor
-                    else:
-                        temp_dict['t_factor'] = ''
-
-                    if entry.potency != None and entry.potency !='None':
-                        temp_dict['potency'] =  entry.potency
-                    else:
-                        temp_dict['potency'] = ''
-
-                    if entry.log_bias_factor != None and entry.log_bias_factor !='None':
-                        temp_dict['log_bias_factor'] = entry.log_bias_factor
-                    else:
-                        temp_dict['log_bias_factor'] = ''
-
-                    temp_dict['emax_ligand_reference'] = entry.emax_ligand_reference
-
-                    temp['biasdata'].append(temp_dict)
-
-                    doubles.append(temp_dict)
-                    increment_assay+=1
-                else:
-                    continue
-
-            rd[increment] = temp
-            increment+=1
-
-
-        return rd
-
-    def multply_assay(self, data):
-
-        for i in data.items():
-
-            lenght = len(i[1]['biasdata'])
-            for key in range(lenght,5):
-                temp_dict = dict()
-                temp_dict['pathway'] = ''
-                temp_dict['bias'] = ''
-                temp_dict['cell_line'] = ''
-                temp_dict['assay_type'] = ''
-                temp_dict['log_bias_factor'] = ''
-                temp_dict['t_factor'] = ''
-                temp_dict['ligand_function'] = ''
-                temp_dict['order_no'] = lenght
-                i[1]['biasdata'].append(temp_dict)
-                lenght+=1
-            test = sorted(i[1]['biasdata'], key=lambda x: x['order_no'],
-                          reverse=True)
-            i[1]['biasdata'] = test
-
-    '''
-    End  of Bias Browser
-    '''
 
+'''
+Bias browser between G protein subtypes
+the rows are loaded page by page from BiasBrowserGSubtypeData
+'''
 class BiasBrowserGSubbtype(TemplateView):
     template_name = 'bias_browser_g.html'
-    #@cache_page(50000)
-    def get_context_data(self, *args, **kwargs  ):
-
-        content = AnalyzedExperiment.objects.filter(source='same_family').prefetch_related(
-    'analyzed_data', 'ligand','ligand__reference_ligand','reference_ligand',
-    'endogenous_ligand' ,'ligand__properities','receptor','receptor__family__parent','receptor__family__parent__parent__parent',
-    'receptor__family__parent__parent','receptor__species',
-    'publication', 'publication__web_link', 'publication__web_link__web_resource',
-    'publication__journal', 'ligand__ref_ligand_bias_analyzed',
-    'analyzed_data__emax_ligand_reference')
-        context = dict()
-        prepare_data = self.process_data(content)
-
-        keys = [k for k, v in prepare_data.items() if len(v['biasdata']) < 2]
-        for x in keys:
-            del prepare_data[x]
-
-        self.multply_assay(prepare_data)
-        context.update({'data': prepare_data})
-        return context
-
-    def process_data(self, content):
-        '''
-        Merge BiasedExperiment with its children
-        and pass it back to loop through dublicates
-        '''
-        rd = dict()
-        increment = 0
-
-        for instance in content:
-            fin_obj = {}
-            fin_obj['main'] = instance
-            temp = dict()
-            doubles = []
-            # TODO: mutation residue
-            temp['experiment_id'] = instance.id
-            temp['publication'] = instance.publication
-            temp['ligand'] = instance.ligand
-            temp['source'] = instance.source
-            temp['chembl'] = instance.chembl
-            temp['endogenous_ligand'] = instance.endogenous_ligand
-            temp['vendor_quantity'] = instance.vendor_quantity
-            temp['publication_quantity'] = instance.article_quantity
-            temp['lab_quantity'] = instance.labs_quantity
-            temp['reference_ligand'] = instance.reference_ligand
-            temp['primary'] =   instance.primary
-            temp['secondary'] = instance.secondary
-            if instance.receptor:
-                temp['class'] = instance.receptor.family.parent.parent.parent.name.replace('Class','').strip()
-                temp['receptor'] = instance.receptor
-                temp['uniprot'] = instance.receptor.entry_short
-                temp['IUPHAR'] = instance.receptor.name.split(' ', 1)[0].strip()
-            else:
-                temp['receptor'] = 'Error appeared'
-            temp['biasdata'] = list()
-            increment_assay = 0
-            for entry in instance.analyzed_data.all():
-                if entry.order_no < 5:
-
-                    temp_dict = dict()
-                    temp_dict['emax_reference_ligand'] = entry.emax_ligand_reference
-                    temp_dict['family'] = entry.family
-                    temp_dict['show_family'] = entry.signalling_protein
-                    temp_dict['signalling_protein'] = entry.signalling_protein
-                    temp_dict['cell_line'] = entry.cell_line
-                    temp_dict['assay_type'] = entry.assay_type
-                    temp_dict['assay_measure'] = entry.assay_measure
-                    temp_dict['assay_time_resolved'] = entry.assay_time_resolved
-                    temp_dict['ligand_function'] = entry.ligand_function
-                    temp_dict['quantitive_measure_type'] = entry.quantitive_measure_type
-                    temp_dict['quantitive_activity'] = entry.quantitive_activity
-                    temp_dict['quantitive_activity_initial'] = entry.quantitive_activity_initial
-                    temp_dict['quantitive_unit'] = entry.quantitive_unit
-                    temp_dict['qualitative_activity'] = entry.qualitative_activity
-                    temp_dict['quantitive_efficacy'] = entry.quantitive_efficacy
-                    temp_dict['efficacy_measure_type'] = entry.efficacy_measure_type
-                    temp_dict['efficacy_unit'] = entry.efficacy_unit
-                    temp_dict['order_no'] =  int(entry.order_no)
-                    temp_dict['t_coefficient'] = entry.t_coefficient
-                    if entry.t_value != None and entry.t_value !='None':
-                        temp_dict['t_value'] = entry.t_value
-                    else:
-                        temp_dict['t_value'] = ''
-
-                    if entry.t_factor != None and entry.t_factor !='None':
-                        temp_dict['t_factor'] = entry.t_factor
-                    else:
-                        temp_dict['t_factor'] = ''
-
-                    if entry.potency != None and entry.potency !='None':
-                        temp_dict['potency'] =  entry.potency
-                    else:
-                        temp_dict['potency'] = ''
-
-                    if entry.log_bias_factor != None and entry.log_bias_factor !='None':
-                        temp_dict['log_bias_factor'] = entry.log_bias_factor
-                    else:
-                        temp_dict['log_bias_factor'] = ''
-
-                    temp_dict['emax_ligand_reference'] = entry.emax_ligand_reference
-
-                    temp['biasdata'].append(temp_dict)
-
-                    doubles.append(temp_dict)
-                    increment_assay+=1
-                else:
-                    continue
-
-            rd[increment] = temp
-            increment+=1
-
-
-        return rd
-
-    def multply_assay(self, data):
-
-        for i in data.items():
-
-            lenght = len(i[1]['biasdata'])
-            for key in range(lenght,5):
-                temp_dict = dict()
-                temp_dict['pathway'] = ''
-                temp_dict['bias'] = ''
-                temp_dict['cell_line'] = ''
-                temp_dict['assay_type'] = ''
-                temp_dict['log_bias_factor'] = ''
-                temp_dict['t_factor'] = ''
-                temp_dict['ligand_function'] = ''
-                temp_dict['order_no'] = lenght
-                i[1]['biasdata'].append(temp_dict)
-                lenght+=1
-            test = sorted(i[1]['biasdata'], key=lambda x: x['order_no'],
-                          reverse=True)
-            i[1]['biasdata'] = test
-
 
 
 '''
-Bias browser between families
-access data from db, fill empty fields with empty parse_children
+Bias browser of the ChEMBL data
+the rows are loaded page by page from BiasBrowserChemblData
 '''
 class BiasBrowserChembl(TemplateView):
     template_name = 'bias_browser_chembl.html'
-    #@cache_page(50000)
-    def get_context_data(self, *args, **kwargs  ):
-        content = AnalyzedExperiment.objects.filter(source='chembl_data').prefetch_related(
-            'analyzed_data', 'ligand','ligand__reference_ligand','reference_ligand',
-            'endogenous_ligand' ,'ligand__properities','receptor','receptor__family',
-            'receptor__family__parent','receptor__family__parent__parent__parent',
-            'receptor__family__parent__parent','receptor__species',
-            'publication', 'publication__web_link', 'publication__web_link__web_resource',
-            'publication__journal', 'ligand__ref_ligand_bias_analyzed',
-            'analyzed_data__emax_ligand_reference')
-        context = dict()
-        prepare_data = self.process_data(content)
-        keys = [k for k, v in prepare_data.items() if len(v['biasdata']) < 2]
-        for x in keys:
-            del prepare_data[x]
 
-        self.multply_assay(prepare_data)
-        context.update({'data': prepare_data})
-        return context
-
-    def process_data(self, content):
-        '''
-        Merge BiasedExperiment with its children
-        and pass it back to loop through dublicates
-        '''
-        rd = dict()
-        increment = 0
-
-        for instance in content:
-            fin_obj = {}
-            fin_obj['main'] = instance
-            temp = dict()
-            doubles = []
-            # TODO: mutation residue
-            temp['experiment_id'] = instance.id
-            temp['ligand'] = instance.ligand
-            temp['source'] = instance.source
-            temp['chembl'] = instance.chembl
-            temp['endogenous_ligand'] = instance.endogenous_ligand
-            temp['vendor_quantity'] = instance.vendor_quantity
-            temp['primary'] =   instance.primary
-            temp['secondary'] = instance.secondary
-
-            if instance.receptor:
-                temp['receptor'] = instance.receptor
-            else:
-                temp['receptor'] = 'Error appeared'
-            temp['biasdata'] = list()
-            increment_assay = 0
-            for entry in instance.analyzed_data.all():
-                if entry.order_no < 5:
-                    temp_dict = dict()
-                    temp_dict['family'] = entry.family
-                    temp_dict['assay'] = entry.assay_type
-                    temp_dict['assay_description'] = entry.assay_description
-                    temp_dict['show_family'] = entry.signalling_protein
-                    temp_dict['signalling_protein'] = entry.signalling_protein
-                    temp_dict['quantitive_measure_type'] = entry.quantitive_measure_type
-                    temp_dict['quantitive_activity'] = entry.quantitive_activity
-                    temp_dict['quantitive_activity_initial'] = entry.quantitive_activity_initial
-                    temp_dict['quantitive_unit'] = entry.quantitive_unit
-                    temp_dict['qualitative_activity'] = entry.qualitative_activity
-                    temp_dict['order_no'] =  int(entry.order_no)
-
-                    if entry.potency != None and entry.potency !='None':
-                        temp_dict['potency'] =  entry.potency
-                    else:
-                        temp_dict['potency'] = ''
-
-                    temp['biasdata'].append(temp_dict)
-                    doubles.append(temp_dict)
-                    increment_assay+=1
-                else:
-                    continue
-            rd[increment] = temp
-            increment+=1
-        return rd
-
-    def multply_assay(self, data):
-
-        for i in data.items():
-
-            lenght = len(i[1]['biasdata'])
-            for key in range(lenght,5):
-                temp_dict = dict()
-                temp_dict['pathway'] = ''
-                temp_dict['order_no'] = lenght
-                i[1]['biasdata'].append(temp_dict)
-                lenght+=1
-            test = sorted(i[1]['biasdata'], key=lambda x: x['order_no'],
-                          reverse=True)
-            i[1]['biasdata'] = test
-
-
-
-
-    '''
-    End  of Bias Browser
-    '''
 
+'''
+Biased pathways browser
+the rows are loaded page by page from BiasPathwaysData
+'''
 class BiasPathways(TemplateView):
 
     template_name = 'bias_browser_pathways.html'
-    #@cache_page(50000)
-    def get_context_data(self, *args, **kwargs  ):
-        content = BiasedPathways.objects.all().prefetch_related(
-        'biased_pathway', 'ligand','receptor','receptor','receptor__family',
-        'receptor__family__parent','receptor__family__parent__parent__parent',
-        'receptor__family__parent__parent','receptor__species',
-        'publication', 'publication__web_link', 'publication__web_link__web_resource',
-        'publication__journal')
-        context = dict()
-        prepare_data = self.process_data(content)
-        context.update({'data': prepare_data})
 
-        return context
-
-    def process_data(self, content):
-        '''
-        Merge BiasedExperiment with its children
-        and pass it back to loop through dublicates
-        '''
-        rd = dict()
-        increment = 0
-
-        for instance in content:
-            fin_obj = {}
-            fin_obj['main'] = instance
-            temp = dict()
-            doubles = []
-            # TODO: mutation residue
-            temp['experiment_id'] = instance.id
-            temp['publication'] = instance.publication
-            temp['ligand'] = instance.ligand
-            temp['rece'] = instance.chembl
-            temp['chembl'] = instance.chembl
-            temp['relevance'] = instance.relevance
-            temp['signalling_protein'] = instance.signalling_protein
-
-            if instance.receptor:
-                temp['receptor'] = instance.receptor
-                temp['uniprot'] = instance.receptor.entry_short
-                temp['IUPHAR'] = instance.receptor.name.split(' ', 1)[0].strip()
-            else:
-                temp['receptor'] = 'Error appeared'
-            # at the moment, there is only 1 pathways for every biased_pathway
-            # change if more pathways added (logic changed)
-            for entry in instance.biased_pathway.all():
-                temp['pathway_outcome_high'] = entry.pathway_outcome_high
-                temp['pathway_outcome_summary'] = entry.pathway_outcome_summary
-                temp['pathway_outcome_detail'] = entry.pathway_outcome_detail
-                temp['experiment_pathway_distinction'] = entry.experiment_pathway_distinction
-                temp['experiment_system'] = entry.experiment_system
-                temp['experiment_outcome_method'] = entry.experiment_outcome_method
 
-            rd[increment] = temp
-            increment+=1
+def short_entry_name(entry_name):
+    return entry_name.split('_')[0].upper()
 
 
-        return rd
+def short_receptor_name(name):
+    return name.split(' ', 1)[0].split('-adrenoceptor', 1)[0].strip()
 
 
+def number(field):
+    """The numbers of a text field, None for other text (e.g. 'High Bias' or the string None)"""
+    return Case(When(**{field + '__regex': r'^-?[0-9]+(\.[0-9]+)?$', 'then': Cast(field, FloatField())}),
+        default=None, output_field=FloatField())
 
 
-    '''
-    End  of Bias Browser
-    '''
+class AnalyzedExperimentData(DataSource):
+    """
+    Rows of a bias browser (the AnalyzedExperiments of a source with at least two assays), paged, sorted and
+    filtered in the database (see common.datasource), with the values of the first five assays (pathways) of every
+    experiment as the columns <name>_<1-5>
+    """
+    experiment_source = None
+    # text fields of numbers, filtered by their numbers (<field>_number)
+    numbers = ['vendor_quantity', 'article_quantity', 'labs_quantity']
+    experiment_columns = [
+        Column('class', 'receptor__family__parent__parent__parent__name', search='exact', searchable=True,
+            format=lambda v: v.replace('Class', '').strip()),
+        Column('receptor_family', 'receptor__family__parent__name', search='exact', searchable=True),
+        Column('accession', 'receptor__accession', search='exact', searchable=True),
+        Column('uniprot', 'receptor__entry_name', search='exact', searchable=True, format=short_entry_name),
+        Column('iuphar', 'receptor__name', search='exact', searchable=True, format=short_receptor_name),
+        Column('species', 'receptor__species__common_name', search='exact'),
+        Column('ligand_id', 'ligand', search=None),
+        Column('ligand', 'ligand__name', search='exact', searchable=True),
+        Column('chembl'),
+        Column('endogenous_ligand', 'endogenous_ligand__name', search='exact', searchable=True),
+        Column('reference_ligand', 'reference_ligand__name', search='exact', searchable=True),
+        Column('primary', search='exact', searchable=True, format=lambda v: v.replace(' family,', '')),
+        Column('secondary', search='exact', searchable=True, format=lambda v: v.replace(' family,', '')),
+        Column('vendor_quantity', search='range', filter_field='vendor_quantity_number'),
+        Column('article_quantity', search='range', filter_field='article_quantity_number'),
+        Column('labs_quantity', search='range', filter_field='labs_quantity_number'),
+        Column('authors', 'publication__authors', search='exact', searchable=True),
+        Column('year', 'publication__year', search='range'),
+        Column('journal', 'publication__journal__name', search='exact'),
+        Column('doi', 'publication__web_link__index', search='exact', searchable=True),
+        Column('doi_url', 'publication__web_link__web_resource__url', search=None),
+        ]
+    # name, AnalyzedAssay field and search of the values of the assays
+    assay_fields = [
+        ('family', 'family', 'exact'),
+        ('t_factor', 't_factor', 'range'),
+        ('log_bias_factor', 'log_bias_factor', 'range'),
+        ('potency', 'potency', 'range'),
+        ('activity', 'quantitive_activity_initial', 'range'),
+        ('measure_type', 'quantitive_measure_type', None),
+        ('qualitative_activity', 'qualitative_activity', None),
+        ('efficacy', 'quantitive_efficacy', 'range'),
+        ('t_coefficient', 't_coefficient', 'range'),
+        ('assay_type', 'assay_type', 'exact'),
+        ('cell_line', 'cell_line', 'exact'),
+        ('time_resolved', 'assay_time_resolved', 'exact'),
+        ]
+    assay_numbers = ['t_factor', 'log_bias_factor', 'potency', 't_coefficient']
+
+    @classmethod
+    def assay_columns(cls):
+        columns = []
+        for i in range(1, 6):
+            for name, field, search in cls.assay_fields:
+                filter_field = 'assay{}_{}_number'.format(i, field) if field in cls.assay_numbers else None
+                columns.append(Column('{}_{}'.format(name, i), 'assay{}__{}'.format(i, field), search=search,
+                    filter_field=filter_field, searchable=search == 'exact'))
+        return columns
+
+    def __init__(self):
+        self.columns = self.experiment_columns + self.assay_columns()
+        super().__init__()
+
+    def get_queryset(self):
+        compared = AnalyzedAssay.objects.filter(order_no__lt=5).values('experiment').annotate(
+            assays=Count('id')).filter(assays__gte=2).values('experiment')
+        # the assays are numbered 0-4 (order_no) by the build, one join per assay
+        assays = dict([('assay{}'.format(i), FilteredRelation('analyzed_data',
+            condition=Q(analyzed_data__order_no=i - 1))) for i in range(1, 6)])
+        numbers = dict([(field + '_number', number(field)) for field in self.numbers])
+        for i in range(1, 6):
+            for field in self.assay_numbers:
+                numbers['assay{}_{}_number'.format(i, field)] = number('assay{}__{}'.format(i, field))
+        return AnalyzedExperiment.objects.filter(source=self.experiment_source, pk__in=compared).annotate(
+            **assays).annotate(**numbers)
+
+    def extend_rows(self, rows):
+        for row in rows:
+            if row['doi_url']:
+                row['doi_url'] = Template(row['doi_url']).substitute(index=row['doi'])
+            # missing values were imported as the string None
+            for name, value in row.items():
+                if value == 'None':
+                    row[name] = None
+
+
+class BiasBrowserData(AnalyzedExperimentData):
+    name = 'bias_browser'
+    experiment_source = 'different_family'
+
+
+class BiasBrowserGSubtypeData(AnalyzedExperimentData):
+    name = 'bias_g_browser'
+    experiment_source = 'same_family'
+
+
+class BiasBrowserChemblData(AnalyzedExperimentData):
+    name = 'bias_chembl_browser'
+    experiment_source = 'chembl_data'
+    assay_fields = [
+        ('signalling_protein', 'signalling_protein', 'exact'),
+        ('potency', 'potency', 'range'),
+        ('activity', 'quantitive_activity', 'range'),
+        ('measure_type', 'quantitive_measure_type', None),
+        ('qualitative_activity', 'qualitative_activity', None),
+        ('assay_type', 'assay_type', 'exact'),
+        ('assay_description', 'assay_description', 'icontains'),
+        ]
+    assay_numbers = ['potency']
+
+
+class BiasPathwaysData(DataSource):
+    """
+    Rows of the biased pathways browser, one per pathway of a BiasedPathways entry (there is one pathway per entry
+    at the moment), paged, sorted and filtered in the database (see common.datasource)
+    """
+    name = 'bias_pathways'
+    columns = [
+        Column('class', 'receptor__family__parent__parent__parent__name', search='exact', searchable=True),
+        Column('receptor_family', 'receptor__family__parent__name', search='exact', searchable=True),
+        Column('accession', 'receptor__accession', search='exact', searchable=True),
+        Column('uniprot', 'receptor__entry_name', search='exact', searchable=True, format=short_entry_name),
+        Column('species', 'receptor__species__common_name', search='exact'),
+        Column('ligand_id', 'ligand', search=None),
+        Column('ligand', 'ligand__name', search='exact', searchable=True),
+        Column('chembl'),
+        Column('signalling_protein', search='exact', searchable=True),
+        Column('relevance', search='exact', searchable=True),
+        Column('pathway_outcome_high', 'biased_pathway__pathway_outcome_high', search='exact', searchable=True),
+        Column('pathway_outcome_summary', 'biased_pathway__pathway_outcome_summary', search='exact',
+            searchable=True),
+        Column('pathway_outcome_detail', 'biased_pathway__pathway_outcome_detail', search='exact', searchable=True),
+        Column('experiment_pathway_distinction', 'biased_pathway__experiment_pathway_distinction', search='exact',
+            searchable=True),
+        Column('experiment_system', 'biased_pathway__experiment_system', search='exact', searchable=True),
+        Column('experiment_outcome_method', 'biased_pathway__experiment_outcome_method', search='exact',
+            searchable=True),
+        Column('authors', 'publication__authors', search='exact', searchable=True),
+        Column('doi', 'publication__web_link__index', search='exact', searchable=True),
+        Column('doi_url', 'publication__web_link__web_resource__url', search=None),
+        Column('reference', 'publication__reference', search=None),
+        ]
+
+    def get_queryset(self):
+        return BiasedPathways.objects.all()
+
+    def extend_rows(self, rows):
+        for row in rows:
+            if row['doi_url']:
+                row['doi_url'] = Template(row['doi_url']).substitute(index=row['doi'])
@@ -1261,8 +1261,9 @@ def showcalculation(request):
         # build the alignment data matrix
         a.build_alignment()
 
-        # calculate similarity
-        a.calculate_similarity()
+        # calculate similarity (precomputed for most receptors)
+        if not a.load_similarity_from_store():
+            a.calculate_similarity()
 
         a.calculate_statistics()
         generic_aa_count = a.calculate_aa_count_per_generic_number()
@@ -0,0 +1,349 @@
+"""
+Phylogenetic trees of aligned protein sequences
+
+Replaces the PHYLIP pipeline (seqboot, protdist, neighbor, consense) that was run on temporary files. The
+alignment is encoded as a matrix of amino acid codes. Protein distances are maximum likelihood distances under
+the Jones-Taylor-Thornton (JTT) model, the protdist default, estimated for all pairs at once from the counts of
+aligned amino acid pairs; the faster Kimura formula (protdist option P) is available as model KIMURA.
+Neighbor-joining or UPGMA trees are built from the distance matrix. Bootstrap replicates are column weights drawn
+from a seeded generator (like seqboot), optionally run in a process pool; the replicate trees are summarised as
+an extended majority rule consensus tree with the number of replicates supporting each group as branch lengths
+(like consense). Trees are written as Newick.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter
+
+import multiprocessing
+
+import numpy
+import scipy.cluster.hierarchy as sch
+import scipy.spatial.distance as ssd
+
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+GAP = 255
+
+# distance of sequence pairs that are too different for the Kimura formula (or have no positions in common)
+MAX_DISTANCE = 10.0
+
+NEIGHBOR_JOINING = 'nj'
+UPGMA = 'upgma'
+
+JTT = 'jtt'
+KIMURA = 'kimura'
+
+# JTT exchangeabilities (lower triangle) and amino acid frequencies, in the order of JTT_AMINO_ACIDS
+# (Jones, Taylor & Thornton, CABIOS 8:275-282, 1992; as distributed with PAML)
+JTT_AMINO_ACIDS = 'ARNDCQEGHILKMFPSTWYV'
+JTT_EXCHANGEABILITIES = """
+ 58
+ 54  45
+ 81  16 528
+ 56 113  34  10
+ 57 310  86  49   9
+105  29  58 767   5 323
+179 137  81 130  59  26 119
+ 27 328 391 112  69 597  26  23
+ 36  22  47  11  17   9  12   6  16
+ 30  38  12   7  23  72   9   6  56 229
+ 35 646 263  26   7 292 181  27  45  21  14
+ 54  44  30  15  31  43  18  14  33 479 388  65
+ 15   5  10   4  78   4   5   5  40  89 248   4  43
+194  74  15  15  14 164  18  24 115  10 102  21  16  17
+378 101 503  59 223  53  30 201  73  40  59  47  29  92 285
+475  64 232  38  42  51  32  33  46 245  25 103 226  12 118 477
+  9 126   8   4 115  18  10  55   8   9  52  10  24  53   6  35  12
+ 11  20  70  46 209  24   7   8 573  32  24   8  18 536  10  63  21  71
+298  17  16  31  62  20  45  47  11 961 180  14 323  62  23  38 112  25  16
+"""
+JTT_FREQUENCIES = [0.076748, 0.051691, 0.042645, 0.051544, 0.019803, 0.040752, 0.061830, 0.073152, 0.022944,
+    0.053761, 0.091904, 0.058676, 0.023826, 0.040126, 0.050901, 0.068765, 0.058565, 0.014261, 0.032102, 0.066005]
+
+
+class TreeNode(object):
+    """Node of a tree, leaves have a name, internal nodes (child node, branch length) pairs"""
+
+    def __init__(self, name=None, children=None):
+        self.name = name
+        self.children = children or []
+
+    def postorder(self):
+        stack = [(self, False)]
+        while stack:
+            node, visited = stack.pop()
+            if visited or not node.children:
+                yield node
+            else:
+                stack.append((node, True))
+                stack.extend((child, False) for child, length in reversed(node.children))
+
+    def to_newick(self, length_format='{:.5f}'):
+        newick = {}
+        for node in self.postorder():
+            if node.children:
+                newick[node] = '(' + ','.join('{}:{}'.format(newick.pop(child), length_format.format(length))
+                    for child, length in node.children) + ')'
+            else:
+                newick[node] = str(node.name)
+        return newick[self] + ';'
+
+
+def encode_sequences(sequences):
+    """Matrix of amino acid codes (GAP for gaps and unknown residues) of equal length aligned sequences"""
+    lookup = numpy.full(256, GAP, dtype=numpy.uint8)
+    for code, amino_acid in enumerate(AMINO_ACIDS):
+        lookup[ord(amino_acid)] = code
+        lookup[ord(amino_acid.lower())] = code
+    return lookup[numpy.array([numpy.frombuffer(s.encode('ascii', 'replace'), dtype=numpy.uint8) for s in sequences])]
+
+
+def kimura_distances(encoded, weights=None):
+    """
+    Distances between all pairs of encoded sequences, -ln(1 - p - 0.2p^2) with p the fraction of differing
+    residues at the (weighted) positions where both sequences have a residue
+    """
+    if weights is None:
+        weights = numpy.ones(encoded.shape[1])
+    weights = numpy.asarray(weights, dtype=numpy.float64)
+
+    present = (encoded != GAP).astype(numpy.float64)
+    compared = (present * weights) @ present.T
+    identical = numpy.zeros_like(compared)
+    for code in range(len(AMINO_ACIDS)):
+        residues = (encoded == code).astype(numpy.float64)
+        identical += (residues * weights) @ residues.T
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        p = 1 - identical / compared
+        kimura = 1 - p - 0.2 * p * p
+        distances = numpy.where((compared > 0) & (kimura > 0), -numpy.log(kimura), MAX_DISTANCE)
+    distances = numpy.minimum(distances, MAX_DISTANCE)
+    numpy.fill_diagonal(distances, 0)
+    return distances
+
+
+class SubstitutionModel(object):
+    """
+    Reversible amino acid substitution model (in the order of AMINO_ACIDS), scaled to one expected substitution
+    per unit of time. The transition probabilities of the (unordered) amino acid pairs are written as
+    exp(eigenvalues * t) @ pair_terms.
+    """
+
+    def __init__(self, exchangeabilities, frequencies, amino_acids):
+        order = [amino_acids.index(amino_acid) for amino_acid in AMINO_ACIDS]
+        rows = [[float(value) for value in line.split()] for line in exchangeabilities.strip().split('\n')]
+        s = numpy.zeros((len(amino_acids), len(amino_acids)))
+        for i, row in enumerate(rows):
+            s[i+1, :len(row)] = row
+        s = (s + s.T)[numpy.ix_(order, order)]
+        pi = numpy.asarray(frequencies, dtype=numpy.float64)[order]
+        pi /= pi.sum()
+
+        q = s * pi[None, :]
+        numpy.fill_diagonal(q, -q.sum(axis=1))
+        q /= -numpy.sum(pi * numpy.diag(q))
+
+        # symmetric form of the rate matrix for the eigendecomposition
+        root = numpy.sqrt(pi)
+        self.eigenvalues, vectors = numpy.linalg.eigh(root[:, None] * q / root[None, :])
+        left = vectors / root[:, None]
+        right = vectors.T * root[None, :]
+
+        # pair index of every (code, code) combination, GAP combinations get the index of no pair
+        self.num_pairs = len(AMINO_ACIDS) * (len(AMINO_ACIDS) + 1) // 2
+        first, second = numpy.triu_indices(len(AMINO_ACIDS))
+        self.pair_index = numpy.full((256, 256), self.num_pairs, dtype=numpy.int64)
+        self.pair_index[first, second] = numpy.arange(self.num_pairs)
+        self.pair_index[second, first] = numpy.arange(self.num_pairs)
+        self.pair_terms = left[first, :].T * right[:, second]
+        self.identical_pairs = first == second
+
+    def pair_counts(self, encoded, weights, row):
+        """(Weighted) counts of the amino acid pairs of a sequence with every following sequence"""
+        others = encoded.shape[0] - row - 1
+        pairs = self.pair_index[encoded[row][None, :], encoded[row+1:]]
+        cells = (numpy.arange(others)[:, None] * (self.num_pairs + 1) + pairs).ravel()
+        counts = numpy.bincount(cells, weights=numpy.broadcast_to(weights, pairs.shape).ravel(),
+            minlength=others * (self.num_pairs + 1))
+        return counts.reshape(others, self.num_pairs + 1)[:, :self.num_pairs]
+
+    def distances(self, encoded, weights=None, iterations=30):
+        """Maximum likelihood distances between all pairs of encoded sequences (Newton's method for every pair)"""
+        if weights is None:
+            weights = numpy.ones(encoded.shape[1])
+        weights = numpy.asarray(weights, dtype=numpy.float64)
+        start = kimura_distances(encoded, weights)
+
+        distances = numpy.zeros((encoded.shape[0], encoded.shape[0]))
+        for row in range(encoded.shape[0] - 1):
+            counts = self.pair_counts(encoded, weights, row)
+            t = numpy.clip(start[row, row+1:], 1e-6, MAX_DISTANCE)
+            changed = counts[:, ~self.identical_pairs].sum(axis=1) > 0
+            for iteration in range(iterations):
+                rates = numpy.exp(self.eigenvalues[None, :] * t[:, None])
+                p = numpy.maximum(rates @ self.pair_terms, 1e-300)
+                dp = (rates * self.eigenvalues) @ self.pair_terms / p
+                ddp = (rates * self.eigenvalues ** 2) @ self.pair_terms / p
+                gradient = (counts * dp).sum(axis=1)
+                curvature = (counts * (ddp - dp * dp)).sum(axis=1)
+
+                # Newton steps where the likelihood is concave, otherwise move halfway up or down
+                step = numpy.where(curvature < 0, -gradient / numpy.where(curvature < 0, curvature, -1),
+                    numpy.sign(gradient) * t / 2)
+                new_t = numpy.where(t + step <= 0, t / 2, numpy.minimum(t + step, MAX_DISTANCE))
+                converged = numpy.all(numpy.abs(new_t - t) < 1e-8 * numpy.maximum(t, 1))
+                t = new_t
+                if converged:
+                    break
+            t = numpy.where(changed, t, 0)
+            t = numpy.where(counts.sum(axis=1) > 0, t, MAX_DISTANCE)
+            distances[row, row+1:] = t
+            distances[row+1:, row] = t
+        return distances
+
+
+jtt_model = SubstitutionModel(JTT_EXCHANGEABILITIES, JTT_FREQUENCIES, JTT_AMINO_ACIDS)
+
+
+def protein_distances(encoded, weights=None, model=JTT):
+    """Distances between all pairs of encoded sequences under the model (JTT or KIMURA)"""
+    if model == KIMURA:
+        return kimura_distances(encoded, weights)
+    elif model == JTT:
+        return jtt_model.distances(encoded, weights)
+    raise ValueError('Unknown distance model {}'.format(model))
+
+
+def neighbor_joining(distances, labels):
+    """Unrooted neighbor-joining tree (trifurcation at the root, as PHYLIP neighbor)"""
+    d = numpy.array(distances, dtype=numpy.float64)
+    nodes = [TreeNode(label) for label in labels]
+    while len(nodes) > 3:
+        n = len(nodes)
+        r = d.sum(axis=1)
+        q = (n - 2) * d - r[:, None] - r[None, :]
+        numpy.fill_diagonal(q, numpy.inf)
+        i, j = sorted(divmod(int(numpy.argmin(q)), n))
+        length_i = 0.5 * d[i, j] + (r[i] - r[j]) / (2 * (n - 2))
+        length_j = d[i, j] - length_i
+        joined = 0.5 * (d[i] + d[j] - d[i, j])
+
+        # the joined node takes the place of i, the last node the place of j
+        d[i], d[:, i] = joined, joined
+        d[i, i] = 0
+        last = n - 1
+        d[j], d[:, j] = d[last], d[:, last]
+        d = d[:last, :last]
+        nodes[i] = TreeNode(children=[(nodes[i], length_i), (nodes[j], length_j)])
+        nodes[j] = nodes[last]
+        nodes.pop()
+
+    if len(nodes) < 3:
+        return TreeNode(children=[(node, d[0, -1] / 2) for node in nodes])
+    a, b, c = range(3)
+    return TreeNode(children=[
+        (nodes[a], (d[a, b] + d[a, c] - d[b, c]) / 2),
+        (nodes[b], (d[a, b] + d[b, c] - d[a, c]) / 2),
+        (nodes[c], (d[a, c] + d[b, c] - d[a, b]) / 2)])
+
+
+def upgma(distances, labels):
+    """Rooted UPGMA (average linkage) tree, node heights are half the cluster distances"""
+    linkage = sch.linkage(ssd.squareform(distances, checks=False), method='average')
+    nodes = [TreeNode(label) for label in labels]
+    heights = [0.0] * len(labels)
+    for left, right, distance, size in linkage:
+        left, right = int(left), int(right)
+        height = distance / 2
+        nodes.append(TreeNode(children=[(nodes[left], height - heights[left]), (nodes[right], height - heights[right])]))
+        heights.append(height)
+    return nodes[-1]
+
+
+def build_tree(distances, labels, method=NEIGHBOR_JOINING):
+    if method == UPGMA:
+        return upgma(distances, labels)
+    return neighbor_joining(distances, labels)
+
+
+def tree_splits(tree, num_leaves):
+    """
+    Groups (as bit masks of leaf indices, the leaves being named 0..num_leaves-1) of the internal branches of a
+    tree, taken on the side without leaf 0 so that the groups of an unrooted tree do not depend on the root
+    """
+    everything = (1 << num_leaves) - 1
+    masks = {}
+    splits = set()
+    for node in tree.postorder():
+        if not node.children:
+            masks[node] = 1 << node.name
+            continue
+        mask = 0
+        for child, length in node.children:
+            mask |= masks.pop(child)
+        masks[node] = mask
+        if node is not tree:
+            if mask & 1:
+                mask = everything ^ mask
+            if 1 < bin(mask).count('1') < num_leaves - 1:
+                splits.add(mask)
+    return splits
+
+
+def _bootstrap_split_counts(encoded, replicate_weights, method, model):
+    labels = list(range(encoded.shape[0]))
+    counts = Counter()
+    for weights in replicate_weights:
+        counts.update(tree_splits(build_tree(protein_distances(encoded, weights, model), labels, method), len(labels)))
+    return counts
+
+
+def consensus_tree(split_counts, labels, replicates):
+    """
+    Extended majority rule consensus: the most frequent groups that are compatible with the groups taken so far,
+    with the number of replicates containing the group as branch length (tips get the number of replicates)
+    """
+    accepted = []
+    for split, count in sorted(split_counts.items(), key=lambda s: (-s[1], s[0])):
+        if all(split & other == 0 or split & other == split or split & other == other for other, c in accepted):
+            accepted.append((split, count))
+
+    # children are attached to the smallest accepted group containing them
+    accepted.sort(key=lambda s: bin(s[0]).count('1'))
+    root = TreeNode()
+    groups = [(split, TreeNode(), count) for split, count in accepted]
+    for index, (split, node, count) in enumerate(groups):
+        parent = next((other for other_split, other, c in groups[index+1:] if split & other_split == split), root)
+        parent.children.append((node, float(count)))
+    for leaf, label in enumerate(labels):
+        parent = next((node for split, node, count in groups if split >> leaf & 1), root)
+        parent.children.append((TreeNode(label), float(replicates)))
+    return root
+
+
+def build_phylogeny(sequences, labels, method=NEIGHBOR_JOINING, bootstrap=0, seed=77, workers=1, model=JTT):
+    """
+    Newick tree of aligned sequences: the neighbor-joining/UPGMA tree of the model (JTT or KIMURA) distances,
+    or with bootstrap replicates the consensus tree of the replicate trees (computed in a pool of workers
+    processes if workers is more than 1, otherwise in this process)
+    """
+    encoded = encode_sequences(sequences)
+    if not bootstrap:
+        return build_tree(protein_distances(encoded, model=model), labels, method).to_newick()
+
+    # resampled columns as weights (number of times each column is drawn)
+    random = numpy.random.RandomState(seed)
+    num_columns = encoded.shape[1]
+    replicate_weights = random.multinomial(num_columns, numpy.full(num_columns, 1 / num_columns), size=bootstrap)
+
+    chunks = [chunk for chunk in numpy.array_split(replicate_weights, max(1, workers or 1)) if len(chunk)]
+    split_counts = Counter()
+    if len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=len(chunks), mp_context=multiprocessing.get_context('spawn')) as executor:
+            for counts in executor.map(_bootstrap_split_counts, [encoded] * len(chunks), chunks,
+                    [method] * len(chunks), [model] * len(chunks)):
+                split_counts.update(counts)
+    else:
+        split_counts = _bootstrap_split_counts(encoded, replicate_weights, method, model)
+
+    return consensus_tree(split_counts, labels, bootstrap).to_newick('{:.1f}')
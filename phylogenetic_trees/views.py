@@ -5,32 +5,28 @@ from django.http import JsonResponse
 from django.shortcuts import render
 from django.views.decorators.csrf import csrf_exempt
 
+from common.jobs import register_job, submit_job
+from common.models import Job
 from common.views import AbsTargetSelection
 from common.views import AbsSegmentSelection
 from common.views import AbsMiscSelection
 from common.selection import SimpleSelection, Selection, SelectionItem
 from mutation.models import *
 from phylogenetic_trees.PrepareTree import *
+from phylogenetic_trees.phylogeny import build_phylogeny, NEIGHBOR_JOINING, UPGMA
 from protein.models import ProteinFamily, ProteinAlias, ProteinSet, Protein, ProteinSegment, ProteinGProteinPair
 
 from copy import deepcopy
 import json
 import math
-import os, shutil, subprocess, signal
-import uuid
+import multiprocessing
+import os, shutil
+import tempfile
 
 from collections import OrderedDict
 
 Alignment = getattr(__import__('common.alignment_' + settings.SITE_NAME, fromlist=['Alignment']), 'Alignment')
 
-def kill_phylo(): #FIXME, needs better way of handling this!
-    p = subprocess.Popen(['ps', '-A'], stdout=subprocess.PIPE)
-    out, err = p.communicate()
-    for line in out.splitlines():
-        if 'protdist' in str(line):
-            pid = int(line.split(None, 1)[0])
-            os.kill(pid, signal.SIGKILL)
-
 class TargetSelection(AbsTargetSelection):
     step = 1
     number_of_steps = 3
@@ -172,21 +168,15 @@ class Treeclass:
         a.calculate_statistics()
         a.calculate_similarity()
         self.total = len(a.proteins)
-        total_length = 0
-        for chain in a.proteins[0].alignment:
-            total_length += len(a.proteins[0].alignment[chain])
         families = ProteinFamily.objects.all()
         self.famdict = {}
         for n in families:
             self.famdict[self.Tree.trans_0_2_A(n.slug)]=n.name
-        dirname = unique_filename = uuid.uuid4()
-        os.mkdir('/tmp/%s' %dirname)
-        infile = open('/tmp/%s/infile' %dirname,'w')
-        infile.write('    '+str(self.total)+'    '+str(total_length)+'\n')
         if len(a.proteins) < 3:
             return 'More_prots',None, None, None, None,None,None,None,None
         ####Get additional protein information
-        accesions = {}
+        labels = []
+        sequences = []
         for n in a.proteins:
             fam = self.Tree.trans_0_2_A(n.protein.family.slug)
             if n.protein.sequence_type.slug == 'consensus':
@@ -199,7 +189,7 @@ class Treeclass:
             if acc:
                 acc = acc.replace('-','_')
             else:
-                acc = link.replace('-','_')[:6]
+                acc = entry_name.replace('-','_')[:6]
             spec = str(n.protein.species)
             fam += '_'+n.protein.species.common_name.replace(' ','_').upper()
             desc = name
@@ -209,83 +199,29 @@ class Treeclass:
             if len(name)>25:
                 name=name[:25]+'...'
             self.family[entry_name] = {'name':name,'family':fam,'description':desc,'species':spec,'class':'','accession':acc,'ligand':'','type':'','link': entry_name}
-            accesions[acc]=entry_name
-            ####Write PHYLIP input
+            ####Aligned sequence
             sequence = ''
             for chain in n.alignment:
                 for residue in n.alignment[chain]:
                     sequence += residue[2].replace('_','-')
-            infile.write(acc+' '*9+sequence+'\n')
-        infile.close()
-
-        ####Run bootstrap
-        if self.bootstrap:
-        ### Write phylip input options
-            inp = open('/tmp/%s/temp' %dirname,'w')
-            inp.write('\n'.join(['r',str(self.bootstrap),'y','77','y'])+'\n')
-            inp.close()
-        ###
-            try:
-                subprocess.check_output(['phylip seqboot<temp'], shell=True, cwd = '/tmp/%s' %dirname, timeout=300)
-                os.rename('/tmp/%s/outfile' %dirname, '/tmp/%s/infile' %dirname)
-            except:
-                kill_phylo() #FIXME, needs better way of handling this!
-                return "too big","too big","too big","too big","too big","too big","too big","too big","too big"
+            labels.append(entry_name)
+            sequences.append(sequence)
 
-        ### Write phylip input options
-        inp = open('/tmp/%s/temp' %dirname,'w')
-        if self.bootstrap:
-            inp.write('\n'.join(['m','d',str(self.bootstrap),'y'])+'\n')
-        else:
-            inp.write('y\n')
-        inp.close()
-        ###
-        try:
-            subprocess.check_output(['phylip protdist<temp>>log'], shell=True, cwd = '/tmp/%s' %dirname, timeout=300)
-        except:
-            kill_phylo() #FIXME, needs better way of handling this!
-            return "too big","too big","too big","too big","too big","too big","too big","too big","too big"
-        os.rename('/tmp/%s/infile' %dirname, '/tmp/%s/dupa' %dirname)
-        os.rename('/tmp/%s/outfile' %dirname, '/tmp/%s/infile' %dirname)
-        inp = open('/tmp/%s/temp' %dirname,'w')
-        if self.bootstrap:
-        ### Write phylip input options
-            if self.UPGMA:
-                inp.write('\n'.join(['N','m',str(self.bootstrap),'111','y'])+'\n')
-            else:
-                inp.write('\n'.join(['m',str(self.bootstrap),'111','y'])+'\n')
+        ####Distances, tree (neighbor-joining or UPGMA) and bootstrap consensus
+        parameters = {'sequences': sequences, 'labels': labels, 'method': UPGMA if self.UPGMA else NEIGHBOR_JOINING,
+            'bootstrap': self.bootstrap}
+        if build != False:
+            self.phylip = phylogeny_data(parameters, workers=multiprocessing.cpu_count())
         else:
-            if self.UPGMA:
-                inp.write('N\ny\n')
-            else:
-                inp.write('y\n')
-        inp.close()
-        ###
-        try:
-            subprocess.check_output(['phylip neighbor<temp'], shell=True, cwd = '/tmp/%s' %dirname, timeout=300)
-        except:
-            kill_phylo() #FIXME, needs better way of handling this!
-            return "too big","too big","too big","too big","too big","too big","too big","too big"
-        if self.bootstrap:
-            os.rename('/tmp/%s/outfile' %dirname, '/tmp/%s/infile' %dirname)
-            os.rename('/tmp/%s/outtree' %dirname, '/tmp/%s/intree' %dirname)
-           ### Write phylip input options
-            inp = open('/tmp/%s/temp' %dirname,'w')
-            inp.write('y\n')
-            inp.close()
-        ###
-            try:
-                subprocess.check_output(['phylip consense<temp'], shell=True, cwd = '/tmp/%s' %dirname, timeout=300)
-            except:
-                kill_phylo() #FIXME, needs better way of handling this!
-                return "too big","too big","too big","too big","too big","too big","too big","too big"
-        self.phylip = open('/tmp/%s/outtree' %dirname).read()
-        for acc in accesions.keys():
-            self.phylip=self.phylip.replace(acc,accesions[acc])
-#        self.phylogeny_output = self.phylip
-        self.outtree = open('/tmp/%s/outfile' %dirname).read().lstrip()
-        phylogeny_input = self.get_phylogeny('/tmp/%s/' %dirname)
-        shutil.rmtree('/tmp/%s' %dirname)
+            # calculated by the job queue, the page waits for the job and is loaded again when the tree is done
+            job = submit_job('phylogeny', parameters)
+            if job.status != Job.DONE:
+                return 'Pending', job.key, None, None, None, None, None, None, None
+            self.phylip = json.loads(job.result)
+        self.outtree = self.phylip
+        dirname = tempfile.mkdtemp()
+        phylogeny_input = self.get_phylogeny(dirname)
+        shutil.rmtree(dirname)
 
         if build != False:
             open('static/home/images/'+build+'_legend.svg','w').write(str(self.Tree.legend))
@@ -303,6 +239,16 @@ class Treeclass:
         return self.branches, self.ttype, self.total, str(self.Tree.legend), self.Tree.box, self.Additional_info, self.buttons
 
 
+@register_job('phylogeny')
+def phylogeny_data(parameters, workers=None):
+    """
+    Newick tree of aligned sequences (run as job, see common.jobs). The bootstrap replicates of a job run in
+    PHYLOGENY_WORKERS processes (default 1, the job process itself), next to the JOB_WORKERS job processes.
+    """
+    return build_phylogeny(parameters['sequences'], parameters['labels'], parameters['method'],
+        int(parameters['bootstrap']), workers=workers or getattr(settings, 'PHYLOGENY_WORKERS', 1))
+
+
 # DEPRECATED CODE - can be cleaned up
 def get_buttons(request):
     Tree_class=request.session['Tree']
@@ -438,6 +384,10 @@ def render_tree_v3(request):
     if phylogeny_input == 'More_prots':
         return render(request, 'phylogenetic_trees/warning.html')
 
+    if phylogeny_input == 'Pending':
+        # the tree is still being calculated, branches is the key of the job
+        return render(request, 'phylogenetic_trees/pending.html', {'job_key': branches})
+
     # if ttype == '1':
     #     float(total)/4*100
     # else:
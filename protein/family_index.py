@@ -0,0 +1,131 @@
+"""
+In-memory index of the protein family tree
+
+Selections refer to families by slug, and every family target used to be resolved with its own
+family__slug__startswith query, with the G protein filters loaded as full model lists. FamilyIndex loads
+the proteins and G protein couplings once per process into arrays sorted by family slug. The
+proteins of a family (and of all its subfamilies) are then a contiguous slug-prefix range, and the species,
+source and coupling filters are boolean masks over the protein arrays, so expanding a tree node or flattening
+a selection of many families is an in-memory set operation followed by (at most) one query for the objects.
+"""
+from django.conf import settings
+
+from protein.models import Protein, ProteinGProteinPair
+
+import bisect
+import threading
+import time
+
+import numpy
+
+
+class FamilyIndex(object):
+    """Proteins sorted by family slug with their species, source and G protein coupling bitmaps"""
+
+    def __init__(self):
+        # proteins sorted by family slug (then id), so the proteins of a family prefix are a contiguous range
+        proteins = sorted(Protein.objects.values_list('pk', 'family__slug', 'family_id', 'species_id', 'source_id',
+            'accession', 'family__parent__parent__name'), key=lambda p: (p[1], p[0]))
+        self.slugs = [p[1] for p in proteins]
+        self.ids = numpy.array([p[0] for p in proteins], dtype=int)
+        self.family_ids = numpy.array([p[2] for p in proteins], dtype=int)
+        self.species_ids = numpy.array([p[3] for p in proteins], dtype=int)
+        self.source_ids = numpy.array([p[4] for p in proteins], dtype=int)
+        # G protein alpha subunit structure objects (e.g. 3sn6_a), excluded from the selection tree
+        self.alpha_chains = numpy.array([p[5] is None and p[6] == 'Alpha' for p in proteins], dtype=bool)
+        self.position = {pk: i for i, pk in enumerate(self.ids.tolist())}
+
+        self.couplings = {}
+        self.primary_couplings = {}
+        for protein_id, g_protein_id, transduction in ProteinGProteinPair.objects.values_list('protein_id', 'g_protein_id', 'transduction'):
+            if protein_id not in self.position:
+                continue
+            self.couplings.setdefault(g_protein_id, set()).add(self.position[protein_id])
+            if transduction == 'primary':
+                self.primary_couplings.setdefault(g_protein_id, set()).add(self.position[protein_id])
+
+        self.created = time.time()
+
+    def prefix_range(self, slug):
+        """Positions (start, end) of the proteins whose family slug starts with slug"""
+        return bisect.bisect_left(self.slugs, slug), bisect.bisect_left(self.slugs, slug + '\uffff')
+
+    def family_mask(self, family_id):
+        return self.family_ids == family_id
+
+    def prefix_mask(self, slug):
+        mask = numpy.zeros(len(self.ids), dtype=bool)
+        start, end = self.prefix_range(slug)
+        mask[start:end] = True
+        return mask
+
+    def species_mask(self, species):
+        """Mask of the proteins of the species (all proteins when no species are given)"""
+        if not species:
+            return numpy.ones(len(self.ids), dtype=bool)
+        return numpy.isin(self.species_ids, [s.pk for s in species])
+
+    def source_mask(self, sources):
+        return numpy.isin(self.source_ids, [s.pk for s in sources])
+
+    def coupling_mask(self, g_proteins, primary=False):
+        """Mask of the proteins coupling to any of the G proteins (as ProteinGProteinPair, optionally primary)"""
+        couplings = self.primary_couplings if primary else self.couplings
+        mask = numpy.zeros(len(self.ids), dtype=bool)
+        for g_protein in g_proteins:
+            positions = couplings.get(g_protein.pk)
+            if positions:
+                mask[list(positions)] = True
+        return mask
+
+    def protein_ids(self, mask):
+        return self.ids[mask].tolist()
+
+
+_family_index = None
+_family_index_lock = threading.Lock()
+
+
+def get_family_index(refresh=False):
+    """The FamilyIndex of this process, rebuilt after FAMILY_INDEX_TIMEOUT seconds (default one hour)"""
+    global _family_index
+    timeout = getattr(settings, 'FAMILY_INDEX_TIMEOUT', 3600)
+    with _family_index_lock:
+        if refresh or _family_index is None or (timeout is not None and time.time() - _family_index.created > timeout):
+            _family_index = FamilyIndex()
+        return _family_index
+
+
+def get_selection_proteins(simple_selection):
+    """
+    Proteins of the selection targets (with numbering scheme and species) in target order, with a single query
+    for the proteins of all family targets
+    """
+    index = get_family_index()
+    species_mask = index.species_mask([species.item for species in simple_selection.species])
+    filter_mask = species_mask & index.source_mask([source.item for source in simple_selection.annotation])
+
+    targets = []
+    family_protein_ids = set()
+    for target in simple_selection.targets:
+        if target.type == 'protein':
+            targets.append([target.item])
+        elif target.type == 'family':
+            start, end = index.prefix_range(target.item.slug)
+            positions = start + numpy.flatnonzero(filter_mask[start:end])
+            ids = sorted(index.ids[positions].tolist())
+            targets.append(ids)
+            family_protein_ids.update(ids)
+
+    objects = {}
+    if family_protein_ids:
+        objects = {p.pk: p for p in Protein.objects.filter(pk__in=family_protein_ids).select_related('residue_numbering_scheme', 'species')}
+
+    proteins = []
+    for target in targets:
+        for protein in target:
+            if isinstance(protein, Protein):
+                proteins.append(protein)
+            elif protein in objects:
+                proteins.append(objects[protein])
+    return proteins
@@ -175,19 +175,50 @@ if DEBUG:
     }
 
 #CACHE
+# Per-process LRU (hot keys only) in front of a sharded file store, see common/cache.py
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'BACKEND': 'common.cache.TieredCache',
         'LOCATION': '/tmp/django_cache',
         'OPTIONS': {
-            'MAX_ENTRIES': 10000000
+            'LRU_MAX_ENTRIES': 2000,
+            'LRU_MAX_SIZE': 256*1024*1024,
+            'LRU_KEY_PREFIXES': ['distanceMap-', 'selection_item-', 'diagram-layout-'],
+            'PERSISTENT': 'common.cache.ShardedFileCache',
+            'PERSISTENT_OPTIONS': {
+                'MAX_ENTRIES': 10000000,
+                'MAX_SIZE': 50*1024*1024*1024,
+                'SHARDS': 4096,
+            },
         }
     },
     'alignments': {
-        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'BACKEND': 'common.cache.TieredCache',
         'LOCATION': '/tmp/django_cache_alignments',
         'OPTIONS': {
-            'MAX_ENTRIES': 1000
+            'LRU_MAX_ENTRIES': 100,
+            'LRU_MAX_SIZE': 64*1024*1024,
+            'PERSISTENT': 'common.cache.ShardedFileCache',
+            'PERSISTENT_OPTIONS': {
+                'MAX_ENTRIES': 1000,
+                'SHARDS': 16,
+            },
+        }
+    },
+    'alignment_core': {
+        'BACKEND': 'common.cache.TieredCache',
+        'LOCATION': '/tmp/django_cache_alignment_core.sqlite3',
+        'OPTIONS': {
+            'LRU_MAX_ENTRIES': 200,
+            'LRU_MAX_SIZE': 512*1024*1024,
+            'LRU_KEY_PREFIXES': ['ALIGNMENTS_'],
+            # alignment data are modified by their callers, every hit gets its own copy
+            'LRU_PICKLED': True,
+            'PERSISTENT': 'common.cache.SQLiteCache',
+            'PERSISTENT_OPTIONS': {
+                'MAX_ENTRIES': 100000,
+                'MAX_SIZE': 20*1024*1024*1024,
+            },
         }
     }
 }
@@ -17,6 +17,7 @@ from signprot.models import SignprotComplex
 
 
 from collections import OrderedDict
+from collections.abc import Mapping
 from copy import deepcopy
 import numpy as np
 from operator import itemgetter
@@ -1147,6 +1148,7 @@ class SignatureMatch():
                     self.residue_to_feat['-'].add(fidx)
 
         self._find_norm()
+        self._prepare_feature_map()
         if protein_set_pos:
             self.scores_pos, self.signatures_pos, self.scored_proteins_pos = self.score_protein_set(self.protein_set_pos, signprot)
         if protein_set_neg:
@@ -1236,11 +1238,126 @@ class SignatureMatch():
         self.signature_consensus = signature
 
 
-    def score_protein_class(self, pclass_slug='001', signprot=False):
+    def _prepare_feature_map(self):
+        """
+        Preferred feature, value and generic number of every relevant position (over all segments), and the
+        residue/feature membership table used to score residues against those features
+        """
+        self.match_segments = []
+        self.match_gns = []
+        self.match_features = []
+        self.match_values = []
+        for segment in self.relevant_segments:
+            signature_map = np.absolute(self.signature_matrix_filtered[segment]).argmax(axis=0)
+            signature_map = self._assign_preferred_features(signature_map, segment, self.signature_matrix_filtered)
+            for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
+                self.match_segments.append(segment)
+                self.match_gns.append(pos)
+                self.match_features.append(signature_map[idx])
+                self.match_values.append(self.signature_matrix_filtered[segment][signature_map[idx]][idx])
+        self.match_gn_index = dict([(pos, idx) for idx, pos in enumerate(self.match_gns)])
+
+        feature_abbreviations = list(AMINO_ACID_GROUPS.keys())
+        feature_names = list(AMINO_ACID_GROUP_NAMES.values())
+        self.match_feature_abbreviations = [feature_abbreviations[feat] for feat in self.match_features]
+        self.match_feature_names = [feature_names[feat] for feat in self.match_features]
+        values = np.array(self.match_values, dtype=float)
+        is_gap = np.array([name == 'Gap' for name in self.match_feature_names], dtype=bool)
+
+        # residue codes index the rows of the membership table, the last row (no features) is for unknown residues
+        self.residue_codes = dict([(aa, idx) for idx, aa in enumerate(self.residue_to_feat.keys())])
+        membership = np.zeros((len(self.residue_codes) + 1, len(AMINO_ACID_GROUPS)), dtype=bool)
+        for aa, feats in self.residue_to_feat.items():
+            membership[self.residue_codes[aa], list(feats)] = True
+        self.position_membership = membership[:, self.match_features] if self.match_features else membership[:, :0]
+
+        # score of a position when the residue has the feature, does not have it, or is missing
+        self.score_match = np.maximum(values, 0)
+        self.score_mismatch = np.maximum(-values, 0)
+        self.score_missing = np.where(is_gap, values, 0)
+        # display colour of the same three cases
+        self.colour_match = np.where(values > 0, "#808080", "white")
+        self.colour_mismatch = np.where(values > 0, "white", "#808080")
+        self.colour_missing = np.where(is_gap & (values > 0), "#808080", "white")
+
+    def _encode_residues(self, residue_sets):
+        """Matrix (proteins x relevant positions) of residue codes, -1 where a protein has no residue"""
+        encoded = np.full((len(residue_sets), len(self.match_gns)), -1, dtype=int)
+        unknown = len(self.residue_codes)
+        for row, residues in enumerate(residue_sets):
+            for gn, amino_acid in residues.items():
+                if gn in self.match_gn_index:
+                    encoded[row, self.match_gn_index[gn]] = self.residue_codes.get(amino_acid, unknown)
+        return encoded
+
+    def _score_encoded(self, encoded):
+        """Scores of all encoded proteins at once"""
+        present = encoded >= 0
+        matches = self.position_membership[np.where(present, encoded, 0), np.arange(encoded.shape[1])] & present
+        scores = np.where(matches, self.score_match, np.where(present, self.score_mismatch, self.score_missing))
+        return scores.sum(axis=1)
+
+    def _signature_rows(self, residues):
+        """Display rows (feature, colour and residue per relevant position) of one protein"""
+        encoded = self._encode_residues([residues])[0]
+        present = encoded >= 0
+        matches = self.position_membership[np.where(present, encoded, 0), np.arange(len(encoded))] & present
+        consensus_match = OrderedDict([(x, []) for x in self.relevant_segments])
+        for idx, pos in enumerate(self.match_gns):
+            if matches[idx]:
+                colour = self.colour_match[idx]
+            elif present[idx]:
+                colour = self.colour_mismatch[idx]
+            else:
+                colour = self.colour_missing[idx]
+            consensus_match[self.match_segments[idx]].append([
+                self.match_feature_abbreviations[idx],
+                self.match_feature_names[idx],
+                self.match_values[idx],
+                str(colour),
+                residues[pos] if present[idx] else '-',
+                pos
+                ])
+        return consensus_match
 
+    def _relevant_residues(self, pcfs):
+        """Amino acid per relevant generic number of each protein conformation (by pk), with a single query"""
+        residues = Residue.objects.filter(
+            protein_conformation__in=pcfs,
+            generic_number__label__in=self.match_gns
+            ).values_list('protein_conformation_id', 'generic_number__label', 'amino_acid')
+        resi_dict_all = {}
+        for pcf, gn, amino_acid in residues:
+            if pcf not in resi_dict_all:
+                resi_dict_all[pcf] = {}
+            resi_dict_all[pcf][gn] = amino_acid
+        return resi_dict_all
+
+    def _score_conformations(self, pcfs):
+        """
+        Scores of the protein conformations (sorted, highest first) with their signature match rows, which are
+        built when a protein is looked up
+        """
         start = time.time()
-        protein_scores = {}
-        protein_signature_match = {}
+        pcfs = list(pcfs)
+        resi_dict_all = self._relevant_residues(pcfs)
+        residue_sets = [resi_dict_all.get(pcf.pk, {}) for pcf in pcfs]
+        scores = self._score_encoded(self._encode_residues(residue_sets))
+
+        order = sorted(range(len(pcfs)), key=lambda i: scores[i], reverse=True)
+        protein_report = OrderedDict([
+            (pcfs[i], (scores[i]/100, scores[i]/self.norm*100)) for i in order
+            ])
+        protein_signatures = SignatureMatchRows(
+            [pcfs[i] for i in order],
+            dict([(pcfs[i], residue_sets[i]) for i in order]),
+            self._signature_rows
+            )
+        print("Total time: ", time.time() - start)
+        return (protein_report, protein_signatures, list(protein_report.keys()))
+
+    def score_protein_class(self, pclass_slug='001', signprot=False):
+
         class_proteins = Protein.objects.filter(
             species__common_name='Human',
             family__slug__startswith=pclass_slug
@@ -1260,44 +1377,11 @@ class SignatureMatch():
                 protein__sequence_type__slug='wt'
                 ).exclude(protein__entry_name__endswith='-consensus').prefetch_related('protein','protein__family__parent','protein__species')
 
-        relevant_gns_total = []
-        for segment in  self.relevant_segments:
-            for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
-                relevant_gns_total.append(pos)
-
-        resi = Residue.objects.filter(
-            protein_conformation__in=class_a_pcf,
-            generic_number__label__in=relevant_gns_total
-            ).prefetch_related('generic_number','protein_conformation')
-        resi_dict_all = {}
-        for r in resi:
-            if r.generic_number:
-                pcf = r.protein_conformation.pk
-                if pcf not in resi_dict_all:
-                    resi_dict_all[pcf] = {}
-                resi_dict_all[pcf][r.generic_number.label] = r
-
-        for pcf in class_a_pcf:
-            p_start = time.time()
-            score, nscore, signature_match = self.score_protein(pcf, resi_dict_all)
-            protein_scores[pcf] = (score, nscore)
-            protein_signature_match[pcf] = signature_match
-            p_end = time.time()
-            print("Time elapsed for {}: ".format(pcf.protein.entry_name), p_end - p_start)
-        end = time.time()
-        self.protein_report = OrderedDict(sorted(protein_scores.items(), key=lambda x: x[1][0], reverse=True))
-        for prot in self.protein_report.items():
-            self.protein_signatures[prot[0]] = protein_signature_match[prot[0]]
-        self.scored_proteins = list(self.protein_report.keys())
-        print("Total time: ", end - start)
+        self.protein_report, self.protein_signatures, self.scored_proteins = self._score_conformations(class_a_pcf)
 
 
     def score_protein_set(self, protein_set, signprot=False):
 
-        start = time.time()
-        protein_scores = {}
-        protein_signature_match = {}
-
         seq_type_slug=['wt']
         if signprot:
             seq_type_slug.append('mod')
@@ -1310,155 +1394,45 @@ class SignatureMatch():
                 protein__sequence_type__slug__in=seq_type_slug
                 ).exclude(protein__entry_name__endswith='-consensus').prefetch_related('protein')
 
-        relevant_gns_total = []
-        for segment in  self.relevant_segments:
-            for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
-                relevant_gns_total.append(pos)
-
-        resi = Residue.objects.filter(
-            protein_conformation__in=pcfs,
-            generic_number__label__in=relevant_gns_total
-            ).prefetch_related('generic_number','protein_conformation')
-        resi_dict_all = {}
-        for r in resi:
-            if r.generic_number:
-                pcf = r.protein_conformation.pk
-                if pcf not in resi_dict_all:
-                    resi_dict_all[pcf] = {}
-                resi_dict_all[pcf][r.generic_number.label] = r
-
-        for pcf in pcfs:
-            p_start = time.time()
-            score, nscore, signature_match = self.score_protein(pcf,resi_dict_all)
-            protein_scores[pcf] = (score, nscore)
-            protein_signature_match[pcf] = signature_match
-            p_end = time.time()
-            print("Time elapsed for {}: ".format(pcf.protein.entry_name), p_end - p_start)
-        end = time.time()
-        protein_report = OrderedDict(sorted(protein_scores.items(), key=lambda x: x[1][0], reverse=True))
-        protein_signatures = OrderedDict()
-        for prot in protein_report.items():
-            protein_signatures[prot[0]] = protein_signature_match[prot[0]]
-        scored_proteins = list(protein_report.keys())
-        print("Total time: ", end - start)
-
-        return (protein_report, protein_signatures, scored_proteins)
+        return self._score_conformations(pcfs)
 
     def score_protein(self, pcf,resi_dict_all):
-        prot_score = 0.0
-        #norm = 0.0
-        consensus_match = OrderedDict([(x, []) for x in self.relevant_segments])
 
         if resi_dict_all == None:
-            relevant_gns_total = []
-            for segment in  self.relevant_segments:
-                for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
-                    relevant_gns_total.append(pos)
-            resi = Residue.objects.filter(
-                protein_conformation=pcf,
-                generic_number__label__in=relevant_gns_total
-                ).prefetch_related('generic_number')
-            resi_dict = {}
-            for r in resi:
-                if r.generic_number:
-                    resi_dict[r.generic_number.label] = r
+            resi_dict = self._relevant_residues([pcf]).get(pcf.pk, {})
         else:
-            resi_dict = resi_dict_all[pcf.pk]
-        for segment in self.relevant_segments:
-            tmp = []
-            # signature_map = self.signature_matrix_filtered[segment].argmax(axis=0)
-            signature_map = np.absolute(self.signature_matrix_filtered[segment]).argmax(axis=0)
-            signature_map = self._assign_preferred_features(signature_map, segment, self.signature_matrix_filtered)
+            resi_dict = dict([
+                (gn, res if isinstance(res, str) else res.amino_acid) for gn, res in resi_dict_all.get(pcf.pk, {}).items()
+                ])
+        prot_score = self._score_encoded(self._encode_residues([resi_dict]))[0]
+        return (prot_score/100, prot_score/self.norm*100, self._signature_rows(resi_dict))
 
-            #norm += np.sum(np.amax(self.signature_matrix_filtered[segment], axis=0))
 
-            for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
-                feat = signature_map[idx]
-                feat_abr = list(AMINO_ACID_GROUPS.keys())[feat]
-                feat_name = list(AMINO_ACID_GROUP_NAMES.values())[feat]
-                val = self.signature_matrix_filtered[segment][feat][idx]
-                if pos in resi_dict:
-                    res = resi_dict[pos]
-                    if feat in self.residue_to_feat[res.amino_acid]:
-                        if val > 0:
-                            prot_score += val
-                        tmp.append([
-                            feat_abr,
-                            feat_name,
-                            val,
-                            #"green",
-                            "#808080",
-                            res.amino_acid, pos
-                            ]) if val > 0 else tmp.append([
-                                feat_abr,
-                                feat_name,
-                                val,
-                                "white",
-                                res.amino_acid,
-                                pos
-                                ])
-                    else:
-                        #David doesn't want the negative values in the score
-                        # prot_score -= val
-                        if val < 0:
-                            prot_score -= val #if a receptor does NOT have the negative property, add the score
-                        tmp.append([
-                            feat_abr,
-                            feat_name,
-                            val,
-                            # "red",
-                            "white",
-                            res.amino_acid,
-                            pos
-                            ]) if val > 0 else tmp.append([
-                                feat_abr,
-                                feat_name,
-                                val,
-                                # "green",
-                                "#808080",
-                                res.amino_acid,
-                                pos
-                                ])
-                else:
-                    if feat_name == 'Gap':
-                        tmp.append([
-                            feat_abr,
-                            feat_name,
-                            val,
-                            # "green",
-                            "#808080",
-                            '-',
-                            pos
-                            ]) if val > 0 else tmp.append([
-                                feat_abr,
-                                feat_name,
-                                val,
-                                "white",
-                                '-',
-                                pos
-                                ])
-                        prot_score += val
-                    else:
-                        #David doesn't want the negative values in the score
-                        #prot_score -= val
-                        tmp.append([
-                            feat_abr,
-                            feat_name,
-                            val,
-                            # "red",
-                            "white",
-                            '-',
-                            pos
-                            ]) if val > 0 else tmp.append([
-                                feat_abr,
-                                feat_name,
-                                val,
-                                "white",
-                                '-',
-                                pos
-                                ])
-            consensus_match[segment] = tmp
-        return (prot_score/100, prot_score/self.norm*100, consensus_match)
+class SignatureMatchRows(Mapping):
+    """
+    Signature match rows per protein, in score order; the rows of a protein are built (and kept) when it is
+    looked up, and all rows are built when the mapping is pickled (e.g. stored in the session)
+    """
+
+    def __init__(self, proteins, residues, build_rows):
+        self.proteins = proteins
+        self.residues = residues
+        self.build_rows = build_rows
+        self.rows = {}
+
+    def __getitem__(self, protein):
+        if protein not in self.rows:
+            self.rows[protein] = self.build_rows(self.residues[protein])
+        return self.rows[protein]
+
+    def __iter__(self):
+        return iter(self.proteins)
+
+    def __len__(self):
+        return len(self.proteins)
+
+    def __reduce__(self):
+        return (OrderedDict, (list(self.items()), ))
 
 def signature_score_excel(workbook, scores, protein_signatures, signature_filtered, relevant_gn, relevant_segments, numbering_schemes, scores_positive=None, scores_negative=None, signatures_positive=None, signatures_negative=None):
 
@@ -1,3 +1,4 @@
+from common.views import DataSourceView
 from contactnetwork.views import PdbTableData
 from django.conf.urls import url
 from django.views.decorators.cache import cache_page
@@ -10,8 +11,10 @@ urlpatterns = [
     url(r'^statistics/(?P<dataset>[^/]*?)/$',  views.GProtein, name='gprotein'),
     url(r'^statistics',  views.GProtein, name='gprotein'),
 #    url(r'^couplings',  views.couplings, name='couplings'),
-    url(r'^couplings$', (CouplingBrowser.as_view()), name='coupling_browser'),
-    url(r'^couplingsbrowser$', (CouplingBrowser.as_view()), name='coupling_browser'),
+    url(r'^couplings$', cache_page(60*60*24)(CouplingBrowser.as_view()), name='coupling_browser'),
+    url(r'^couplingsbrowser$', cache_page(60*60*24)(CouplingBrowser.as_view()), name='coupling_browser'),
+    url(r'^couplings/data$', DataSourceView.as_view(source=CouplingBrowserData), name='coupling_browser_data'),
+    url(r'^couplings/data/(?P<column>\w+)$', DataSourceView.as_view(source=CouplingBrowserData), name='coupling_browser_data'),
     url(r'^ginterface/(?P<protein>[^/]*?)/$', views.Ginterface, name='render'),
     url(r'^ginterface[/]?$', views.TargetSelection.as_view(), name='targetselection'),
     url(r'^ajax/barcode/(?P<slug>[-\w]+)/(?P<cutoff>\d+\.\d{0,2})/$', views.ajaxBarcode, name='ajaxBarcode'),
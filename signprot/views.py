@@ -1,12 +1,13 @@
 from django.contrib.postgres.aggregates import ArrayAgg
 from django.core.cache import cache
-from django.db.models import F, Q
+from django.db.models import Case, CharField, Count, F, Max, Min, Q, Value, When
 from django.http import HttpResponse, JsonResponse
 from django.shortcuts import render
 from django.views.decorators.cache import cache_page
 from django.views.generic import TemplateView
 
 from common import definitions
+from common.datasource import Column, DataSource
 from common.diagrams_gpcr import DrawSnakePlot
 from common.diagrams_gprotein import DrawGproteinPlot
 from common.tools import fetch_from_web_api
@@ -126,405 +127,97 @@ class TargetSelection(AbsTargetSelection):
     }
 
 
+# G protein families and subunits of the coupling browser, Inoue's data are stored as the source 'Aska'
+COUPLING_FAMILIES = OrderedDict([('gs', 'Gs family'), ('gio', 'Gi/Go family'), ('gq11', 'Gq/G11 family'),
+    ('g1213', 'G12/G13 family')])
+COUPLING_SOURCES = OrderedDict([('inoue', 'Aska'), ('bouvier', 'Bouvier')])
+COUPLING_SUBUNITS = OrderedDict([
+    ('inoue', ['gnas2', 'gnal', 'gnai1', 'gnai2', 'gnai3', 'gnao', 'gnaz', 'gnaq', 'gna11', 'gna14', 'gna15', 'gna12',
+        'gna13']),
+    ('bouvier', ['gnas2', 'gnai1', 'gnai2', 'gnao', 'gnaz', 'gnaq', 'gna11', 'gna14', 'gna15', 'gna12', 'gna13'])])
+COUPLING_MEASURES = ['emax_dnorm', 'pec50_dnorm', 'emax_mean', 'pec50_mean', 'emax_sem', 'pec50_sem']
+# primary and secondary coupling by the highest double normalized Emax of a family
+COUPLING_PRIMARY = 0.5
+COUPLING_SECONDARY = 0.01
+
+
 class CouplingBrowser(TemplateView):
     """
     Class based generic view which serves coupling data between Receptors and G-proteins.
     Data coming from Guide to Pharmacology, Asuka Inuoue and Michel Bouvier.
     More data might come later from Roth and Strachan TRUPATH biosensor.
+    The rows are loaded page by page from CouplingBrowserData.
     :param dataset: ProteinGProteinPair (see build/management/commands/build_g_proteins.py)
     :return: context
     """
     template_name = "signprot/coupling_browser.html"
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        fam_tab = self.fams_tab()
-
-        protobj = Protein.objects.filter(sequence_type__slug='wt',
-                                         family__slug__startswith='00',
-                                         species__common_name='Human').prefetch_related(
-            "family",
-            "parent",
-            "source")
-
-        coupobj = ProteinGProteinPair.objects.all().prefetch_related('protein',
-                                                                     'g_protein_subunit',
-                                                                     'g_protein')
-
-#        context['proteins'] = protobj
-#        context['couplings'] = coupobj
-        context['famtab'] = fam_tab
-
-        return context
-
-    @staticmethod
-    def fams_tab():
-        """
-        This function returns what is needed in the families (maybe others - needs refactoring) tab of the coupling
-        browser.
-        :return: key.value pairs from fd dictionary
-        keys = gene names of proteins
-        values = gpcrDB general values and emax-double-normalized, pec50-double-normalized, emax-mean, pec50-mean
-        emax-sem, pec50sem.
-        """
-        threshold_primary_inoue = 0.5  # -0.1
-        threshold_secondary_inoue = 0.01  # -1
-        threshold_primary_bouvier = 0.5  # -0.1
-        threshold_secondary_bouvier = 0.01  # -1
-        proteins = Protein.objects.filter(sequence_type__slug='wt',
-                                          family__slug__startswith='00',
-                                          species__common_name='Human').all().prefetch_related('family')
-        data = {}
-        class_names = {}
-        family_names = {}
-        for p in proteins:
-            p_class = p.family.slug.split('_')[0]
-            if p_class not in class_names:
-                class_names[p_class] = p.family.parent.parent.parent.name
-                family_names[p_class] = p.family.parent.name
-            p_class_name = class_names[p_class].replace('Class', '').strip()
-            p_family_name = family_names[p_class].replace('receptors', '').strip()
-            p_accession = p.accession
-            p_entryname = p.entry_name
-            data[p.entry_short()] = {'class': p_class_name,
-                                     'family': p_family_name,
-                                     'accession': p_accession,
-                                     'entryname': p_entryname,
-                                     'pretty': p.short(),
-                                     'GuideToPharma': {},
-                                     'Aska': {},
-                                     'Bouvier': {}}
-
-        distinct_g_families = []
-        distinct_g_subunit_families = {}
-        couplings = ProteinGProteinPair.objects.prefetch_related('protein',
-                                                                 'g_protein_subunit',
-                                                                 'g_protein')
-        for c in couplings:
-            p = c.protein.entry_short()
-            
-            # Skip entries without any annotation
-            if p not in data:
-                continue
-
-            s = c.source
-            t = c.transduction
-            emdn = c.emax_dnorm
-            pec50dn = c.pec50_dnorm
-            emmean = c.emax_mean
-            pec50mean = c.pec50_mean
-            emsem = c.emax_sem
-            pec50sem = c.pec50_sem
-            gf = c.g_protein.name
-            gf = gf.replace(" family", "")
-
-            if gf not in distinct_g_families:
-                distinct_g_families.append(gf)
-                distinct_g_subunit_families[gf] = []
-
-            if c.g_protein_subunit:
-                g = c.g_protein_subunit.entry_name
-                g = g.replace("_human", "")
-                if g not in distinct_g_subunit_families[gf]:
-                    distinct_g_subunit_families[gf].append(g)
-                    distinct_g_subunit_families[gf] = sorted(distinct_g_subunit_families[gf])
-
-            if s not in data[p]:
-                data[p][s] = {}
-
-            if gf not in data[p][s]:
-                data[p][s][gf] = {}
-
-            # If transduction (primary, secondary) in Guide To Pharmacology data
-            if t:
-                data[p][s][gf] = t
-
-            # Else t (primary secondary classification) doesn't exist, such as
-            # source [s]  Aska (Inoue) or Bouvier.
-            else:
-                if 'emdn' not in data[p][s][gf]:
-                    data[p][s][gf] = {'emdn': {}, 'max': 0.00, 'maxid': str()}
-                if emdn is None:
-                    data[p][s][gf]['emdn'][g] = round(Decimal(0), 2)
-                    continue
-                data[p][s][gf]['emdn'][g] = round(Decimal(emdn), 2)
-                # get the highest number into 'max'
-                # TODO: Who is max? It will eventually be needed, count on it!
-                if emdn > data[p][s][gf]['max']:
-                    data[p][s][gf]['max'] = round(Decimal(emdn), 2)
-                    data[p][s][gf]['maxid'] = g
-                # pec50dn
-                if 'pec50dn' not in data[p][s][gf]:
-                    data[p][s][gf]['pec50dn'] = {}
-                if pec50dn is None:
-                    data[p][s][gf]['pec50dn'][g] = round(Decimal(0), 2)
-                    continue
-                data[p][s][gf]['pec50dn'][g] = round(Decimal(pec50dn), 2)
-                # emmean
-                if 'emmean' not in data[p][s][gf]:
-                    data[p][s][gf]['emmean'] = {}
-                if emmean is None:
-                    data[p][s][gf]['emmean'][g] = round(Decimal(0), 2)
-                    continue
-                data[p][s][gf]['emmean'][g] = round(Decimal(emmean), 2)
-                # pec50mean
-                if 'pec50mean' not in data[p][s][gf]:
-                    data[p][s][gf]['pec50mean'] = {}
-                if pec50mean is None:
-                    data[p][s][gf]['pec50mean'][g] = round(Decimal(0), 2)
-                    continue
-                data[p][s][gf]['pec50mean'][g] = round(Decimal(pec50mean), 2)
-                # emsem
-                if 'emsem' not in data[p][s][gf]:
-                    data[p][s][gf]['emsem'] = {}
-                if emsem is None:
-                    data[p][s][gf]['emsem'][g] = round(Decimal(0), 2)
-                    continue
-                data[p][s][gf]['emsem'][g] = round(Decimal(emsem), 2)
-                # pec50sem
-                if 'pec50sem' not in data[p][s][gf]:
-                    data[p][s][gf]['pec50sem'] = {}
-                if pec50sem is None:
-                    data[p][s][gf]['pec50sem'][g] = round(Decimal(0), 2)
-                    continue
-                data[p][s][gf]['pec50sem'][g] = round(Decimal(pec50sem), 2)
-
-
-        fd = {}  # final data
-        distinct_g_families = ['Gs', 'Gi/Go', 'Gq/G11', 'G12/G13']
-        distinct_g_subunit_families = OrderedDict(
-            [('Gs', ['gnas2', 'gnal']),
-             ('Gi/Go', ['gnai1', 'gnai2', 'gnai3', 'gnat1', 'gnat2', 'gnat3', 'gnao', 'gnaz']),
-             ('Gq/G11', ['gnaq', 'gna11', 'gna14', 'gna15']),
-             ('G12/G13', ['gna12', 'gna13'])])
-
-        # This for loop, does the job of putting together
-        # data-sets, GuideToPharma, Asuka's and Bouvier.
-        for p, v in data.items():
-            fd[p] = [v['class'], v['family'], v['accession'], v['entryname'], p, v['pretty']]
-            s = 'GuideToPharma'
-            # MERGED CRITERIA FOR COUPLING
-            # merge primary, secondary, coupling, no coupling classificationm currently from
-            # three sources, GtP, Inoue, Bouvier. Exact rules being worked on.
-            for gf in distinct_g_families:
-                values = []
-                if 'GuideToPharma' in v and gf in v['GuideToPharma']:
-                    values.append(v['GuideToPharma'][gf])
-                else:
-                    values.append('na gtf')
-                if 'Aska' in v and gf in v['Aska']:
-                    max = v['Aska'][gf]['max']
-                    if max > threshold_primary_inoue:
-                        values.append('primary')
-                    elif max > threshold_secondary_inoue:
-                        values.append('secondary')
-                    elif max == 0:
-                        values.append('NCI')
-                else:
-                    values.append('na inoue')
-                if 'Bouvier' in v and gf in v['Bouvier']:
-                    max = v['Bouvier'][gf]['max']
-                    if max > threshold_primary_bouvier:
-                        values.append('primary')
-                    elif max > threshold_secondary_bouvier:
-                        values.append('secondary')
-                    elif max == 0:
-                        values.append('NCB')
-                else:
-                    values.append('na bouvier')
-                if 'primary' in values:
-                    fd[p].append('primary')
-                elif 'secondary' in values:
-                    fd[p].append('secondary')
-#                elif 'NCI' or 'NCB' in values:
-#                    fd[p].append('no coupling')
-                else:
-                    fd[p].append('NA')  # Should this be NA of no-coupling? What's the GtP meaning?
-                # if (len(values) >= 2):
-                #     print(values, gf, p)
-
-            # Loop over GuideToPharma
-            s = 'GuideToPharma'
-            for gf in distinct_g_families:
-                if gf in v[s]:
-                    fd[p].append(v[s][gf])
-                else:
-                    #fd[p].append("NAg")
-                    fd[p].append('')
 
-            # Loop over Aska
-            s = 'Aska'
-            for gf in distinct_g_families:
-                if gf in v[s]:
-                    if v[s][gf]['max'] > threshold_primary_inoue:
-                        fd[p].append("primaryino")
-                    elif v[s][gf]['max'] > threshold_secondary_inoue:
-                        fd[p].append("secondaryino")
-                    else:
-                        fd[p].append("No coup. Ino")
-                else:
-                    fd[p].append('NAino')  # This last empty one means not-available, NOT no-coupling
-
-            # Last bit adds values in subfamilies (i.e. subtypes)
-            for gf, sfs in distinct_g_subunit_families.items():
-                for sf in sfs:
-                    if gf in v[s]:
-                        if sf in v[s][gf]['emdn']:
-                            fd[p].append(v[s][gf]['emdn'][sf])
-                        else:
-                            #fd[p].append("NAi1")
-                            fd[p].append('')
-                    else:
-                        #fd[p].append("emdn nai")
-                        fd[p].append('')
-
-                    if gf in v[s]:
-                        if sf in v[s][gf]['pec50dn']:
-                            fd[p].append(v[s][gf]['pec50dn'][sf])
-                        else:
-                            #fd[p].append("NAi1")
-                            fd[p].append('')
-                    else:
-                        #fd[p].append("pec50dn nai")
-                        fd[p].append('')
-
-                    if gf in v[s]:
-                        if sf in v[s][gf]['emmean']:
-                            fd[p].append(v[s][gf]['emmean'][sf])
-                        else:
-                            #fd[p].append("NAi1")
-                            fd[p].append('')
-                    else:
-                        #fd[p].append("emmean nai")
-                        fd[p].append('')
-
-                    if gf in v[s]:
-                        if sf in v[s][gf]['pec50mean']:
-                            fd[p].append(v[s][gf]['pec50mean'][sf])
-                        else:
-                            #fd[p].append("NAi1")
-                            fd[p].append('')
-                    else:
-                        #fd[p].append("pec50mean nai")
-                        fd[p].append('')
-
-                    if gf in v[s]:
-                        if sf in v[s][gf]['emsem']:
-                            fd[p].append(v[s][gf]['emsem'][sf])
-                        else:
-                           #fd[p].append("NAi1")
-                           fd[p].append('')
-                    else:
-                        #fd[p].append("emsem nai")
-                        fd[p].append('')
-
-                    if gf in v[s]:
-                        if sf in v[s][gf]['pec50sem']:
-                            fd[p].append(v[s][gf]['pec50sem'][sf])
-                        else:
-                            #fd[p].append("NAi1")
-                            fd[p].append('')
-                    else:
-                        #fd[p].append("pec50sem nai")
-                        fd[p].append('')
-
-            # Loop over Bouvier
-            s = 'Bouvier'
-            for gf in distinct_g_families:
-                if gf in v[s]:
-                    if v[s][gf]['max'] > threshold_primary_bouvier:
-                        fd[p].append("primary")
-                    elif v[s][gf]['max'] > threshold_secondary_bouvier:
-                        fd[p].append("secondary")
-                    else:
-                        fd[p].append("NC")
-                else:
-                    fd[p].append('NA')  # This last empty one means not-available, NOT no-coupling
-
-            # Last bit adds values to subfamilies (i.e. subtypes)
-            for gf, sfs in distinct_g_subunit_families.items():
-                for sf in sfs:
-                    if gf in v[s]:
-                        if sf in v[s][gf]['emdn']:
-                            fd[p].append(v[s][gf]['emdn'][sf])
-                        else:
-                            #fd[p].append("NAb1")
-                            fd[p].append('')
-                    else:
-                        #fd[p].append("emdn nab")
-                        fd[p].append('')
-
-                    if gf in v[s]:
-                        if sf in v[s][gf]['pec50dn']:
-                            fd[p].append(v[s][gf]['pec50dn'][sf])
-                        else:
-                            #fd[p].append("NAb1")
-                            fd[p].append('')
-                    else:
-                        #fd[p].append("pec50dn nab")
-                        fd[p].append('')
-
-                    if gf in v[s]:
-                        if sf in v[s][gf]['emmean']:
-                            fd[p].append(v[s][gf]['emmean'][sf])
-                        else:
-                            #fd[p].append("NAb1")
-                            fd[p].append('')
-                    else:
-                        #fd[p].append("emmean nab")
-                        fd[p].append('')
-
-                    if gf in v[s]:
-                        if sf in v[s][gf]['pec50mean']:
-                            fd[p].append(v[s][gf]['pec50mean'][sf])
-                        else:
-                            #fd[p].append("NAb1")
-                            fd[p].append('')
-                    else:
-                        #fd[p].append("pec50mean nab")
-                        fd[p].append('')
-
-                    if gf in v[s]:
-                        if sf in v[s][gf]['emsem']:
-                            fd[p].append(v[s][gf]['emsem'][sf])
-                        else:
-                            #fd[p].append("NAb1")
-                            fd[p].append('')
-                    else:
-                        #fd[p].append("emsem nab")
-                        fd[p].append('')
-
-                    if gf in v[s]:
-                        if sf in v[s][gf]['pec50sem']:
-                            fd[p].append(v[s][gf]['pec50sem'][sf])
-                        else:
-                            #fd[p].append("NAb1")
-                            fd[p].append('')
-                    else:
-                        #fd[p].append("pec50sem nab")
-                        fd[p].append('')
-
-            # max Values for Gs, Gi/Go, Gq/G11, G12/13 and source Inoue
-            s = 'Aska'
-            for gf in distinct_g_families:
-                if gf in v[s]:
-                    # fd[p].append(v[s][gf]['max'] + 100)
-                    fd[p].append(v[s][gf]['max'])
-                else:
-                    #fd[p].append("NAi max")
-                    fd[p].append('')
-
-            # max Values for Gs, Gi/Go, Gq/G11, G12/13 and source Bouvier
-            s = 'Bouvier'
-            for gf in distinct_g_families:
-                if gf in v[s]:
-                    #fd[p].append(v[s][gf]['max'] + 200)
-                    fd[p].append(v[s][gf]['max'])
-                else:
-                    #fd[p].append("NAb max")
-                    fd[p].append('')
+def coupling_columns():
+    """Columns of the coupling browser: the receptor, then the couplings per G protein family and subunit"""
+    columns = [
+        Column('class', 'family__parent__parent__parent__name', search='exact',
+            format=lambda v: v.replace('Class', '').strip()),
+        Column('receptor_family', 'family__parent__name', search='exact',
+            format=lambda v: v.replace('receptors', '').strip()),
+        Column('uniprot', 'entry_name', search='exact', format=lambda v: Protein(entry_name=v).entry_short()),
+        Column('accession', search=None),
+        Column('entry_name', search=None),
+        Column('iuphar', 'name', search='exact', format=lambda v: Protein(name=v).short()),
+        ]
+    for family in COUPLING_FAMILIES:
+        columns.append(Column('gtp_' + family, search='exact'))
+        for source in COUPLING_SOURCES:
+            columns.append(Column('{}_{}'.format(source, family), search='range'))
+            columns.append(Column('{}_{}_status'.format(source, family), search='exact'))
+    for source, subunits in COUPLING_SUBUNITS.items():
+        for subunit in subunits:
+            for measure in COUPLING_MEASURES:
+                columns.append(Column('{}_{}_{}'.format(source, subunit, measure), search='range'))
+    return columns
+
+
+class CouplingBrowserData(DataSource):
+    """
+    G protein couplings of the human receptors, one row per receptor with the Guide to Pharmacology transduction,
+    the highest double normalized Emax and the coupling status per family and the values per subunit of Inoue
+    and Bouvier, aggregated, paged, sorted and filtered in the database (see common.datasource)
+    """
+    name = 'coupling_browser'
+    columns = coupling_columns()
+    default_order = ['family__slug']
+
+    def get_queryset(self):
+        aggregates = {}
+        for family, g_protein in COUPLING_FAMILIES.items():
+            aggregates['gtp_' + family] = Min('proteingproteinpair__transduction',
+                filter=Q(proteingproteinpair__source='GuideToPharma', proteingproteinpair__g_protein__name=g_protein))
+            for source, source_name in COUPLING_SOURCES.items():
+                pairs = Q(proteingproteinpair__source=source_name, proteingproteinpair__g_protein__name=g_protein)
+                aggregates['{}_{}'.format(source, family)] = Max('proteingproteinpair__emax_dnorm', filter=pairs)
+                aggregates['{}_{}_pairs'.format(source, family)] = Count('proteingproteinpair', filter=pairs)
+        for source, subunits in COUPLING_SUBUNITS.items():
+            for subunit in subunits:
+                pairs = Q(proteingproteinpair__source=COUPLING_SOURCES[source],
+                    proteingproteinpair__g_protein_subunit__entry_name=subunit + '_human')
+                for measure in COUPLING_MEASURES:
+                    aggregates['{}_{}_{}'.format(source, subunit, measure)] = Max('proteingproteinpair__' + measure,
+                        filter=pairs)
+
+        statuses = {}
+        for family in COUPLING_FAMILIES:
+            for source in COUPLING_SOURCES:
+                name = '{}_{}'.format(source, family)
+                # NC: measured without coupling, NA: not measured
+                statuses[name + '_status'] = Case(
+                    When(**{name + '__gt': COUPLING_PRIMARY, 'then': Value('primary')}),
+                    When(**{name + '__gt': COUPLING_SECONDARY, 'then': Value('secondary')}),
+                    When(**{name + '_pairs__gt': 0, 'then': Value('NC')}),
+                    default=Value('NA'), output_field=CharField())
+
+        return Protein.objects.filter(sequence_type__slug='wt', family__slug__startswith='00',
+            species__common_name='Human').annotate(**aggregates).annotate(**statuses)
 
-        return fd
 
 def GProtein(request, dataset="GuideToPharma"):
     name_of_cache = 'gprotein_statistics_{}'.format(dataset)
@@ -1,5 +1,6 @@
 from django.shortcuts import render
 from django.conf import settings
+from django.http import StreamingHttpResponse
 
 from common.views import AbsReferenceSelection
 from common.views import AbsSegmentSelection
@@ -105,11 +106,7 @@ def render_fasta_alignment(request):
     # calculate identity and similarity of each row compared to the reference
     a.calculate_similarity()
 
-    num_of_sequences = len(a.proteins)
-    num_residue_columns = len(a.positions) + len(a.segments)
-    
-    response = render(request, 'alignment/alignment_fasta.html', {'a': a, 'num_of_sequences': num_of_sequences,
-        'num_residue_columns': num_residue_columns}, content_type='text/fasta')
+    response = StreamingHttpResponse(a.stream_fasta(), content_type='text/fasta')
     response['Content-Disposition'] = "attachment; filename=" + settings.SITE_TITLE + "_alignment.fasta"
     return response
 
@@ -135,10 +132,6 @@ def render_csv_alignment(request):
     # calculate identity and similarity of each row compared to the reference
     a.calculate_similarity()
 
-    num_of_sequences = len(a.proteins)
-    num_residue_columns = len(a.positions) + len(a.segments)
-    
-    response = render(request, 'alignment/alignment_csv.html', {'a': a, 'num_of_sequences': num_of_sequences,
-        'num_residue_columns': num_residue_columns}, content_type='text/fasta')
+    response = StreamingHttpResponse(a.stream_csv(), content_type='text/fasta')
     response['Content-Disposition'] = "attachment; filename=" + settings.SITE_TITLE + "_alignment.csv"
     return response
@@ -1,14 +1,17 @@
-function superposition(oTable, columns, site, hide_first_column) {
+function superposition(oTable, columns, site, hide_first_column, checked_data) {
     // oTable: DataTable object of table of entries
     // columns: Column indeces of oTable to be extracted to build table for reference selection. First column has to be structure/model string used for superposition workflow
     // site: Structure browser or Homology model browser (add new logic when expanding to new sites)
+    // checked_data: selected entries as arrays of cell HTML (default the rows of oTable with the class alt_selected)
     // if(window.location.hash === "#keepselection") {}
     // else {
     ClearSelection('targets');
     ClearSelection('reference');
     // }
 
-    var checked_data = oTable.rows('.alt_selected').data();
+    if (typeof checked_data === "undefined") {
+        checked_data = oTable.rows('.alt_selected').data();
+    }
     if (checked_data.length===0) {
         window.alert('No entries selected for superposition')
         return 0;
@@ -68,7 +71,6 @@ function superposition(oTable, columns, site, hide_first_column) {
             modal.style.display = "none";
         }
     }
-    var checked_data = oTable.rows('.alt_selected').data();
     // var needed_columns = [6,1,2,3,4,5,10,26]
     for (i=0; i<checked_data.length; i++) {
         var div = document.createElement("div");
@@ -0,0 +1,32 @@
+// Helpers of the browser tables that load their rows page by page from a DataSource (common/datasource.py)
+
+function datasourceEscape(value) {
+    // HTML of a value of the rows
+    if (value === null || value === undefined) {
+        return '';
+    }
+    return String(value).replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;').replace(/"/g, '&quot;');
+}
+
+function datasourceDash(value) {
+    // Value of the rows, or a dash when it is empty
+    return (value === null || value === undefined || value === '' || value.length === 0) ? '-' : value;
+}
+
+function datasourceFilterOptions(url, columns, filters, callback) {
+    // Fills the data of the select filters of yadcf with the options of their column (url/<column>), the data
+    // of the DataTables column is the name of the DataSource column, then calls callback
+    var requests = [];
+    filters.forEach(function (filter) {
+        var column = columns[filter.column_number];
+        if ((filter.filter_type === 'select' || filter.filter_type === 'multi_select') && filter.data === undefined &&
+                column && typeof column.data === 'string') {
+            requests.push($.getJSON(url + '/' + column.data, function (response) {
+                filter.data = response.options;
+            }));
+        }
+    });
+    $.when.apply($, requests).always(function () {
+        callback();
+    });
+}
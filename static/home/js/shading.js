@@ -49,9 +49,13 @@ class MyShadingTable {
 
     shade(rows) {
         let that = this;
-        this.calculateLimitValues(rows.data());
-        rows.every(function(){
-            that.shadeMyTableRow(this.node(), this.data());
+        // The cells as displayed, as the data of the rows can also be
+        // objects (e.g. tables loaded from the server).
+        let columns = this.table.columns().indexes().toArray();
+        let data = rows.indexes().toArray().map(row => columns.map(column => that.table.cell(row, column).render("display")));
+        this.calculateLimitValues(data);
+        rows.every(function(rowIdx, tableLoop, rowLoop){
+            that.shadeMyTableRow(this.node(), data[rowLoop]);
         });
 	}
 
@@ -5,6 +5,105 @@ let oTable4 = [];
 
 let table1data;
 
+// The rows of the four tables are loaded page by page from the coupling browser data (signprot.views.CouplingBrowserData)
+var url = '/signprot/couplings/data';
+var families = ['gs', 'gio', 'gq11', 'g1213'];
+var measures = ['pec50_dnorm', 'emax_dnorm', 'pec50_mean', 'emax_mean', 'pec50_sem', 'emax_sem'];
+
+function receptorColumns() {
+    // checkbox, class, family, uniprot and IUPHAR name of the receptor of a row
+    return [
+        {
+            data: null,
+            orderable: false,
+            className: 'text-center',
+            render: function (data, type, row) {
+                return '<input class="alt" type="checkbox" id="' + row.id + '">';
+            }
+        },
+        {data: 'class', className: 'text-left'},
+        {data: 'receptor_family', className: 'text-left'},
+        {
+            data: 'uniprot',
+            className: 'uniprot',
+            render: function (data, type, row) {
+                return '<span><a href="https://www.uniprot.org/uniprot/' + row.accession + '">' + datasourceEscape(data) + '</a></span>';
+            }
+        },
+        {
+            data: 'iuphar',
+            className: 'text-left',
+            render: function (data, type, row) {
+                // the names of the receptors hold HTML (e.g. <sub>)
+                return '<a href="https://gpcrdb.org/protein/' + row.entry_name + '">' + data + '</a>';
+            }
+        }
+    ];
+}
+
+function valueColumn(name) {
+    // a coupling value of the rows, numbers with two decimals
+    return {
+        data: name,
+        className: 'text-center',
+        render: function (data) {
+            if (data === null || data === undefined) {
+                return '';
+            }
+            return typeof data === 'number' ? data.toFixed(2) : datasourceEscape(data);
+        }
+    };
+}
+
+function soonColumn() {
+    return {data: null, orderable: false, className: 'text-center', defaultContent: 'soon'};
+}
+
+function subunitColumns(source, subunits) {
+    // the values of the subunits of a source, grouped by measure
+    var columns = [];
+    measures.forEach(function (measure) {
+        subunits.forEach(function (subunit) {
+            columns.push(valueColumn(source + '_' + subunit + '_' + measure));
+        });
+    });
+    return columns;
+}
+
+// Families: Bouvier max and (hidden) Bouvier coupling per family, then Bouvier, Inoue and GtP per family
+var columns1 = receptorColumns();
+families.forEach(function (family) {
+    columns1.push(valueColumn('bouvier_' + family), valueColumn('bouvier_' + family + '_status'));
+});
+families.forEach(function (family) {
+    columns1.push(valueColumn('bouvier_' + family), valueColumn('inoue_' + family), valueColumn('gtp_' + family));
+});
+columns1.push(soonColumn());
+
+// Subtypes: double normalized Emax of the subunits of Bouvier and Inoue, then barr1/GRK2 and barr2/GRK2
+var columns2 = receptorColumns().concat([
+    ['bouvier', 'gnas2'], ['inoue', 'gnas2'], ['inoue', 'gnal'],
+    ['bouvier', 'gnai1'], ['bouvier', 'gnai2'], ['bouvier', 'gnao'], ['bouvier', 'gnaz'],
+    ['inoue', 'gnai1'], ['inoue', 'gnai2'], ['inoue', 'gnai3'], ['inoue', 'gnao'], ['inoue', 'gnaz'],
+    ['bouvier', 'gnaq'], ['bouvier', 'gna11'], ['bouvier', 'gna14'], ['bouvier', 'gna15'],
+    ['inoue', 'gnaq'], ['inoue', 'gna11'], ['inoue', 'gna14'], ['inoue', 'gna15'],
+    ['bouvier', 'gna12'], ['bouvier', 'gna13'], ['inoue', 'gna12'], ['inoue', 'gna13']
+].map(function (subunit) {
+    return valueColumn(subunit[0] + '_' + subunit[1] + '_emax_dnorm');
+}), [soonColumn(), soonColumn()]);
+
+// Bouvier: max per family, arrestin, then the measures of the subunits
+var columns3 = receptorColumns().concat(families.map(function (family) {
+    return valueColumn('bouvier_' + family);
+}), [soonColumn()], subunitColumns('bouvier',
+    ['gnas2', 'gnai1', 'gnai2', 'gnao', 'gnaz', 'gnaq', 'gna11', 'gna14', 'gna15', 'gna12', 'gna13']));
+
+// Inoue: max per family, then the measures of the subunits
+var columns4 = receptorColumns().concat(families.map(function (family) {
+    return valueColumn('inoue_' + family);
+}), subunitColumns('inoue',
+    ['gnas2', 'gnal', 'gnai1', 'gnai3', 'gnao', 'gnaz', 'gnaq', 'gna14', 'gna15', 'gna12', 'gna13']));
+
 var tableToExcel = (function () {
     var uri = 'data:application/vnd.ms-excel;base64,',
         template = '<html xmlns:o="urn:schemas-microsoft-com:office:office" xmlns:x="urn:schemas-microsoft-com:office:excel" xmlns="http://www.w3.org/TR/REC-html40"><head><!--[if gte mso 9]><xml><x:ExcelWorkbook><x:ExcelWorksheets><x:ExcelWorksheet><x:Name>{worksheet}</x:Name><x:WorksheetOptions><x:DisplayGridlines/></x:WorksheetOptions></x:ExcelWorksheet></x:ExcelWorksheets></x:ExcelWorkbook></xml><![endif]--></head><body><table>{table}</table></body></html>',
@@ -136,14 +235,16 @@ $(document).ready(function () {
 
     console.time("table1load");
     oTable1 = $("#familiestabletab").DataTable({
+        serverSide: true,
+        processing: true,
+        ajax: url,
+        columns: columns1,
 //        data: table1data,
-//        serverSide: true,
         deferRender: true,
         scrollY: '50vh',
         scrollX: true,
         scrollCollapse: true,
         scroller: true,
-        paging: false,
 //        lengthMenu: [[10, 25, 50, -1], [10, 25, 50, "All"]],
         bSortCellsTop: false, //prevent sort arrows going on bottom row
         aaSorting: [],
@@ -156,43 +257,16 @@ $(document).ready(function () {
                 visible: false
             }
         ],
-        // columns: [
-        //     null,
-        //     null,
-        //     null,
-        //     null,
-        //     null, // 4
-        //     {width: "20%"}, // 5
-        //     null, // 6
-        //     null, // 7
-        //     null, // 8
-        //     null, // 9
-        //     null, // 10
-        //     null, // 11
-        //     null,
-        //     null,
-        //     null,
-        //     null,
-        //     null,
-        //     null,
-        //     null,
-        //     null,
-        //     null,
-        //     null,
-        //     null,
-        //     null,
-        //     null,
-        //     null
-        // ],
     });
 
-    yadcf.init(oTable1,
+    var filters1 =
         [
             {
                 column_number: 1,
                 filter_type: "multi_select",
                 select_type: 'select2',
                 filter_default_label: "Class",
+                filter_match_mode : "exact",
                 filter_reset_button_text: false,
             },
             {
@@ -200,6 +274,7 @@ $(document).ready(function () {
                 filter_type: "multi_select",
                 select_type: 'select2',
                 filter_default_label: "Family",
+                filter_match_mode : "exact",
                 filter_reset_button_text: false,
             },
             {
@@ -233,6 +308,7 @@ $(document).ready(function () {
                 column_number: 6,
                 filter_type: "multi_select",
                 filter_container_id: "gs_drop",
+                filter_match_mode : "exact",
                 select_type: 'select2',
                 filter_default_label: "Gs",
                 select_type_options: {
@@ -250,6 +326,7 @@ $(document).ready(function () {
                 column_number: 8,
                 filter_type: "multi_select",
                 filter_container_id: "gio_drop",
+                filter_match_mode : "exact",
                 select_type: 'select2',
                 filter_default_label: "Gi/Go",
                 select_type_options: {
@@ -267,6 +344,7 @@ $(document).ready(function () {
                 column_number: 10,
                 filter_type: "multi_select",
                 filter_container_id: "gq11_drop",
+                filter_match_mode : "exact",
                 select_type: 'select2',
                 filter_default_label: "Gq/G11",
                 select_type_options: {
@@ -284,6 +362,7 @@ $(document).ready(function () {
                 column_number: 12,
                 filter_type: "multi_select",
                 filter_container_id: "g1213_drop",
+                filter_match_mode : "exact",
                 select_type: 'select2',
                 filter_default_label: "G12/13",
                 select_type_options: {
@@ -305,8 +384,11 @@ $(document).ready(function () {
 
             {
                 column_number : 15,
-                filter_type: "range_number",
-                filter_default_label: ["Min", "Max"],
+                filter_type: "multi_select",
+                select_type: 'select2',
+                filter_default_label: "GtP",
+                filter_match_mode : "exact",
+                filter_reset_button_text: false,
             },
 
             {
@@ -323,8 +405,11 @@ $(document).ready(function () {
 
             {
                 column_number : 18,
-                filter_type: "range_number",
-                filter_default_label: ["Min", "Max"],
+                filter_type: "multi_select",
+                select_type: 'select2',
+                filter_default_label: "GtP",
+                filter_match_mode : "exact",
+                filter_reset_button_text: false,
             },
 
             {
@@ -341,8 +426,11 @@ $(document).ready(function () {
 
             {
                 column_number : 21,
-                filter_type: "range_number",
-                filter_default_label: ["Min", "Max"],
+                filter_type: "multi_select",
+                select_type: 'select2',
+                filter_default_label: "GtP",
+                filter_match_mode : "exact",
+                filter_reset_button_text: false,
             },
 
             {
@@ -359,8 +447,11 @@ $(document).ready(function () {
 
             {
                 column_number : 24,
-                filter_type: "range_number",
-                filter_default_label: ["Min", "Max"],
+                filter_type: "multi_select",
+                select_type: 'select2',
+                filter_default_label: "GtP",
+                filter_match_mode : "exact",
+                filter_reset_button_text: false,
             },
 
             {
@@ -369,16 +460,11 @@ $(document).ready(function () {
                 filter_default_label: ["Min", "Max"],
             },
 
-        ],
-
-        {filters_tr_index: 1},
-
-        {
-            cumulative_filtering: true
-        }
-    );
+        ];
+    datasourceFilterOptions(url, columns1, filters1, function () {
+        yadcf.init(oTable1, filters1, {filters_tr_index: 1});
+    });
 
-    yadcf.exResetAllFilters(oTable1);
 //    setTimeout(() => {
 //        console.timeEnd("table1load");
 //    }, );
@@ -386,14 +472,16 @@ $(document).ready(function () {
 
     console.time("table2load");
     oTable2 = $("#subtypestabletab").DataTable({
+        serverSide: true,
+        processing: true,
+        ajax: url,
+        columns: columns2,
 //        data: table2data,
-//        serverSide: true,
         deferRender: true,
         scrollY: '50vh',
         scrollX: true,
         scrollCollapse: true,
         scroller: true,
-        paging: false,
 //        lengthMenu: [[10, 25, 50, -1], [10, 25, 50, "All"]],
         bSortCellsTop: false, //prevent sort arrows going on bottom row
         aaSorting: [],
@@ -408,16 +496,16 @@ $(document).ready(function () {
 //                orderable: false
 //            }
 //            ],
-        pageLength: -1,
         bInfo: true
     });
-    yadcf.init(oTable2,
+    var filters2 =
         [
             {
                 column_number: 1,
                 filter_type: "multi_select",
                 select_type: 'select2',
                 filter_default_label: "Class",
+                filter_match_mode : "exact",
                 filter_reset_button_text: false,
                 select_type_options: {
                     width: '90px',
@@ -428,6 +516,7 @@ $(document).ready(function () {
                 filter_type: "multi_select",
                 select_type: 'select2',
                 filter_default_label: "Family",
+                filter_match_mode : "exact",
                 filter_reset_button_text: false,
                 select_type_options: {
                     width: '100px',
@@ -599,15 +688,11 @@ $(document).ready(function () {
                 filter_default_label: ["Min", "Max"],
             },
 
-        ],
-        {filters_tr_index: 2},
-
-        {
-            cumulative_filtering: false
-        }
-    );
+        ];
+    datasourceFilterOptions(url, columns2, filters2, function () {
+        yadcf.init(oTable2, filters2, {filters_tr_index: 2});
+    });
 
-    yadcf.exResetAllFilters(oTable2);
 //    setTimeout(() => {
 //        console.timeEnd("table2load");
 //    }, );
@@ -615,13 +700,16 @@ $(document).ready(function () {
 
     console.time("table3load");
     oTable3 = $("#bouviertabletab").DataTable({
+        serverSide: true,
+        processing: true,
+        ajax: url,
+        columns: columns3,
 //        data: table3data,
         deferRender: true,
         scrollY:  '50vh',
         scrollX: true,
         scrollCollapse: true,
         scroller: true,
-        paging: false,
 //        lengthMenu: [[10, 25, 50, -1], [10, 25, 50, "All"]],
         bSortCellsTop: false, //prevent sort arrows going on bottom row
         aaSorting: [],
@@ -629,13 +717,14 @@ $(document).ready(function () {
 //        pageLength: -1,
         bInfo: true
     });
-    yadcf.init(oTable3,
+    var filters3 =
         [
             {
                 column_number: 1,
                 filter_type: "multi_select",
                 select_type: 'select2',
                 filter_default_label: "Class",
+                filter_match_mode : "exact",
                 filter_reset_button_text: false,
                 select_type_options: {
                     width: '90px',
@@ -646,6 +735,7 @@ $(document).ready(function () {
                 filter_type: "multi_select",
                 select_type: 'select2',
                 filter_default_label: "Family",
+                filter_match_mode : "exact",
                 filter_reset_button_text: false,
                 select_type_options: {
                     width: '100px',
@@ -1259,14 +1349,11 @@ $(document).ready(function () {
             },
 
 
-        ],
-        {filters_tr_index: 1},
-        {
-            cumulative_filtering: true
-        }
-    );
+        ];
+    datasourceFilterOptions(url, columns3, filters3, function () {
+        yadcf.init(oTable3, filters3, {filters_tr_index: 1});
+    });
 
-    yadcf.exResetAllFilters(oTable3);
 //    setTimeout(() => {
 //        console.timeEnd("table3load");
 //    }, );
@@ -1274,6 +1361,10 @@ $(document).ready(function () {
 
     console.time("table4load");
     oTable4 = $("#inouetabletab").DataTable({
+        serverSide: true,
+        processing: true,
+        ajax: url,
+        columns: columns4,
 //        data: table4data,
         //data: data1,
         //"ordering": false,
@@ -1285,7 +1376,6 @@ $(document).ready(function () {
         scrollX: true,
 //        scrollCollapse: true,
         scroller: true,
-        paging: false,
         lengthMenu: [[10, 25, 50, -1], [10, 25, 50, "All"]],
         bSortCellsTop: false, //prevent sort arrows going on bottom row
         aaSorting: [],
@@ -1294,13 +1384,14 @@ $(document).ready(function () {
         bInfo: true
     });
 
-    yadcf.init(oTable4,
+    var filters4 =
         [
             {
                 column_number: 1,
                 filter_type: "multi_select",
                 select_type: 'select2',
                 filter_default_label: "Class",
+                filter_match_mode : "exact",
                 filter_reset_button_text: false,
                 select_type_options: {
                     width: '90px',
@@ -1311,6 +1402,7 @@ $(document).ready(function () {
                 filter_type: "multi_select",
                 select_type: 'select2',
                 filter_default_label: "Family",
+                filter_match_mode : "exact",
                 filter_reset_button_text: false,
                 select_type_options: {
                     width: '100px',
@@ -1919,16 +2011,11 @@ $(document).ready(function () {
 
 
 
-        ],
-
-        {filters_tr_index: 1},
-
-        {
-            cumulative_filtering: true
-        }
-    );
+        ];
+    datasourceFilterOptions(url, columns4, filters4, function () {
+        yadcf.init(oTable4, filters4, {filters_tr_index: 1});
+    });
 
-    yadcf.exResetAllFilters(oTable4);
 
 //    setTimeout(() => {
 //        console.timeEnd("table4load");
@@ -2139,6 +2226,10 @@ $(document).ready(function () {
     create_overlay1();
     create_overlay2();
     create_overlay3();
+    // the rows are replaced on every draw (page, sort or filter)
+    oTable2.on('draw', create_overlay1);
+    oTable3.on('draw', create_overlay2);
+    oTable4.on('draw', create_overlay3);
     $("#overlay1").hide();
     $("#overlay2").hide();
     $("#overlay3").hide();
@@ -2,75 +2,112 @@ function structurebrowser() {
 // $(document).ready(function () {
     // 'use strict';
 
-    var oTable2 = $('#structures_scrollable').DataTable({
-        "scrollY":        "65vh",
-        "scrollX":        true,
-        "scrollCollapse": true,
-        "scroller": true,
-        "paging":         false,
-        // "bSortCellsTop": true,
-        "aaSorting": [],
-        "autoWidth": false,
-        "order": [[28,'desc'],[1,'asc']],
-        "columnDefs": [
-            { "targets": 'no-sort', "orderable": false }
-            ],
-        "columns": [
-            null,
-            null,
-            null,
-            null,
-            null,
-            null,
-            null,
-            null,
-            null,
-            null,
-            null,
-            null,
-            null,
-            null,
-            null,
-            null,
-            null,
-            null,
-            null,
-            null,
-            {"width": "20%"},
-            null,
-            null,
-            null,
-            null,
-            null,
-            null,
-            null,
-            null,
-            null
-        ],
-        "bInfo" : true,
-    });
-
-    var prev_ids = Array()
-    var current_align_ids = Array()
+    var url = '/structure/browser_data';
+    // structures selected in the browser by id (rows of other pages are not in the table)
+    var selected = {};
 
-    //Uncheck every row when using back button on browser
-    $('.alt_selected').prop('checked',false)
-    $('.alt').prop('checked',false)
-    $('.select-all').prop('checked',false)
-    
-    ClearSelection('targets');
-    ClearSelection('reference');
+    function cut_at_20(value) {
+        if (value.length > 20) {
+            return '<span title="' + datasourceEscape(value) + '">' + value.substring(0, 20) + '...</span>';
+        }
+        return value;
+    }
 
-    $("#loading_div").hide();
+    var columns = [
+        { "data": null, "orderable": false, "className": "text-center", "render": function (data, type, row) {
+            return '<input class="alt" type="checkbox" id="' + row.id + '"' + (selected[row.id] ? ' checked' : '') + '>';
+        } },
+        { "data": "uniprot", "render": function (data, type, row) {
+            return '<span><a target="_blank" href="http://www.uniprot.org/uniprot/' + row.accession + '">' + data + '</a></span>';
+        } },
+        { "data": "iuphar", "className": "uniprot", "render": function (data, type, row) {
+            return '<a target="_blank" href="/protein/' + row.entry_name + '">' + data + '</a>';
+        } },
+        { "data": "receptor_family", "render": function (data) { return '<span>' + data + '</span>'; } },
+        { "data": "class", "render": function (data) { return '<span>' + data + '</span>'; } },
+        { "data": "species", "render": datasourceEscape },
+        { "data": "method", "render": datasourceEscape },
+        { "data": "pdb", "className": "pdb text-left", "render": function (data) {
+            return '<a target="_blank" href="' + data + '">' + data + '</a>';
+        } },
+        { "data": "refined", "render": function (data, type, row) {
+            if (data === 'Yes') {
+                return '<a target="_blank" href="homology_models/' + row.pdb + '_refined">' + row.pdb + '_refined</a>';
+            }
+            return '-';
+        } },
+        { "data": "resolution", "className": "text-center", "render": function (data) {
+            return data === null ? '' : parseFloat(data).toFixed(1);
+        } },
+        { "data": "preferred_chain", "className": "text-center", "render": datasourceEscape },
+        { "data": "state", "render": datasourceEscape },
+        { "data": "degree_active", "className": "text-center", "render": function (data) {
+            return parseFloat(data) ? String(Math.round(parseFloat(data) * 10) / 10) : '-';
+        } },
+        { "data": "signal_protein_family", "orderable": false, "render": function (data) {
+            return datasourceEscape(datasourceDash(data));
+        } },
+        { "data": "signal_protein", "orderable": false, "render": function (data, type, row) {
+            if (!row.signal_protein_entry_name) {
+                return '-';
+            }
+            return '<a target="_blank" href="/signprot/' + row.signal_protein_entry_name + '">' + data + '</a>';
+        } },
+        { "data": "signal_protein_note", "orderable": false, "render": function (data) {
+            return cut_at_20(datasourceDash(data));
+        } },
+        { "data": "signal_protein_coverage", "orderable": false, "render": function (data) {
+            return datasourceDash(data);
+        } },
+        { "data": "fusion", "orderable": false, "render": function (data) {
+            return datasourceDash(data.map(datasourceEscape).join('<br>'));
+        } },
+        { "data": "antibodies", "orderable": false, "render": function (data) {
+            return datasourceDash(data.map(datasourceEscape).join('<br>'));
+        } },
+        { "data": "ligand", "orderable": false, "render": function (data) {
+            return datasourceDash(data.map(function (ligand) {
+                return cut_at_20(ligand.name) + ligand.links.map(function (link) {
+                    return ' <a href="' + link.url + '" target="_blank">' + link.name + '</a>';
+                }).join('') + '<br />';
+            }).join(''));
+        } },
+        { "data": "ligand_type", "orderable": false, "width": "20%", "render": function (data) {
+            return datasourceDash(data.map(datasourceEscape).join('<br>'));
+        } },
+        { "data": "ligand_function", "orderable": false, "render": function (data) {
+            // the function of a ligand shown twice is shown once
+            if (data.length > 1 && data[0] === data[1]) {
+                return datasourceEscape(data[0]);
+            }
+            return datasourceDash(data.map(datasourceEscape).join('<br>'));
+        } },
+        { "data": "endogenous_ligand", "orderable": false, "render": function (data) {
+            return cut_at_20(datasourceDash(data.join(', ')));
+        } },
+        { "data": "endogenous_ligand_type", "orderable": false, "render": function (data) {
+            return datasourceEscape(datasourceDash(data));
+        } },
+        { "data": "sodium_site" },
+        { "data": "sodium" },
+        { "data": "last_author", "render": function (data) {
+            return datasourceEscape(datasourceDash(data));
+        } },
+        { "data": "reference", "render": function (data, type, row) {
+            if (!data) {
+                return '-';
+            }
+            return '<a target="_blank" href="' + row.reference_url + '">' + datasourceEscape(data) + '</a>';
+        } },
+        { "data": "publication_date" },
+        { "data": "annotated" }
+    ];
 
-    yadcf.init(oTable2,
-        [
+    var filters = [
             {
                 column_number : 1,
                 filter_type: "multi_select",
                 select_type: 'select2',
-                column_data_type: "html",
-                html_data_type: "text",
                 filter_default_label: "UniProt",
                 filter_match_mode : "exact",
                 filter_reset_button_text: false,
@@ -82,8 +119,6 @@ function structurebrowser() {
                 column_number : 2,
                 filter_type: "multi_select",
                 select_type: 'select2',
-                column_data_type: "html",
-                html_data_type: "text",
                 filter_default_label: "IUPHAR",
                 filter_match_mode : "exact",
                 filter_reset_button_text: false,
@@ -95,8 +130,6 @@ function structurebrowser() {
                 column_number : 3,
                 filter_type: "multi_select",
                 select_type: 'select2',
-                column_data_type: "html",
-                html_data_type: "text",
                 filter_default_label: "Receptor family",
                 filter_match_mode : "exact",
                 filter_reset_button_text: false,
@@ -108,9 +141,8 @@ function structurebrowser() {
                 column_number: 4,
                 filter_type: "multi_select",
                 select_type: 'select2',
-                column_data_type: "html",
-                html_data_type: "text",
                 filter_default_label: "Class",
+                filter_match_mode : "exact",
                 filter_reset_button_text: false,
                 select_type_options: {
                     width: '80px',
@@ -121,6 +153,7 @@ function structurebrowser() {
                 filter_type: "multi_select",
                 select_type: 'select2',
                 filter_default_label: "Species",
+                filter_match_mode : "exact",
                 filter_reset_button_text: false,
                 select_type_options: {
                     width: '80px',
@@ -131,6 +164,7 @@ function structurebrowser() {
                 filter_type: "multi_select",
                 select_type: 'select2',
                 filter_default_label: "Method",
+                filter_match_mode : "exact",
                 filter_reset_button_text: false,
                 select_type_options: {
                     width: '60px',
@@ -140,8 +174,8 @@ function structurebrowser() {
                 column_number : 7,
                 filter_type: "multi_select",
                 select_type: 'select2',
-                column_data_type: "html",
                 filter_default_label: "Select",
+                filter_match_mode : "exact",
                 filter_reset_button_text: false,
                 select_type_options: {
                     width: '50px',
@@ -152,7 +186,7 @@ function structurebrowser() {
                 filter_type: "multi_select",
                 select_type: 'select2',
                 filter_default_label: "Select",
-                column_data_type: "html",
+                filter_match_mode : "exact",
                 filter_reset_button_text: false,
                 select_type_options: {
                     width: '50px',
@@ -168,6 +202,7 @@ function structurebrowser() {
                 filter_type: "multi_select",
                 select_type: 'select2',
                 filter_default_label: "",
+                filter_match_mode : "exact",
                 filter_reset_button_text: false,
                 select_type_options: {
                     width: '30px',
@@ -215,64 +250,42 @@ function structurebrowser() {
             {
                 column_number : 15,
                 filter_type: "text",
-                select_type: 'select2',
                 filter_default_label: "Note",
-                filter_match_mode : "exact",
                 filter_reset_button_text: false,
-                select_type_options: {
-                    width: '80px',
-                }
             },
             {
                 column_number : 16,
                 filter_type: "range_number",
                 filter_default_label: ["From", "To"],
-                select_type_options: {
-                    width: '50px',
-                }
             },
             {
                 column_number : 17,
                 filter_type: "text",
-                select_type: 'select2',
                 filter_default_label: "Fusion",
                 filter_reset_button_text: false,
-                select_type_options: {
-                    width: '100px',
-                }
             },
             {
                 column_number : 18,
                 filter_type: "text",
-                select_type: 'select2',
                 filter_default_label: "Antibodies",
                 filter_reset_button_text: false,
-                select_type_options: {
-                    width: '100px',
-                }
             },
             {
                 column_number : 19,
                 filter_type: "text",
-                select_type: 'select2',
-                html_data_type: "text",
                 filter_default_label: "Ligand name",
                 filter_reset_button_text: false,
-                select_type_options: {
-                    width: '100px',
-                }
             },
             {
                 column_number : 20,
                 filter_type: "multi_select",
                 select_type: 'select2',
-                html_data_type: "text",
                 filter_default_label: "Ligand type",
+                filter_match_mode : "exact",
                 filter_reset_button_text: false,
                 select_type_options: {
                     width: '100px',
-                },
-                data: ['none', 'nonesmall molecule', 'peptide', 'peptideion', 'peptidesmall molecule', 'protein', 'small molecule', 'small moleculesmall molecule']
+                }
             },
             {
                 column_number : 21,
@@ -283,25 +296,20 @@ function structurebrowser() {
                 filter_reset_button_text: false,
                 select_type_options: {
                     width: '100px',
-                },
-                data: ['Agonist', 'Antagonist', 'Apo (no ligand)', 'Inverse agonist', 'AgonistPAM', 'AntagonistNAM',
-                       'Inverse agonistNAM', 'NAMAntagonist', 'NAMAgonist', 'PAMAgonist', 'unknown', 'N/A']
+                }
             },
             {
                 column_number : 22,
                 filter_type: "text",
-                select_type: 'select2',
                 filter_default_label: "Ligand name",
                 filter_reset_button_text: false,
-                select_type_options: {
-                    width: '100px',
-                }
             },
             {
                 column_number : 23,
                 filter_type: "multi_select",
                 select_type: 'select2',
                 filter_default_label: "Ligand type",
+                filter_match_mode : "exact",
                 filter_reset_button_text: false,
                 select_type_options: {
                     width: '80px',
@@ -312,6 +320,7 @@ function structurebrowser() {
                 filter_type: "multi_select",
                 select_type: 'select2',
                 filter_default_label: "D2x50-S3x39",
+                filter_match_mode : "exact",
                 filter_reset_button_text: false,
                 select_type_options: {
                     width: '80px',
@@ -322,6 +331,7 @@ function structurebrowser() {
                 filter_type: "multi_select",
                 select_type: 'select2',
                 filter_default_label: "Sodium in structure",
+                filter_match_mode : "exact",
                 filter_reset_button_text: false,
                 select_type_options: {
                     width: '100px',
@@ -329,19 +339,16 @@ function structurebrowser() {
             },
             {
                 column_number : 26,
-                filter_type: "multi_select",
-                select_type: 'select2',
+                filter_type: "text",
                 filter_default_label: "Last author",
                 filter_reset_button_text: false,
-                select_type_options: {
-                    width: '100px',
-                }
             },
             {
                 column_number : 27,
                 filter_type: "multi_select",
                 select_type: 'select2',
                 filter_default_label: "Reference",
+                filter_match_mode : "exact",
                 filter_reset_button_text: false,
                 select_type_options: {
                     width: '140px',
@@ -351,7 +358,6 @@ function structurebrowser() {
                 column_number : 28,
                 filter_type: "range_date",
                 date_format: "yyyy-mm-dd",
-                select_type: 'select2',
                 filter_default_label: ["From", "To"],
                 // filter_reset_button_text: false,
             },
@@ -360,19 +366,99 @@ function structurebrowser() {
                 filter_type: "multi_select",
                 select_type: 'select2',
                 filter_default_label: "Select",
+                filter_match_mode : "exact",
                 filter_reset_button_text: false,
                 select_type_options: {
                     width: '80px',
                 }
             }
-        ],
+        ];
+
+    //Uncheck every row when using back button on browser
+    $('.select-all').prop('checked',false)
+
+    ClearSelection('targets');
+    ClearSelection('reference');
+
+    datasourceFilterOptions(url, columns, filters, function () {
+        init_table();
+    });
+
+    function set_selected(tr, checked) {
+        var data = oTable2.row(tr).data();
+        if (checked) {
+            selected[data.id] = data;
+        } else {
+            delete selected[data.id];
+        }
+        $(':checkbox', tr).prop('checked', checked);
+        $(tr).toggleClass('alt_selected', checked);
+        $(tr).find('td').toggleClass('highlight', checked);
+    }
+
+    function selected_links(href) {
+        // links of the selected structures, for copyToClipboard
+        return $(Object.keys(selected).map(function (id) {
+            return $('<a>').attr('href', href(selected[id]))[0];
+        }));
+    }
+
+    function selected_cells() {
+        // cells of the selected structures (HTML of the columns), for superposition
+        return Object.keys(selected).map(function (id) {
+            return columns.map(function (column) {
+                var value = column.data === null ? null : selected[id][column.data];
+                return column.render ? column.render(value, 'display', selected[id]) : value;
+            });
+        });
+    }
+
+    var oTable2;
+
+    function init_table() {
+
+    oTable2 = $('#structures_scrollable').DataTable({
+        "scrollY":        "65vh",
+        "scrollX":        true,
+        "scrollCollapse": true,
+        "serverSide": true,
+        "processing": true,
+        "ajax": {
+            "url": url,
+            "data": function (data) {
+                if ($('#representative_btn').hasClass('toggled')) {
+                    data.representative = 'True';
+                }
+            }
+        },
+        "pageLength": 100,
+        "lengthMenu": [100, 250, 500, 1000],
+        // "bSortCellsTop": true,
+        "aaSorting": [],
+        "autoWidth": false,
+        "order": [[28,'desc'],[1,'asc']],
+        "columns": columns,
+        "createdRow": function (row, data) {
+            $(row).attr('model_id', data.id);
+            if (data.representative) {
+                $(row).addClass('repr-st');
+            }
+            if (selected[data.id]) {
+                $(row).addClass('alt_selected');
+                $(row).find('td').addClass('highlight');
+            }
+        },
+        "bInfo" : true,
+    });
+
+    $("#loading_div").hide();
+
+    yadcf.init(oTable2, filters,
         {
             cumulative_filtering: false
         }
     );
 
-    yadcf.exResetAllFilters(oTable2);
-
     // $(function(){
     //     $(".wrapper").scroll(function(){
     //         $(".dataTables_scrollBody").eq(0).scrollLeft($(".wrapper").scrollLeft());
@@ -382,28 +468,19 @@ function structurebrowser() {
     //     });
     // });
 
-    $('#structures_scrollable'+' > tbody > tr').click(function(event) {
-        if (event.target.type !== 'checkbox') {
-            $(':checkbox', this).trigger('click');
-            $(this).eq(0).toggleClass('alt_selected');
-            $(this).find('td').toggleClass('highlight');
+    $('#structures_scrollable tbody').on('click', 'tr', function(event) {
+        if (event.target.type === 'checkbox') {
+            set_selected(this, $(event.target).prop('checked'));
+        } else {
+            set_selected(this, !$(':checkbox', this).prop('checked'));
         }
-        $(this).eq(0).toggleClass('alt_selected');
-        $(this).find('td').toggleClass('highlight');
     });
 
     $(".select-all").click(function() {
-        $(':checkbox', this).trigger('click');
-        if ($(this).prop('checked')===true) {
-            $('.alt').prop('checked', true);
-            $('.alt').parent().parent().addClass('alt_selected');
-            $('.alt').parent().parent().find('td').addClass('highlight');
-        }
-        if ($(this).prop('checked')===false) {
-            $('.alt').prop('checked', false);
-            $('.alt').parent().parent().removeClass('alt_selected');
-            $('.alt').parent().parent().find('td').removeClass('highlight');
-        }
+        var checked = $(this).prop('checked');
+        $('#structures_scrollable tbody tr').each(function() {
+            set_selected(this, checked);
+        });
     });
 
     // $('.wrapper').find('div').width($(".yadcf-datatables-table--structures_scrollable").width());
@@ -464,50 +541,23 @@ function structurebrowser() {
         oTable2.draw();
     });
 
-    $.fn.dataTable.ext.search.push(
-        function (settings, data, dataIndex) {
-            if ($('#representative_btn').hasClass('toggled')) {
-                if ($(oTable2.row(dataIndex).node()).hasClass("repr-st") && $(oTable2.row(dataIndex).node()).hasClass("repr-st")) {
-                    return true;
-                }
-                return false;
-            }
-            else {
-                return true;
-            }
-    });
-
     $('#align_btn').click(function () {
-        var checked_data = oTable2.rows('.alt_selected').data();
         ClearSelection('targets');
-        for (i = 0; i < checked_data.length; i++) {
-            var div = document.createElement("div");
-            div.innerHTML = checked_data[i][7];
-            if (typeof div.innerText !== "undefined") {
-                AddToSelection('targets', 'structure', div.innerText.replace(/\s+/g, ''));
-            } else {
-                AddToSelection('targets', 'structure', div.textContent.replace(/\s+/g, ''));
-            }
-        }
+        Object.keys(selected).forEach(function (id) {
+            AddToSelection('targets', 'structure', selected[id].pdb);
+        });
         window.location.href = '/structure/selection_convert';
     });
 
     $('#superpose_btn').click(function() {
-        superposition(oTable2, [7,1,2,3,4,5,11,28], 'structure_browser');
+        superposition(oTable2, [7,1,2,3,4,5,11,28], 'structure_browser', undefined, selected_cells());
     });
 
     $('#download_btn').click(function () {
         ClearSelection('targets');
-        var checked_data = oTable2.rows('.alt_selected').data();
-        for (i = 0; i < checked_data.length; i++) {
-            var div = document.createElement("div");
-            div.innerHTML = checked_data[i][7];
-            if (typeof div.innerText !== "undefined") {
-                AddToSelection('targets', 'structure',  div.innerText.replace(/\s+/g, '') );
-            } else {
-                AddToSelection('targets', 'structure', div.textContent.replace(/\s+/g, ''));
-            }
-        }
+        Object.keys(selected).forEach(function (id) {
+            AddToSelection('targets', 'structure', selected[id].pdb);
+        });
         window.location.href = '/structure/pdb_download_index';
     });
 
@@ -525,10 +575,10 @@ function structurebrowser() {
         smartPlacement: true
     });
     $('#uniprot_copy').click(function () {
-        copyToClipboard($('.alt_selected > .uniprot > a'), '\n', 'UniProt IDs', $('.uniprot-export'));
+        copyToClipboard(selected_links(function (row) { return '/protein/' + row.entry_name; }), '\n', 'UniProt IDs', $('.uniprot-export'));
     });
     $('#pdb_copy').click(function () {
-        copyToClipboard($('.alt_selected > .pdb > a'), '\n', 'PDB IDs', $('.pdb-export'));
+        copyToClipboard(selected_links(function (row) { return row.pdb; }), '\n', 'PDB IDs', $('.pdb-export'));
     });
 
     $('#reset_filters_btn').click(function () {
@@ -581,6 +631,7 @@ function structurebrowser() {
     // $('#yadcf-filter--structures_scrollable-from-12').width(10);
     // console.log($('#yadcf-filter--structures_scrollable-from-12').width());
 
+    }
 };
 
 var tableToExcel = (function () {
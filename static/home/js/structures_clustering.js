@@ -219,6 +219,32 @@ function renderTree(data) {
 }
 
 var maxLeafNodeLenght = -1
+// Submits an analysis to the job queue and calls callback with the result once the job has finished,
+// or errorCallback with a message when the job (or its submission) fails
+function getJobResult(name, parameters, callback, errorCallback, interval = 1000) {
+    var failed = function(xhr) {
+        var message = xhr.responseJSON && xhr.responseJSON.error ? xhr.responseJSON.error : xhr.statusText;
+        console.log('Job ' + name + ' failed', xhr.responseJSON);
+        errorCallback(message);
+    };
+    $.getJSON('/common/jobs/submit/' + name, parameters, function(job) {
+        var poll = function() {
+            $.ajax({
+                url: '/common/jobs/' + job.key + '/result',
+                dataType: 'json',
+                success: function(data, status, xhr) {
+                    if (xhr.status == 202)
+                        setTimeout(poll, interval);
+                    else
+                        callback(data);
+                },
+                error: failed
+            });
+        };
+        poll();
+    }).fail(failed);
+}
+
 function maximumLeafSize(refresh = true) {
   // set to 0
   maxLeafNodeLenght = 0;
@@ -1203,7 +1229,7 @@ function initializeButtons(selector, treeFunction) {
             else if (this.innerHTML.startsWith("Go (distance to \"origin\")"))
               clusterMethod = 6
 
-            $.getJSON( '/contactnetwork/clusteringdata',
+            getJobResult('clustering',
             {
                 'pdbs': pdbs.join(","),
                 'cluster-method': clusterMethod
@@ -1255,6 +1281,9 @@ function initializeButtons(selector, treeFunction) {
                     zoomScaleSensitivity: 0.25,
                     dblClickZoomEnabled: false
                 });
+            },
+            function( message ) {
+                $("#svgloading").text("The clustering could not be calculated (" + message + ")");
             });
         } else {
             toggleAlert()
@@ -205,9 +205,10 @@ class GenericNumbering(object):
     def assign_generic_numbers(self):
         
         alignments = {}
-        #blast search goes first, looping through all the chains
-        for chain in self.pdb_seq.keys():
-            alignments[chain] = self.blast.run(self.pdb_seq[chain])
+        #blast search goes first, all the chains in a single run
+        chains = list(self.pdb_seq.keys())
+        for chain, chain_alignments in zip(chains, self.blast.run_many([self.pdb_seq[chain] for chain in chains])):
+            alignments[chain] = chain_alignments
 
         #map the results onto pdb sequence for every sequence pair from blast
         for chain in self.pdb_seq.keys():
@@ -0,0 +1,146 @@
+"""
+Local BLAST searches of many sequences at once
+
+BlastSearch used to start one blastp process (through the shell) per query sequence and parse its XML report.
+BlastService runs a single multi-threaded blastp for all sequences of a request or build step (as a multi-FASTA
+query), reads the tabular output with the aligned sequences, and caches the hits of every sequence in the
+shared cache under the hash of the sequence, the database and the number of hits. The cache keys include the
+modification time of the database, so rebuilding it invalidates the hits.
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+from collections import OrderedDict
+from subprocess import Popen, PIPE
+
+import hashlib
+import logging
+import os
+
+
+logger = logging.getLogger("protwis")
+
+TABULAR_FIELDS = ['qseqid', 'sseqid', 'stitle', 'evalue', 'bitscore', 'score', 'length', 'nident', 'positive',
+    'gaps', 'qstart', 'qend', 'sstart', 'send', 'qseq', 'sseq']
+
+
+class BlastHsp(object):
+    """High-scoring segment pair, with the attributes of Bio.Blast.Record.HSP used by the generic numbering"""
+
+    def __init__(self, expect, bits, score, align_length, identities, positives, gaps, query_start, query_end,
+            sbjct_start, sbjct_end, query, sbjct):
+        self.expect = expect
+        self.bits = bits
+        self.score = score
+        self.align_length = align_length
+        self.identities = identities
+        self.positives = positives
+        self.gaps = gaps
+        self.query_start = query_start
+        self.query_end = query_end
+        self.sbjct_start = sbjct_start
+        self.sbjct_end = sbjct_end
+        self.query = query
+        self.sbjct = sbjct
+
+    def __str__(self):
+        return "Score {} ({} bits), expectation {:.1e}, alignment length {}\nQuery: {} {} {}\nSbjct: {} {} {}".format(
+            self.score, self.bits, self.expect, self.align_length, self.query_start, self.query, self.query_end,
+            self.sbjct_start, self.sbjct, self.sbjct_end)
+
+
+class BlastHit(object):
+    """Database sequence matched by a query (like Bio.Blast.Record.Alignment), hit_id is the database id"""
+
+    def __init__(self, hit_id, hit_def):
+        self.hit_id = hit_id
+        self.hit_def = hit_def
+        self.hsps = []
+
+    def __str__(self):
+        return "{} {}\n{}".format(self.hit_id, self.hit_def, "\n".join([str(hsp) for hsp in self.hsps]))
+
+
+def parse_tabular(output, num_queries):
+    """Hits (in report order) of every query of blastp tabular output with TABULAR_FIELDS, queries named 0..n-1"""
+    results = [OrderedDict() for i in range(num_queries)]
+    for line in output.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        fields = dict(zip(TABULAR_FIELDS, line.split('\t')))
+        hits = results[int(fields['qseqid'])]
+        hit_id = fields['sseqid'].split('|')[-1]
+        if hit_id not in hits:
+            # the title starts with the id when the database was made with -parse_seqids
+            title = fields['stitle']
+            if title.startswith(fields['sseqid'] + ' ') or title.startswith(hit_id + ' '):
+                title = title.split(' ', 1)[1]
+            hits[hit_id] = BlastHit(hit_id, title)
+        hits[hit_id].hsps.append(BlastHsp(float(fields['evalue']), float(fields['bitscore']), float(fields['score']),
+            int(fields['length']), int(fields['nident']), int(fields['positive']), int(fields['gaps']),
+            int(fields['qstart']), int(fields['qend']), int(fields['sstart']), int(fields['send']),
+            fields['qseq'], fields['sseq']))
+    return [list(hits.values()) for hits in results]
+
+
+class BlastService(object):
+    """Batched blastp searches against a local database with cached hits"""
+
+    def __init__(self, blast_path='blastp', blastdb=os.sep.join([settings.STATICFILES_DIRS[0], 'blast', 'protwis_blastdb']),
+            top_results=1, threads=None):
+        self.blast_path = blast_path
+        self.blastdb = blastdb
+        self.top_results = top_results
+        self.threads = threads or getattr(settings, 'BLAST_THREADS', min(4, os.cpu_count() or 1))
+
+    def database_version(self):
+        """Modification time and size of the database sequence file (changes when the database is rebuilt)"""
+        for extension in ('.psq', '.pal', '.00.psq'):
+            try:
+                stat = os.stat(self.blastdb + extension)
+                return '{}-{}'.format(stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                continue
+        return ''
+
+    def cache_key(self, sequence, database_version):
+        return 'blast-' + hashlib.sha256('|'.join([self.blastdb, database_version, str(self.top_results),
+            sequence]).encode('utf-8')).hexdigest()
+
+    def run_blast(self, sequences):
+        """Hits of every sequence from one blastp run, None if blastp failed"""
+        query = ''.join(['>{}\n{}\n'.format(index, sequence) for index, sequence in enumerate(sequences)])
+        blast = Popen([self.blast_path, '-db', self.blastdb, '-outfmt', '6 ' + ' '.join(TABULAR_FIELDS),
+            '-num_threads', str(self.threads)], universal_newlines=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        (blast_out, blast_err) = blast.communicate(input=query)
+        if len(blast_err) != 0:
+            logger.debug(blast_err)
+        if blast.returncode != 0:
+            logger.error("Blast search failed: {}".format(blast_err))
+            return None
+        return parse_tabular(blast_out, len(sequences))
+
+    def search(self, sequences):
+        """
+        List of (hit id, BlastHit) tuples (the top_results best hits) for every sequence, as returned by
+        BlastSearch.run; sequences already searched against the same database come from the cache
+        """
+        sequences = [str(sequence).strip() for sequence in sequences]
+        database_version = self.database_version()
+        keys = dict([(sequence, self.cache_key(sequence, database_version)) for sequence in OrderedDict.fromkeys(sequences) if sequence])
+        cached = cache.get_many(list(keys.values()))
+        results = dict([(sequence, cached[key]) for sequence, key in keys.items() if key in cached])
+
+        missing = [sequence for sequence in keys if sequence not in results]
+        if missing:
+            logger.debug("Running Blast with {} sequences".format(len(missing)))
+            blast_results = self.run_blast(missing)
+            if blast_results is not None:
+                new_results = {}
+                for sequence, hits in zip(missing, blast_results):
+                    new_results[sequence] = [(hit.hit_id, hit) for hit in hits[:self.top_results]]
+                cache.set_many(dict([(keys[sequence], hits) for sequence, hits in new_results.items()]),
+                    getattr(settings, 'BLAST_CACHE_TIMEOUT', 60*60*24*30))
+                results.update(new_results)
+
+        return [results.get(sequence, []) for sequence in sequences]
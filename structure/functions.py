@@ -16,6 +16,7 @@ from protein.models import Protein, ProteinSegment, ProteinConformation, Protein
 from residue.functions import dgn, ggn
 from residue.models import Residue, ResidueGenericNumberEquivalent
 from structure.models import Structure, Rotamer
+from structure.blast import BlastService
 
 from subprocess import Popen, PIPE
 from io import StringIO
@@ -30,6 +31,7 @@ import Bio.PDB as PDB
 import csv
 # from openpyxl import Workbook
 import numpy
+from scipy.spatial import cKDTree
 import zipfile
 import pprint
 import json
@@ -55,35 +57,18 @@ class BlastSearch(object):
         #residues it is better to use more results to avoid getting sequence of
         #e.g.  different species
         self.top_results = top_results
+        self.service = BlastService(blast_path=blast_path, blastdb=blastdb, top_results=top_results)
 
     #takes Bio.Seq sequence as an input and returns a list of tuples with the
     #alignments
     def run (self, input_seq):
 
-        output = []
-        #Windows has problems with Popen and PIPE
-        if sys.platform == 'win32':
-            tmp = tempfile.NamedTemporaryFile()
-            logger.debug("Running Blast with sequence: {}".format(input_seq))
-            tmp.write(bytes(str(input_seq) + '\n', 'latin1'))
-            tmp.seek(0)
-            blast = Popen('%s -db %s -outfmt 5' % (self.blast_path, self.blastdb), universal_newlines=True, stdin=tmp,
-                stdout=PIPE, stderr=PIPE)
-            (blast_out, blast_err) = blast.communicate()
-        else:
-        #Rest of the world:
-            blast = Popen('%s -db %s -outfmt 5' % (self.blast_path, self.blastdb), universal_newlines=True, shell=True,
-                stdin=PIPE, stdout=PIPE, stderr=PIPE)
-            (blast_out, blast_err) = blast.communicate(input=str(input_seq))
-
-        if len(blast_err) != 0:
-            logger.debug(blast_err)
-        if blast_out!='\n':
-            result = NCBIXML.read(StringIO(blast_out))
-            for aln in result.alignments[:self.top_results]:
-                logger.debug("Looping over alignments, current hit: {}".format(aln.hit_id))
-                output.append((aln.hit_id, aln))
-        return output
+        return self.service.search([input_seq])[0]
+
+    #same for a list of sequences (searched with a single blastp run), returns a list of results
+    def run_many (self, input_seqs):
+
+        return self.service.search(input_seqs)
 #==============================================================================
 
 class BlastSearchOnline(object):
@@ -555,6 +540,8 @@ class HSExposureCB(AbstractPropertyMap):
     The HSE can be calculated based on the CA-CB vector, or the pseudo CB-CA
     vector based on three consecutive CA atoms. This is done by two separate
     subclasses.
+    The neighbour, clash and hetero atom searches use coordinate arrays and KD-trees (scipy cKDTree) instead of
+    comparing all pairs of Vectors, the results are the same (see benchmark_hse).
     """
     def __init__(self, model, radius, offset=0, hse_up_key='HSE_U', hse_down_key='HSE_D', angle_key=None, check_chain_breaks=False, 
                  check_knots=False, receptor=None, signprot=None,  restrict_to_chain=[], check_hetatoms=False):
@@ -590,27 +577,20 @@ class HSExposureCB(AbstractPropertyMap):
         ### GP
         if model.get_id()!=0:
             model = model[0]
-        residues_in_pdb,residues_with_proper_CA=[],[]
+        residues_in_pdb=[]
         if check_chain_breaks==True:
-            # for m in model:
-                for chain in model:
-                    for res in chain:
-                        # try:
-                            if is_aa(res):
-                                residues_in_pdb.append(res.get_id()[1])
-                        # except:
-                        #     if is_aa(chain):
-                        #         residues_in_pdb.append(chain.get_id()[1])
-                        #         print('chain', chain, res)
-                        #         break
-        het_resis, het_resis_close, het_resis_clash = [], [], []
+            for chain in model:
+                for res in chain:
+                    if is_aa(res):
+                        residues_in_pdb.append(res.get_id()[1])
+        het_resis = []
         for chain in model:
             for res in chain:
                 if res.get_id()[0]!=' ':
                     het_resis.append(res)
         self.clash_pairs = []
         self.chain_breaks = []
-        
+
         if check_knots:
             possible_knots = PossibleKnots(receptor, signprot)
             knot_resis = possible_knots.get_resnums()
@@ -621,10 +601,39 @@ class HSExposureCB(AbstractPropertyMap):
                 if p[0].get_parent().get_id() in restrict_to_chain:
                     restricted_ppl.append(p)
             ppl = restricted_ppl
+
+        ### residues of all peptides in one array, with their peptide and position in the peptide
+        residues = [res for pp in ppl for res in pp]
+        peptide_lengths = numpy.array([len(pp) for pp in ppl], dtype=int)
+        peptide_starts = numpy.concatenate(([0], numpy.cumsum(peptide_lengths))).astype(int)
+        residue_peptide = numpy.repeat(numpy.arange(len(ppl)), peptide_lengths)
+        residue_position = numpy.arange(len(residues)) - peptide_starts[residue_peptide]
+        residues_with_proper_CA = set([res.get_id()[1] for res in residues])
+        # coordinates are converted to float64 as in Bio.PDB Vectors
+        ca_coords = numpy.array([res['CA'].get_coord() for res in residues], dtype='d').reshape(-1, 3)
+        valid_neighbour = numpy.array([bool(is_aa(res) and res.has_id('CA')) for res in residues], dtype=bool)
+
+        # atoms of the peptide residues (residue by residue, so the atom index follows the residue order)
+        residue_atoms = [list(res) for res in residues]
+        atom_counts = numpy.array([len(atoms) for atoms in residue_atoms], dtype=int)
+        atom_starts = numpy.concatenate(([0], numpy.cumsum(atom_counts))).astype(int)
+        atom_residue = numpy.repeat(numpy.arange(len(residues)), atom_counts)
+        atom_coords = numpy.array([atom.get_coord() for atoms in residue_atoms for atom in atoms], dtype='d').reshape(-1, 3)
+
+        # spatial indices, the radius is slightly enlarged and the exact distances are checked afterwards
+        if len(residues):
+            ca_neighbours = cKDTree(ca_coords).query_ball_point(ca_coords, radius*(1+1e-9)+1e-9)
+            atom_tree = cKDTree(atom_coords)
+        het_atoms = [(h, atom) for h, het_res in enumerate(het_resis) for atom in het_res] if check_hetatoms else []
+        if het_atoms:
+            het_atom_residue = numpy.array([h for h, atom in het_atoms], dtype=int)
+            het_atom_coords = numpy.array([atom.get_coord() for h, atom in het_atoms], dtype='d')
+            het_tree = cKDTree(het_atom_coords)
+        het_resis_close, het_resis_clash = set(), set()
         ###########
-        for pp1 in ppl:
+        for p, pp1 in enumerate(ppl):
             for i in range(0, len(pp1)):
-                residues_with_proper_CA.append(pp1[i].get_id()[1])
+                k = peptide_starts[p] + i
                 if i==0:
                     r1=None
                 else:
@@ -640,41 +649,30 @@ class HSExposureCB(AbstractPropertyMap):
                     # Missing atoms, or i==0, or i==len(pp1)-1
                     continue
                 pcb, angle=result
-                hse_u=0
-                hse_d=0
-                ca2=r2['CA'].get_vector()
-                residue_up=[]   ### GP
-                residue_down=[] ### GP
-                for pp2 in ppl:
-                    for j in range(0, len(pp2)):
-                        try:
-                            if r2.get_id()[1]-1!=r1.get_id()[1] or r2.get_id()[1]+1!=r3.get_id()[1]:
-                                pass
-                            else:
-                                raise Exception
-                        except:
-                            if pp1 is pp2 and abs(i-j)<=offset:
-                            # neighboring residues in the chain are ignored
-                                continue
-                        ro=pp2[j]
-                        if not is_aa(ro) or not ro.has_id('CA'):
-                            continue
-                        cao=ro['CA'].get_vector()
-                        d=(cao-ca2)
-                        if d.norm()<radius:
-                            if d.angle(pcb)<(math.pi/2):
-                                hse_u+=1
-                                ### GP
-                                # Puts residues' names in a list that were found in the upper half sphere
-                                residue_up.append(ro)
-
-                                ### end of GP code
-                            else:
-                                hse_d+=1
-                                ### GP
-                                # Puts residues' names in a list that were found in the lower half sphere
-                                residue_down.append(ro)
-                                ### end of GP code
+
+                # neighboring residues in the chain are ignored, unless the residue is next to a chain break
+                ignore_flanking = r1 is None or (r2.get_id()[1]-1==r1.get_id()[1] and (r3 is None or r2.get_id()[1]+1==r3.get_id()[1]))
+
+                # CA atoms within the radius, in the order of the peptides
+                neighbours = numpy.array(sorted(ca_neighbours[k]), dtype=int)
+                keep = valid_neighbour[neighbours]
+                if ignore_flanking:
+                    keep &= ~((residue_peptide[neighbours]==p) & (numpy.abs(residue_position[neighbours]-i)<=offset))
+                neighbours = neighbours[keep]
+                d = ca_coords[neighbours] - ca_coords[k]
+                norms = numpy.sqrt(numpy.sum(d*d, axis=1))
+                neighbours, d, norms = neighbours[norms<radius], d[norms<radius], norms[norms<radius]
+
+                # half sphere: angle between CA-CA and CA-CB below 90 degrees (Vector.angle)
+                pcb_array = pcb.get_array()
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    c = numpy.sum(d*pcb_array, axis=1) / (norms * pcb.norm())
+                up = numpy.arccos(numpy.clip(c, -1, 1)) < (math.pi/2)
+                residue_up = [residues[n] for n in neighbours[up]]       ### GP
+                residue_down = [residues[n] for n in neighbours[~up]]    ### GP
+                hse_u = len(residue_up)
+                hse_d = len(residue_down)
+
                 res_id=r2.get_id()
                 chain_id=r2.get_parent().get_id()
                 # Fill the 3 data structures
@@ -692,10 +690,8 @@ class HSExposureCB(AbstractPropertyMap):
                 if check_knots:
                     for knot in knot_resis:
                         if knot[0][1]==pp1[i].get_id()[1] and knot[0][0]==pp1[i].get_parent().get_id():
-                            # print(pp1[i].get_parent().get_id(),pp1[i]) #print reference
                             for r in residue_up:
                                 if r.get_parent().get_id()==knot[1][0] and r.get_id()[1] in knot[1][1]:
-                                    # print('close: ', r.get_parent().get_id(),r) #print res within radius
                                     resi_range = [knot[1][1][0], knot[1][1][-1]]
                                     if knot[1][0] not in self.remodel_resis:
                                         self.remodel_resis[knot[1][0]] = [resi_range]
@@ -704,52 +700,42 @@ class HSExposureCB(AbstractPropertyMap):
                                             self.remodel_resis[knot[1][0]].append(resi_range)
 
                 ### GP checking for atom clashes
-                include_prev, include_next = False, False
-                try:
-                    if pp1[i].get_id()[1]-1!=pp1[i-1].get_id()[1]:
-                        include_prev = True
-                except:
-                    include_prev = False
-                try:
-                    if pp1[i].get_id()[1]+1!=pp1[i+1].get_id()[1]:
-                        include_next = True
-                except:
-                    include_next = False
-                for atom in pp1[i]:
-                    ref_vector = atom.get_vector()
-                    for other_res in residue_up:
-                        try:
-                            if other_res==pp1[i-1] and include_prev==False:
-                                continue
-                            elif len(pp1)>=i+1 and other_res==pp1[i+1] and include_next==False:
+                # the previous/next residue in the peptide is skipped, unless there is a gap in the numbering
+                # (pp1[i-1] is the last residue of the peptide for i==0)
+                clash_residues = set(neighbours[up].tolist())
+                if pp1[i].get_id()[1]-1==pp1[i-1].get_id()[1]:
+                    clash_residues.discard(peptide_starts[p] + (i-1) % len(pp1))
+                if i+1<len(pp1) and pp1[i].get_id()[1]+1==pp1[i+1].get_id()[1]:
+                    clash_residues.discard(k+1)
+                ref_atoms = range(atom_starts[k], atom_starts[k+1])
+                if clash_residues:
+                    for a, close_atoms in zip(ref_atoms, atom_tree.query_ball_point(atom_coords[ref_atoms], 2*(1+1e-9))):
+                        for other_atom in sorted(close_atoms):
+                            other = atom_residue[other_atom]
+                            if other not in clash_residues:
                                 continue
-                            else:
-                                raise Exception
-                        except:
-                            for other_atom in other_res:
-                                other_vector = other_atom.get_vector()
-                                d = other_vector-ref_vector
-                                if d.norm()<2:
-                                    if len(str(pp1[i]['CA'].get_bfactor()).split('.')[1])==1:
-                                        clash_res1 = float(str(pp1[i]['CA'].get_bfactor())+'0')
-                                    else:
-                                        clash_res1 = pp1[i]['CA'].get_bfactor()
-                                    if len(str(other_res['CA'].get_bfactor()).split('.')[1])==1:
-                                        clash_res2 = float(str(other_res['CA'].get_bfactor())+'0')
-                                    else:
-                                        clash_res2 = other_res['CA'].get_bfactor()
-                                    self.clash_pairs.append([(clash_res1, pp1[i].get_id()[1]), (clash_res2, other_res.get_id()[1])])
-                    if check_hetatoms:
-                        for het_res in het_resis:
-                            for het_atom in het_res:
-                                het_atom_vector = het_atom.get_vector()
-                                d = het_atom_vector-ref_vector
-                                if d.norm()<6:
-                                    if d.norm()<1:
-                                        het_resis_clash.append(het_res)
-                                    het_resis_close.append(het_res)
+                            d = atom_coords[other_atom] - atom_coords[a]
+                            if numpy.sqrt(sum(d*d))<2:
+                                other_res = residues[other]
+                                if len(str(pp1[i]['CA'].get_bfactor()).split('.')[1])==1:
+                                    clash_res1 = float(str(pp1[i]['CA'].get_bfactor())+'0')
+                                else:
+                                    clash_res1 = pp1[i]['CA'].get_bfactor()
+                                if len(str(other_res['CA'].get_bfactor()).split('.')[1])==1:
+                                    clash_res2 = float(str(other_res['CA'].get_bfactor())+'0')
+                                else:
+                                    clash_res2 = other_res['CA'].get_bfactor()
+                                self.clash_pairs.append([(clash_res1, pp1[i].get_id()[1]), (clash_res2, other_res.get_id()[1])])
+                if het_atoms:
+                    for a, close_atoms in zip(ref_atoms, het_tree.query_ball_point(atom_coords[ref_atoms], 6*(1+1e-9))):
+                        if close_atoms:
+                            d = het_atom_coords[close_atoms] - atom_coords[a]
+                            norms = numpy.sqrt(numpy.sum(d*d, axis=1))
+                            close_residues = het_atom_residue[close_atoms]
+                            het_resis_close.update(close_residues[norms<6].tolist())
+                            het_resis_clash.update(close_residues[norms<1].tolist())
         ### GP checking HETRESIS to remove if not interacting with AAs
-        self.hetresis_to_remove = [i for i in het_resis if i not in het_resis_close or i in het_resis_clash]
+        self.hetresis_to_remove = [res for h, res in enumerate(het_resis) if h not in het_resis_close or h in het_resis_clash]
         if check_chain_breaks:
             for r in residues_in_pdb:
                 if r not in residues_with_proper_CA:
@@ -149,8 +149,7 @@ class GPCRDBParsingPDB(object):
                             break
             else:
                 rotamer = rotamer[0]
-            io = StringIO(rotamer.pdbdata.pdb)
-            rota_struct = PDB.PDBParser(QUIET=True).get_structure('structure', io)[0]
+            rota_struct = rotamer.pdbdata.get_structure('structure')[0]
             for chain in rota_struct:
                 for residue in chain:
                     for atom in residue:
@@ -228,9 +227,7 @@ class GPCRDBParsingPDB(object):
                     output[r.protein_segment.slug] = OrderedDict()
                 rotamer = Rotamer.objects.filter(residue=r)
                 rotamer = self.right_rotamer_select(rotamer)
-                rota_io = StringIO(rotamer.pdbdata.pdb)
-                p = PDB.PDBParser()
-                parsed_rota = p.get_structure('rota', rota_io)
+                parsed_rota = rotamer.pdbdata.get_structure('rota')
                 for chain in parsed_rota[0]:
                     for res in chain:
                         atom_list = []
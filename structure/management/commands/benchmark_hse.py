@@ -0,0 +1,265 @@
+from django.core.management.base import BaseCommand
+
+from structure.functions import HSExposureCB, PossibleKnots
+from structure.models import Structure
+
+from Bio.PDB import PDBParser
+from Bio.PDB.Polypeptide import CaPPBuilder, is_aa
+from io import StringIO
+import math
+import os
+import time
+
+
+class Command(BaseCommand):
+
+    help = "Benchmark the KD-tree HSExposureCB against the former implementation and compare the results"
+
+    def add_arguments(self, parser):
+        parser.add_argument('structures',
+            nargs='+',
+            help='PDB files or PDB codes of structures in the database')
+        parser.add_argument('--radius',
+            type=float,
+            action='store',
+            dest='radius',
+            default=11,
+            help='HSE radius')
+        parser.add_argument('--hetatoms',
+            action='store_true',
+            dest='hetatoms',
+            default=False,
+            help='Also check the hetero atoms')
+        parser.add_argument('--repeat',
+            type=int,
+            action='store',
+            dest='repeat',
+            default=1,
+            help='Number of times each calculation is run')
+
+    def handle(self, *args, **options):
+        parser = PDBParser(QUIET=True)
+        for name in options['structures']:
+            if os.path.isfile(name):
+                model = parser.get_structure(name, name)[0]
+            else:
+                structure = Structure.objects.get(pdb_code__index=name.upper())
+                model = parser.get_structure(name, StringIO(structure.pdb_data.pdb))[0]
+
+            results = []
+            for hse_class in (HSExposureCB, ReferenceHSExposureCB):
+                start = time.time()
+                for i in range(options['repeat']):
+                    hse = hse_class(model, radius=options['radius'], check_chain_breaks=True, check_hetatoms=options['hetatoms'])
+                    xtra = [(res.get_full_id(), res.xtra.get('HSE_U'), res.xtra.get('HSE_D')) for res in model.get_residues()]
+                    for res in model.get_residues():
+                        res.xtra.clear()
+                results.append(((time.time() - start)/options['repeat'], hse, xtra))
+
+            (new_time, new, new_xtra), (ref_time, ref, ref_xtra) = results
+            identical = (new.clash_pairs == ref.clash_pairs and new.chain_breaks == ref.chain_breaks and new_xtra == ref_xtra
+                and [r.get_full_id() for r in new.hetresis_to_remove] == [r.get_full_id() for r in ref.hetresis_to_remove])
+            print("{}: {} residues, {} clashes, KD-tree {:.3f}s, former {:.3f}s ({:.1f}x), identical: {}".format(name,
+                len(new_xtra), len(new.clash_pairs), new_time, ref_time, ref_time/max(new_time, 1e-9), identical))
+
+
+class ReferenceHSExposureCB(HSExposureCB):
+    """Former implementation of HSExposureCB (pairwise Vector comparisons), kept as a reference"""
+    def __init__(self, model, radius, offset=0, hse_up_key='HSE_U', hse_down_key='HSE_D', angle_key=None, check_chain_breaks=False, 
+                 check_knots=False, receptor=None, signprot=None,  restrict_to_chain=[], check_hetatoms=False):
+        """
+        @param model: model
+        @type model: L{Model}
+
+        @param radius: HSE radius
+        @type radius: float
+
+        @param offset: number of flanking residues that are ignored in the calculation
+        of the number of neighbors
+        @type offset: int
+
+        @param hse_up_key: key used to store HSEup in the entity.xtra attribute
+        @type hse_up_key: string
+
+        @param hse_down_key: key used to store HSEdown in the entity.xtra attribute
+        @type hse_down_key: string
+
+        @param angle_key: key used to store the angle between CA-CB and CA-pCB in
+        the entity.xtra attribute
+        @type angle_key: string
+        """
+        assert(offset>=0)
+        # For PyMOL visualization
+        self.ca_cb_list=[]
+        ppb=CaPPBuilder()
+        ppl=ppb.build_peptides(model)
+        hse_map={}
+        hse_list=[]
+        hse_keys=[]
+        ### GP
+        if model.get_id()!=0:
+            model = model[0]
+        residues_in_pdb,residues_with_proper_CA=[],[]
+        if check_chain_breaks==True:
+            # for m in model:
+                for chain in model:
+                    for res in chain:
+                        # try:
+                            if is_aa(res):
+                                residues_in_pdb.append(res.get_id()[1])
+                        # except:
+                        #     if is_aa(chain):
+                        #         residues_in_pdb.append(chain.get_id()[1])
+                        #         print('chain', chain, res)
+                        #         break
+        het_resis, het_resis_close, het_resis_clash = [], [], []
+        for chain in model:
+            for res in chain:
+                if res.get_id()[0]!=' ':
+                    het_resis.append(res)
+        self.clash_pairs = []
+        self.chain_breaks = []
+        
+        if check_knots:
+            possible_knots = PossibleKnots(receptor, signprot)
+            knot_resis = possible_knots.get_resnums()
+            self.remodel_resis = {}
+        if len(restrict_to_chain)>0:
+            restricted_ppl = []
+            for p in ppl:
+                if p[0].get_parent().get_id() in restrict_to_chain:
+                    restricted_ppl.append(p)
+            ppl = restricted_ppl
+        ###########
+        for pp1 in ppl:
+            for i in range(0, len(pp1)):
+                residues_with_proper_CA.append(pp1[i].get_id()[1])
+                if i==0:
+                    r1=None
+                else:
+                    r1=pp1[i-1]
+                r2=pp1[i]
+                if i==len(pp1)-1:
+                    r3=None
+                else:
+                    r3=pp1[i+1]
+                # This method is provided by the subclasses to calculate HSE
+                result=self._get_cb(r1, r2, r3)
+                if result is None:
+                    # Missing atoms, or i==0, or i==len(pp1)-1
+                    continue
+                pcb, angle=result
+                hse_u=0
+                hse_d=0
+                ca2=r2['CA'].get_vector()
+                residue_up=[]   ### GP
+                residue_down=[] ### GP
+                for pp2 in ppl:
+                    for j in range(0, len(pp2)):
+                        try:
+                            if r2.get_id()[1]-1!=r1.get_id()[1] or r2.get_id()[1]+1!=r3.get_id()[1]:
+                                pass
+                            else:
+                                raise Exception
+                        except:
+                            if pp1 is pp2 and abs(i-j)<=offset:
+                            # neighboring residues in the chain are ignored
+                                continue
+                        ro=pp2[j]
+                        if not is_aa(ro) or not ro.has_id('CA'):
+                            continue
+                        cao=ro['CA'].get_vector()
+                        d=(cao-ca2)
+                        if d.norm()<radius:
+                            if d.angle(pcb)<(math.pi/2):
+                                hse_u+=1
+                                ### GP
+                                # Puts residues' names in a list that were found in the upper half sphere
+                                residue_up.append(ro)
+
+                                ### end of GP code
+                            else:
+                                hse_d+=1
+                                ### GP
+                                # Puts residues' names in a list that were found in the lower half sphere
+                                residue_down.append(ro)
+                                ### end of GP code
+                res_id=r2.get_id()
+                chain_id=r2.get_parent().get_id()
+                # Fill the 3 data structures
+                hse_map[(chain_id, res_id)]=(hse_u, hse_d, angle)
+                hse_list.append((r2, (residue_up, residue_down, hse_u, hse_d, angle)))
+                ### GP residue_up and residue_down added to hse_list
+                hse_keys.append((chain_id, res_id))
+                # Add to xtra
+                r2.xtra[hse_up_key]=hse_u
+                r2.xtra[hse_down_key]=hse_d
+                if angle_key:
+                    r2.xtra[angle_key]=angle
+
+                ### GP checking for knots
+                if check_knots:
+                    for knot in knot_resis:
+                        if knot[0][1]==pp1[i].get_id()[1] and knot[0][0]==pp1[i].get_parent().get_id():
+                            # print(pp1[i].get_parent().get_id(),pp1[i]) #print reference
+                            for r in residue_up:
+                                if r.get_parent().get_id()==knot[1][0] and r.get_id()[1] in knot[1][1]:
+                                    # print('close: ', r.get_parent().get_id(),r) #print res within radius
+                                    resi_range = [knot[1][1][0], knot[1][1][-1]]
+                                    if knot[1][0] not in self.remodel_resis:
+                                        self.remodel_resis[knot[1][0]] = [resi_range]
+                                    else:
+                                        if resi_range not in self.remodel_resis[knot[1][0]]:
+                                            self.remodel_resis[knot[1][0]].append(resi_range)
+
+                ### GP checking for atom clashes
+                include_prev, include_next = False, False
+                try:
+                    if pp1[i].get_id()[1]-1!=pp1[i-1].get_id()[1]:
+                        include_prev = True
+                except:
+                    include_prev = False
+                try:
+                    if pp1[i].get_id()[1]+1!=pp1[i+1].get_id()[1]:
+                        include_next = True
+                except:
+                    include_next = False
+                for atom in pp1[i]:
+                    ref_vector = atom.get_vector()
+                    for other_res in residue_up:
+                        try:
+                            if other_res==pp1[i-1] and include_prev==False:
+                                continue
+                            elif len(pp1)>=i+1 and other_res==pp1[i+1] and include_next==False:
+                                continue
+                            else:
+                                raise Exception
+                        except:
+                            for other_atom in other_res:
+                                other_vector = other_atom.get_vector()
+                                d = other_vector-ref_vector
+                                if d.norm()<2:
+                                    if len(str(pp1[i]['CA'].get_bfactor()).split('.')[1])==1:
+                                        clash_res1 = float(str(pp1[i]['CA'].get_bfactor())+'0')
+                                    else:
+                                        clash_res1 = pp1[i]['CA'].get_bfactor()
+                                    if len(str(other_res['CA'].get_bfactor()).split('.')[1])==1:
+                                        clash_res2 = float(str(other_res['CA'].get_bfactor())+'0')
+                                    else:
+                                        clash_res2 = other_res['CA'].get_bfactor()
+                                    self.clash_pairs.append([(clash_res1, pp1[i].get_id()[1]), (clash_res2, other_res.get_id()[1])])
+                    if check_hetatoms:
+                        for het_res in het_resis:
+                            for het_atom in het_res:
+                                het_atom_vector = het_atom.get_vector()
+                                d = het_atom_vector-ref_vector
+                                if d.norm()<6:
+                                    if d.norm()<1:
+                                        het_resis_clash.append(het_res)
+                                    het_resis_close.append(het_res)
+        ### GP checking HETRESIS to remove if not interacting with AAs
+        self.hetresis_to_remove = [i for i in het_resis if i not in het_resis_close or i in het_resis_clash]
+        if check_chain_breaks:
+            for r in residues_in_pdb:
+                if r not in residues_with_proper_CA:
+                    self.chain_breaks.append(r)
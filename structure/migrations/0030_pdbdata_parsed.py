@@ -0,0 +1,18 @@
+# Generated by Django 2.0.8 on 2026-10-16 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('structure', '0029_auto_20200831_1835'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pdbdata',
+            name='parsed',
+            field=models.BinaryField(null=True),
+        ),
+    ]
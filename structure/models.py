@@ -3,8 +3,10 @@ from django.core.cache import cache
 
 from io import StringIO
 from Bio.PDB import PDBIO
+import numpy
 import re
 from protein.models import ProteinGProteinPair
+from structure.parsed_pdb import load_parsed_pdb, pack_pdb_text
 
 class Structure(models.Model):
     # linked onto the Xtal ProteinConformation, which is linked to the Xtal protein
@@ -60,51 +62,39 @@ class Structure(models.Model):
 
     def get_cleaned_pdb(self, pref_chain=True, remove_waters=True, ligands_to_keep=None, remove_aux=False, aux_range=5.0):
 
-        tmp = []
-        for line in self.pdb_data.pdb.split('\n'):
-            save_line = False
+        # line filters on the stored line columns instead of splitting the text
+        parsed = self.pdb_data.get_parsed()
+        chain = parsed.lines['chain'] == self.preferred_chain[0].encode()
+        resname = parsed.lines['resname']
+        het = parsed.record_mask('HET')
+        if pref_chain:
+            # or 'refined' bit needs rework, it fucks up the extraction
+            save_lines = parsed.record_mask('ATOM', 'HET') & (chain | ('refined' in self.pdb_code.index))
+        else:
+            save_lines = numpy.ones(len(parsed.lines), dtype=bool)
+        if remove_waters:
+            save_lines &= ~(het & (resname == b'HOH'))
+        if ligands_to_keep:
+            ligand_lines = het & (resname != b'HOH')
+            keep = numpy.isin(resname, [ligand.encode() for ligand in ligands_to_keep])
             if pref_chain:
-                # or 'refined' bit needs rework, it fucks up the extraction
-                if (line.startswith('ATOM') or line.startswith('HET')) and (line[21] == self.preferred_chain[0] or 'refined' in self.pdb_code.index):
-                # if (line.startswith('ATOM') or line.startswith('HET')) and (line[21] == self.preferred_chain[0]):
-                    save_line = True
-            else:
-                save_line = True
-            if remove_waters and line.startswith('HET') and line[17:20] == 'HOH':
-                save_line = False
-            if ligands_to_keep and line.startswith('HET'):
-                if pref_chain:
-                    if line[17:20] != 'HOH' and line[17:20] in ligands_to_keep and line[21] == self.preferred_chain[0]:
-                        save_line = True
-                    elif line[17:20] != 'HOH':
-                        save_line=False
-                else:
-                    if line[17:20] != 'HOH' and line[17:20] in ligands_to_keep:
-                        save_line = True
-                    elif line[17:20] != 'HOH':
-                        save_line=False
-            if save_line:
-                tmp.append(line)
-
-        return '\n'.join(tmp)
+                keep &= chain
+            save_lines[ligand_lines] = keep[ligand_lines]
+
+        return parsed.select_lines(save_lines)
 
     def get_ligand_pdb(self, ligand):
 
-        tmp = []
-        for line in self.pdb_data.pdb.split('\n'):
-            if line.startswith('HET') and line[21] == self.preferred_chain[0]:
-                if line[17:20] != 'HOH' and line[17:20] == ligand:
-                    tmp.append(line)
-        return '\n'.join(tmp)
+        parsed = self.pdb_data.get_parsed()
+        resname = parsed.lines['resname']
+        return parsed.select_lines(parsed.record_mask('HET') & (parsed.lines['chain'] == self.preferred_chain[0].encode())
+            & (resname != b'HOH') & (resname == ligand.encode()))
 
     def get_preferred_chain_pdb(self):
 
-        tmp = []
-        for line in self.pdb_data.pdb.split('\n'):
-            # http://www.wwpdb.org/documentation/file-format-content/format33/sect9.html#ATOM
-            if (line.startswith('ATOM') or line.startswith('HET')) and line[21] == self.preferred_chain[0]:
-                tmp.append(line)
-        return '\n'.join(tmp)
+        # http://www.wwpdb.org/documentation/file-format-content/format33/sect9.html#ATOM
+        parsed = self.pdb_data.get_parsed()
+        return parsed.select_lines(parsed.record_mask('ATOM', 'HET') & (parsed.lines['chain'] == self.preferred_chain[0].encode()))
 
     @property
     def is_refined(self):
@@ -360,10 +350,23 @@ class StructureStabilizingAgent(models.Model):
 
 class PdbData(models.Model):
     pdb = models.TextField()
+    parsed = models.BinaryField(null=True) # coordinate arrays of pdb, see structure.parsed_pdb
 
     def __str__(self):
         return self.pdb
 
+    def save(self, *args, **kwargs):
+        # keep the coordinate arrays in sync with the text
+        self.parsed = pack_pdb_text(self.pdb)
+        super().save(*args, **kwargs)
+
+    def get_parsed(self):
+        return load_parsed_pdb(self)
+
+    def get_structure(self, structure_id='structure'):
+        """Bio.PDB structure of pdb (without parsing the text again)"""
+        return self.get_parsed().get_structure(structure_id)
+
     class Meta():
         db_table = "structure_pdb_data"
 
@@ -0,0 +1,288 @@
+"""
+Binary coordinate arrays of PdbData.pdb
+
+The PDB text is parsed once (see PdbData.save) into three NumPy record arrays that are stored as one
+binary blob next to the text (PdbData.parsed):
+    atoms   ATOM/HETATM records as read by Bio.PDB.PDBParser (coordinates, element, residue, chain, ...)
+    lines   offset, length and record/chain/residue columns of every line of the text, for line based filters
+    models  serial number of every model (-1 when the file has no MODEL record)
+
+load_parsed_pdb gives a ParsedPdb for a PdbData object with array views on the blob, and rebuilds a
+Bio.PDB structure from the arrays when needed. The blobs are kept in a bounded in-process LRU, so loading the
+same structure again only costs a checksum of the text instead of a parse.
+"""
+from django.conf import settings
+
+from Bio.PDB.PDBExceptions import PDBConstructionException, PDBConstructionWarning
+from Bio.PDB.StructureBuilder import StructureBuilder
+from Bio.PDB.parse_pdb_header import parse_pdb_header
+
+from common.cache import LRUTier
+
+from io import StringIO
+
+import numpy
+import struct
+import warnings
+import zlib
+
+
+ATOM_DTYPE = numpy.dtype([
+    ('hetatm', '?'),
+    ('serial', '<i4'),
+    ('fullname', 'S4'),
+    ('altloc', 'S1'),
+    ('resname', 'S3'),
+    ('chain', 'S1'),
+    ('resseq', '<i4'),
+    ('icode', 'S1'),
+    ('coord', '<f4', (3,)),
+    ('occupancy', '<f8'),
+    ('bfactor', '<f8'),
+    ('segid', 'S4'),
+    ('element', 'S2'),
+    ('model', '<i4'),
+])
+
+LINE_DTYPE = numpy.dtype([
+    ('offset', '<i8'),
+    ('length', '<i4'),
+    ('record', 'S6'),
+    ('chain', 'S1'),
+    ('resname', 'S3'),
+])
+
+MODEL_DTYPE = numpy.dtype([
+    ('serial', '<i4'),
+])
+
+# magic, checksum and length of the text, line index where the coordinates start, number of atoms/lines/models
+MAGIC = b'PDBARR01'
+HEADER = struct.Struct('<8sIQQQQQ')
+
+parsed_pdb_cache = LRUTier(getattr(settings, 'PARSED_PDB_CACHE_ENTRIES', 512),
+                           getattr(settings, 'PARSED_PDB_CACHE_SIZE', 256*1024*1024))
+
+
+def text_checksum(text):
+    return zlib.crc32(text.encode('utf-8'))
+
+
+def encode_field(value):
+    return value.encode('ascii', 'replace')
+
+
+class ParsedPdb(object):
+    """Array representation of a PDB file, with Bio.PDB and text views"""
+
+    def __init__(self, text, atoms, lines, models, header_end):
+        self.text = text
+        self.atoms = atoms
+        self.lines = lines
+        self.models = models
+        self.header_end = header_end
+
+    @classmethod
+    def from_text(cls, text):
+        """Parse the PDB text, following Bio.PDB.PDBParser (permissive mode, ANISOU/SIG* records are not kept)"""
+        split_lines = text.split('\n')
+        lines = numpy.zeros(len(split_lines), dtype=LINE_DTYPE)
+        offset = 0
+        for i, line in enumerate(split_lines):
+            lines[i] = (offset, len(line), encode_field(line[:6]), encode_field(line[21:22]), encode_field(line[17:20]))
+            offset += len(line) + 1
+
+        # the header ends at the first coordinate record (or at the last line, as read by readlines)
+        header_end = 0
+        for header_end, line in enumerate(split_lines[:-1] if text.endswith('\n') else split_lines):
+            if line[0:6] in ('ATOM  ', 'HETATM', 'MODEL '):
+                break
+
+        atoms = []
+        models = []
+        model_open = False
+        for line in split_lines[header_end:]:
+            record_type = line[0:6]
+            if not line.strip():
+                continue
+            elif record_type == 'ATOM  ' or record_type == 'HETATM':
+                if not model_open:
+                    models.append(-1)
+                    model_open = True
+                try:
+                    serial_number = int(line[6:11])
+                except Exception:
+                    serial_number = 0
+                resseq = int(line[22:26].split()[0])
+                try:
+                    coord = (float(line[30:38]), float(line[38:46]), float(line[46:54]))
+                except Exception:
+                    raise PDBConstructionException('Invalid or missing coordinate(s) in line: {}'.format(line)) from None
+                try:
+                    occupancy = float(line[54:60])
+                except Exception:
+                    occupancy = numpy.nan
+                try:
+                    bfactor = float(line[60:66])
+                except Exception:
+                    bfactor = 0.0
+                atoms.append((record_type == 'HETATM', serial_number, encode_field(line[12:16]), encode_field(line[16]),
+                    encode_field(line[17:20]), encode_field(line[21]), resseq, encode_field(line[26]), coord, occupancy,
+                    bfactor, encode_field(line[72:76]), encode_field(line[76:78].strip().upper()), len(models) - 1))
+            elif record_type == 'MODEL ':
+                try:
+                    serial_num = int(line[10:14])
+                except Exception:
+                    serial_num = 0
+                models.append(serial_num)
+                model_open = True
+            elif record_type == 'END   ' or record_type == 'CONECT':
+                break
+            elif record_type == 'ENDMDL':
+                model_open = False
+
+        return cls(text, numpy.array(atoms, dtype=ATOM_DTYPE), lines, numpy.array(models, dtype=MODEL_DTYPE), header_end)
+
+    @classmethod
+    def from_bytes(cls, text, data):
+        """Array views on a blob made by to_bytes, raises ValueError if the blob does not belong to the text"""
+        data = bytes(data)
+        if len(data) < HEADER.size:
+            raise ValueError('Invalid parsed PDB data')
+        magic, checksum, length, header_end, num_atoms, num_lines, num_models = HEADER.unpack_from(data)
+        if magic != MAGIC or length != len(text) or checksum != text_checksum(text):
+            raise ValueError('Parsed PDB data does not match the PDB text')
+        offset = HEADER.size
+        arrays = []
+        for dtype, count in ((ATOM_DTYPE, num_atoms), (LINE_DTYPE, num_lines), (MODEL_DTYPE, num_models)):
+            arrays.append(numpy.frombuffer(data, dtype=dtype, count=count, offset=offset))
+            offset += dtype.itemsize * count
+        return cls(text, *arrays, header_end=header_end)
+
+    def to_bytes(self):
+        return b''.join([
+            HEADER.pack(MAGIC, text_checksum(self.text), len(self.text), self.header_end,
+                len(self.atoms), len(self.lines), len(self.models)),
+            self.atoms.tobytes(), self.lines.tobytes(), self.models.tobytes()])
+
+    @property
+    def coords(self):
+        return self.atoms['coord']
+
+    @property
+    def elements(self):
+        return self.atoms['element']
+
+    @property
+    def chains(self):
+        return self.atoms['chain']
+
+    @property
+    def residue_numbers(self):
+        return self.atoms['resseq']
+
+    def record_mask(self, *prefixes):
+        """Lines starting with one of the prefixes (like line.startswith)"""
+        mask = numpy.zeros(len(self.lines), dtype=bool)
+        for prefix in prefixes:
+            mask |= numpy.char.startswith(self.lines['record'], encode_field(prefix))
+        return mask
+
+    def select_lines(self, mask):
+        """Text of the selected lines, joined with newlines"""
+        selected = self.lines[mask]
+        return '\n'.join([self.text[offset:offset+length] for offset, length in zip(selected['offset'].tolist(), selected['length'].tolist())])
+
+    def get_structure(self, structure_id='structure'):
+        """Bio.PDB Structure built from the arrays, equal to PDBParser(PERMISSIVE=True, QUIET=True).get_structure()"""
+        builder = StructureBuilder()
+        atoms = self.atoms
+        coords = numpy.array(atoms['coord'], dtype='f')
+        columns = [atoms[field].astype('U').tolist() for field in ('fullname', 'altloc', 'resname', 'chain', 'icode', 'segid', 'element')]
+        numbers = [atoms[field].tolist() for field in ('hetatm', 'serial', 'resseq', 'occupancy', 'bfactor', 'model')]
+
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', category=PDBConstructionWarning)
+            builder.init_structure(structure_id)
+            current_model = -1
+            current_segid = None
+            for i, (fullname, altloc, resname, chainid, icode, segid, element, hetatm, serial_number, resseq, occupancy, bfactor, model) in \
+                    enumerate(zip(*(columns + numbers))):
+                while current_model < model:
+                    # models without atoms are kept as well
+                    current_model += 1
+                    serial_num = self.models[current_model]['serial']
+                    if serial_num < 0:
+                        builder.init_model(current_model)
+                    else:
+                        builder.init_model(current_model, int(serial_num))
+                    current_chain_id = None
+                    current_residue_id = None
+                    current_resname = None
+
+                split_list = fullname.split()
+                name = fullname if len(split_list) != 1 else split_list[0]
+                if hetatm:
+                    hetero_flag = 'W' if resname == 'HOH' or resname == 'WAT' else 'H'
+                else:
+                    hetero_flag = ' '
+                residue_id = (hetero_flag, resseq, icode)
+                if occupancy != occupancy:
+                    occupancy = None
+
+                if current_segid != segid:
+                    current_segid = segid
+                    builder.init_seg(current_segid)
+                if current_chain_id != chainid or current_residue_id != residue_id or current_resname != resname:
+                    if current_chain_id != chainid:
+                        current_chain_id = chainid
+                        builder.init_chain(current_chain_id)
+                    current_residue_id = residue_id
+                    current_resname = resname
+                    try:
+                        builder.init_residue(resname, hetero_flag, resseq, icode)
+                    except PDBConstructionException:
+                        pass
+                try:
+                    builder.init_atom(name, coords[i], bfactor, occupancy, altloc, fullname, serial_number, element)
+                except PDBConstructionException:
+                    pass
+
+            for model in range(current_model + 1, len(self.models)):
+                serial_num = self.models[model]['serial']
+                builder.init_model(model, None if serial_num < 0 else int(serial_num))
+
+            # the header lines end where the line of header_end starts
+            builder.set_header(parse_pdb_header(StringIO(self.text[:int(self.lines[self.header_end]['offset'])])))
+        return builder.get_structure()
+
+
+def pack_pdb_text(text):
+    """Binary arrays for PdbData.parsed, None if the text cannot be parsed"""
+    try:
+        return ParsedPdb.from_text(text).to_bytes()
+    except (PDBConstructionException, ValueError, IndexError):
+        return None
+
+
+def load_parsed_pdb(pdb_data):
+    """ParsedPdb of a PdbData object, from the in-process cache, the stored arrays or (if missing/outdated) parsed"""
+    key = pdb_data.pk
+    if key is not None:
+        entry = parsed_pdb_cache.get(key)
+        candidates = [entry[1]] if entry is not None else []
+        if not candidates and pdb_data.parsed:
+            candidates.append(bytes(pdb_data.parsed))
+        for data in candidates:
+            try:
+                parsed = ParsedPdb.from_bytes(pdb_data.pdb, data)
+            except ValueError:
+                continue
+            if entry is None:
+                parsed_pdb_cache.set(key, data, 0)
+            return parsed
+
+    parsed = ParsedPdb.from_text(pdb_data.pdb)
+    if key is not None:
+        parsed_pdb_cache.set(key, parsed.to_bytes(), 0)
+    return parsed
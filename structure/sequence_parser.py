@@ -231,6 +231,7 @@ class SequenceParser(object):
         bio.pdb reads pdb in the following cascade: model->chain->residue->atom
         """
         
+        peptides = []
         for chain in pdb_struct:
             self.residues[chain.id] = []
             
@@ -242,7 +243,12 @@ class SequenceParser(object):
             poly = self.get_chain_peptides(chain.id)
             for peptide in poly:
                 #print("Start: {} Stop: {} Len: {}".format(peptide[0].id[1], peptide[-1].id[1], len(peptide)))
-                self.map_to_wt_blast(chain.id, peptide, None, int(peptide[0].id[1]))
+                peptides.append((chain.id, peptide))
+
+        # a single blast run for the peptides of all chains
+        alignments = self.blast.run_many([self.get_peptide_sequence(peptide) for chain_id, peptide in peptides])
+        for (chain_id, peptide), peptide_alignments in zip(peptides, alignments):
+            self.map_to_wt_blast(chain_id, peptide, None, int(peptide[0].id[1]), alignments=peptide_alignments)
 
 
     def get_segments(self):
@@ -318,15 +324,16 @@ class SequenceParser(object):
         return nrc
 
 
-    def map_to_wt_blast(self, chain_id, residues = None, sequence=None, starting_aa = 1, seqres = False):
+    def map_to_wt_blast(self, chain_id, residues = None, sequence=None, starting_aa = 1, seqres = False, alignments = None):
 
-        if residues:
-            seq = self.get_peptide_sequence(residues)
-        elif sequence:
-            seq = sequence
-        else:
-            seq = self.get_chain_sequence(chain_id)
-        alignments = self.blast.run(seq)
+        if alignments is None:
+            if residues:
+                seq = self.get_peptide_sequence(residues)
+            elif sequence:
+                seq = sequence
+            else:
+                seq = self.get_chain_sequence(chain_id)
+            alignments = self.blast.run(seq)
         
         if self.wt_protein_id!=None:
             self.wt = Protein.objects.get(id=self.wt_protein_id)
@@ -423,8 +430,9 @@ class SequenceParser(object):
 
     def map_seqres(self):
 
-        for sr in self.seqres:
-            self.map_to_wt_blast(sr.annotations['chain'], sequence=sr.seq, seqres=True)
+        alignments = self.blast.run_many([sr.seq for sr in self.seqres])
+        for sr, seqres_alignments in zip(self.seqres, alignments):
+            self.map_to_wt_blast(sr.annotations['chain'], sequence=sr.seq, seqres=True, alignments=seqres_alignments)
 
     def mark_deletions(self):
         for chain in self.mapping.keys():
@@ -4,6 +4,10 @@ import re
 
 register = template.Library()
 
+# names of the stabilizing agents that are fusion proteins and antibodies (matched at the start of the name)
+FUSIONS = '.*thase.*|PGS|BRIL|.*Lysozyme|.*b562.*|TrxA|Flavodoxin|Rubredoxin|Sialidase|.*Thioredoxin.*|Endolysin|.*cytochrome.*'
+ANTIBODIES = '.*bod.*|.*Ab.*|.*scFv.*|.*Fab.*|.*activity.*|.*RAMP.*|Unidentified peptide|.*CD4.*|.*IgG.*|.*NB.*|.*Fv.*'
+
 @register.filter
 def join_attr(obj_list, attr_name, sep=', '):
     return sep.join(getattr(i, attr_name) for i in obj_list)
@@ -104,7 +108,7 @@ def only_arrestins ( objs ):
 
 @register.filter
 def only_fusions ( objs ):
-    elements = [element for obj in objs for element in obj.name.split(',') if re.match(".*thase.*|PGS|BRIL|.*Lysozyme|.*b562.*|TrxA|Flavodoxin|Rubredoxin|Sialidase|.*Thioredoxin.*|Endolysin|.*cytochrome.*", element)] #not re.match(".*bod.*|.*Ab.*|.*Sign.*|.*G.*|.*restin.*|.*scFv.*|.*Fab.*|.*activity.*|.*RAMP.*|.*peptide.*|.*CD4.*", element) or 
+    elements = [element for obj in objs for element in obj.name.split(',') if re.match(FUSIONS, element)] #not re.match(".*bod.*|.*Ab.*|.*Sign.*|.*G.*|.*restin.*|.*scFv.*|.*Fab.*|.*activity.*|.*RAMP.*|.*peptide.*|.*CD4.*", element) or 
     if len(elements) > 0:
         return "\n".join(elements)
     else:
@@ -112,7 +116,7 @@ def only_fusions ( objs ):
 
 @register.filter
 def only_antibodies ( objs ):
-    elements = [element for obj in objs for element in obj.name.split(',') if re.match(".*bod.*|.*Ab.*|.*scFv.*|.*Fab.*|.*activity.*|.*RAMP.*|Unidentified peptide|.*CD4.*|.*IgG.*|.*NB.*|.*Fv.*", element)]
+    elements = [element for obj in objs for element in obj.name.split(',') if re.match(ANTIBODIES, element)]
     if len(elements) > 0:
         return "\n".join(elements)
     else:
@@ -4,11 +4,14 @@ from structure import views
 from django.conf import settings
 from django.views.generic import TemplateView
 from django.views.decorators.cache import cache_page
+from common.views import DataSourceView
 
 urlpatterns = [
     url(r'^$', cache_page(60*60*24)(StructureBrowser.as_view()), name='structure_browser'),
     url(r'^g_protein_structure_browser$', cache_page(60*60*24)(GProteinStructureBrowser.as_view()), name='g_protein_structure_browser'),
     url(r'^browser$', RedirectBrowser, name='redirect_browser'),
+    url(r'^browser_data$', DataSourceView.as_view(source=StructureBrowserData), name='structure_browser_data'),
+    url(r'^browser_data/(?P<column>\w+)$', DataSourceView.as_view(source=StructureBrowserData), name='structure_browser_data'),
     url(r'^selection_convert$', ConvertStructuresToProteins, name='convert'),
     url(r'^selection_convert_model$', ConvertStructureModelsToProteins, name='convert_mod'),
     url(r'^selection_convert_signprot_model$', ConvertStructureComplexSignprotToProteins, name='convert_signprot'),
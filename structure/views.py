@@ -2,7 +2,8 @@ from django.shortcuts import render
 from django.conf import settings
 from django.views.generic import TemplateView, View
 from django.http import HttpResponse, JsonResponse, HttpResponseRedirect
-from django.db.models import Count, Q, Prefetch
+from django.db.models import Count, Q, Prefetch, Exists, OuterRef, Value, FilteredRelation
+from django.db.models.functions import Concat
 from django import forms
 from django.core.cache import cache
 from django.views.decorators.cache import cache_page
@@ -10,7 +11,7 @@ from django.shortcuts import redirect
 
 from common.phylogenetic_tree import PhylogeneticTreeGenerator
 from protein.models import Gene, ProteinSegment, IdentifiedSites, ProteinGProteinPair
-from structure.models import (Structure, StructureModel, StructureComplexModel, StructureModelStatsRotamer, StructureComplexModelStatsRotamer,
+from structure.models import (Structure, StructureType, StructureModel, StructureComplexModel, StructureModelStatsRotamer, StructureComplexModelStatsRotamer,
 							 StructureModelSeqSim, StructureComplexModelSeqSim, StructureRefinedStatsRotamer, StructureRefinedSeqSim, StructureExtraProteins)
 from structure.functions import CASelector, SelectionParser, GenericNumbersSelector, SubstructureSelector, check_gn, PdbStateIdentifier
 from structure.assign_generic_numbers_gpcr import GenericNumbering
@@ -26,17 +27,22 @@ from common.selection import Selection, SelectionItem
 from common.extensions import MultiFileField
 from common.models import ReleaseNotes
 from common.alignment import GProteinAlignment
+from common.datasource import Column, DataSource
+from ligand.models import LigandProperities
+from structure.templatetags.structure_extras import last_author, FUSIONS, ANTIBODIES
 
 Alignment = getattr(__import__('common.alignment_' + settings.SITE_NAME, fromlist=['Alignment']), 'Alignment')
 
 import inspect
 import os
+import re
 import time
 import zipfile
 import math
 import json
 import ast
 from copy import deepcopy
+from string import Template
 from io import StringIO, BytesIO
 from collections import OrderedDict
 from Bio.PDB import PDBIO, PDBParser
@@ -54,32 +60,129 @@ class_dict = {'001':'A','002':'B1','003':'B2','004':'C','005':'D1','006':'F','00
 
 class StructureBrowser(TemplateView):
 	"""
-	Fetching Structure data for browser
+	Structure browser, the rows are loaded page by page from StructureBrowserData
 	"""
 	template_name = "structure_browser.html"
 
-	def get_context_data (self, **kwargs):
 
-		context = super(StructureBrowser, self).get_context_data(**kwargs)
-		try:
-			context['structures'] = Structure.objects.filter(refined=False).select_related(
-				"state",
-				"pdb_code__web_resource",
-				"protein_conformation__protein__species",
-				"protein_conformation__protein__source",
-				"protein_conformation__protein__family__parent__parent__parent",
-				"publication__web_link__web_resource").prefetch_related(
-				"stabilizing_agents", "construct__crystallization__crystal_method",
-				"protein_conformation__protein__parent__endogenous_ligands__properities__ligand_type",
-				"protein_conformation__site_protein_conformation__site",
-				Prefetch("ligands", queryset=StructureLigandInteraction.objects.filter(
-				annotated=True).prefetch_related('ligand__properities__ligand_type', 'ligand_role','ligand__properities__web_links__web_resource')),
-				Prefetch("extra_proteins", queryset=StructureExtraProteins.objects.all().prefetch_related(
-					'protein_conformation','wt_protein')))
-		except Structure.DoesNotExist as e:
-			pass
+def yes_no(value):
+	return 'Yes' if value else 'No'
 
-		return context
+
+def g_alpha_name(display_name):
+	return '&alpha;' + display_name[1:] if display_name[0] == 'G' else display_name
+
+
+def matching_agents(names, pattern):
+	return [element for name in names for element in name.split(',') if re.match(pattern, element)]
+
+
+class StructureBrowserData(DataSource):
+	"""
+	Rows of the structure browser, paged, sorted and filtered in the database (see common.datasource)
+	"""
+	name = 'structure_browser'
+	signal_protein_categories = ['G alpha', 'Arrestin']
+	columns = [
+		Column('uniprot', 'protein_conformation__protein__parent__entry_name', search='exact', format=lambda v: Protein(entry_name=v).entry_short()),
+		Column('accession', 'protein_conformation__protein__parent__accession', search=None),
+		Column('entry_name', 'protein_conformation__protein__parent__entry_name', search=None),
+		Column('receptor', 'protein_conformation__protein__parent', search=None),
+		Column('iuphar', 'protein_conformation__protein__parent__name', search='exact', format=lambda v: Protein(name=v).short()),
+		Column('receptor_family', 'protein_conformation__protein__family__parent__name', search='exact', format=lambda v: ProteinFamily(name=v).short()),
+		Column('class', 'protein_conformation__protein__family__parent__parent__parent__name', search='exact', format=lambda v: ProteinFamily(name=v).short()),
+		Column('species', 'protein_conformation__protein__species__common_name', search='exact'),
+		Column('method', 'structure_type__name', search='exact', format=lambda v: StructureType(name=v).type_short()),
+		Column('pdb', 'pdb_code__index', search='exact'),
+		Column('refined', 'is_refined', search='exact', format=yes_no),
+		Column('resolution', search='range'),
+		Column('preferred_chain', search='exact'),
+		Column('state', 'state__name', search='exact'),
+		Column('degree_active', 'gprot_bound_likeness', search='range'),
+		Column('signal_protein_family', 'signal_proteins__wt_protein__family__parent__name', search='exact', many=True),
+		Column('signal_protein', 'signal_proteins__display_name', search='exact', format=g_alpha_name, many=True),
+		Column('signal_protein_note', 'signal_proteins__note', many=True),
+		Column('signal_protein_coverage', 'signal_proteins__wt_coverage', search='range', many=True),
+		Column('fusion', 'fusions__name', many=True),
+		Column('antibodies', 'antibodies__name', many=True),
+		Column('ligand', 'annotated_ligands__ligand__name', many=True),
+		Column('ligand_type', 'annotated_ligands__ligand__properities__ligand_type__name', search='exact', many=True),
+		Column('ligand_function', 'annotated_ligands__ligand_role__name', search='exact', many=True),
+		Column('endogenous_ligand', 'protein_conformation__protein__parent__endogenous_ligands__name', many=True),
+		Column('endogenous_ligand_type', 'protein_conformation__protein__parent__endogenous_ligands__properities__ligand_type__name', search='exact', many=True),
+		Column('sodium_site', 'is_sodium_site', search='exact', format=yes_no),
+		Column('sodium', search='exact', format=yes_no),
+		Column('last_author', 'publication__authors', format=last_author),
+		Column('reference', 'publication__web_link__index'),
+		Column('reference_url', 'publication__web_link__web_resource__url', search=None),
+		Column('publication_date', search='range'),
+		Column('representative', search='exact'),
+		Column('annotated', search='exact', format=yes_no),
+		]
+	default_order = ['-publication_date']
+
+	def get_queryset(self):
+		refined = Structure.objects.filter(refined=True, pdb_code__index=Concat(OuterRef('pdb_code__index'), Value('_refined')))
+		sodium_site = IdentifiedSites.objects.filter(protein_conformation=OuterRef('protein_conformation'), site__slug='sodium_pocket')
+		return Structure.objects.filter(refined=False).annotate(
+			is_refined=Exists(refined),
+			is_sodium_site=Exists(sodium_site),
+			signal_proteins=FilteredRelation('extra_proteins', condition=Q(extra_proteins__category__in=self.signal_protein_categories)),
+			fusions=FilteredRelation('stabilizing_agents', condition=Q(stabilizing_agents__name__regex='^(' + FUSIONS + ')')),
+			antibodies=FilteredRelation('stabilizing_agents', condition=Q(stabilizing_agents__name__regex='^(' + ANTIBODIES + ')')),
+			annotated_ligands=FilteredRelation('structureligandinteraction', condition=Q(structureligandinteraction__annotated=True)))
+
+	def extend_rows(self, rows):
+		ids = [row['id'] for row in rows]
+		signal_proteins, stabilizing_agents, ligands, endogenous_ligands, links = {}, {}, {}, {}, {}
+		for values in Structure.extra_proteins.through.objects.filter(structure__in=ids,
+				structureextraproteins__category__in=self.signal_protein_categories).order_by('pk').values(
+				'structure', 'structureextraproteins__display_name', 'structureextraproteins__note',
+				'structureextraproteins__wt_coverage', 'structureextraproteins__wt_protein__name',
+				'structureextraproteins__wt_protein__entry_name', 'structureextraproteins__wt_protein__family__parent__name'):
+			signal_proteins.setdefault(values['structure'], values)
+		for structure_id, name in Structure.stabilizing_agents.through.objects.filter(structure__in=ids).values_list(
+				'structure', 'structurestabilizingagent__name'):
+			stabilizing_agents.setdefault(structure_id, []).append(name)
+		for structure_id, name, role, ligand_type, properities in StructureLigandInteraction.objects.filter(
+				structure__in=ids, annotated=True).order_by('pk').values_list('structure', 'ligand__name',
+				'ligand_role__name', 'ligand__properities__ligand_type__name', 'ligand__properities'):
+			ligands.setdefault(structure_id, []).append({'name': name, 'role': role, 'type': ligand_type, 'properities': properities})
+		for receptor, name, ligand_type in Protein.endogenous_ligands.through.objects.filter(
+				protein__in=set([row['receptor'] for row in rows])).order_by('pk').values_list('protein', 'ligand__name',
+				'ligand__properities__ligand_type__name'):
+			endogenous_ligands.setdefault(receptor, []).append((name, ligand_type))
+		properities = [l['properities'] for structure_ligands in ligands.values() for l in structure_ligands]
+		for properities_id, index, slug, url in LigandProperities.web_links.through.objects.filter(
+				ligandproperities__in=properities).order_by('pk').values_list('ligandproperities', 'weblink__index',
+				'weblink__web_resource__slug', 'weblink__web_resource__url'):
+			links.setdefault(properities_id, []).append({'name': slug, 'url': Template(url).substitute(index=index)})
+
+		for row in rows:
+			signal_protein = signal_proteins.get(row['id'])
+			if signal_protein:
+				row['signal_protein_family'] = signal_protein['structureextraproteins__wt_protein__family__parent__name']
+				row['signal_protein_entry_name'] = signal_protein['structureextraproteins__wt_protein__entry_name']
+				if signal_protein['structureextraproteins__display_name'][0] == 'G':
+					row['signal_protein'] = g_alpha_name(signal_protein['structureextraproteins__display_name'])
+				else:
+					row['signal_protein'] = signal_protein['structureextraproteins__wt_protein__name']
+				row['signal_protein_note'] = signal_protein['structureextraproteins__note']
+				row['signal_protein_coverage'] = signal_protein['structureextraproteins__wt_coverage']
+			else:
+				row['signal_protein_family'] = row['signal_protein_entry_name'] = row['signal_protein'] = None
+				row['signal_protein_note'] = row['signal_protein_coverage'] = None
+			row['fusion'] = matching_agents(stabilizing_agents.get(row['id'], []), FUSIONS)
+			row['antibodies'] = matching_agents(stabilizing_agents.get(row['id'], []), ANTIBODIES)
+			structure_ligands = ligands.get(row['id'], [])
+			row['ligand'] = [{'name': l['name'], 'links': links.get(l['properities'], [])} for l in structure_ligands]
+			row['ligand_type'] = [l['type'] for l in structure_ligands]
+			row['ligand_function'] = [l['role'] for l in structure_ligands]
+			receptor_ligands = endogenous_ligands.get(row['receptor'], [])
+			row['endogenous_ligand'] = [name for name, ligand_type in receptor_ligands]
+			row['endogenous_ligand_type'] = receptor_ligands[0][1] if receptor_ligands else None
+			if row['reference_url']:
+				row['reference_url'] = Template(row['reference_url']).substitute(index=row['reference'])
 
 
 class GProteinStructureBrowser(TemplateView):
@@ -190,7 +293,7 @@ def HomologyModelDetails(request, modelname, state):
 	color_palette = ["orange","cyan","yellow","lime","fuchsia","green","teal","olive","thistle","grey","chocolate","blue","red","pink","maroon",]
 
 	if state=='refined':
-		model = Structure.objects.get(pdb_code__index=modelname+'_refined')
+		model = Structure.objects.select_related('pdb_data').defer('pdb_data__parsed').get(pdb_code__index=modelname+'_refined')
 		model_main_template = Structure.objects.get(pdb_code__index=modelname)
 		rotamers = StructureRefinedStatsRotamer.objects.filter(structure=model).prefetch_related(
 			"structure", "residue__generic_number","rotamer_template__protein_conformation__protein__parent__family",
@@ -369,9 +472,9 @@ def format_model_details(rotamers, model_main_template, color_palette, chain=Non
 
 def ServeHomModDiagram(request, modelname, state):
 	if state=='refined':
-		model=Structure.objects.filter(pdb_code__index=modelname+'_refined')
+		model=Structure.objects.filter(pdb_code__index=modelname+'_refined').select_related('pdb_data').defer('pdb_data__parsed')
 	else:
-		model=StructureModel.objects.filter(protein__entry_name=modelname, state__slug=state)
+		model=StructureModel.objects.filter(protein__entry_name=modelname, state__slug=state).select_related('pdb_data').defer('pdb_data__parsed')
 	if model.exists():
 		model=model.get()
 	else:
@@ -384,7 +487,7 @@ def ServeHomModDiagram(request, modelname, state):
 	return response
 
 def ServeComplexModDiagram(request, modelname, signprot):
-	model=StructureComplexModel.objects.filter(receptor_protein__entry_name=modelname, sign_protein__entry_name=signprot)
+	model=StructureComplexModel.objects.filter(receptor_protein__entry_name=modelname, sign_protein__entry_name=signprot).select_related('pdb_data').defer('pdb_data__parsed')
 	if model.exists():
 		model=model.get()
 	else:
@@ -421,7 +524,7 @@ def StructureDetails(request, pdbname):
 	return render(request,'structure_details.html',{'pdbname': pdbname, 'structures': structures, 'crystal': crystal, 'protein':p, 'residues':residues, 'annotated_resn': resn_list, 'main_ligand': main_ligand, 'refined': refined, 'ligands': ligands})
 
 def ServePdbDiagram(request, pdbname):
-	structure=Structure.objects.filter(pdb_code__index=pdbname)
+	structure=Structure.objects.filter(pdb_code__index=pdbname).select_related('pdb_data').defer('pdb_data__parsed')
 	if structure.exists():
 		structure=structure.get()
 	else:
@@ -2014,9 +2117,9 @@ def HommodDownload(request):
 	hommodels = []
 	for pk in pks:
 		if 'r' in pk:
-			hommodels.append(Structure.objects.get(pk=int(pk[:-1])))
+			hommodels.append(Structure.objects.select_related('pdb_data').defer('pdb_data__parsed').get(pk=int(pk[:-1])))
 		else:
-			hommodels.append(StructureModel.objects.get(pk=pk))
+			hommodels.append(StructureModel.objects.select_related('pdb_data').defer('pdb_data__parsed').get(pk=pk))
 
 	zip_io = BytesIO()
 	with zipfile.ZipFile(zip_io, mode='w', compression=zipfile.ZIP_DEFLATED) as backup_zip:
@@ -2047,7 +2150,7 @@ def ComplexmodDownload(request):
 	"Download selected complex homology models in zip file"
 	pks = request.GET['ids'].split(',')
 
-	hommodels = StructureComplexModel.objects.filter(pk__in=pks).prefetch_related('receptor_protein__family','main_template__pdb_code').all()
+	hommodels = StructureComplexModel.objects.filter(pk__in=pks).prefetch_related('receptor_protein__family','main_template__pdb_code').select_related('pdb_data').defer('pdb_data__parsed').all()
 	zip_io = BytesIO()
 	with zipfile.ZipFile(zip_io, mode='w', compression=zipfile.ZIP_DEFLATED) as backup_zip:
 		for hommod in hommodels:
@@ -2069,9 +2172,9 @@ def SingleModelDownload(request, modelname, state, csv=False):
 
 	zip_io = BytesIO()
 	if state=='refined':
-		hommod = Structure.objects.get(pdb_code__index=modelname+'_refined')
+		hommod = Structure.objects.select_related('pdb_data').defer('pdb_data__parsed').get(pdb_code__index=modelname+'_refined')
 	else:
-		hommod = StructureModel.objects.get(protein__entry_name=modelname, state__slug=state)
+		hommod = StructureModel.objects.select_related('pdb_data').defer('pdb_data__parsed').get(protein__entry_name=modelname, state__slug=state)
 	if state=='refined':
 		version = hommod.pdb_data.pdb.split('\n')[0][-10:]
 		mod_name = 'Class{}_{}_{}_{}_{}_GPCRdb.pdb'.format(class_dict[hommod.protein_conformation.protein.family.slug[:3]], hommod.protein_conformation.protein.entry_name,
@@ -2098,7 +2201,7 @@ def SingleComplexModelDownload(request, modelname, signprot, csv=False):
 	"Download single homology model"
 
 	zip_io = BytesIO()
-	hommod = StructureComplexModel.objects.get(receptor_protein__entry_name=modelname, sign_protein__entry_name=signprot)
+	hommod = StructureComplexModel.objects.select_related('pdb_data').defer('pdb_data__parsed').get(receptor_protein__entry_name=modelname, sign_protein__entry_name=signprot)
 	mod_name = 'Class{}_{}-{}_{}_{}_GPCRdb.pdb'.format(class_dict[hommod.receptor_protein.family.slug[:3]], hommod.receptor_protein.entry_name,
 														hommod.sign_protein.entry_name, hommod.main_template.pdb_code.index, hommod.version)
 	stat_name = 'Class{}_{}-{}_{}_{}_GPCRdb.templates.csv'.format(class_dict[hommod.receptor_protein.family.slug[:3]], hommod.receptor_protein.entry_name,
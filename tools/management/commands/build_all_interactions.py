@@ -6,8 +6,10 @@ from django.db import connection
 from structure.models import Structure
 
 from contactnetwork.cube import *
+from contactnetwork.interaction import InteractionBatchWriter
 
-import logging, json, os
+from multiprocessing import Value
+import logging, json, os, time
 
 class Command(BaseBuild):
 
@@ -24,23 +26,47 @@ class Command(BaseBuild):
             dest='proc',
             default=1,
             help='Number of processes to run')
+        parser.add_argument('--no-copy',
+            action='store_false',
+            dest='use_copy',
+            default=True,
+            help='Store the interactions with bulk inserts instead of PostgreSQL COPY')
 
     def handle(self, *args, **options):
+        self.use_copy = options['use_copy']
+        # totals over all processes for the throughput report
+        self.num_pairs = Value('l', 0)
+        self.num_interactions = Value('l', 0)
+        self.write_time = Value('d', 0)
+
+        start = time.time()
         try:
             self.logger.info('CREATING ALL INTERACTIONS')
-            self.prepare_input(options['proc'], self.pdbs)
+            self.prepare_input(options['proc'], list(self.pdbs))
         except Exception as msg:
             print(msg)
             self.logger.error(msg)
+        self.report_throughput(time.time() - start)
         self.logger.info('COMPLETED ALL INTERACTIONS')
 
-    def main_func(self, positions, iteration,count,lock):
-        pdbs = self.pdbs
-        while count.value<len(pdbs):
-            with lock:
-                pdb = pdbs[count.value]
-                count.value +=1
-            try:
-                compute_interactions(pdb, True)
-            except:
-                print('Issue making interactions for',pdb)
+    def process_item(self, pdb, iteration):
+        writer = InteractionBatchWriter(None, use_copy=self.use_copy)
+        compute_interactions(pdb, True, writer=writer)
+
+        with self.num_pairs.get_lock():
+            self.num_pairs.value += writer.pairs_written
+        with self.num_interactions.get_lock():
+            self.num_interactions.value += writer.interactions_written
+        with self.write_time.get_lock():
+            self.write_time.value += writer.write_time
+
+    def report_throughput(self, seconds):
+        timings = getattr(self, 'item_timings', [])
+        done = len([timing for timing in timings if not timing[3]])
+        seconds = max(seconds, 1e-6)
+        report = ('Interactions of {} structures in {:.1f}s: {:.2f} structures/s, {} residue pairs ({:.0f}/s), '
+            '{} interactions ({:.0f}/s), {:.1f}s spent writing to the database').format(
+            done, seconds, done / seconds, self.num_pairs.value, self.num_pairs.value / seconds,
+            self.num_interactions.value, self.num_interactions.value / seconds, self.write_time.value)
+        self.logger.info(report)
+        print(report)
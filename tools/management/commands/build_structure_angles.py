@@ -1,11 +1,12 @@
-from django.core.management.base import BaseCommand
-from django.db import connection
+from build.management.commands.base_build import Command as BaseBuild
 
 import contactnetwork.pdb as pdb
-from structure.models import Structure, StructureVectors
+from structure.models import Structure, StructureVectors, PdbData
 from residue.models import Residue
 from angles.models import ResidueAngle as Angle
-from contactnetwork.models import Distance, distance_scaling_factor
+from contactnetwork.models import Distance, DistanceMatrix, distance_scaling_factor
+
+from django.db.models import Prefetch
 
 import Bio.PDB
 import copy
@@ -20,6 +21,7 @@ import traceback
 
 import numpy as np
 import scipy.stats as stats
+import scipy.spatial.distance as ssd
 
 from scipy.spatial.transform import Rotation as R
 from collections import OrderedDict
@@ -27,8 +29,6 @@ from sklearn.decomposition import PCA
 from numpy.core.umath_tests import inner1d
 
 
-from multiprocessing import Queue, Process, Value, Lock
-
 SASA = True
 HSE  = True
 extra_pca = True
@@ -216,7 +216,7 @@ class NonHetSelect(Bio.PDB.Select):
     def accept_residue(self, residue):
         return 1 if residue.id[0] == " " else 0
 
-class Command(BaseCommand):
+class Command(BaseBuild):
 
     help = "Command to calculate all angles for residues in each TM helix."
 
@@ -229,36 +229,6 @@ class Command(BaseCommand):
 
     processes = 2
 
-    def prepare_input(self, proc, items, iteration=1):
-        q = Queue()
-        procs = list()
-        num_items = len(items)
-        num = Value('i', 0)
-        lock = Lock()
-
-        if not num_items:
-            return False
-
-        # make sure not to use more jobs than proteins (chunk size will be 0, which is not good)
-        if proc > num_items:
-            proc = num_items
-
-        chunk_size = int(num_items / proc)
-        connection.close()
-        for i in range(0, proc):
-            first = chunk_size * i
-            if i == proc - 1:
-                last = False
-            else:
-                last = chunk_size * (i + 1)
-
-            p = Process(target=self.main_func, args=([(first, last), iteration,num,lock]))
-            procs.append(p)
-            p.start()
-
-        for p in procs:
-            p.join()
-
     def add_arguments(self, parser):
         parser.add_argument('-p', '--proc',
             type=int,
@@ -266,28 +236,32 @@ class Command(BaseCommand):
             dest='proc',
             default=2,
             help='Number of processes to run')
-
-    def load_pdb_var(self, pdb_code, var):
-        """
-        load string of pdb as pdb with a file handle. Would be nicer to do this
-        directly, but no such function implemented in Bio PDB
-        """
-        parser = pdb.PDBParser(QUIET=True)
-        with io.StringIO(var) as f:
-            return parser.get_structure(pdb_code,f)
-
+        parser.add_argument('--distance-backend',
+            choices=['rows', 'matrix', 'both'],
+            action='store',
+            dest='distance_backend',
+            default='both',
+            help='Store residue distances as Distance rows, packed DistanceMatrix objects or both')
+        parser.add_argument('--distance-dtype',
+            choices=['int32', 'float16'],
+            action='store',
+            dest='distance_dtype',
+            default='int32',
+            help='Value type of the packed distance matrices')
 
     def handle(self, *args, **options):
+        # the coordinate arrays of the pdb data (parsed) are deferred, each process loads those of its own structures
         if incremental_update:
             done_structures = Angle.objects.values('structure_id').distinct()
             # TODO add filter here for non-processed structures
-            self.references = Structure.objects.all().exclude(refined=True).exclude(id__in=done_structures).prefetch_related('pdb_code','pdb_data','protein_conformation__protein','protein_conformation__state').order_by('protein_conformation__protein')
+            self.references = Structure.objects.all().exclude(refined=True).exclude(id__in=done_structures).prefetch_related('pdb_code',Prefetch('pdb_data', queryset=PdbData.objects.defer('parsed')),'protein_conformation__protein','protein_conformation__state').order_by('protein_conformation__protein')
         else:
             Angle.objects.all().delete()
             Distance.objects.all().delete()
+            DistanceMatrix.objects.all().delete()
             StructureVectors.objects.all().delete()
             print("All Angle, Distance, and StructureVector data cleaned")
-            self.references = Structure.objects.all().exclude(refined=True).prefetch_related('pdb_code','pdb_data','protein_conformation__protein','protein_conformation__state').order_by('protein_conformation__protein')
+            self.references = Structure.objects.all().exclude(refined=True).prefetch_related('pdb_code',Prefetch('pdb_data', queryset=PdbData.objects.defer('parsed')),'protein_conformation__protein','protein_conformation__state').order_by('protein_conformation__protein')
 
         # DEBUG for a specific PDB
         # self.references = Structure.objects.filter(pdb_code__index="4OO9").exclude(refined=True).prefetch_related('pdb_code','pdb_data','protein_conformation__protein','protein_conformation__state').order_by('protein_conformation__protein')
@@ -295,9 +269,13 @@ class Command(BaseCommand):
         if 'proc' in options and options['proc']>0:
             self.processes = options['proc']
 
+        self.distance_backend = options.get('distance_backend', 'both')
+        self.distance_dtype = options.get('distance_dtype', 'int32')
+
         print(len(self.references),'structures')
         self.references = list(self.references)
-        self.prepare_input(self.processes, self.references)
+        # largest structures first, so that a large structure does not end up last
+        self.prepare_input(self.processes, self.references, costs=lambda reference: len(reference.pdb_data.pdb))
 
     def main_func(self, positions, iteration,count,lock):
         def recurse(entity,slist):
@@ -561,7 +539,7 @@ class Command(BaseCommand):
 #            print(pdb_code)
 
             try:
-                structure = self.load_pdb_var(pdb_code,reference.pdb_data.pdb)
+                structure = reference.pdb_data.get_structure(pdb_code)
                 pchain = structure[0][preferred_chain]
                 state_id = reference.protein_conformation.state.id
 
@@ -1228,26 +1206,41 @@ class Command(BaseCommand):
 
                 # triangular matrix for distances
                 up_ind = np.triu_indices(len(gns_ca_list), 1)
-                bulk_distances = []
-
-                for i1, i2 in zip(up_ind[0], up_ind[1]):
-                    key1 = gns_ids_list[i1]
-                    key2 = gns_ids_list[i2]
-                    res1 = full_resdict[str(key1)]
-                    res2 = full_resdict[str(key2)]
-
-                    ca_dist = int(np.linalg.norm(gns_ca_list[key1] - gns_ca_list[key2])*distance_scaling_factor)
-                    cb_dist = int(np.linalg.norm(gns_cb_list[key1] - gns_cb_list[key2])*distance_scaling_factor)
-                    center_dist = None
-                    if key1 in gns_center_list and key2 in gns_center_list:
-                        center_dist = int(np.linalg.norm(gns_center_list[key1] - gns_center_list[key2])*distance_scaling_factor)
-
-                    # residues in gn_reslist, structure in structure
-                    distance = Distance(distance = ca_dist, distance_cb = cb_dist, distance_helix_center = center_dist, res1=res1, res2=res2, gn1=res1.generic_number.label, gn2=res2.generic_number.label, gns_pair='_'.join([res1.generic_number.label, res2.generic_number.label]), structure=reference)
-                    bulk_distances.append(distance)
 
-                # Bulk insert
-                Distance.objects.bulk_create(bulk_distances, batch_size=5000)
+                if self.distance_backend in ['rows', 'both']:
+                    bulk_distances = []
+                    for i1, i2 in zip(up_ind[0], up_ind[1]):
+                        key1 = gns_ids_list[i1]
+                        key2 = gns_ids_list[i2]
+                        res1 = full_resdict[str(key1)]
+                        res2 = full_resdict[str(key2)]
+
+                        ca_dist = int(np.linalg.norm(gns_ca_list[key1] - gns_ca_list[key2])*distance_scaling_factor)
+                        cb_dist = int(np.linalg.norm(gns_cb_list[key1] - gns_cb_list[key2])*distance_scaling_factor)
+                        center_dist = None
+                        if key1 in gns_center_list and key2 in gns_center_list:
+                            center_dist = int(np.linalg.norm(gns_center_list[key1] - gns_center_list[key2])*distance_scaling_factor)
+
+                        # residues in gn_reslist, structure in structure
+                        distance = Distance(distance = ca_dist, distance_cb = cb_dist, distance_helix_center = center_dist, res1=res1, res2=res2, gn1=res1.generic_number.label, gn2=res2.generic_number.label, gns_pair='_'.join([res1.generic_number.label, res2.generic_number.label]), structure=reference)
+                        bulk_distances.append(distance)
+
+                    # Bulk insert
+                    Distance.objects.bulk_create(bulk_distances, batch_size=5000)
+
+                if self.distance_backend in ['matrix', 'both']:
+                    # Same pairs as the rows above, but as packed condensed matrices
+                    matrix_keys = gns_ids_list[:len(gns_ca_list)]
+                    matrix_res = [full_resdict[str(key)] for key in matrix_keys]
+                    ca_dist = np.trunc(ssd.pdist(np.array([gns_ca_list[key] for key in matrix_keys], dtype=float))*distance_scaling_factor)
+                    cb_dist = np.trunc(ssd.pdist(np.array([gns_cb_list[key] for key in matrix_keys], dtype=float))*distance_scaling_factor)
+                    center_coords = np.array([gns_center_list[key] if key in gns_center_list else [np.nan]*3 for key in matrix_keys], dtype=float)
+                    center_dist = np.trunc(ssd.pdist(center_coords)*distance_scaling_factor)
+
+                    DistanceMatrix.objects.filter(structure=reference).delete()
+                    dm = DistanceMatrix(structure=reference)
+                    dm.set_matrices([r.generic_number.label for r in matrix_res], [r.amino_acid for r in matrix_res], ca_dist, cb_dist, center_dist, self.distance_dtype)
+                    dm.save()
 
                 ### ANGLES
                 # Center axis to helix axis to CA
@@ -1261,7 +1254,7 @@ class Command(BaseCommand):
 
                 ### freeSASA (only for TM bundle)
                 # SASA calculations - results per atom
-                clean_structure = self.load_pdb_var(pdb_code,reference.pdb_data.pdb)
+                clean_structure = reference.pdb_data.get_structure(pdb_code)
                 clean_pchain = clean_structure[0][preferred_chain]
 
                 # PTM residues give an FreeSASA error - remove
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.core.cache import caches
+
+
+class Command(BaseCommand):
+
+    help = ("Print entry counts and sizes of the configured caches. Hit/miss counters and the in-memory tier are "
+        "per process, so from this command they only cover the command itself")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clear',
+            action='store_true',
+            dest='clear',
+            default=False,
+            help='Clear the caches after printing their stats')
+
+    def handle(self, *args, **options):
+        for alias in settings.CACHES:
+            cache = caches[alias]
+            print(alias, '-', settings.CACHES[alias]['BACKEND'])
+            if hasattr(cache, 'get_stats'):
+                for tier, stats in cache.get_stats().items():
+                    print('   ', tier, ', '.join('{}: {}'.format(k, v) for k, v in stats.items()))
+                print('    (hit/miss counters and the lru tier are those of this process, not of the web workers)')
+            else:
+                print('    no statistics available for this backend')
+
+            if options['clear']:
+                cache.clear()
+                print('    cleared')
@@ -1,10 +1,11 @@
 from django.core.management.base import BaseCommand
+from django.db.models import Prefetch
 
 import copy
 
 import contactnetwork.pdb as pdb
 
-from structure.models import Structure
+from structure.models import Structure, PdbData
 from residue.models import Residue
 from angles.models import Angle
 import logging
@@ -134,7 +135,7 @@ class Command(BaseCommand):
         failed = []
         
         # get preferred chain for PDB-code
-        references = Structure.objects.filter(protein_conformation__protein__family__slug__startswith="001").exclude(refined=True).prefetch_related('pdb_code','pdb_data','protein_conformation__protein','protein_conformation__state').order_by('protein_conformation__protein')
+        references = Structure.objects.filter(protein_conformation__protein__family__slug__startswith="001").exclude(refined=True).prefetch_related('pdb_code',Prefetch('pdb_data', queryset=PdbData.objects.defer('parsed')),'protein_conformation__protein','protein_conformation__state').order_by('protein_conformation__protein')
         references = list(references)
         
         pids = [ref.protein_conformation.protein.id for ref in references]